@@ -11,14 +11,27 @@ del get_versions
 from . import loadutils as lu
 from . import diffusion
 from . import timestamps
+from . import detectors
+from . import storage
+from . import transits
+from . import dirstore
+from . import catalog
+from . import vds
+from . import cache
 from . import plot
 from . import plotter
 
 from .utils import hdf5
 
 from .diffusion import Box, Particles, ParticlesSimulation, hashfunc
+from .catalog import Catalog
+from .cache import ArtifactCache
 from .psflib import GaussianPSF, NumericPSF
-from .timestamps import TimestampSimulation
+from .timestamps import TimestampSimulation, KineticTimestampSimulation
+from .kinetics import KineticScheme, Photophysics
+from .nanotimes import TCSPCModel
+from .excitation import ExcitationSchedule
+from .detectors import DetectorModel
 
 import warnings
 
@@ -0,0 +1,385 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module runs batches of simulations on a local pool of processes.
+
+A batch is described by a configuration file (JSON or YAML) with the
+parameters of the diffusion simulation, of one or more timestamps
+simulations (see :class:`timestamps.TimestampSimulation`) and a grid of
+parameters to vary. For example::
+
+    path: data
+    seed: 1
+    replicates: 8          # simulations with EID = 0..7 of each grid point
+    retries: 1
+    merge: true            # merge the replicates in a Photon-HDF5 file
+    diffusion:
+        t_step: 0.5e-6
+        t_max: 1
+        num_particles: [10, 15]
+        D: [12.0e-12, 6.0e-12]
+        box: {x1: -4.0e-6, x2: 4.0e-6, y1: -4.0e-6, y2: 4.0e-6,
+              z1: -6.0e-6, z2: 6.0e-6}
+        psf: gaussian      # or numeric, or a dict with `kind` and arguments
+        options: {total_emission: false, chunksize: 65536}
+    timestamps:
+        em_rates: [200.0e+3, 300.0e+3]
+        E_values: [0.75, 0.25]
+        num_particles: [10, 15]
+        bg_rate_d: 1500
+        bg_rate_a: 800
+    grid:
+        diffusion.t_max: [1, 2]
+        timestamps.E_values: [[0.75, 0.25], [0.5, 0.5]]
+
+Each point of the diffusion grid (ID) and replicate (EID) is a job,
+simulating the diffusion and then all the timestamps of the timestamps
+grid. Jobs are executed by a process pool where idle workers take the
+next job from a shared queue. Random seeds are derived from `seed`, ID,
+EID and the index of the timestamps simulation, so results do not
+depend on the execution order.
+
+The result of each job is saved in the manifest file `manifest_filename`
+in the data folder. Jobs completed in a previous run (same parameters and
+output files present) are skipped and failed jobs are retried
+`retries` times. When a worker process dies (e.g. killed by the OS), the
+pool is restarted and all the jobs that were in the pool are retried.
+
+The command `pybromo-batch config.yaml` runs a batch from the shell.
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import numpy as np
+
+from .diffusion import (Box, Particles, ParticlesSimulation, hashfunc,
+                        get_seed)
+from .psflib import GaussianPSF, NumericPSF
+from .storage import store_backends
+from .timestamps import TimestampSimulation, merge_ensemble
+
+
+manifest_filename = 'batch_manifest.json'
+
+_psf_kinds = {'gaussian': GaussianPSF, 'numeric': NumericPSF}
+
+
+def load_config(filename):
+    """Load a batch configuration from a JSON or YAML (.yaml/.yml) file."""
+    filename = Path(filename)
+    with open(str(filename)) as f:
+        if filename.suffix in ('.yaml', '.yml'):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _to_float(value):
+    """Convert numbers (or nested lists) read as strings to float.
+
+    YAML 1.1 parses numbers like `12e-12` (without dot) as strings.
+    """
+    if isinstance(value, (list, tuple)):
+        return [_to_float(v) for v in value]
+    return float(value)
+
+
+def _grid_points(grid, section):
+    """Return the list of dict of the parameters of `section` in `grid`."""
+    names = [name for name in grid if name.split('.', 1)[0] == section]
+    values = [grid[name] for name in names]
+    return [OrderedDict((name.split('.', 1)[1], value)
+                        for name, value in zip(names, point))
+            for point in itertools.product(*values)]
+
+
+def expand_jobs(config):
+    """Return the list of jobs of the batch described by `config`.
+
+    Each job is a dict with the job `key`, the diffusion parameters, ID,
+    EID, seed and the list of timestamps simulations. The job `hash`
+    identifies the job parameters (used to skip completed jobs).
+    """
+    grid = config.get('grid', {})
+    for name in grid:
+        if name.split('.', 1)[0] not in ('diffusion', 'timestamps'):
+            raise ValueError('Grid parameter "%s" is not "diffusion.<name>" '
+                             'or "timestamps.<name>".' % name)
+    seed = config.get('seed', 1)
+    path = str(config.get('path', './'))
+    ts_configs = config.get('timestamps', [])
+    if isinstance(ts_configs, dict):
+        ts_configs = [ts_configs]
+    ts_params_list = [dict(ts_config, **point) for ts_config in ts_configs
+                      for point in _grid_points(grid, 'timestamps')]
+    jobs = []
+    for ID, point in enumerate(_grid_points(grid, 'diffusion')):
+        diffusion = dict(config['diffusion'], **point)
+        for EID in range(config.get('replicates', 1)):
+            timestamps = [
+                dict(key='ts%d' % k, params=ts_params,
+                     seed=int(hashfunc((seed, ID, EID, k))[:8], 16))
+                for k, ts_params in enumerate(ts_params_list)]
+            job = dict(key='ID%d-%d' % (ID, EID), path=path, ID=ID, EID=EID,
+                       seed=get_seed(seed, ID=ID, EID=EID),
+                       diffusion=diffusion, timestamps=timestamps)
+            job['hash'] = hashfunc(json.dumps(job, sort_keys=True))[:12]
+            jobs.append(job)
+    return jobs
+
+
+def _make_simulation(job):
+    """Return the ParticlesSimulation of `job` and its RandomState."""
+    params = job['diffusion']
+    box = Box(**{k: float(v) for k, v in params['box'].items()})
+    psf = params.get('psf', 'gaussian')
+    if isinstance(psf, str):
+        psf = dict(kind=psf)
+    psf = dict(psf)
+    psf = _psf_kinds[psf.pop('kind')](**psf)
+    rs = np.random.RandomState(job['seed'])
+    P = Particles.from_specs(num_particles=params['num_particles'],
+                             D=_to_float(params['D']), box=box, rs=rs)
+    S = ParticlesSimulation(t_step=float(params['t_step']),
+                            t_max=float(params['t_max']), particles=P,
+                            box=box, psf=psf, ID=job['ID'], EID=job['EID'])
+    return S, rs
+
+
+def _trajectory_complete(filepath, store_class):
+    """Return True if the trajectory file exists and is complete."""
+    if not filepath.exists():
+        return False
+    store = store_class(filepath, mode='r')
+    try:
+        return store.committed()[1]
+    finally:
+        store.close()
+
+
+def run_job(job):
+    """Run the diffusion and timestamps simulations of `job`.
+
+    Existing complete trajectories and timestamps arrays (same parameters
+    and random state) are not simulated again. Incomplete timestamps
+    arrays, left by a failed attempt, are replaced (see
+    :meth:`storage.TimestampStore.add_timestamps`).
+
+    Returns:
+        Dict with the result of the job, saved in the manifest.
+    """
+    t_start = time.time()
+    path = Path(job['path'])
+    S, rs = _make_simulation(job)
+    name = S.compact_name()
+    options = dict(job['diffusion'].get('options', {}))
+    store_class = store_backends[options.get('backend', 'hdf5')][0]
+    traj_file = path / ('%s_%s%s' % (S._PREFIX_TRAJ, name,
+                                     store_class.file_extension))
+    if not _trajectory_complete(traj_file, store_class):
+        S.simulate_diffusion(rs=rs, path=path, verbose=False, **options)
+        S.store.close()
+    S = ParticlesSimulation.from_datafile(name, path=path, mode='a')
+    try:
+        timestamps = OrderedDict()
+        for ts_job in job['timestamps']:
+            params = ts_job['params']
+            mix_sim = TimestampSimulation(
+                S, em_rates=_to_float(params['em_rates']),
+                E_values=_to_float(params['E_values']),
+                num_particles=params['num_particles'],
+                bg_rate_d=float(params['bg_rate_d']),
+                bg_rate_a=float(params['bg_rate_a']),
+                timeslice=params.get('timeslice'))
+            mix_sim.run(rs=np.random.RandomState(ts_job['seed']),
+                        overwrite=False, skip_existing=True)
+            timestamps[ts_job['key']] = dict(
+                names=[mix_sim.name_timestamps_d, mix_sim.name_timestamps_a],
+                photon_hdf5=mix_sim.filename)
+        ts_file = S.ts_store.filepath.name if len(timestamps) > 0 else None
+    finally:
+        S.store.close()
+        if hasattr(S, 'ts_store'):
+            S.ts_store.close()
+    return dict(status='done', hash=job['hash'],
+                trajectory_file=traj_file.name, timestamps_file=ts_file,
+                timestamps=timestamps, elapsed=time.time() - t_start)
+
+
+def _job_done(entry, job):
+    """Return True if the manifest `entry` is a completed run of `job`."""
+    if entry is None or entry.get('status') != 'done' or \
+            entry.get('hash') != job['hash']:
+        return False
+    path = Path(job['path'])
+    files = [entry['trajectory_file'], entry['timestamps_file']]
+    return all((path / f).exists() for f in files if f is not None)
+
+
+def load_manifest(path):
+    """Load the manifest of the batch in `path` (empty if missing)."""
+    filepath = Path(path, manifest_filename)
+    if not filepath.exists():
+        return dict(jobs={}, merged={})
+    with open(str(filepath)) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    """Save the `manifest` (atomically) in the folder `path`."""
+    filepath = Path(path, manifest_filename)
+    tmp_path = filepath.with_suffix('.tmp')
+    with open(str(tmp_path), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(str(tmp_path), str(filepath))
+
+
+def _merge_replicates(jobs, manifest, path):
+    """Merge the timestamps of the replicates (EID) of each grid point."""
+    by_ID = OrderedDict()
+    for job in jobs:
+        by_ID.setdefault(job['ID'], []).append(job)
+    for ID, replicates in by_ID.items():
+        entries = [manifest['jobs'].get(job['key']) for job in replicates]
+        if not all(_job_done(entry, job)
+                   for entry, job in zip(entries, replicates)):
+            continue
+        for ts_job in replicates[0]['timestamps']:
+            key = 'ID%d_%s' % (ID, ts_job['key'])
+            ts_results = [entry['timestamps'][ts_job['key']]
+                          for entry in entries]
+            h5_fname = Path(ts_results[0]['photon_hdf5']).stem + '_merged.hdf5'
+            merge_hash = hashfunc([entry['hash'] for entry in entries])[:12]
+            done = manifest['merged'].get(key, {})
+            if done.get('hash') == merge_hash and (path / h5_fname).exists():
+                continue
+            merge_ensemble([path / entry['timestamps_file']
+                            for entry in entries],
+                           [result['names'] for result in ts_results],
+                           path / h5_fname)
+            manifest['merged'][key] = dict(hash=merge_hash,
+                                           photon_hdf5=h5_fname)
+            save_manifest(path, manifest)
+
+
+def run_batch(config, processes=None, retries=None, dry_run=False):
+    """Run the batch of simulations described by `config`.
+
+    Arguments:
+        config (dict): the batch configuration (see :func:`load_config`).
+        processes (int or None): number of worker processes. If None, use
+            `config['processes']` or the number of CPUs.
+        retries (int or None): number of retries of failed jobs. If None,
+            use `config['retries']` (default 1).
+        dry_run (bool): if True, only print the jobs to run.
+
+    Returns:
+        The manifest (dict), also saved in the data folder.
+    """
+    if processes is None:
+        processes = config.get('processes') or os.cpu_count()
+    if retries is None:
+        retries = config.get('retries', 1)
+    path = Path(config.get('path', './'))
+    path.mkdir(parents=True, exist_ok=True)
+    jobs = expand_jobs(config)
+    manifest = load_manifest(path)
+    todo = [job for job in jobs
+            if not _job_done(manifest['jobs'].get(job['key']), job)]
+    print('- Batch: %d jobs, %d completed, %d to run on %d processes.' %
+          (len(jobs), len(jobs) - len(todo), len(todo), processes),
+          flush=True)
+    if dry_run:
+        for job in todo:
+            print('  %s  %s' % (job['key'], job['hash']))
+        return manifest
+
+    attempts = {job['key']: 0 for job in todo}
+    executor = concurrent.futures.ProcessPoolExecutor(processes)
+    futures = {}
+
+    def submit(job):
+        attempts[job['key']] += 1
+        futures[executor.submit(run_job, job)] = job
+
+    try:
+        for job in todo:
+            submit(job)
+        while len(futures) > 0:
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool)
+                   for future in done):
+                # A worker died: all the jobs in the pool fail (each one
+                # counts an attempt) and a new pool is started
+                print('- Process pool broken, restarting it.', flush=True)
+                done, _ = concurrent.futures.wait(futures)
+                executor.shutdown()
+                executor = concurrent.futures.ProcessPoolExecutor(processes)
+            retry = []
+            for future in done:
+                job = futures.pop(future)
+                try:
+                    entry = future.result()
+                except Exception as exc:
+                    error = ''.join(traceback.format_exception(
+                        type(exc), exc, exc.__traceback__))
+                    entry = dict(status='failed', hash=job['hash'],
+                                 error=error)
+                    if attempts[job['key']] <= retries:
+                        print('- Job %s failed, retrying: %r' %
+                              (job['key'], exc), flush=True)
+                        retry.append(job)
+                        continue
+                entry['attempts'] = attempts[job['key']]
+                manifest['jobs'][job['key']] = entry
+                save_manifest(path, manifest)
+                print('- Job %s %s (%d left).' % (job['key'], entry['status'],
+                                                   len(futures) + len(retry)),
+                      flush=True)
+            for job in retry:
+                submit(job)
+    finally:
+        executor.shutdown()
+    if config.get('merge', False):
+        _merge_replicates(jobs, manifest, path)
+    return manifest
+
+
+def main(argv=None):
+    """Command line entry point (`pybromo-batch`)."""
+    parser = argparse.ArgumentParser(
+        description='Run a batch of PyBroMo simulations on local processes.')
+    parser.add_argument('config', help='batch configuration (JSON or YAML)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('-r', '--retries', type=int, default=None,
+                        help='number of retries of failed jobs')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='print the jobs to run and exit')
+    args = parser.parse_args(argv)
+    manifest = run_batch(load_config(args.config), processes=args.processes,
+                         retries=args.retries, dry_run=args.dry_run)
+    failed = [key for key, entry in manifest['jobs'].items()
+              if entry['status'] != 'done']
+    if len(failed) > 0:
+        print('- Failed jobs: %s' % ', '.join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,371 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module implements a content-addressed cache of simulation files.
+
+Each artifact (a trajectories file, a timestamps file or a Photon-HDF5
+file) is identified by the hash of all the inputs of the stage producing
+it: particles, PSF, box, time step, duration, initial random state and
+options for the trajectories; the trajectories plus rates, populations,
+background and models for the timestamps; the timestamps plus the
+file metadata for Photon-HDF5. An artifact is computed only the first
+time, later requests (in any session) return the cached file.
+
+Artifacts are saved in the cache folder in a sub-folder named as the
+hash of the inputs (key) and the cache index is a SQLite database
+(`index_filename`). When `max_size` is set, the least recently used
+artifacts are removed when the cache exceeds it.
+
+The generic API is :meth:`ArtifactCache.get_or_compute`. The functions
+:func:`cached_diffusion`, :func:`cached_timestamps` and
+:func:`cached_photon_hdf5` cache the stages of the simulation pipeline.
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+
+from .diffusion import ParticlesSimulation, hashfunc
+from .storage import TimestampStore, _to_json
+
+
+index_filename = 'artifact_cache.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    key TEXT PRIMARY KEY,
+    stage TEXT,
+    filename TEXT,
+    size INTEGER,
+    created REAL,
+    last_access REAL,
+    inputs TEXT);
+"""
+
+
+def _dir_size(path):
+    """Return the size in bytes of the files in the folder `path`."""
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+class ArtifactCache:
+    """Content-addressed cache of simulation files in a folder.
+    """
+    def __init__(self, path, max_size=None):
+        """Open (or create) the cache in the folder `path`.
+
+        Arguments:
+            path (string or Path): the cache folder.
+            max_size (int or None): maximum size of the cache in bytes.
+                If None, artifacts are never evicted.
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        # Concurrent processes may use the cache: wait for the lock
+        self.connection = sqlite3.connect(str(self.path / index_filename),
+                                          timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def key(stage, inputs):
+        """Return the key (hash) of the artifact of `stage` from `inputs`.
+
+        `inputs` is a dict of JSON-serializable values (slices and
+        arrays are allowed, see :func:`storage._to_json`).
+        """
+        content = _to_json(dict(stage=stage, inputs=inputs), sort_keys=True)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def key_of(self, filepath):
+        """Return the key of the artifact `filepath` (None if not cached)."""
+        filepath = Path(filepath).resolve()
+        if filepath.parent.parent != self.path.resolve():
+            return None
+        key = filepath.parent.name
+        return key if self._entry(key) is not None else None
+
+    def _entry(self, key):
+        return self.connection.execute(
+            'SELECT * FROM artifacts WHERE key = ?', (key,)).fetchone()
+
+    def get(self, key):
+        """Return the path of the artifact `key` (None if not cached)."""
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        filepath = self.path / key / entry['filename']
+        if not filepath.exists():
+            # Removed outside the cache
+            self.remove(key)
+            return None
+        with self.connection:
+            self.connection.execute(
+                'UPDATE artifacts SET last_access = ? WHERE key = ?',
+                (time.time(), key))
+        return filepath
+
+    def get_or_compute(self, stage, inputs, compute):
+        """Return the artifact of `stage` for `inputs`, computing it if needed.
+
+        Arguments:
+            stage (string): name of the pipeline stage.
+            inputs (dict): all the inputs determining the artifact content.
+            compute (callable): function called as `compute(path)` when the
+                artifact is not cached. It saves the artifact in the empty
+                folder `path` and returns the artifact file path.
+
+        Returns:
+            Path of the cached artifact.
+        """
+        key = self.key(stage, inputs)
+        filepath = self.get(key)
+        if filepath is not None:
+            return filepath
+        tmp_path = self.path / ('tmp_%s_%d' % (key, os.getpid()))
+        shutil.rmtree(str(tmp_path), ignore_errors=True)
+        tmp_path.mkdir()
+        try:
+            filename = Path(compute(tmp_path)).name
+            artifact_path = self.path / key
+            # A concurrent process may have computed the same artifact
+            shutil.rmtree(str(artifact_path), ignore_errors=True)
+            os.replace(str(tmp_path), str(artifact_path))
+        finally:
+            shutil.rmtree(str(tmp_path), ignore_errors=True)
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO artifacts '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, stage, filename, _dir_size(artifact_path), now, now,
+                 _to_json(inputs, sort_keys=True)))
+        if self.max_size is not None:
+            self.evict(keep=key)
+        return artifact_path / filename
+
+    def remove(self, key):
+        """Remove the artifact `key` from the cache."""
+        shutil.rmtree(str(self.path / key), ignore_errors=True)
+        with self.connection:
+            self.connection.execute('DELETE FROM artifacts WHERE key = ?',
+                                    (key,))
+
+    @property
+    def size(self):
+        """Total size in bytes of the cached artifacts."""
+        size = self.connection.execute(
+            'SELECT SUM(size) FROM artifacts').fetchone()[0]
+        return 0 if size is None else size
+
+    def entries(self, stage=None):
+        """Return a list of dict with the cached artifacts (of `stage`)."""
+        query, args = 'SELECT * FROM artifacts', ()
+        if stage is not None:
+            query, args = query + ' WHERE stage = ?', (stage,)
+        return [dict(row) for row in
+                self.connection.execute(query + ' ORDER BY created', args)]
+
+    def evict(self, max_size=None, keep=None):
+        """Remove the least recently used artifacts exceeding `max_size`.
+
+        Arguments:
+            max_size (int or None): the maximum cache size in bytes. If
+                None, use `self.max_size`.
+            keep (string or None): key of an artifact not to remove.
+
+        Returns:
+            List of the keys of the removed artifacts.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        size, removed = self.size, []
+        rows = self.connection.execute(
+            'SELECT key, size FROM artifacts ORDER BY last_access').fetchall()
+        for row in rows:
+            if size <= max_size:
+                break
+            if row['key'] == keep:
+                continue
+            self.remove(row['key'])
+            size -= row['size']
+            removed.append(row['key'])
+        return removed
+
+
+def _model_inputs(model):
+    """Return a JSON-serializable identifier of an optional model object."""
+    if model is None:
+        return None
+    if hasattr(model, 'hash'):
+        return model.hash()
+    return _to_json(vars(model), sort_keys=True)
+
+
+def trajectory_inputs(S, rs, **kwargs):
+    """Return the inputs of the diffusion simulation of `S` from `rs`.
+
+    `kwargs` are the arguments of `ParticlesSimulation.simulate_diffusion()`
+    (excluding `rs` and `path`).
+    """
+    kwargs = {k: v for k, v in kwargs.items() if k != 'verbose'}
+    return dict(particles=S.particles.to_json(), psf=S.psf.hash(),
+                box=S.box.to_dict(), t_step=S.t_step, t_max=S.t_max,
+                rng=type(rs).__name__, random_state=hashfunc(rs.get_state()),
+                options={k: (v.__module__ + '.' + v.__qualname__
+                             if callable(v) else v)
+                         for k, v in kwargs.items()})
+
+
+def cached_diffusion(cache, S, rs, **kwargs):
+    """Simulate the diffusion of `S` (or load it from the cache).
+
+    Arguments:
+        cache (ArtifactCache): the cache.
+        S (ParticlesSimulation): the simulation (not yet simulated).
+        rs (RandomState): the random state used for the simulation. After
+            the call, it is in the same state as after the simulation.
+        kwargs: additional arguments of `S.simulate_diffusion()`.
+
+    Returns:
+        A new ParticlesSimulation object with the cached trajectories
+        (opened read-only).
+    """
+    def compute(path):
+        S.simulate_diffusion(rs=rs, path=path, **kwargs)
+        S.store.close()
+        return S.store.filepath
+
+    filepath = cache.get_or_compute('trajectories',
+                                    trajectory_inputs(S, rs, **kwargs),
+                                    compute)
+    name = filepath.stem.split('_', 1)[1]
+    S_cached = ParticlesSimulation.from_datafile(name, path=filepath.parent,
+                                                 ignore_timestamps=True)
+    rs.set_state(S_cached.traj_group._v_attrs['last_random_state'])
+    return S_cached
+
+
+def _trajectory_key(cache, S):
+    """Return the key of the trajectories of `S`.
+
+    For trajectories not in the cache, the key is computed from the
+    simulation hash, initial random state, ID and EID.
+    """
+    key = cache.key_of(S.store.filepath)
+    if key is None:
+        key = hashfunc((S.hash(), S.traj_group._v_attrs['init_random_state'],
+                        S.ID, S.EID))
+    return key
+
+
+def timestamps_inputs(cache, mix_sim, rs, method='run', **kwargs):
+    """Return the inputs of the timestamps simulation of `mix_sim`.
+
+    `kwargs` are the arguments of the `method` of `mix_sim` (excluding
+    `rs` and `path`), e.g. `scale`, `t_chunksize` and `chunksize`.
+    """
+    return dict(
+        trajectories=_trajectory_key(cache, mix_sim.S), method=method,
+        em_rates_d=mix_sim.em_rates_d, em_rates_a=mix_sim.em_rates_a,
+        E_values=mix_sim.E_values, populations=mix_sim.populations,
+        bg_rate_d=mix_sim.bg_rate_d, bg_rate_a=mix_sim.bg_rate_a,
+        timeslice=mix_sim.timeslice,
+        photophysics=_model_inputs(mix_sim.photophysics),
+        tcspc=_model_inputs(mix_sim.tcspc),
+        excitation=_model_inputs(mix_sim.excitation),
+        detector=_model_inputs(mix_sim.detector),
+        rng=type(rs).__name__, random_state=hashfunc(rs.get_state()),
+        options=kwargs)
+
+
+def cached_timestamps(cache, mix_sim, rs, method='run', **kwargs):
+    """Simulate the timestamps of `mix_sim` (or load them from the cache).
+
+    The timestamps are saved in a new timestamps file (the simulation
+    `mix_sim.S` must not have a timestamps file open). After the call,
+    `mix_sim.S.ts_store` is the cached file (opened read-only) and `rs` is
+    in the same state as after the simulation.
+
+    Arguments:
+        cache (ArtifactCache): the cache.
+        mix_sim (TimestampSimulation): the timestamps simulation.
+        rs (RandomState): the random state used for the simulation.
+        method (string): 'run' or 'run_da', the method of `mix_sim` used
+            to simulate donor and acceptor timestamps.
+        kwargs: additional arguments of the `method` of `mix_sim`
+            (e.g. `scale` or `t_chunksize`).
+
+    Returns:
+        Path of the cached timestamps file.
+    """
+    S = mix_sim.S
+    assert not hasattr(S, 'ts_store'), 'A timestamps file is already open.'
+    assert method in ('run', 'run_da')
+    hash_d = hashfunc(rs.get_state())[:6]
+
+    def compute(path):
+        getattr(mix_sim, method)(rs=rs, path=str(path), **kwargs)
+        S.ts_store.close()
+        filepath = S.ts_store.filepath
+        del S.ts_store, S.ts_group
+        return filepath
+
+    filepath = cache.get_or_compute(
+        'timestamps', timestamps_inputs(cache, mix_sim, rs, method, **kwargs),
+        compute)
+    S.ts_store = TimestampStore(filepath, mode='r')
+    S.ts_group = S.ts_store.get_group('timestamps')
+    # Array names and final random state, as after the simulation
+    mix_sim.hash_d = hash_d
+    if method == 'run_da':
+        mix_sim.hash_a = hash_d
+        rs.set_state(S.ts_group._v_attrs['last_random_state'])
+    else:
+        ts_d = S.ts_store.get_timestamps(mix_sim.name_timestamps_d)
+        rs.set_state(ts_d.attrs['last_random_state'])
+        mix_sim.hash_a = hashfunc(rs.get_state())[:6]
+        ts_a = S.ts_store.get_timestamps(mix_sim.name_timestamps_a)
+        rs.set_state(ts_a.attrs['last_random_state'])
+    return filepath
+
+
+def cached_photon_hdf5(cache, mix_sim, identity=None):
+    """Save the Photon-HDF5 file of `mix_sim` (or get it from the cache).
+
+    The timestamps of `mix_sim` must be in the cache (see
+    :func:`cached_timestamps`).
+
+    Returns:
+        Path of the cached Photon-HDF5 file.
+    """
+    ts_key = cache.key_of(mix_sim.S.ts_store.filepath)
+    if ts_key is None:
+        raise ValueError('The timestamps are not in the cache.')
+    inputs = dict(timestamps=ts_key, identity=identity,
+                  name_d=mix_sim.name_timestamps_d,
+                  name_a=mix_sim.name_timestamps_a)
+
+    def compute(path):
+        mix_sim.save_photon_hdf5(identity=identity, path=path)
+        return Path(path, mix_sim.filename)
+
+    return cache.get_or_compute('photon_hdf5', inputs, compute)
@@ -0,0 +1,343 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module implements a catalog of the simulation files in a data folder.
+
+The catalog is a SQLite database (`catalog_filename`) saved in the same
+folder of the data files. A file is added to the catalog when its store
+is created by :class:`diffusion.ParticlesSimulation` and each timestamps
+array is added when it is created. For each file the catalog records the
+simulation hash, the numeric parameters, the PSF hash, the particles
+populations and the timestamps arrays.
+
+The catalog allows finding files from the simulation hash without listing
+the folder (see :meth:`ParticlesSimulation.from_datafile`) and querying
+simulations by parameters (see :meth:`Catalog.find` and
+:meth:`Catalog.find_timestamps`). The catalog of a folder of files saved
+without catalog can be built with :meth:`Catalog.scan`.
+"""
+
+import json
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from .storage import TrajectoryStore, TimestampStore, _to_json
+from .psflib import psf_from_pytables
+
+
+catalog_filename = 'pybromo_catalog.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    kind TEXT,
+    hash TEXT,
+    backend TEXT,
+    D REAL,
+    np INTEGER,
+    t_step REAL,
+    t_max REAL,
+    pico_mol REAL,
+    ID INTEGER,
+    EID INTEGER,
+    psf_hash TEXT,
+    particles TEXT,
+    box TEXT);
+CREATE INDEX IF NOT EXISTS files_kind_hash ON files (kind, hash);
+CREATE TABLE IF NOT EXISTS populations (
+    filename TEXT,
+    D REAL,
+    num_particles INTEGER);
+CREATE INDEX IF NOT EXISTS populations_filename ON populations (filename);
+CREATE TABLE IF NOT EXISTS timestamps (
+    filename TEXT,
+    name TEXT,
+    clk_p REAL,
+    max_rates TEXT,
+    bg_rate TEXT,
+    populations TEXT,
+    E_values TEXT,
+    PRIMARY KEY (filename, name));
+"""
+
+# Columns of the `files` table that can be used in queries
+_numeric_columns = ('D', 'np', 't_step', 't_max', 'pico_mol', 'ID', 'EID')
+_text_columns = ('kind', 'hash', 'backend', 'psf_hash', 'filename')
+
+
+def _populations(particles_json):
+    """Return a list of (D, num_particles) from the particles JSON string."""
+    counts = OrderedDict()
+    for particle in json.loads(particles_json)['particles']:
+        counts[particle['D']] = counts.get(particle['D'], 0) + 1
+    return list(counts.items())
+
+
+def _numeric_condition(column, value, rtol):
+    """Return SQL condition and arguments to match a numeric `column`.
+
+    `value` is either a number (matched with relative tolerance `rtol`)
+    or a (min, max) tuple.
+    """
+    if isinstance(value, (tuple, list)):
+        return '%s BETWEEN ? AND ?' % column, list(value)
+    return 'ABS(%s - ?) <= ?' % column, [value, abs(value) * rtol]
+
+
+def _match(values, value, rtol):
+    """Return True if any element of `values` matches `value`."""
+    values = np.asarray(values, dtype=float)
+    if isinstance(value, (tuple, list)):
+        return bool(((values >= value[0]) & (values <= value[1])).any())
+    return bool((np.abs(values - value) <= abs(value) * rtol).any())
+
+
+class Catalog:
+    """Catalog of the simulation files in a folder (SQLite database).
+    """
+    def __init__(self, path):
+        """Open (or create) the catalog in the folder `path`.
+
+        Stores open the catalog of the folder of their file: `path` has
+        no default, so that a catalog is never created in the current
+        working directory by mistake.
+        """
+        self.path = Path(path)
+        self.filepath = self.path / catalog_filename
+        # Concurrent simulations may write the catalog: wait for the lock
+        self.connection = sqlite3.connect(str(self.filepath), timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_file(self, filename, kind, hash_, nparams, particles,
+                 psf_hash=None, box=None, backend='hdf5', overwrite=True):
+        """Add (or update) a data file in the catalog.
+
+        Arguments:
+            filename (string): name of the file in the catalog folder.
+            kind (string): 'trajectories' or 'timestamps'.
+            hash_ (string): hash of the simulation parameters.
+            nparams (dict): simulation numeric parameters, as in
+                `ParticlesSimulation.numeric_params` (values can be
+                (value, description) tuples).
+            particles (string): JSON of the particles (`Particles.to_json()`).
+            psf_hash (string or None): hash of the PSF.
+            box (Box or None): the simulation box.
+            backend (string): the storage backend of the file.
+            overwrite (bool): if True, remove the timestamps arrays
+                previously cataloged for this file (it was overwritten).
+        """
+        values = {name: (value[0] if isinstance(value, tuple) else value)
+                  for name, value in nparams.items()}
+        row = dict(filename=filename, kind=kind, hash=hash_,
+                   backend=backend, psf_hash=psf_hash, particles=particles,
+                   box=None if box is None else repr(box))
+        for name in _numeric_columns:
+            try:
+                row[name] = float(values[name])
+            except (KeyError, TypeError, ValueError):
+                row[name] = None
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files (%s) VALUES (%s)' %
+                (', '.join(row), ', '.join('?' * len(row))),
+                list(row.values()))
+            self.connection.execute(
+                'DELETE FROM populations WHERE filename = ?', (filename,))
+            self.connection.executemany(
+                'INSERT INTO populations VALUES (?, ?, ?)',
+                [(filename, D, num) for D, num in _populations(particles)])
+            if overwrite:
+                self.connection.execute(
+                    'DELETE FROM timestamps WHERE filename = ?', (filename,))
+
+    def remove_file(self, filename):
+        """Remove a data file (and its timestamps arrays) from the catalog.
+        """
+        with self.connection:
+            for table in ('files', 'populations', 'timestamps'):
+                self.connection.execute(
+                    'DELETE FROM %s WHERE filename = ?' % table, (filename,))
+
+    def add_timestamps(self, filename, name, clk_p, max_rates, bg_rate,
+                       populations=None, E_values=None):
+        """Add (or update) a timestamps array of the file `filename`."""
+        row = (filename, name, clk_p, _to_json(max_rates), _to_json(bg_rate),
+               _to_json(populations),
+               None if E_values is None else _to_json(E_values))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO timestamps '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+
+    def set_E_values(self, filename, names, E_values):
+        """Set the FRET efficiencies of the populations of timestamps arrays.
+        """
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE timestamps SET E_values = ? '
+                'WHERE filename = ? AND name = ?',
+                [(_to_json(E_values), filename, name) for name in names])
+
+    def lookup(self, hash_, kind):
+        """Return the paths of the existing files of `kind` matching `hash_`.
+
+        `hash_` can be the full simulation hash or its beginning.
+        """
+        # Hashes are hex strings: all the ones starting with `hash_` are
+        # between `hash_` and `hash_ + 'g'` (index range scan)
+        cursor = self.connection.execute(
+            'SELECT filename FROM files WHERE kind = ? AND hash >= ? '
+            'AND hash < ?', (kind, hash_, hash_ + 'g'))
+        datafiles = [self.path / row['filename'] for row in cursor]
+        return [datafile for datafile in datafiles if datafile.exists()]
+
+    def find(self, kind='trajectories', rtol=1e-6, **conditions):
+        """Return the cataloged files matching the passed conditions.
+
+        Conditions on numeric parameters ('np', 't_step', 't_max',
+        'pico_mol' (concentration), 'ID', 'EID') are either a value,
+        matched with relative tolerance `rtol`, or a (min, max) tuple.
+        A condition on 'D' matches files with at least one population with
+        that diffusion coefficient. Conditions on 'hash', 'psf_hash' and
+        'backend' are exact matches.
+
+        Arguments:
+            kind (string or None): 'trajectories', 'timestamps' or None
+                for both.
+
+        Returns:
+            A list of dict, one per file, with the catalog columns
+            and the list of populations as (D, num_particles) pairs.
+        """
+        where, args = [], []
+        if kind is not None:
+            conditions['kind'] = kind
+        for column, value in conditions.items():
+            if column == 'D':
+                condition, cond_args = _numeric_condition('p.D', value, rtol)
+                where.append('EXISTS (SELECT 1 FROM populations p WHERE '
+                             'p.filename = files.filename AND %s)' % condition)
+                args += cond_args
+            elif column in _numeric_columns:
+                condition, cond_args = _numeric_condition(column, value, rtol)
+                where.append(condition)
+                args += cond_args
+            elif column in _text_columns:
+                where.append('%s = ?' % column)
+                args.append(value)
+            else:
+                raise ValueError('Unknown catalog column "%s".' % column)
+        query = 'SELECT * FROM files'
+        if len(where) > 0:
+            query += ' WHERE ' + ' AND '.join(where)
+        results = []
+        for row in self.connection.execute(query + ' ORDER BY filename',
+                                           args):
+            result = dict(row)
+            result['path'] = self.path / row['filename']
+            result['populations'] = [
+                (p['D'], p['num_particles']) for p in self.connection.execute(
+                    'SELECT * FROM populations WHERE filename = ?',
+                    (row['filename'],))]
+            results.append(result)
+        return results
+
+    def find_timestamps(self, E=None, rtol=1e-6, **conditions):
+        """Return the cataloged timestamps arrays matching the conditions.
+
+        Arguments:
+            E (float, tuple or None): if not None, return only arrays
+                with at least one population with FRET efficiency `E`
+                (a value or a (min, max) tuple).
+            conditions: conditions on the simulation parameters of the
+                timestamps file, see :meth:`find`.
+
+        Returns:
+            A list of dict, one per timestamps array, with the file info
+            (see :meth:`find`) and the array name, clk_p, max_rates,
+            bg_rate, populations and E_values.
+        """
+        results = []
+        for file_info in self.find(kind='timestamps', rtol=rtol, **conditions):
+            cursor = self.connection.execute(
+                'SELECT * FROM timestamps WHERE filename = ? ORDER BY name',
+                (file_info['filename'],))
+            for row in cursor:
+                E_values = (None if row['E_values'] is None
+                            else json.loads(row['E_values']))
+                if E is not None and (E_values is None or
+                                      not _match(E_values, E, rtol)):
+                    continue
+                result = dict(file_info)
+                result.update(name=row['name'], clk_p=row['clk_p'],
+                              max_rates=json.loads(row['max_rates']),
+                              bg_rate=json.loads(row['bg_rate']),
+                              populations=json.loads(row['populations']),
+                              E_values=E_values)
+                result['particle_populations'] = file_info['populations']
+                results.append(result)
+        return results
+
+    def scan(self, prefixes=None):
+        """Add to the catalog all the HDF5 data files in the folder.
+
+        Used to build the catalog of files saved without catalog. The
+        simulation hash is read from the file name (first 6 characters).
+
+        Arguments:
+            prefixes (dict or None): map of file name prefix to kind.
+                If None, use the prefixes of `ParticlesSimulation`.
+
+        Returns:
+            Number of files added to the catalog.
+        """
+        if prefixes is None:
+            prefixes = {'pybromo': 'trajectories', 'times': 'timestamps'}
+        stores = dict(trajectories=TrajectoryStore, timestamps=TimestampStore)
+        num_files = 0
+        for prefix, kind in prefixes.items():
+            for datafile in sorted(self.path.glob('%s_*.hdf5' % prefix)):
+                store = stores[kind](datafile, mode='r')
+                try:
+                    psf_hash = None
+                    if '/psf/default_psf' in store.h5file:
+                        psf_hash = psf_from_pytables(
+                            store.h5file.get_node('/psf/default_psf')).hash()
+                    self.add_file(
+                        datafile.name, kind,
+                        hash_=datafile.name.split('_')[1],
+                        nparams=store.numeric_params,
+                        particles=store.get_param_attr('particles'),
+                        psf_hash=psf_hash,
+                        box=store.get_param_attr('box'))
+                    if kind == 'timestamps':
+                        for node in store.get_group('timestamps'):
+                            if 'clk_p' not in node.attrs:
+                                continue
+                            attrs = node.attrs
+                            self.add_timestamps(
+                                datafile.name, node.name, attrs['clk_p'],
+                                attrs['max_rates'], attrs['bg_rate'],
+                                attrs['populations'])
+                finally:
+                    store.close()
+                num_files += 1
+        return num_files
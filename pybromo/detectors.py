@@ -0,0 +1,341 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module implements a post-processing stage applying the artifacts of
+real single-photon detectors (SPAD) to a sorted stream of timestamps:
+
+- Gaussian timing jitter,
+- non-paralyzable dead time,
+- afterpulsing with a given probability and delay distribution,
+- quantization to the acquisition clock.
+
+The stage processes the photons of one detector chunk by chunk, carrying
+its state (last detected photon, pending afterpulses) across chunks.
+It can be applied while simulating the timestamps (see the `detector`
+argument of `ParticlesSimulation.simulate_timestamps_mix`) or as a
+standalone pass over an existing timestamps array (:func:`apply_detector`).
+"""
+
+import numpy as np
+
+from .diffusion import hashfunc
+from .iter_chunks import iter_chunk_index
+from .storage import DeltaTimestamps
+
+
+# Value of per-photon arrays assigned to afterpulses (other arrays,
+# e.g. nanotimes and excitation source, copy the value of the parent photon)
+afterpulse_values = {'_pos': np.nan, '_state': 255}
+
+
+def dead_time_filter(times, dead_time, t_last=-np.inf):
+    """Return a bool mask of the photons detected with a non-paralyzable
+    dead time.
+
+    Arguments:
+        times (array): sorted photon times.
+        dead_time (float): dead time in the same units of `times`.
+        t_last (float): time of the last detected photon before `times`.
+
+    A photon closer than `dead_time` to its predecessor is lost only if
+    the predecessor is detected. Photons farther than `dead_time` from
+    their predecessor are always detected. Therefore, at each iteration,
+    the first photon of each sequence of close photons can be discarded.
+    The number of iterations is the length of the longest sequence.
+    """
+    index = np.arange(times.size)
+    while True:
+        diff = np.diff(times[index], prepend=t_last)
+        close = diff < dead_time
+        if not close.any():
+            break
+        # The predecessor of these photons is surely detected
+        lost = close.copy()
+        lost[1:] &= ~close[:-1]
+        index = index[~lost]
+    mask = np.zeros(times.size, dtype=bool)
+    mask[index] = True
+    return mask
+
+
+class DetectorModel:
+    """Model of the artifacts of a single-photon detector."""
+
+    def __init__(self, dead_time=0, afterpulse_prob=0, afterpulse_delay=1e-6,
+                 jitter=0, clk_p=None):
+        """
+        Arguments:
+            dead_time (float): non-paralyzable dead time (seconds).
+            afterpulse_prob (float): probability that a detected photon
+                generates an afterpulse.
+            afterpulse_delay (float or array): if a float, the mean delay
+                (seconds) of an exponential delay distribution. If an array,
+                a sample of delays (seconds) from which the afterpulse delays
+                are drawn.
+            jitter (float): standard deviation (seconds) of the Gaussian
+                timing jitter.
+            clk_p (float or None): unit (seconds) of the output timestamps.
+                If None, use the unit of the input timestamps.
+        """
+        if not 0 <= afterpulse_prob < 1:
+            raise ValueError('`afterpulse_prob` must be in [0, 1).')
+        self.dead_time = dead_time
+        self.afterpulse_prob = afterpulse_prob
+        self.afterpulse_delay = afterpulse_delay
+        if not np.isscalar(afterpulse_delay):
+            self.afterpulse_delay = np.asarray(afterpulse_delay, dtype=float)
+        self.jitter = jitter
+        self.clk_p = clk_p
+
+    def __repr__(self):
+        delay = self.afterpulse_delay
+        if not np.isscalar(delay):
+            delay = 'array_%s' % hashfunc(delay.tobytes())[:6]
+        return ('DetectorModel(dead_time=%r, afterpulse_prob=%r, '
+                'afterpulse_delay=%r, jitter=%r, clk_p=%r)' %
+                (self.dead_time, self.afterpulse_prob, delay, self.jitter,
+                 self.clk_p))
+
+    def hash(self):
+        """Return an hash string computed on the model parameters."""
+        return hashfunc(repr(self))
+
+    def sim_afterpulse_delays(self, size, rs):
+        """Draw `size` afterpulse delays (seconds)."""
+        if np.isscalar(self.afterpulse_delay):
+            return rs.standard_exponential(size) * self.afterpulse_delay
+        return rs.choice(self.afterpulse_delay, size=size)
+
+    def stream(self, clk_p, rs, bg_particle=None):
+        """Return a :class:`DetectorStream` for timestamps in units `clk_p`.
+
+        If not None, `bg_particle` is the particle ID assigned to
+        afterpulses.
+        """
+        values = dict(afterpulse_values)
+        if bg_particle is not None:
+            values['_par'] = bg_particle
+        return DetectorStream(self, clk_p, rs, afterpulse_values=values)
+
+
+def _take(photon_arrays, index):
+    return {k: v[index] for k, v in photon_arrays.items()}
+
+
+def _concat(photon_arrays1, photon_arrays2):
+    return {k: np.concatenate((v, photon_arrays2[k]))
+            for k, v in photon_arrays1.items()}
+
+
+class DetectorStream:
+    """Apply a :class:`DetectorModel` to the sorted photons of one detector.
+
+    Photons are passed in chunks to :meth:`process` followed by a final call
+    to :meth:`flush`. Photons whose order may still change because of the
+    jitter, and afterpulses falling after the current chunk, are held back
+    and returned with the following chunks.
+    """
+
+    def __init__(self, model, clk_p, rs, afterpulse_values=afterpulse_values):
+        """
+        Arguments:
+            model (DetectorModel): the detector model.
+            clk_p (float): unit (seconds) of the input timestamps.
+            rs (RandomState): random state used to draw the random numbers.
+            afterpulse_values (dict): value of the per-photon arrays assigned
+                to afterpulses. Arrays not in the dict copy the value of
+                the photon generating the afterpulse.
+        """
+        self.model = model
+        self.rs = rs
+        self.afterpulse_values = afterpulse_values
+        self.clk_p = clk_p
+        self.clk_p_out = clk_p if model.clk_p is None else model.clk_p
+        self._dead_time = model.dead_time / clk_p
+        self._jitter = model.jitter / clk_p
+        # The jitter is truncated at 5 sigma, photons of the next chunks
+        # cannot move before the last input timestamp minus `_margin`
+        self._margin = 5 * self._jitter
+        self._t_last = -np.inf
+        self._pending_times = None
+        self._pending = None
+
+    def _afterpulses(self, times, photon_arrays):
+        """Generate afterpulses of detected photons."""
+        model, rs = self.model, self.rs
+        index = np.nonzero(rs.rand(times.size) < model.afterpulse_prob)[0]
+        ap_times = (times[index] +
+                    model.sim_afterpulse_delays(index.size, rs) / self.clk_p)
+        ap_arrays = _take(photon_arrays, index)
+        for key, value in self.afterpulse_values.items():
+            if key in ap_arrays:
+                ap_arrays[key][:] = value
+        return ap_times, ap_arrays
+
+    def process(self, timestamps, photon_arrays, flush=False):
+        """Process a chunk of sorted timestamps.
+
+        Arguments:
+            timestamps (array): sorted int64 timestamps (unit `clk_p`).
+            photon_arrays (dict): per-photon arrays (e.g. particles) aligned
+                with `timestamps`. The same keys must be used in all chunks.
+            flush (bool): if True, this is the last chunk and all the
+                pending photons are returned.
+
+        Returns:
+            Timestamps (int64, unit `clk_p_out`) and dict of per-photon
+            arrays of the detected photons.
+        """
+        model = self.model
+        times = timestamps.astype('float64')
+        if self._jitter > 0:
+            times += np.clip(self.rs.randn(times.size), -5, 5) * self._jitter
+        if self._pending is not None:
+            times = np.concatenate((self._pending_times, times))
+            photon_arrays = _concat(self._pending, photon_arrays)
+        index_sort = times.argsort(kind='mergesort')
+        times = times[index_sort]
+        photon_arrays = _take(photon_arrays, index_sort)
+
+        if flush:
+            t_safe = np.inf
+        elif timestamps.size > 0:
+            t_safe = timestamps[-1] - self._margin
+        else:
+            t_safe = -np.inf
+        num_ready = np.searchsorted(times, t_safe)
+        ready_times, ready = times[:num_ready], _take(photon_arrays,
+                                                     slice(0, num_ready))
+        pending_times = times[num_ready:]
+        pending = _take(photon_arrays, slice(num_ready, None))
+
+        mask = dead_time_filter(ready_times, self._dead_time, self._t_last)
+        ready_times, ready = ready_times[mask], _take(ready, mask)
+        if model.afterpulse_prob > 0 and ready_times.size > 0:
+            ap_times, ap_arrays = self._afterpulses(ready_times, ready)
+            is_late = ap_times >= t_safe
+            pending_times = np.concatenate((pending_times, ap_times[is_late]))
+            pending = _concat(pending, _take(ap_arrays, is_late))
+            if (~is_late).any():
+                # Afterpulses in the current chunk also cause dead time
+                ready_times = np.concatenate((ready_times,
+                                              ap_times[~is_late]))
+                ready = _concat(ready, _take(ap_arrays, ~is_late))
+                index_sort = ready_times.argsort(kind='mergesort')
+                ready_times = ready_times[index_sort]
+                ready = _take(ready, index_sort)
+                mask = dead_time_filter(ready_times, self._dead_time,
+                                        self._t_last)
+                ready_times, ready = ready_times[mask], _take(ready, mask)
+        if ready_times.size > 0:
+            self._t_last = ready_times[-1]
+        self._pending_times, self._pending = pending_times, pending
+
+        ts = np.rint(ready_times * (self.clk_p / self.clk_p_out))
+        return ts.astype('int64'), ready
+
+    def flush(self, photon_arrays):
+        """Return the pending photons. `photon_arrays` is a dict of empty
+        arrays with the same keys (and dtypes) used in :meth:`process`.
+        """
+        return self.process(np.zeros(0, dtype='int64'), photon_arrays,
+                            flush=True)
+
+
+def detector_name(name, detector, hashsize=6):
+    """Name of the timestamps array `name` processed with `detector`."""
+    tag = 'DET%s' % detector.hash()[:hashsize]
+    if '_rs_' in name:
+        return name.replace('_rs_', '_%s_rs_' % tag)
+    return '%s_%s' % (name, tag)
+
+
+def apply_detector(ts_store, name, detector, rs=None, seed=1,
+                   chunksize=2**16, overwrite=False):
+    """Apply the detector model to a timestamps array in a TimestampStore.
+
+    The timestamps array `name` and all its per-photon arrays are read in
+    chunks and the detected photons are saved in a new set of arrays
+    (see :func:`detector_name`). Timestamps saved without particles array
+    (e.g. simulated from the population emission) are processed without
+    particles.
+
+    Arguments:
+        ts_store (storage.TimestampStore): store with the input timestamps
+            (opened in write mode).
+        name (string): name of the input timestamps array.
+        detector (DetectorModel): the detector model.
+        rs (RandomState or None): random state used to draw the random
+            numbers. If None, use a random state initialized from `seed`.
+        chunksize (int): number of timestamps processed in each chunk.
+        overwrite (bool): if True, overwrite a pre-existing output array.
+
+    Returns:
+        The name of the new timestamps array.
+    """
+    if rs is None:
+        rs = np.random.RandomState(seed=seed)
+    timestamps = ts_store.get_timestamps(name)
+    particles = ts_store.get_photon_array(name, '_par')
+    inputs = {}
+    for suffix in ts_store.photon_array_suffixes:
+        node = ts_store.get_photon_array(name, suffix)
+        if node is not None:
+            inputs[suffix] = node
+    new_name = detector_name(name, detector)
+    clk_p = timestamps.attrs['clk_p']
+    num_particles, bg_particle = None, None
+    if particles is not None:
+        num_particles = particles.attrs['num_particles']
+        bg_particle = particles.attrs['bg_particle']
+    stream = detector.stream(clk_p, rs, bg_particle=bg_particle)
+
+    kw = dict(name=new_name, clk_p=stream.clk_p_out,
+              max_rates=timestamps.attrs['max_rates'],
+              bg_rate=timestamps.attrs['bg_rate'],
+              populations=timestamps.attrs['populations'],
+              num_particles=num_particles, bg_particle=bg_particle,
+              save_particles=particles is not None,
+              overwrite=overwrite, chunksize=chunksize,
+              save_pos='_pos' in inputs, save_states='_state' in inputs,
+              save_excitation='_exc' in inputs,
+              encoding=('delta' if isinstance(timestamps, DeltaTimestamps)
+                        else 'int64'))
+    if ts_store.has_timestamps_index:
+        info = ts_store.timestamps_info(name)
+        kw.update(index_key=detector_name(info['index_key'], detector),
+                  rs_hash=info['rs_hash'])
+    if '_pos' in inputs:
+        kw.update(spatial_dims=inputs['_pos'].shape[1])
+    if '_nanotimes' in inputs:
+        nt_attrs = inputs['_nanotimes'].attrs
+        kw.update(nanotimes_specs={k: nt_attrs[k] for k in
+                                   ('tcspc_unit', 'tcspc_num_bins',
+                                    'tcspc_range')})
+    out_timestamps, _, _ = ts_store.add_timestamps(**kw)
+    outputs = {suffix: ts_store.get_photon_array(new_name, suffix)
+               for suffix in inputs}
+    for key in ('init_random_state', 'photophysics', 'excitation'):
+        if key in timestamps.attrs:
+            out_timestamps.set_attr(key, timestamps.attrs[key])
+    out_timestamps.set_attr('detector', repr(detector))
+    out_timestamps.set_attr('source', name)
+
+    for i_start, i_end in iter_chunk_index(timestamps.shape[0], chunksize):
+        ts, arrays = stream.process(
+            timestamps[i_start:i_end],
+            {k: v[i_start:i_end] for k, v in inputs.items()})
+        out_timestamps.append(ts)
+        for key, array in arrays.items():
+            outputs[key].append(array)
+    ts, arrays = stream.flush({k: v[:0] for k, v in inputs.items()})
+    out_timestamps.append(ts)
+    for key, array in arrays.items():
+        outputs[key].append(array)
+    ts_store.update_timestamps_info(new_name)
+    ts_store.flush()
+    return new_name
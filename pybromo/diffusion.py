@@ -10,6 +10,7 @@ Brownian motion and timestamps simulation.
 """
 
 import os
+import shutil
 import hashlib
 import itertools
 from pathlib import Path
@@ -20,9 +21,14 @@ import numpy as np
 from numpy import array, sqrt
 import tables
 
-from .storage import TrajectoryStore, TimestampStore, ExistingArrayError
-from .iter_chunks import iter_chunksize, iter_chunk_index
+from .storage import (TrajectoryStore, TimestampStore, ExistingArrayError,
+                      store_backends, CommittedArray,
+                      LRUCache, VirtualArray, chunk_cache_params)
+from .catalog import Catalog, catalog_filename
+from .iter_chunks import (iter_chunksize, iter_chunk_index,
+                          iter_chunks_prefetch, hdf5_lock)
 from .psflib import NumericPSF, GaussianPSF, psf_from_pytables
+from .transits import TransitTracker
 
 from ._version import get_versions
 __version__ = get_versions()['version']
@@ -42,6 +48,22 @@ def hashfunc(x):
     return hashlib.sha1(repr(x).encode()).hexdigest()
 
 
+def _rates_str(rates):
+    """Format a rate (or a sequence of per-laser rates) for array names."""
+    return 'x'.join('%.0f' % r for r in np.atleast_1d(rates))
+
+
+def derived_randomstate(rs, salt=None):
+    """Return a new RandomState seeded from the current state of `rs`.
+
+    The input `rs` is not modified. This is used to draw the random numbers
+    of optional stages (e.g. nanotimes) without altering the main stream.
+    Different `salt` values give independent streams for different stages.
+    """
+    key = rs.get_state() if salt is None else (salt, rs.get_state())
+    return np.random.RandomState(int(hashfunc(key)[:8], 16))
+
+
 class Box:
     """The simulation box. Sizes in meters."""
     def __init__(self, x1, x2, y1, y2, z1, z2):
@@ -273,13 +295,34 @@ class ParticlesSimulation(object):
     """
     _PREFIX_TRAJ = 'pybromo'
     _PREFIX_TS = 'times'
+    # Kind of data file in the catalog for each file name prefix
+    _CATALOG_KINDS = {_PREFIX_TRAJ: 'trajectories', _PREFIX_TS: 'timestamps'}
 
     @staticmethod
     def datafile_from_hash(hash_, prefix, path):
         """Return pathlib.Path for a data-file with given hash and prefix.
+
+        The file is looked up in the catalog of the folder `path` (see
+        :class:`catalog.Catalog`), when present. Otherwise (or when the
+        file is not in the catalog) the folder is listed.
+        `hash_` can also be the full compact name of the simulation
+        (see :meth:`compact_name`), which selects a single ID and EID.
         """
+        path = Path(path)
+        extensions = {store.file_extension for stores in
+                      store_backends.values() for store in stores}
+        for extension in sorted(extensions):
+            datafile = path / ('%s_%s%s' % (prefix, hash_, extension))
+            if datafile.exists():
+                return datafile
         pattern = '%s_%s*.h*' % (prefix, hash_)
-        datafiles = list(path.glob(pattern))
+        datafiles = []
+        if (path / catalog_filename).exists():
+            with Catalog(path) as catalog:
+                datafiles = catalog.lookup(
+                    hash_, ParticlesSimulation._CATALOG_KINDS[prefix])
+        if len(datafiles) == 0:
+            datafiles = list(path.glob(pattern))
         if len(datafiles) == 0:
             raise NoMatchError('No matches for "%s"' % pattern)
         if len(datafiles) > 1:
@@ -287,22 +330,47 @@ class ParticlesSimulation(object):
         return datafiles[0]
 
     @staticmethod
-    def from_datafile(hash_, path='./', ignore_timestamps=False, mode='r'):
+    def from_datafile(hash_, path='./', ignore_timestamps=False, mode='r',
+                      follow=False, poll_interval=1., timeout=None):
         """Load simulation from disk trajectories and (when present) timestamps.
 
         `mode` is only applied for opening a prexisting timestamp file.
+        When the file is writable, it is added to the catalog of its folder
+        (see :class:`catalog.Catalog`) and the timestamps added later are
+        cataloged.
+
+        If `follow` is True, the trajectory store can be still being written
+        by :meth:`simulate_diffusion` in another process. In this case
+        `emission`, `emission_tot` and `position` are
+        :class:`storage.CommittedArray` objects and reading a time slice
+        waits (checking every `poll_interval` seconds, at most `timeout`
+        seconds) until it is committed by the writer. For example,
+        `simulate_timestamps_mix` can then run while trajectories are still
+        simulated.
+
+        Following requires the trajectories saved with the 'directory'
+        backend. A HDF5 file cannot be read while it is written, since
+        PyTables does not write files in SWMR (single writer multiple
+        readers) mode: with a HDF5 trajectory file `follow=True` raises
+        ValueError and the file can be loaded only after the simulation.
         """
         path = Path(path)
         assert path.exists()
 
         file_traj = ParticlesSimulation.datafile_from_hash(
             hash_, prefix=ParticlesSimulation._PREFIX_TRAJ, path=path)
-        store = TrajectoryStore(file_traj, mode='r')
-
-        psf_pytables = store.h5file.get_node('/psf/default_psf')
+        store_classes = {stores[0].file_extension: stores
+                         for stores in store_backends.values()}
+        traj_class = store_classes[file_traj.suffix][0]
+        if follow and traj_class.backend != 'directory':
+            raise ValueError('Following a store being written requires the '
+                             '"directory" backend.')
+        store = traj_class(file_traj, mode='r')
+
+        psf_pytables = store.get_psf_array()
         psf = psf_from_pytables(psf_pytables)
-        box = store.h5file.get_node_attr('/parameters', 'box')
-        P = store.h5file.get_node_attr('/parameters', 'particles')
+        box = store.get_param_attr('box')
+        P = store.get_param_attr('particles')
 
         names = ['t_step', 't_max', 'EID', 'ID']
         kwargs = {name: store.numeric_params[name] for name in names}
@@ -312,13 +380,13 @@ class ParticlesSimulation(object):
         # Emulate S.open_store_traj()
         S.store = store
         S.psf_pytables = psf_pytables
-        S.traj_group = S.store.h5file.root.trajectories
-        S.emission = S.traj_group.emission
-        S.emission_tot = S.traj_group.emission_tot
-        if 'position' in S.traj_group:
-            S.position = S.traj_group.position
-        elif 'position_rz' in S.traj_group:
-            S.position = S.traj_group.position_rz
+        S.traj_group = S.store.get_group('trajectories')
+        if follow:
+            S._init_committed_trajectories(poll_interval, timeout)
+        elif 'virtual' in S.traj_group._v_attrs:
+            S._init_virtual_trajectories()
+        else:
+            S._init_stored_trajectories()
         if not ignore_timestamps:
             try:
                 file_ts = ParticlesSimulation.datafile_from_hash(
@@ -328,8 +396,13 @@ class ParticlesSimulation(object):
                 pass
             else:
                 # Load the timestamps
-                S.ts_store = TimestampStore(file_ts, mode=mode)
-                S.ts_group = S.ts_store.h5file.root.timestamps
+                ts_class = store_classes[file_ts.suffix][1]
+                S.ts_store = ts_class(file_ts, mode=mode)
+                S.ts_group = S.ts_store.get_group('timestamps')
+                if mode != 'r':
+                    # Catalog the timestamps added to the file
+                    S._catalog_store(S.ts_store, S._PREFIX_TS,
+                                     overwrite=(mode == 'w'))
                 print(' - Found matching timestamps.')
         return S
 
@@ -485,7 +558,8 @@ class ParticlesSimulation(object):
                 All the previously stored data in that file will be lost.
         """[1:]
 
-    def _open_store(self, store, prefix='', path='./', mode='w'):
+    def _open_store(self, store, prefix='', path='./', mode='w',
+                    compression=None, **store_kwargs):
         """Open and setup the on-disk storage file (pytables HDF5 file).
 
         Low level method used to implement different stores.
@@ -496,44 +570,125 @@ class ParticlesSimulation(object):
         Returns:
             Store object.
         """
-        store_fname = '%s_%s.hdf5' % (prefix, self.compact_name())
+        store_fname = '%s_%s%s' % (prefix, self.compact_name(),
+                                    store.file_extension)
         attr_params = dict(particles=self.particles.to_json(), box=self.box)
         kwargs = dict(path=path, nparams=self.numeric_params,
-                      attr_params=attr_params, mode=mode)
+                      attr_params=attr_params, mode=mode,
+                      compression=compression, **store_kwargs)
         store_obj = store(store_fname, **kwargs)
+        if mode != 'r':
+            self._catalog_store(store_obj, prefix, overwrite=(mode == 'w'))
         return store_obj
 
+    def _catalog_store(self, store_obj, prefix, overwrite=True):
+        """Add (or update) the file of `store_obj` in the folder catalog.
+
+        The catalog connection is closed with the store.
+        """
+        if store_obj.catalog is None:
+            store_obj.catalog = Catalog(store_obj.filepath.parent)
+        kind = self._CATALOG_KINDS.get(prefix, prefix)
+        store_obj.catalog.add_file(
+            store_obj.filepath.name, kind, self.hash(),
+            nparams=self.numeric_params,
+            particles=self.particles.to_json(), psf_hash=self.psf.hash(),
+            box=self.box, backend=store_obj.backend, overwrite=overwrite)
+
     def open_store_traj(self, path='./', chunksize=2**19, chunkslice='bytes',
-                        mode='w', radial=False):
+                        mode='w', radial=False, compression=None,
+                        layout='time-major', quantization=None,
+                        position_storage=None, virtual=False,
+                        backend='hdf5', populations=None):
         """Open and setup the on-disk storage file (pytables HDF5 file).
 
         Arguments:
-        """ + self.__DOCS_STORE_ARGS___
+        """ + self.__DOCS_STORE_ARGS___ + """
+            compression (dict or None): compression profiles overriding
+                the defaults, per array kind (e.g. 'emission', 'position').
+                See `storage.compression_profiles`.
+            layout (string): chunk layout of the trajectory arrays,
+                'time-major' (all the particles in a chunk, fast reading
+                of time windows), 'particle-major' (one particle per chunk,
+                fast reading of single particles) or 'balanced'.
+            quantization (string or None): if not None, store the
+                `emission` array as fixed-point integers, 'uint16' or
+                'uint8log'. See :class:`storage.QuantizedEmission`.
+            position_storage (dict or None): options for storing the
+                positions in compact form (e.g. `quantization='int16'`,
+                `quantum=1e-9`, `stride=10`, `reconstruction='bridge'`).
+                See :meth:`storage.TrajectoryStore.add_position`.
+            virtual (bool): if True, do not create the trajectory arrays
+                but only the table of per-chunk checkpoints.
+                See :meth:`simulate_diffusion`.
+            backend (string): the storage backend, 'hdf5' (a single
+                HDF5 file) or 'directory' (a directory of `.npy` chunks,
+                see :mod:`dirstore`). See `storage.store_backends`.
+            populations (list of slices or None): if not None, create
+                also the array of the emission summed per population
+                (`emission_pop`). See :meth:`simulate_diffusion`.
+        """
         if hasattr(self, 'store'):
             return
-        self.store = self._open_store(TrajectoryStore,
+        ncoords = 2 if radial else 3
+        chunkshape = TrajectoryStore.calc_chunkshape(
+            chunksize, (self.num_particles, ncoords, 0), kind=chunkslice,
+            layout=layout)
+        chunk_cache = chunk_cache_params(
+            layout, self.num_particles,
+            np.prod(chunkshape) * np.dtype('float32').itemsize)
+        self.store = self._open_store(store_backends[backend][0],
                                       prefix=ParticlesSimulation._PREFIX_TRAJ,
                                       path=path,
-                                      mode=mode)
+                                      mode=mode,
+                                      compression=compression,
+                                      layout=layout,
+                                      chunk_cache=chunk_cache)
 
-        self.psf_pytables = self.psf.to_hdf5(self.store.h5file, '/psf')
-        self.store.h5file.create_hard_link('/psf', 'default_psf',
-                                           target=self.psf_pytables)
+        self.psf_pytables = self.store.save_psf(self.psf)
         # Note psf.fname is the psf name in `h5file.root.psf`
-        self.traj_group = self.store.h5file.root.trajectories
+        self.traj_group = self.store.get_group('trajectories')
         self.traj_group._v_attrs['psf_name'] = self.psf.fname
 
+        if virtual:
+            self.store.add_checkpoints()
+            self.traj_group._v_attrs['virtual'] = True
+            self.traj_group._v_attrs['chunksize'] = chunkshape[-1]
+            self.traj_group._v_attrs['radial'] = radial
+            return
         kwargs = dict(chunksize=chunksize, chunkslice=chunkslice)
         self.emission_tot = self.store.add_emission_tot(**kwargs)
-        self.emission = self.store.add_emission(**kwargs)
-        self.position = self.store.add_position(radial=radial, **kwargs)
-
-    def open_store_timestamp(self, path=None, mode='w'):
+        self.emission = self.store.add_emission(quantization=quantization,
+                                                **kwargs)
+        if populations is not None:
+            self.emission_pop = self.store.add_emission_pop(populations,
+                                                            **kwargs)
+        if position_storage is None: position_storage = {}
+        self.position = self.store.add_position(
+            radial=radial, step_sigma=self.sigma_1d, **position_storage,
+            **kwargs)
+
+    def open_store_timestamp(self, path=None, mode='w', encoding=None,
+                             compression=None, backend=None):
         """Open and setup the on-disk storage file (pytables HDF5 file).
 
         Arguments:
-        """ + self.__DOCS_STORE_ARGS___
+        """ + self.__DOCS_STORE_ARGS___ + """
+            encoding (string or None): if not None, encoding of the
+                timestamps arrays created in the store ('int64' or 'delta').
+                See :meth:`storage.TimestampStore.add_timestamps`.
+            compression (dict or None): compression profiles overriding
+                the defaults, per array kind (e.g. 'timestamps',
+                'particles'). See `storage.compression_profiles`.
+            backend (string or None): the storage backend (see
+                :meth:`open_store_traj`). If None, use the backend of the
+                trajectory store or 'hdf5' if there is none.
+        """
         if hasattr(self, 'ts_store'):
+            if encoding is not None:
+                self.ts_store.timestamps_encoding = encoding
+            for kind, profile in (compression or {}).items():
+                self.ts_store.set_compression(kind, **profile)
             return
         if path is None:
             if hasattr(self, 'store'):
@@ -542,11 +697,83 @@ class ParticlesSimulation(object):
             else:
                 # No trajectory file, use current folder
                 path = '.'
-        self.ts_store = self._open_store(TimestampStore,
+        if backend is None:
+            backend = self.store.backend if hasattr(self, 'store') else 'hdf5'
+        self.ts_store = self._open_store(store_backends[backend][1],
                                          prefix=ParticlesSimulation._PREFIX_TS,
                                          path=path,
-                                         mode=mode)
-        self.ts_group = self.ts_store.h5file.root.timestamps
+                                         mode=mode,
+                                         compression=compression)
+        self.ts_group = self.ts_store.get_group('timestamps')
+        if encoding is not None:
+            self.ts_store.timestamps_encoding = encoding
+
+    def particle_emission(self, particle, i_start=0, i_stop=None):
+        """Return the emission trace of a single particle.
+
+        Reads the particle-major copy of the emission (`emission_pm`) when
+        available, otherwise the `emission` array.
+
+        Arguments:
+            particle (int): index of the particle.
+            i_start, i_stop (int): the time slice (in time steps).
+        """
+        emission = getattr(self, 'emission_pm', self.emission)
+        return emission[particle, i_start:i_stop]
+
+    def get_transits(self, particles=None, i_start=None, i_stop=None,
+                     min_peak=None, include_open=True):
+        """Return the transits of the particles through the observation volume.
+
+        Transits are saved by :meth:`simulate_diffusion` when passing
+        `transit_threshold`. Each transit has the fields `particle`,
+        `start` and `stop` (the time steps of the transit, `stop`
+        excluded), `peak` (maximum emission) and `integral` (emission
+        summed over the time steps of the transit). The duration of a
+        transit is `(stop - start) * t_step` and its expected number of
+        photons `integral * max_rate * t_step`.
+
+        Arguments:
+            particles (int, list or None): if not None, return only the
+                transits of these particles.
+            i_start, i_stop (int or None): if not None, return only the
+                transits overlapping the time steps [i_start, i_stop).
+            min_peak (float or None): if not None, return only the
+                transits with `peak >= min_peak`.
+            include_open (bool): if True, include the transits still in
+                progress at the end of the simulation (with `stop` equal
+                to the number of time steps).
+
+        Returns:
+            Structured array of transits (`transits.transit_dtype`) sorted
+            by `start`.
+        """
+        conditions = dict(i_start='stop > i_start', i_stop='start < i_stop',
+                          min_peak='peak >= min_peak')
+        condvars = {name: value for name, value in
+                    dict(i_start=i_start, i_stop=i_stop,
+                         min_peak=min_peak).items() if value is not None}
+        condition = ' & '.join('(%s)' % conditions[name]
+                               for name in condvars) or None
+        transits = self.store.get_transits(condition, condvars)
+        if transits is None:
+            raise ValueError('The trajectories have no transits table.')
+        if include_open and 'transits_state' in self.traj_group._v_attrs:
+            tracker = TransitTracker(
+                self.num_particles, None,
+                state=self.traj_group._v_attrs['transits_state'])
+            open_transits = tracker.open_transits(self.n_samples)
+            mask = np.ones(open_transits.size, dtype=bool)
+            if i_start is not None:
+                mask &= open_transits['stop'] > i_start
+            if i_stop is not None:
+                mask &= open_transits['start'] < i_stop
+            if min_peak is not None:
+                mask &= open_transits['peak'] >= min_peak
+            transits = np.concatenate([transits, open_transits[mask]])
+        if particles is not None:
+            transits = transits[np.isin(transits['particle'], particles)]
+        return np.sort(transits, order=('start', 'particle'))
 
     def _sim_trajectories(self, time_size, start_pos, rs,
                           total_emission=False, save_pos=False, radial=False,
@@ -614,7 +841,12 @@ class ParticlesSimulation(object):
     def simulate_diffusion(self, save_pos=False, total_emission=True,
                            radial=False, rs=None, seed=1, path='./',
                            wrap_func=wrap_periodic,
-                           chunksize=2**19, chunkslice='times', verbose=True):
+                           chunksize=2**19, chunkslice='times', verbose=True,
+                           compression=None, layout='time-major',
+                           particle_major_copy=False, quantization=None,
+                           position_storage=None, virtual=False,
+                           cache_chunks=16, backend='hdf5', populations=None,
+                           transit_threshold=None):
         """Simulate Brownian motion trajectories and emission rates.
 
         This method performs the Brownian motion simulation using the current
@@ -637,100 +869,604 @@ class ParticlesSimulation(object):
                 condition (use :func:`wrap_periodic` or :func:`wrap_mirror`).
             path (string): a folder where simulation data is saved.
             verbose (bool): if False, prints no output.
+            compression (dict or None): compression profiles of the
+                trajectory arrays. See :meth:`open_store_traj`.
+            layout (string): chunk layout of the trajectory arrays.
+                See :meth:`open_store_traj`.
+            particle_major_copy (bool): if True and `total_emission` is
+                False, save also a copy of the emission with one particle
+                per chunk (`self.emission_pm`) for fast per-particle reads.
+                See :meth:`particle_emission`.
+            quantization (string or None): if not None, store the emission
+                of each particle as fixed-point integers, 'uint16' or
+                'uint8log' (the total emission is always float32).
+                See :meth:`open_store_traj`.
+            position_storage (dict or None): options for storing the
+                positions (when `save_pos` is True) quantized and/or every
+                `stride` time steps. See :meth:`open_store_traj`.
+            virtual (bool): if True, do not store the trajectories but
+                only the particles positions and the random state at the
+                beginning of each time chunk. `self.emission`,
+                `self.emission_tot` and `self.position` are then
+                :class:`storage.VirtualArray` objects regenerating the
+                requested chunks on demand. `save_pos`, `total_emission`,
+                `quantization`, `position_storage` and
+                `particle_major_copy` are ignored.
+            cache_chunks (int): number of regenerated chunks kept in memory
+                when `virtual` is True.
+            backend (string): the storage backend, 'hdf5' or 'directory'.
+                See :meth:`open_store_traj`.
+            populations (list of slices or None): if not None, store only
+                the emission summed over the particles of each population
+                (`self.emission_pop`, one row per population) instead of
+                the emission of each particle. Timestamps simulated from
+                it need one Poisson sample per population and time step
+                but have no particle IDs (see
+                :meth:`simulate_timestamps_mix`). `total_emission`,
+                `quantization` and `particle_major_copy` are ignored.
+            transit_threshold (float or None): if not None, save the
+                catalog of the transits of the particles through the
+                observation volume, i.e. the intervals where the emission
+                of a particle is >= `transit_threshold` (e.g. 0.05).
+                See :meth:`get_transits`. Not supported when
+                `total_emission` or `virtual` are True.
+
+        Unless `total_emission` is True, the maximum and the integral of
+        the emission of each particle (or population) in each time chunk
+        are saved in the zone map (see
+        :meth:`storage.TrajectoryStore.get_zone_map`). The timestamps
+        simulation uses it to skip the particles far from the PSF (see
+        `min_counts` in :meth:`simulate_timestamps_mix`).
         """
+        if populations is not None:
+            populations = self._check_populations(populations)
+            total_emission = False
+            quantization = particle_major_copy = None
+        if transit_threshold is not None and (total_emission or virtual):
+            raise ValueError('Transits require the emission of each '
+                             'particle (`total_emission=False`) and '
+                             'stored trajectories.')
         if rs is None:
             rs = np.random.RandomState(seed=seed)
+        if position_storage is not None:
+            boundary = 'mirror' if wrap_func is wrap_mirror else 'periodic'
+            position_storage = dict(dict(boundary=boundary),
+                                    **position_storage)
         self.open_store_traj(chunksize=chunksize, chunkslice=chunkslice,
-                             radial=radial, path=path)
+                             radial=radial, path=path, compression=compression,
+                             layout=layout, quantization=quantization,
+                             position_storage=position_storage,
+                             virtual=virtual, backend=backend,
+                             populations=None if virtual else populations)
         # Save current random state for reproducibility
-        self.traj_group._v_attrs['init_random_state'] = rs.get_state()
-
-        em_store = self.emission_tot if total_emission else self.emission
+        attrs = self.traj_group._v_attrs
+        attrs['init_random_state'] = rs.get_state()
+        attrs['wrap_func'] = wrap_func.__name__
+        if virtual:
+            self._simulate_checkpoints(rs, wrap_func, verbose=verbose)
+            self._init_virtual_trajectories(cache_chunks)
+            return
+        # Options needed to continue the simulation (see `extend`)
+        attrs['total_emission'] = total_emission
+        attrs['save_pos'] = save_pos
+        attrs['radial'] = radial
+
+        em_copy = None
+        if particle_major_copy and not total_emission:
+            em_copy = self.store.add_emission(
+                chunksize=self.emission.chunkshape[1], chunkslice='times',
+                layout='particle-major', name='emission_pm', overwrite=True,
+                quantization=quantization)
+            self.emission_pm = em_copy
+        if not total_emission:
+            self.store.add_zone_map(self.num_particles if populations is None
+                                    else len(populations))
+        transits = None
+        if transit_threshold is not None:
+            self.store.add_transits(transit_threshold)
+            transits = TransitTracker(self.num_particles, transit_threshold)
 
         print('- Start trajectories simulation - %s' % ctime(), flush=True)
+        self.store.commit(0)
+        self._simulate_chunks(self.n_samples, self.particles.positions, rs,
+                              em_copy=em_copy, save_pos=save_pos,
+                              total_emission=total_emission, radial=radial,
+                              wrap_func=wrap_func, populations=populations,
+                              zone_map=not total_emission, transits=transits,
+                              verbose=verbose)
+        print('\n- End trajectories simulation - %s' % ctime(), flush=True)
+
+    def _simulate_chunks(self, num_steps, start_pos, rs, i_start=0,
+                         em_copy=None, save_pos=False, total_emission=True,
+                         radial=False, wrap_func=wrap_periodic,
+                         populations=None, zone_map=False, transits=None,
+                         verbose=True):
+        """Simulate `num_steps` time steps appending them to the store.
+
+        The trajectories are simulated in chunks and appended after the
+        first `i_start` time steps already stored. At the end, the final
+        positions and random state are saved in the '/trajectories'
+        attributes. `start_pos` (particles x 3 x 1) is modified in-place
+        to store the final positions. If `populations` is not None, the
+        emission summed per population is stored in `emission_pop`.
+        If `zone_map` is True, the zone map of each chunk is appended.
+        If `transits` (:class:`transits.TransitTracker`) is not None, the
+        transits ended in each chunk are appended to the transits table.
+        """
+        em_store = self.emission_tot if total_emission else self.emission
+        if populations is not None:
+            em_store = self.emission_pop
         if verbose:
             print('[PID %d] Diffusion time:' % os.getpid(), end='')
-        i_chunk = 0
         t_chunk_size = self.emission.chunkshape[1]
-        chunk_duration = t_chunk_size * self.t_step
-
-        par_start_pos = self.particles.positions
-        prev_time = 0
-        for time_size in iter_chunksize(self.n_samples, t_chunk_size):
+        prev_time = int(i_start * self.t_step)
+        i_stop = i_start
+        for time_size in iter_chunksize(num_steps, t_chunk_size):
             if verbose:
-                curr_time = int(chunk_duration * (i_chunk + 1))
+                curr_time = int((i_stop + time_size) * self.t_step)
                 if curr_time > prev_time:
                     print(' %ds' % curr_time, end='', flush=True)
                     prev_time = curr_time
 
-            POS, em = self._sim_trajectories(time_size, par_start_pos, rs,
+            POS, em = self._sim_trajectories(time_size, start_pos, rs,
                                              total_emission=total_emission,
                                              save_pos=save_pos, radial=radial,
                                              wrap_func=wrap_func)
 
+            if transits is not None:
+                transits_chunk = transits.process(em, i_stop)
+                if transits_chunk.size > 0:
+                    self.store.append_transits(transits_chunk)
+
             # Append em to the permanent storage
             # if total_emission, data is just a linear array
             # otherwise is a 2-D array (self.num_particles, c_size)
+            if populations is not None:
+                em = np.vstack([em[pop].sum(axis=0) for pop in populations])
             em_store.append(em)
+            if zone_map:
+                self.store.append_zone_map(i_stop, em)
+            if em_copy is not None:
+                em_copy.append(em)
             if save_pos:
                 self.position.append(np.vstack(POS).astype('float32'))
-            i_chunk += 1
-            self.store.h5file.flush()
+            i_stop += time_size
+            # Make the new chunk visible to readers following the file
+            self.store.commit(i_stop)
+
+        # Save current random state and positions to continue the simulation
+        attrs = self.traj_group._v_attrs
+        attrs['last_random_state'] = rs.get_state()
+        attrs['last_position'] = start_pos[..., 0]
+        if transits is not None:
+            attrs['transits_state'] = transits.get_state()
+        self.store.commit(i_stop, complete=True)
+
+    def extend(self, t_extra, verbose=True):
+        """Extend the simulated trajectories by `t_extra` seconds.
+
+        The trajectory store is reopened in append mode and the diffusion
+        continues from the particles positions and random state saved at
+        the end of the previous simulation. The new time steps are appended
+        to the arrays saved by :meth:`simulate_diffusion` (`emission` or
+        `emission_tot`, `emission_pm` and `position`) and `t_max` is
+        updated in '/parameters'. The file (and its catalog entry) is then
+        renamed after the new `t_max`, i.e. with the new :meth:`hash`,
+        so that timestamps simulated afterwards are saved in a new file
+        matching it.
+        When the number of simulated time steps is a multiple of the
+        chunk size, the result is identical to a single longer simulation.
+
+        Timestamps simulated before the extension are not updated (they
+        keep the old hash) and the timestamps store is closed.
+
+        Arguments:
+            t_extra (float): additional simulation time (seconds).
+            verbose (bool): if False, prints no output.
+        """
+        attrs = self.traj_group._v_attrs
+        if 'virtual' in attrs:
+            raise ValueError('Virtual trajectory files cannot be extended.')
+        if 'last_position' not in attrs:
+            raise ValueError('The file does not contain the final positions '
+                             'of the particles, it cannot be extended.')
+        if not self.store.committed()[1]:
+            raise ValueError('The trajectory simulation is not complete.')
+        n_extra = int(round(t_extra / self.t_step))
+        if n_extra < 1:
+            raise ValueError('`t_extra` must be at least one time step.')
+
+        if hasattr(self, 'ts_store'):
+            # Timestamps of the old duration: new ones go in a new file
+            self.ts_store.close()
+            del self.ts_store, self.ts_group
+
+        # Reopen the store in append mode
+        store_class, filepath = type(self.store), self.store.filepath
+        self.store.close()
+        self._reopen_store_traj(store_class, filepath)
+        attrs = self.traj_group._v_attrs
 
-        # Save current random state
+        rs = np.random.RandomState()
+        rs.set_state(attrs['last_random_state'])
+        start_pos = np.array(attrs['last_position'])[..., np.newaxis]
+        wrap_func = {'wrap_periodic': wrap_periodic,
+                     'wrap_mirror': wrap_mirror}[attrs['wrap_func']]
+        populations = None
+        if hasattr(self, 'emission_pop'):
+            populations = self.store.get_populations()
+        transits = None
+        if 'transits_state' in attrs:
+            threshold = self.traj_group.transits.attrs['threshold']
+            transits = TransitTracker(self.num_particles, threshold,
+                                      state=attrs['transits_state'])
+        print('- Start trajectories extension - %s' % ctime(), flush=True)
+        self._simulate_chunks(n_extra, start_pos, rs, i_start=self.n_samples,
+                              em_copy=getattr(self, 'emission_pm', None),
+                              save_pos=attrs['save_pos'],
+                              total_emission=attrs['total_emission'],
+                              radial=attrs['radial'], wrap_func=wrap_func,
+                              populations=populations,
+                              zone_map=self.store.get_zone_map() is not None,
+                              transits=transits, verbose=verbose)
+        print('\n- End trajectories extension - %s' % ctime(), flush=True)
+
+        # t_max from the number of steps (summing floats can round down
+        # the number of steps computed from t_max)
+        self.n_samples += n_extra
+        self.t_max = self.n_samples * self.t_step
+        t_max = self.numeric_params['t_max']
+        self.store.set_sim_params(dict(t_max=t_max), {})
+        self.store.flush()
+
+        # Rename the file after the new t_max (i.e. the new hash)
+        new_filepath = filepath.with_name('%s_%s%s' % (
+            self._PREFIX_TRAJ, self.compact_name(), filepath.suffix))
+        if new_filepath != filepath:
+            self.store.close()
+            if new_filepath.is_dir():
+                shutil.rmtree(str(new_filepath))
+            os.replace(str(filepath), str(new_filepath))
+            self._reopen_store_traj(store_class, new_filepath)
+        self._catalog_store(self.store, self._PREFIX_TRAJ,
+                            overwrite=new_filepath != filepath)
+        if new_filepath != filepath:
+            self.store.catalog.remove_file(filepath.name)
+
+    def _reopen_store_traj(self, store_class, filepath):
+        """Open the trajectory file `filepath` in append mode."""
+        self.store = store_class(filepath, mode='a')
+        self.psf_pytables = self.store.get_psf_array()
+        self.traj_group = self.store.get_group('trajectories')
+        self._init_stored_trajectories()
+
+    def _simulate_checkpoints(self, rs, wrap_func, verbose=True):
+        """Simulate the diffusion storing only the per-chunk checkpoints."""
+        t_chunk_size = self.traj_group._v_attrs['chunksize']
+        print('- Start trajectories simulation (checkpoints only) - %s' %
+              ctime(), flush=True)
+        if verbose:
+            print('[PID %d] Diffusion time:' % os.getpid(), end='')
+        par_start_pos = self.particles.positions
+        i_start = 0
+        for time_size in iter_chunksize(self.n_samples, t_chunk_size):
+            self.store.append_checkpoint(i_start, time_size,
+                                         par_start_pos[..., 0], rs)
+            # Advance positions and random state to the next chunk
+            self._sim_trajectories(time_size, par_start_pos, rs,
+                                   total_emission=True, wrap_func=wrap_func)
+            i_start += time_size
+            if verbose:
+                print(' %ds' % int(i_start * self.t_step), end='',
+                      flush=True)
         self.traj_group._v_attrs['last_random_state'] = rs.get_state()
-        self.store.h5file.flush()
+        self.store.flush()
         print('\n- End trajectories simulation - %s' % ctime(), flush=True)
 
+    def _regenerate_chunk(self, i_chunk):
+        """Recompute emission and positions of the time chunk `i_chunk`.
+
+        Returns:
+            Emission (num_particles x size) and positions (num_particles x
+            coords x size) arrays (float32).
+        """
+        _, size, start_pos, rs = self.store.get_checkpoint(i_chunk)
+        attrs = self.traj_group._v_attrs
+        wrap_func = {'wrap_periodic': wrap_periodic,
+                     'wrap_mirror': wrap_mirror}[attrs['wrap_func']]
+        POS, em = self._sim_trajectories(size, start_pos[..., np.newaxis], rs,
+                                         save_pos=True,
+                                         radial=attrs['radial'],
+                                         wrap_func=wrap_func)
+        return em, np.vstack(POS).astype('float32')
+
+    def _check_populations(self, populations):
+        """Return `populations` as a list of slices, validated."""
+        populations = [slice(*pop.indices(self.num_particles)[:2])
+                       for pop in populations]
+        for pop, next_pop in zip(populations, populations[1:] + [None]):
+            if pop.stop <= pop.start:
+                raise ValueError('Empty population %r.' % pop)
+            if next_pop is not None and next_pop.start < pop.stop:
+                raise ValueError('Populations must be sorted and not '
+                                 'overlapping.')
+        return populations
+
+    def _timestamps_emission(self, populations):
+        """Return the emission and populations used to simulate timestamps.
+
+        When the trajectories store only the emission summed per population
+        (`emission_pop`), `populations` must be None or equal to the stored
+        ones. In this case each population of the returned list is a single
+        row of `emission_pop`.
+
+        Returns:
+            A tuple (emission, sim_populations, populations) where
+            `sim_populations` are the populations (rows) of `emission` and
+            `populations` are the populations of particles.
+        """
+        if not hasattr(self, 'emission_pop'):
+            return self.emission, populations, populations
+        stored = self.store.get_populations()
+        if populations is not None and \
+                self._check_populations(populations) != stored:
+            raise ValueError('The trajectories store the emission of the '
+                             'populations %r.' % stored)
+        rows = [slice(i, i + 1) for i in range(len(stored))]
+        return self.emission_pop, rows, stored
+
+    def _zone_map_rows(self, populations, max_rates, min_counts):
+        """Return a function selecting the emission rows of each time chunk.
+
+        Using the zone map of the trajectories, the returned function of
+        `(i_start, i_end)` returns the indexes of the rows of the emission
+        array whose expected number of photons in the time chunk (with the
+        peak rates `max_rates` of each population) is at least
+        `min_counts`. Returns None if the trajectories have no zone map
+        (or are still being simulated).
+        """
+        if not self.store.committed()[1]:
+            return None
+        zone_map = self.store.get_zone_map()
+        if zone_map is None:
+            return None
+        start, _, integral = zone_map
+        if populations is None:
+            populations = [slice(0, self.num_particles)]
+        row_rates = np.zeros(integral.shape[1])
+        for max_rate, pop in zip(max_rates, populations):
+            row_rates[pop] = max_rate
+        expected = integral * row_rates * self.t_step
+
+        def rows(i_start, i_end):
+            j_start = max(np.searchsorted(start, i_start, side='right') - 1, 0)
+            j_end = np.searchsorted(start, i_end, side='left')
+            counts = expected[j_start:j_end].sum(axis=0)
+            return np.nonzero(counts >= min_counts)[0]
+        return rows
+
+    def _init_stored_trajectories(self):
+        """Setup the trajectory arrays stored in `self.store`."""
+        attrs = self.traj_group._v_attrs
+        if 'committed_steps' in attrs and attrs['complete']:
+            # Stored number of steps: `int(t_max / t_step)` can be one
+            # step short due to rounding (e.g. after `extend`)
+            self.n_samples = int(attrs['committed_steps'])
+        self.emission = self.store.get_emission()
+        self.emission_tot = self.traj_group.emission_tot
+        if 'emission_pm' in self.traj_group:
+            self.emission_pm = self.store.get_emission('emission_pm')
+        if 'emission_pop' in self.traj_group:
+            self.emission_pop = self.store.get_emission('emission_pop')
+        if 'position' in self.traj_group:
+            self.position = self.store.get_position('position')
+        elif 'position_rz' in self.traj_group:
+            self.position = self.store.get_position('position_rz')
+
+    def _init_committed_trajectories(self, poll_interval=1., timeout=None):
+        """Setup the trajectory arrays of a file being written."""
+        kwargs = dict(num_steps=self.n_samples, poll_interval=poll_interval,
+                      timeout=timeout)
+        self.emission = CommittedArray(self.store, 'emission', **kwargs)
+        self.emission_tot = CommittedArray(self.store, 'emission_tot',
+                                           **kwargs)
+        for name in ('position', 'position_rz'):
+            if name in self.traj_group:
+                self.position = CommittedArray(self.store, name, **kwargs)
+
+    def _init_virtual_trajectories(self, cache_chunks=16):
+        """Setup the emission and position arrays of a virtual store."""
+        attrs = self.traj_group._v_attrs
+        cache = LRUCache(cache_chunks)
+        self._trajectories_cache = cache
+
+        def get_chunk(i_chunk):
+            return cache.get_or_compute(
+                i_chunk, lambda: self._regenerate_chunk(i_chunk))
+
+        shape = (self.num_particles, self.n_samples)
+        chunksize = attrs['chunksize']
+        ncoords = 2 if attrs['radial'] else 3
+        self.emission = VirtualArray(
+            'emission', shape, chunksize, lambda i: get_chunk(i)[0])
+        self.emission_tot = VirtualArray(
+            'emission_tot', shape[1:], chunksize,
+            lambda i: get_chunk(i)[0].sum(axis=0))
+        self.position = VirtualArray(
+            'position_rz' if attrs['radial'] else 'position',
+            (self.num_particles, ncoords, self.n_samples), chunksize,
+            lambda i: get_chunk(i)[1])
+
+    def get_photon_positions(self, name):
+        """Return the particle position of each photon of timestamps `name`.
+
+        Positions are computed from the trajectories (reading or
+        regenerating each time chunk only once), so they do not need to be
+        saved with the timestamps (`save_pos`). Background photons
+        have NaN positions.
+
+        Returns:
+            Array of positions (float32) with shape (num_photons, coords).
+        """
+        timestamps = self.ts_store.get_timestamps(name)
+        particles = self.ts_store.get_photon_array(name, '_par')[:]
+        bins = np.floor(timestamps[:] * timestamps.attrs['clk_p'] /
+                        self.t_step + 1e-6).astype('int64')
+        position = np.full((bins.size, self.position.shape[1]), np.nan,
+                           dtype='float32')
+        t_chunksize = self.position.chunkshape[-1]
+        for i_start, i_end in iter_chunk_index(self.n_samples, t_chunksize):
+            start, stop = np.searchsorted(bins, (i_start, i_end))
+            if stop == start:
+                continue
+            pos_chunk = self.position[:, :, i_start:i_end]
+            par = particles[start:stop]
+            valid = par < self.num_particles
+            index = np.arange(start, stop)[valid]
+            position[index] = pos_chunk[par[valid], :,
+                                        bins[index] - i_start]
+        return position
+
     def _get_ts_name_mix_core(self, max_rates, populations, bg_rate,
-                              timeslice=None):
+                              timeslice=None, photophysics=None,
+                              excitation=None, detector=None):
         if timeslice is None:
             timeslice = self.t_max
         if populations is None:
             populations = [slice(0, self.num_particles)]
+        if excitation is not None:
+            # max_rates has one row per laser, transpose to get populations
+            max_rates = np.asarray(max_rates).T
         s = []
         for ipop, (max_rate, pop) in enumerate(zip(max_rates, populations)):
-            kw = dict(npop=ipop + 1, max_rate=max_rate,
-                      npart=pop.stop - pop.start, pop=pop, bg_rate=bg_rate)
+            kw = dict(npop=ipop + 1, max_rate=_rates_str(max_rate),
+                      npart=pop.stop - pop.start, pop=pop,
+                      bg_rate=_rates_str(bg_rate))
             s.append('Pop{npop}_P{npart}_Pstart{pop.start}_'
-                     'max_rate{max_rate:.0f}cps_BG{bg_rate:.0f}cps'
+                     'max_rate{max_rate}cps_BG{bg_rate}cps'
                      .format(**kw))
         s.append('t_{}s'.format(timeslice))
+        if photophysics is not None:
+            s.append('PP{}'.format(photophysics.hash()[:6]))
+        if excitation is not None:
+            s.append('EX{}'.format(excitation.hash()[:6]))
+        if detector is not None:
+            s.append('DET{}'.format(detector.hash()[:6]))
         return '_'.join(s)
 
     def _get_ts_name_mix(self, max_rates, populations, bg_rate, rs,
-                         hashsize=6):
-        s = self._get_ts_name_mix_core(max_rates, populations, bg_rate)
+                         hashsize=6, photophysics=None, excitation=None,
+                         detector=None):
+        s = self._get_ts_name_mix_core(max_rates, populations, bg_rate,
+                                       photophysics=photophysics,
+                                       excitation=excitation,
+                                       detector=detector)
+        return '%s_rs_%s' % (s, hashfunc(rs.get_state())[:hashsize])
+
+    def _get_ts_name_kinetic_core(self, scheme, channel, populations,
+                                  bg_rate, timeslice=None, hashsize=6,
+                                  photophysics=None):
+        if timeslice is None:
+            timeslice = self.t_max
+        if populations is None:
+            populations = [slice(0, self.num_particles)]
+        s = ['Kin{ch}_{hash}'.format(ch=channel,
+                                     hash=scheme.hash()[:hashsize])]
+        for ipop, pop in enumerate(populations):
+            s.append('Pop{npop}_P{npart}_Pstart{pop.start}'.format(
+                npop=ipop + 1, npart=pop.stop - pop.start, pop=pop))
+        s.append('BG{:.0f}cps'.format(bg_rate))
+        s.append('t_{}s'.format(timeslice))
+        if photophysics is not None:
+            s.append('PP{}'.format(photophysics.hash()[:hashsize]))
+        return '_'.join(s)
+
+    def _get_ts_name_kinetic(self, scheme, channel, populations, bg_rate, rs,
+                             hashsize=6, photophysics=None):
+        s = self._get_ts_name_kinetic_core(scheme, channel, populations,
+                                           bg_rate, photophysics=photophysics)
         return '%s_rs_%s' % (s, hashfunc(rs.get_state())[:hashsize])
 
+    def timestamps_match_kinetic(self, scheme, channel, populations, bg_rate,
+                                 hash_=None, photophysics=None):
+        index_key = self._get_ts_name_kinetic_core(scheme, channel,
+                                                   populations, bg_rate,
+                                                   photophysics=photophysics)
+        return self._timestamps_match_key(index_key, hash_)
+
     def timestamps_match_pattern(self, pattern):
         return [t for t in self.timestamp_names if pattern in t]
 
-    def timestamps_match_mix(self, max_rates, populations, bg_rate,
-                             hash_=None):
-        pattern = self._get_ts_name_mix_core(max_rates, populations, bg_rate)
+    @staticmethod
+    def _ts_index_key(name):
+        """Return the timestamps `name` without the random state hash."""
+        return name.rsplit('_rs_', 1)[0]
+
+    def _timestamps_match_key(self, index_key, hash_=None):
+        """Return the timestamps names with `index_key` and random state hash.
+
+        Uses the index of the timestamps file when present, otherwise
+        matches the names with `index_key` (and `hash_`) as pattern.
+        """
+        if self.ts_store.has_timestamps_index:
+            return self.ts_store.find_timestamps(index_key=index_key,
+                                                 rs_hash=hash_)
+        pattern = index_key
         if hash_ is not None:
             pattern = '_'.join([pattern, 'rs', hash_])
         return self.timestamps_match_pattern(pattern)
 
+    def timestamps_match_mix(self, max_rates, populations, bg_rate,
+                             hash_=None, photophysics=None, excitation=None,
+                             detector=None):
+        index_key = self._get_ts_name_mix_core(max_rates, populations, bg_rate,
+                                               photophysics=photophysics,
+                                               excitation=excitation,
+                                               detector=detector)
+        return self._timestamps_match_key(index_key, hash_)
+
     def get_timestamp_data(self, name):
         """Return matching (timestamps, particles, positions) pytables arrays.
         """
-        par_name = name + '_par'
-        pos_name = name + '_pos'
-        timestamps = self.ts_store.h5file.get_node('/timestamps', name)
-        particles = self.ts_store.h5file.get_node('/timestamps', par_name)
-        try:
-            positions = self.ts_store.h5file.get_node('/timestamps', pos_name)
-        except tables.NoSuchNodeError:
-            positions = None
+        timestamps = self.ts_store.get_timestamps(name)
+        particles = self.ts_store.get_photon_array(name, '_par')
+        positions = self.ts_store.get_photon_array(name, '_pos')
         return timestamps, particles, positions
 
+    def get_timestamp_states(self, name):
+        """Return the pytables array of per-photon states (None if missing).
+        """
+        return self.ts_store.get_photon_array(name, '_state')
+
+    def get_timestamp_nanotimes(self, name):
+        """Return the pytables array of per-photon nanotimes (None if missing).
+        """
+        return self.ts_store.get_photon_array(name, '_nanotimes')
+
+    def get_timestamp_excitation(self, name):
+        """Return the pytables array of per-photon excitation source
+        (None if missing).
+        """
+        return self.ts_store.get_photon_array(name, '_exc')
+
+    def _E_particles(self, populations, E_values):
+        """Return the FRET efficiency of each particle (NaN for background).
+
+        The returned array has `self.num_particles + 1` elements, the last
+        one being the conventional background particle.
+        """
+        E_par = np.full(self.num_particles + 1, np.nan)
+        for pop, E in zip(populations, E_values):
+            E_par[pop] = E
+        return E_par
+
     @property
     def timestamp_names(self):
         names = []
+        suffixes = (TimestampStore.photon_array_suffixes +
+                    TimestampStore.encoding_suffixes)
         for node in self.ts_group._f_list_nodes():
-            if node.name.endswith('_par') or node.name.endswith('_pos'):
+            if node.name.endswith(suffixes):
                 continue
             names.append(node.name)
         return names
@@ -834,7 +1570,8 @@ class ParticlesSimulation(object):
 
     def _sim_timestamps_populations(self, emission, max_rates, populations,
                                     bg_rate, i_start, rs,
-                                    position=None, scale=10):
+                                    position=None, scale=10, em_factor=None,
+                                    active=None, rows=None):
         """Simulate timestamps for all the populations of particles.
 
         This method simulates timestamps for a time-chunk starting at
@@ -864,6 +1601,17 @@ class ParticlesSimulation(object):
                 `(num_particles, num_spatial_dims, num_time_bins)` containing
                 particle positions for the same time chunk covered by
                 the `emission` array.
+            em_factor (None or array): array with the same shape of
+                `emission` used to scale the emission before the Poisson
+                sampling (e.g. the brightness from a photophysics model).
+            active (None or array): bool array with one element per time
+                bin. If not None, photons are generated only in the bins
+                where `active` is True (e.g. when a laser is on).
+            rows (None or array): sorted indexes of the particles of the
+                rows of `emission` and `position` (see
+                :meth:`_zone_map_rows`). The other particles emit no photons.
+                If None, `emission` contains all the particles.
+                `em_factor` always contains all the particles.
 
         Returns:
             3 arrays for the current time-chunk:
@@ -876,6 +1624,14 @@ class ParticlesSimulation(object):
         save_pos = position is not None
 
         times = (i_start + np.arange(emission.shape[1], dtype='int64')) * scale
+        if active is not None:
+            # Skip the Poisson sampling in bins without excitation
+            times = times[active]
+            emission = emission[:, active]
+            if em_factor is not None:
+                em_factor = em_factor[:, active]
+            if save_pos:
+                position = position[:, :, active]
 
         # These lists will contain one array per population
         ts_times_poplist = []
@@ -885,15 +1641,33 @@ class ParticlesSimulation(object):
         for ipop, (max_rate, pop) in enumerate(zip(max_rates, populations)):
             is_last_population = ipop == len(populations) - 1
             bg = bg_rate if is_last_population else None
-            emission_pop = emission[pop]
-            position_pop = position[pop] if save_pos else None
+            pop_rows = pop
+            if rows is not None:
+                # Rows of the particles of the population in `emission`
+                pop_range = range(*pop.indices(self.num_particles))
+                pop_rows = (rows >= pop_range.start) & (rows < pop_range.stop)
+                if bg is None and not pop_rows.any():
+                    continue
+            emission_pop = emission[pop_rows]
+            if em_factor is not None:
+                # Photophysics stage: zero-out or scale the emission
+                em_factor_pop = (em_factor[pop] if rows is None else
+                                 em_factor[rows[pop_rows]])
+                emission_pop = emission_pop * em_factor_pop
+            position_pop = position[pop_rows] if save_pos else None
             counts_pop = sim_counts_timetrace_with_bg(
                 emission_pop, max_rate, bg, self.t_step, rs=rs)
             ts_times_pop, ts_particles_pop, ts_positions_pop = \
                 self._timestamps_from_counts(
                     counts_pop, times, max_rate=max_rate,
                     sort=False, position=position_pop)
-            ts_particles_pop += pop.start
+            if rows is None:
+                ts_particles_pop += pop.start
+            else:
+                # Particle IDs of the rows (the last one is the background)
+                ids = np.append(rows[pop_rows], pop_range.stop)
+                ts_particles_pop = ids[ts_particles_pop].astype(
+                    ts_particles_pop.dtype)
             ts_times_poplist.append(ts_times_pop)
             ts_particles_poplist.append(ts_particles_pop)
             if save_pos:
@@ -915,11 +1689,143 @@ class ParticlesSimulation(object):
             ts_positions = ts_positions[index_sort]
         return ts_times, ts_particles, ts_positions
 
+    def _sim_timestamps_alex(self, emission, max_rates, populations,
+                             bg_rates, i_start, rs, excitation,
+                             position=None, scale=10, em_factor=None,
+                             rows=None):
+        """Simulate timestamps with alternated excitation.
+
+        For each laser, photons are generated only in the time bins where
+        the laser is on, using the peak emission rates for that laser.
+
+        Arguments:
+            max_rates (2D array): peak emission rates (Hz) with shape
+                (num_lasers, num_populations).
+            bg_rates (float or list): background rate (Hz) for each laser.
+                A scalar is used for all the lasers.
+            excitation (excitation.ExcitationSchedule): the schedule of
+                the lasers.
+            Other arguments are the same as in
+            :meth:`_sim_timestamps_populations`.
+
+        Returns:
+            4 arrays for the current time-chunk: timestamps, particles,
+            positions and the excitation source (laser index) of each
+            timestamp.
+        """
+        max_rates = np.asarray(max_rates, dtype='float64')
+        bg_rates = np.broadcast_to(bg_rates, (excitation.num_lasers,))
+        assert max_rates.shape[0] == excitation.num_lasers
+        ts_list, par_list, pos_list, exc_list = [], [], [], []
+        for laser in range(excitation.num_lasers):
+            active = excitation.active_bins(laser, i_start, emission.shape[1],
+                                            self.t_step)
+            ts, par, pos = self._sim_timestamps_populations(
+                emission, max_rates[laser], populations, bg_rates[laser],
+                i_start, rs, position=position, scale=scale,
+                em_factor=em_factor, active=active, rows=rows)
+            ts_list.append(ts)
+            par_list.append(par)
+            pos_list.append(pos)
+            exc_list.append(np.full(ts.size, laser, dtype='uint8'))
+        ts_times = np.hstack(ts_list)
+        index_sort = ts_times.argsort(kind='mergesort')
+        ts_positions = None
+        if position is not None:
+            ts_positions = np.vstack(pos_list)[index_sort]
+        return (ts_times[index_sort], np.hstack(par_list)[index_sort],
+                ts_positions, np.hstack(exc_list)[index_sort])
+
+    @staticmethod
+    def _sim_photon_nanotimes(tcspc, E_par, particles, channel, rs,
+                              excitation=None, exc=None):
+        """Simulate the nanotimes for a chunk of photons.
+
+        `E_par` is the FRET efficiency of each particle (see
+        :meth:`_E_particles`) and `particles` the particle of each photon.
+        With alternated excitation, `exc` is the laser of each photon.
+        Photons excited by the acceptor laser (index > 0) have no donor
+        decay and, for pulsed schedules, are delayed by the start of the
+        laser window.
+        """
+        E_photons = E_par[particles]
+        delay = None
+        if excitation is not None:
+            is_aex = (exc > 0) & ~np.isnan(E_photons)
+            E_photons = np.where(is_aex, 1, E_photons)
+            if excitation.pulsed:
+                delay = np.array([w[0] for w in excitation.windows])[exc]
+        return tcspc.sim_nanotimes(E_photons, channel, rs, delay=delay)
+
+    @staticmethod
+    def _save_photons(timestamps, photon_nodes, ts, photons, det_stream=None,
+                      flush=False):
+        """Append a chunk of timestamps and per-photon arrays to disk.
+
+        `photons` and `photon_nodes` are dicts of per-photon arrays and of
+        the corresponding pytables arrays (keys are the array suffixes).
+        If `det_stream` is not None, photons are first processed by the
+        detector stage (:class:`detectors.DetectorStream`).
+        """
+        if det_stream is not None:
+            ts, photons = det_stream.process(ts, photons, flush=flush)
+        timestamps.append(ts)
+        for suffix, array in photons.items():
+            photon_nodes[suffix].append(array)
+
+    @staticmethod
+    def _empty_photons(photon_nodes):
+        """Return a dict of empty per-photon arrays with the dtype (and
+        shape) of the arrays in `photon_nodes`, e.g. to flush the detector
+        stage (see :meth:`detectors.DetectorStream.flush`).
+        """
+        return {suffix: np.zeros((0,) + tuple(node.shape[1:]),
+                                 dtype=node.dtype)
+                for suffix, node in photon_nodes.items()}
+
+    def _sim_timestamps_states(self, emission, states, state_rates,
+                               populations, bg_rate, i_start, rs, scale=10,
+                               em_factor=None):
+        """Simulate timestamps for particles with state-dependent emission.
+
+        Arguments:
+            emission (array): 2D array of normalized emission rates
+                (max emission is 1), one row per particle.
+            states (array): 2D uint8 array with the state of each particle
+                in each time bin. Same shape as `emission`.
+            state_rates (array): peak emission rate (Hz) for each state.
+            Other arguments are the same as in
+            :meth:`_sim_timestamps_populations`.
+
+        Returns:
+            4 arrays for the current time-chunk: timestamps, particles,
+            positions (always None) and the state of each timestamp.
+            Background timestamps have state 255.
+        """
+        if populations is None:
+            populations = [slice(0, self.num_particles)]
+        state_rates = np.asarray(state_rates, dtype='float64')
+        em_states = np.zeros(emission.shape, dtype='float64')
+        for pop in populations:
+            em_states[pop] = emission[pop] * state_rates[states[pop]]
+        ts_times, ts_particles, _ = self._sim_timestamps_populations(
+            em_states, [1] * len(populations), populations, bg_rate, i_start,
+            rs, scale=scale, em_factor=em_factor)
+        is_bg = ts_particles == self.num_particles
+        index = ts_times // scale - i_start
+        ts_states = states[np.where(is_bg, 0, ts_particles), index]
+        ts_states[is_bg] = 255
+        return ts_times, ts_particles, None, ts_states
+
     def simulate_timestamps_mix(self, max_rates, populations, bg_rate,
                                 rs=None, seed=1, chunksize=2**16,
                                 comp_filter=None, overwrite=False,
                                 skip_existing=False, scale=10, save_pos=False,
-                                path=None, t_chunksize=None, timeslice=None):
+                                path=None, t_chunksize=None, timeslice=None,
+                                photophysics=None, tcspc=None,
+                                nanotimes_channel='D', E_values=None,
+                                excitation=None, detector=None,
+                                prefetch=2, min_counts=None):
         """Compute a timestamps array for a mixture of N populations.
 
         Timestamp data are saved to disk and accessible as pytables arrays in
@@ -953,26 +1859,88 @@ class ParticlesSimulation(object):
                 for each emitted photon.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            photophysics (kinetics.Photophysics or None): if not None,
+                simulate blinking and bleaching of each particle and scale
+                the emission accordingly before the Poisson sampling.
+                Note that donor and acceptor timestamps simulated with
+                two calls get independent blinking realizations. Use
+                :meth:`simulate_timestamps_mix_da` for a single realization.
+            tcspc (nanotimes.TCSPCModel or None): if not None, simulate
+                the TCSPC nanotime of each photon. Nanotimes are saved in an
+                additional array (suffix '_nanotimes').
+            nanotimes_channel (string): 'D' or 'A', the detection channel
+                of the simulated timestamps. Used only for nanotimes.
+            E_values (list or None): FRET efficiency for each population.
+                Used only (and required) when simulating nanotimes.
+            excitation (excitation.ExcitationSchedule or None): if not None,
+                simulate alternated excitation (μs-ALEX or ns-ALEX/PIE).
+                In this case `max_rates` is a 2D array with one row of
+                per-population rates for each laser and `bg_rate` can be
+                a list with one rate per laser. The excitation source of
+                each photon is saved in an additional array (suffix '_exc').
+            detector (detectors.DetectorModel or None): if not None, apply
+                the detector artifacts (jitter, dead time, afterpulsing and
+                clock quantization) to the simulated photons. Afterpulses
+                are assigned to the background particle.
+            prefetch (int): number of emission chunks read from disk in
+                advance by a background thread, while the current chunk is
+                processed. If 0, read each chunk only when needed.
+            min_counts (float or None): if not None, skip the particles
+                whose expected number of photons in a time chunk is below
+                `min_counts` (e.g. 1e-3), according to the zone map saved
+                by :meth:`simulate_diffusion`. The emission of the skipped
+                particles is not read and no photons are drawn for them.
+                Ignored when the trajectories have no zone map.
+
+        When the trajectories store the emission summed per population
+        (see :meth:`simulate_diffusion`), the photons of each population
+        are drawn from its summed emission and the particles array
+        ('_par') is not saved. In this case `populations` can be None
+        (the stored populations are used), the nanotimes are simulated
+        from the FRET efficiency of each population and `save_pos` and
+        `photophysics` are not supported.
         """
+        emission, sim_populations, populations = \
+            self._timestamps_emission(populations)
+        save_particles = emission is self.emission
+        if not save_particles and (save_pos or photophysics is not None):
+            raise ValueError('`save_pos` and `photophysics` require the '
+                             'emission of each particle.')
+        if tcspc is not None and E_values is None:
+            raise ValueError('Simulating nanotimes (`tcspc`) requires the '
+                             'FRET efficiency of each population '
+                             '(`E_values`).')
         self.open_store_timestamp(path=path)
         rs = self._get_group_randomstate(rs, seed, self.ts_group)
         if t_chunksize is None:
-            t_chunksize = self.emission.chunkshape[1]
+            t_chunksize = emission.chunkshape[1]
         timeslice_size = self.n_samples
         if timeslice is not None:
             timeslice_size = timeslice // self.t_step
 
-        name = self._get_ts_name_mix(max_rates, populations, bg_rate, rs=rs)
+        name = self._get_ts_name_mix(max_rates, populations, bg_rate, rs=rs,
+                                     photophysics=photophysics,
+                                     excitation=excitation, detector=detector)
+        clk_p = self.t_step / scale
+        if detector is not None and detector.clk_p is not None:
+            clk_p = detector.clk_p
         kw = dict(
-            name=name, clk_p=self.t_step / scale,
+            name=name, clk_p=clk_p,
+            index_key=self._ts_index_key(name),
+            rs_hash=hashfunc(rs.get_state()),
             max_rates=max_rates, bg_rate=bg_rate, populations=populations,
             num_particles=self.num_particles,
             bg_particle=self.num_particles,
             overwrite=overwrite, chunksize=chunksize,
-            save_pos=save_pos,
+            save_pos=save_pos, delta_unit=scale if detector is None else 1,
+            save_particles=save_particles,
             )
         if save_pos:
             kw.update(spatial_dims=self.position.shape[1])
+        if tcspc is not None:
+            kw.update(nanotimes_specs=tcspc.nanotimes_specs)
+        if excitation is not None:
+            kw.update(save_excitation=True)
         if comp_filter is not None:
             kw.update(comp_filter=comp_filter)
         try:
@@ -988,43 +1956,118 @@ class ParticlesSimulation(object):
         self.ts_group._v_attrs['init_random_state'] = rs.get_state()
         self._timestamps.attrs['init_random_state'] = rs.get_state()
         self._timestamps.attrs['PyBroMo'] = __version__
-
-        ts_list, part_list, pos_list = [], [], []
+        if E_values is not None and self.ts_store.catalog is not None:
+            self.ts_store.catalog.set_E_values(self.ts_store.filepath.name,
+                                               [name], E_values)
+        if photophysics is not None:
+            self._timestamps.attrs['photophysics'] = repr(photophysics)
+            pp_states = photophysics.init_states(self.num_particles, rs)
+        if tcspc is not None:
+            self._tnanotimes = self.get_timestamp_nanotimes(name)
+            self._tnanotimes.attrs['model'] = repr(tcspc)
+            E_par = self._E_particles(sim_populations, E_values)
+            rs_nanotimes = derived_randomstate(rs)
+        if excitation is not None:
+            self._timestamps.attrs['excitation'] = repr(excitation)
+            self._texcitation = self.get_timestamp_excitation(name)
+
+        # Per-photon arrays saved along the timestamps (keys are the suffixes)
+        photon_nodes = {}
+        if save_particles:
+            photon_nodes['_par'] = self._tparticles
+        if save_pos:
+            photon_nodes['_pos'] = self._tpositions
+        if tcspc is not None:
+            photon_nodes['_nanotimes'] = self._tnanotimes
+        if excitation is not None:
+            photon_nodes['_exc'] = self._texcitation
+        if detector is not None:
+            self._timestamps.attrs['detector'] = repr(detector)
+            det_stream = detector.stream(
+                self.t_step / scale, derived_randomstate(rs, salt='detector'),
+                bg_particle=self.num_particles if save_particles else None)
+
+        ts_list, photons_list = [], []
         # Load emission in chunks, and save only the final timestamps
         prev_time = 0
         # Loop through time and for each time-slice simulate all populations
         pos_chunk = None
-        for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
+        arrays = [emission]
+        if save_pos:
+            arrays.append(self.position)
+        rows, rows_chunk = None, None
+        if min_counts is not None:
+            rates = np.atleast_2d(np.asarray(max_rates, dtype=float))
+            rows = self._zone_map_rows(sim_populations, rates.sum(axis=0),
+                                       min_counts)
+            self._timestamps.attrs['min_counts'] = min_counts
+        for i_start, i_end, chunks in iter_chunks_prefetch(
+                arrays, timeslice_size, t_chunksize, depth=prefetch,
+                rows=rows):
 
             curr_time = np.around(i_start * self.t_step, decimals=0)
             if curr_time > prev_time:
                 print(' %.1fs' % curr_time, end='', flush=True)
                 prev_time = curr_time
 
-            em_chunk = self.emission[:, i_start:i_end]
+            em_chunk = chunks[0]
             if save_pos:
-                pos_chunk = self.position[:, :, i_start:i_end]
-
-            ts_times_chunk, ts_particles_chunk, ts_positions_chunk = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates, populations, bg_rate, i_start,
-                    rs, scale=scale, position=pos_chunk)
+                pos_chunk = chunks[1]
+            if rows is not None:
+                rows_chunk = rows(i_start, i_end)
+            em_factor = None
+            if photophysics is not None:
+                em_factor, pp_states = photophysics.sim_brightness(
+                    pp_states, em_chunk.shape[1], self.t_step, rs)
+
+            ts_exc_chunk = None
+            if excitation is None:
+                ts_times_chunk, ts_particles_chunk, ts_positions_chunk = \
+                    self._sim_timestamps_populations(
+                        em_chunk, max_rates, sim_populations, bg_rate,
+                        i_start, rs, scale=scale, position=pos_chunk,
+                        em_factor=em_factor, rows=rows_chunk)
+            else:
+                (ts_times_chunk, ts_particles_chunk, ts_positions_chunk,
+                 ts_exc_chunk) = self._sim_timestamps_alex(
+                    em_chunk, max_rates, sim_populations, bg_rate, i_start,
+                    rs, excitation, scale=scale, position=pos_chunk,
+                    em_factor=em_factor, rows=rows_chunk)
+
+            photons = {}
+            if save_particles:
+                photons['_par'] = ts_particles_chunk
+            if save_pos:
+                photons['_pos'] = ts_positions_chunk
+            if tcspc is not None:
+                photons['_nanotimes'] = self._sim_photon_nanotimes(
+                    tcspc, E_par, ts_particles_chunk, nanotimes_channel,
+                    rs_nanotimes, excitation=excitation, exc=ts_exc_chunk)
+            if excitation is not None:
+                photons['_exc'] = ts_exc_chunk
+            if detector is not None:
+                ts_times_chunk, photons = det_stream.process(ts_times_chunk,
+                                                             photons)
 
             # Save sorted "photons" (suffix '_s')
             ts_list.append(ts_times_chunk)
-            part_list.append(ts_particles_chunk)
-            pos_list.append(ts_positions_chunk)  # it may be a list of None
+            photons_list.append(photons)
 
-        for ts, part, pos in zip(ts_list, part_list, pos_list):
+        if detector is not None:
+            ts, photons = det_stream.flush(self._empty_photons(photon_nodes))
+            ts_list.append(ts)
+            photons_list.append(photons)
+        for ts, photons in zip(ts_list, photons_list):
             self._timestamps.append(ts)
-            self._tparticles.append(part)
-            if save_pos:
-                self._tpositions.append(pos)
+            for suffix, array in photons.items():
+                photon_nodes[suffix].append(array)
+            self.ts_store.update_time_index(name)
 
         # Save current random state so it can be resumed in the next session
         self.ts_group._v_attrs['last_random_state'] = rs.get_state()
         self._timestamps.attrs['last_random_state'] = rs.get_state()
-        self.ts_store.h5file.flush()
+        self.ts_store.update_timestamps_info(name)
+        self.ts_store.flush()
 
     def simulate_timestamps_mix_da(self, max_rates_d, max_rates_a,
                                    populations, bg_rate_d, bg_rate_a,
@@ -1032,7 +2075,9 @@ class ParticlesSimulation(object):
                                    comp_filter=None, overwrite=False,
                                    skip_existing=False, scale=10,
                                    path=None, t_chunksize=2**19,
-                                   timeslice=None):
+                                   timeslice=None, photophysics=None,
+                                   tcspc=None, excitation=None, detector=None,
+                                   prefetch=2, min_counts=None):
 
         """Compute D and A timestamps arrays for a mixture of N populations.
 
@@ -1073,27 +2118,71 @@ class ParticlesSimulation(object):
             path (string): folder where to save the data.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            photophysics (kinetics.Photophysics or None): if not None,
+                simulate blinking and bleaching of each particle and scale
+                the emission accordingly before the Poisson sampling.
+            tcspc (nanotimes.TCSPCModel or None): if not None, simulate
+                the TCSPC nanotime of each photon. Nanotimes are saved in an
+                additional array (suffix '_nanotimes').
+            excitation (excitation.ExcitationSchedule or None): if not None,
+                simulate alternated excitation. See
+                :meth:`simulate_timestamps_mix` for details.
+            detector (detectors.DetectorModel or None): if not None, apply
+                the detector artifacts to the photons of each channel.
+                See :meth:`simulate_timestamps_mix` for details.
+            prefetch (int): number of emission chunks read in advance.
+                See :meth:`simulate_timestamps_mix`.
+            min_counts (float or None): if not None, skip the particles
+                with less than `min_counts` expected photons (donor plus
+                acceptor) in a time chunk. See
+                :meth:`simulate_timestamps_mix`.
+
+        When the trajectories store the emission summed per population,
+        the particles arrays are not saved and `photophysics` is not
+        supported (see :meth:`simulate_timestamps_mix`).
         """
+        emission, sim_populations, populations = \
+            self._timestamps_emission(populations)
+        save_particles = emission is self.emission
+        if not save_particles and photophysics is not None:
+            raise ValueError('`photophysics` requires the emission of each '
+                             'particle.')
         self.open_store_timestamp(path=path)
         rs = self._get_group_randomstate(rs, seed, self.ts_group)
         if t_chunksize is None:
-            t_chunksize = self.emission.chunkshape[1]
+            t_chunksize = emission.chunkshape[1]
         timeslice_size = self.n_samples
         if timeslice is not None:
             timeslice_size = timeslice // self.t_step
 
-        name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs)
-        name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a, rs)
-
-        kw = dict(clk_p=self.t_step / scale,
+        name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs,
+                                       photophysics=photophysics,
+                                       excitation=excitation,
+                                       detector=detector)
+        name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a, rs,
+                                       photophysics=photophysics,
+                                       excitation=excitation,
+                                       detector=detector)
+        clk_p = self.t_step / scale
+        if detector is not None and detector.clk_p is not None:
+            clk_p = detector.clk_p
+
+        kw = dict(clk_p=clk_p, rs_hash=hashfunc(rs.get_state()),
                   populations=populations,
                   num_particles=self.num_particles,
                   bg_particle=self.num_particles,
-                  overwrite=overwrite, chunksize=chunksize)
+                  overwrite=overwrite, chunksize=chunksize,
+                  delta_unit=scale if detector is None else 1,
+                  save_particles=save_particles)
+        if tcspc is not None:
+            kw.update(nanotimes_specs=tcspc.nanotimes_specs)
+        if excitation is not None:
+            kw.update(save_excitation=True)
         if comp_filter is not None:
             kw.update(comp_filter=comp_filter)
 
-        kw.update(name=name_d, max_rates=max_rates_d, bg_rate=bg_rate_d)
+        kw.update(name=name_d, index_key=self._ts_index_key(name_d))
+        kw.update(max_rates=max_rates_d, bg_rate=bg_rate_d)
         try:
             self._timestamps_d, self._tparticles_d, _ = (
                 self.ts_store.add_timestamps(**kw))
@@ -1104,7 +2193,8 @@ class ParticlesSimulation(object):
             else:
                 raise e
 
-        kw.update(name=name_a, max_rates=max_rates_a, bg_rate=bg_rate_a)
+        kw.update(name=name_a, index_key=self._ts_index_key(name_a))
+        kw.update(max_rates=max_rates_a, bg_rate=bg_rate_a)
         try:
             self._timestamps_a, self._tparticles_a, _ = (
                 self.ts_store.add_timestamps(**kw))
@@ -1120,38 +2210,336 @@ class ParticlesSimulation(object):
         self._timestamps_d.attrs['PyBroMo'] = __version__
         self._timestamps_a.attrs['init_random_state'] = rs.get_state()
         self._timestamps_a.attrs['PyBroMo'] = __version__
+        if self.ts_store.catalog is not None:
+            # Catalog the FRET efficiency of each population
+            rates_d = np.asarray(max_rates_d, dtype=float)
+            rates_a = np.asarray(max_rates_a, dtype=float)
+            if excitation is not None:
+                rates_d, rates_a = rates_d[0], rates_a[0]
+            self.ts_store.catalog.set_E_values(
+                self.ts_store.filepath.name, [name_d, name_a],
+                rates_a / (rates_d + rates_a))
+        if photophysics is not None:
+            self._timestamps_d.attrs['photophysics'] = repr(photophysics)
+            self._timestamps_a.attrs['photophysics'] = repr(photophysics)
+            pp_states = photophysics.init_states(self.num_particles, rs)
+        if tcspc is not None:
+            self._tnanotimes_d = self.get_timestamp_nanotimes(name_d)
+            self._tnanotimes_a = self.get_timestamp_nanotimes(name_a)
+            self._tnanotimes_d.attrs['model'] = repr(tcspc)
+            self._tnanotimes_a.attrs['model'] = repr(tcspc)
+            rates_d, rates_a = np.asarray(max_rates_d), np.asarray(max_rates_a)
+            if excitation is not None:
+                # FRET efficiency from the donor-excitation rates
+                rates_d, rates_a = rates_d[0], rates_a[0]
+            E_values = rates_a / (rates_d + rates_a)
+            E_par = self._E_particles(sim_populations, E_values)
+            rs_nanotimes = derived_randomstate(rs)
+        if excitation is not None:
+            self._timestamps_d.attrs['excitation'] = repr(excitation)
+            self._timestamps_a.attrs['excitation'] = repr(excitation)
+            self._texcitation_d = self.get_timestamp_excitation(name_d)
+            self._texcitation_a = self.get_timestamp_excitation(name_a)
+
+        # Per-photon arrays saved along the timestamps (keys are the suffixes)
+        photon_nodes_d, photon_nodes_a = {}, {}
+        if save_particles:
+            photon_nodes_d['_par'] = self._tparticles_d
+            photon_nodes_a['_par'] = self._tparticles_a
+        if tcspc is not None:
+            photon_nodes_d['_nanotimes'] = self._tnanotimes_d
+            photon_nodes_a['_nanotimes'] = self._tnanotimes_a
+        if excitation is not None:
+            photon_nodes_d['_exc'] = self._texcitation_d
+            photon_nodes_a['_exc'] = self._texcitation_a
+        det_stream_d, det_stream_a = None, None
+        if detector is not None:
+            self._timestamps_d.attrs['detector'] = repr(detector)
+            self._timestamps_a.attrs['detector'] = repr(detector)
+            rs_detector = derived_randomstate(rs, salt='detector')
+            det_stream_d, det_stream_a = (
+                detector.stream(self.t_step / scale, rs_detector,
+                                bg_particle=(self.num_particles
+                                             if save_particles else None))
+                for _ in range(2))
+
+        rows, rows_chunk = None, None
+        if min_counts is not None:
+            rates = (np.atleast_2d(np.asarray(max_rates_d, dtype=float)) +
+                     np.atleast_2d(np.asarray(max_rates_a, dtype=float)))
+            rows = self._zone_map_rows(sim_populations, rates.sum(axis=0),
+                                       min_counts)
+            self._timestamps_d.attrs['min_counts'] = min_counts
+            self._timestamps_a.attrs['min_counts'] = min_counts
 
         # Load emission in chunks, and save only the final timestamps
         prev_time = 0
-        for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
+        for i_start, i_end, (em_chunk,) in iter_chunks_prefetch(
+                [emission], timeslice_size, t_chunksize, depth=prefetch,
+                rows=rows):
+            if rows is not None:
+                rows_chunk = rows(i_start, i_end)
 
             curr_time = np.around(i_start * self.t_step, decimals=1)
             if curr_time > prev_time:
                 print(' %.1fs' % curr_time, end='', flush=True)
                 prev_time = curr_time
 
-            em_chunk = self.emission[:, i_start:i_end]
+            em_factor = None
+            if photophysics is not None:
+                em_factor, pp_states = photophysics.sim_brightness(
+                    pp_states, em_chunk.shape[1], self.t_step, rs)
+
+            exc_chunk_s_d, exc_chunk_s_a = None, None
+            if excitation is None:
+                times_chunk_s_d, par_index_chunk_s_d, _ = \
+                    self._sim_timestamps_populations(
+                        em_chunk, max_rates_d, sim_populations, bg_rate_d,
+                        i_start, rs=rs, scale=scale, em_factor=em_factor,
+                        rows=rows_chunk)
+
+                times_chunk_s_a, par_index_chunk_s_a, _ = \
+                    self._sim_timestamps_populations(
+                        em_chunk, max_rates_a, sim_populations, bg_rate_a,
+                        i_start, rs=rs, scale=scale, em_factor=em_factor,
+                        rows=rows_chunk)
+            else:
+                times_chunk_s_d, par_index_chunk_s_d, _, exc_chunk_s_d = \
+                    self._sim_timestamps_alex(
+                        em_chunk, max_rates_d, sim_populations, bg_rate_d,
+                        i_start, rs, excitation, scale=scale,
+                        em_factor=em_factor, rows=rows_chunk)
+
+                times_chunk_s_a, par_index_chunk_s_a, _, exc_chunk_s_a = \
+                    self._sim_timestamps_alex(
+                        em_chunk, max_rates_a, sim_populations, bg_rate_a,
+                        i_start, rs, excitation, scale=scale,
+                        em_factor=em_factor, rows=rows_chunk)
+
+            photons_d, photons_a = {}, {}
+            if save_particles:
+                photons_d['_par'] = par_index_chunk_s_d
+                photons_a['_par'] = par_index_chunk_s_a
+            if tcspc is not None:
+                photons_d['_nanotimes'] = self._sim_photon_nanotimes(
+                    tcspc, E_par, par_index_chunk_s_d, 'D', rs_nanotimes,
+                    excitation=excitation, exc=exc_chunk_s_d)
+                photons_a['_nanotimes'] = self._sim_photon_nanotimes(
+                    tcspc, E_par, par_index_chunk_s_a, 'A', rs_nanotimes,
+                    excitation=excitation, exc=exc_chunk_s_a)
+            if excitation is not None:
+                photons_d['_exc'] = exc_chunk_s_d
+                photons_a['_exc'] = exc_chunk_s_a
 
-            times_chunk_s_d, par_index_chunk_s_d, _ = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_d, populations, bg_rate_d, i_start,
-                    rs=rs, scale=scale)
+            # Save sorted timestamps (suffix '_s') and corresponding particles
+            # (the next chunks are read meanwhile in a background thread)
+            with hdf5_lock:
+                self._save_photons(self._timestamps_d, photon_nodes_d,
+                                   times_chunk_s_d, photons_d, det_stream_d)
+                self._save_photons(self._timestamps_a, photon_nodes_a,
+                                   times_chunk_s_a, photons_a, det_stream_a)
+                self.ts_store.update_time_index(name_d)
+                self.ts_store.update_time_index(name_a)
+
+        if detector is not None:
+            # Save the photons held back by the detector stage
+            for timestamps, nodes, det_stream in (
+                    (self._timestamps_d, photon_nodes_d, det_stream_d),
+                    (self._timestamps_a, photon_nodes_a, det_stream_a)):
+                self._save_photons(timestamps, nodes,
+                                   np.zeros(0, dtype='int64'),
+                                   self._empty_photons(nodes), det_stream,
+                                   flush=True)
 
-            times_chunk_s_a, par_index_chunk_s_a, _ = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_a, populations, bg_rate_a, i_start,
-                    rs=rs, scale=scale)
+        # Save current random state so it can be resumed in the next session
+        self.ts_group._v_attrs['last_random_state'] = rs.get_state()
+        self._timestamps_d._v_attrs['last_random_state'] = rs.get_state()
+        self.ts_store.update_timestamps_info(name_d)
+        self.ts_store.update_timestamps_info(name_a)
+        self.ts_store.flush()
+
+    def simulate_timestamps_kinetic_da(self, scheme, populations, bg_rate_d,
+                                       bg_rate_a, rs=None, seed=1,
+                                       chunksize=2**16, comp_filter=None,
+                                       overwrite=False, skip_existing=False,
+                                       scale=10, path=None, t_chunksize=2**19,
+                                       timeslice=None, photophysics=None,
+                                       tcspc=None):
+        """Compute D and A timestamps for particles with state dynamics.
+
+        Each particle switches between the states of a kinetic scheme with
+        exponentially distributed dwell times. The state trajectories are
+        simulated chunk by chunk, aligned with the emission chunks, and
+        the emission rate in each time bin depends on the current state.
+        The trajectory file is read only once (as in
+        :meth:`simulate_timestamps_mix_da`) and the state of each photon
+        is saved in an additional array (suffix '_state').
 
-            # Save sorted timestamps (suffix '_s') and corresponding particles
-            self._timestamps_d.append(times_chunk_s_d)
-            self._tparticles_d.append(par_index_chunk_s_d)
-            self._timestamps_a.append(times_chunk_s_a)
-            self._tparticles_a.append(par_index_chunk_s_a)
+        Timestamp data are saved to disk and accessible as pytables arrays in
+        `._timestamps_d/a`, `._tparticles_d/a` and `._tstates_d/a`.
+        The background generated timestamps are assigned a
+        conventional particle number (last particle index + 1) and state 255.
+
+        Arguments:
+            scheme (kinetics.KineticScheme): the kinetic scheme, including
+                the emission rate and FRET efficiency of each state.
+            populations (list of slices): slices to `self.particles`
+                defining the particles to simulate.
+            bg_rate_d (float, cps): rate for a Poisson background process
+                in the donor channel.
+            bg_rate_a (float, cps): rate for a Poisson background process
+                in the acceptor channel.
+            rs (RandomState object): random state object used as random number
+                generator. If None, use a random state initialized from seed.
+            seed (uint): when `rs` is None, `seed` is used to initialize the
+                random state, otherwise is ignored.
+            chunksize (int): chunk size used for the on-disk timestamp array
+            comp_filter (tables.Filter or None): compression filter to use
+                for the on-disk `timestamps` and `tparticles` arrays.
+                If None use default compression.
+            overwrite (bool): if True, overwrite any pre-existing timestamps
+                array. If False, never overwrite. The outcome of simulating an
+                existing array is controlled by `skip_existing` flag.
+            skip_existing (bool): if True, skip simulation if the same
+                timestamps array is already present.
+            scale (int): `self.t_step` is multiplied by `scale` to obtain the
+                timestamps units in seconds.
+            path (string): folder where to save the data.
+            timeslice (float or None): timestamps are simulated until
+                `timeslice` seconds. If None, simulate until `self.t_max`.
+            photophysics (kinetics.Photophysics or None): if not None,
+                simulate blinking and bleaching of each particle and scale
+                the emission accordingly before the Poisson sampling.
+            tcspc (nanotimes.TCSPCModel or None): if not None, simulate
+                the TCSPC nanotime of each photon. Nanotimes are saved in an
+                additional array (suffix '_nanotimes').
+        """
+        if hasattr(self, 'emission_pop'):
+            raise ValueError('State dynamics require the emission of each '
+                             'particle.')
+        self.open_store_timestamp(path=path)
+        rs = self._get_group_randomstate(rs, seed, self.ts_group)
+        if t_chunksize is None:
+            t_chunksize = self.emission.chunkshape[1]
+        timeslice_size = self.n_samples
+        if timeslice is not None:
+            timeslice_size = timeslice // self.t_step
+
+        name_d = self._get_ts_name_kinetic(scheme, 'D', populations,
+                                           bg_rate_d, rs,
+                                           photophysics=photophysics)
+        name_a = self._get_ts_name_kinetic(scheme, 'A', populations,
+                                           bg_rate_a, rs,
+                                           photophysics=photophysics)
+
+        kw = dict(clk_p=self.t_step / scale, rs_hash=hashfunc(rs.get_state()),
+                  populations=populations,
+                  num_particles=self.num_particles,
+                  bg_particle=self.num_particles,
+                  overwrite=overwrite, chunksize=chunksize, save_states=True,
+                  delta_unit=scale)
+        if tcspc is not None:
+            kw.update(nanotimes_specs=tcspc.nanotimes_specs)
+        if comp_filter is not None:
+            kw.update(comp_filter=comp_filter)
+
+        kw.update(name=name_d, index_key=self._ts_index_key(name_d))
+        kw.update(max_rates=scheme.em_rates_d, bg_rate=bg_rate_d)
+        try:
+            self._timestamps_d, self._tparticles_d, _ = (
+                self.ts_store.add_timestamps(**kw))
+        except ExistingArrayError as e:
+            if skip_existing:
+                print(' - Skipping already present timestamps array.')
+                return
+            else:
+                raise e
+
+        kw.update(name=name_a, index_key=self._ts_index_key(name_a))
+        kw.update(max_rates=scheme.em_rates_a, bg_rate=bg_rate_a)
+        try:
+            self._timestamps_a, self._tparticles_a, _ = (
+                self.ts_store.add_timestamps(**kw))
+        except ExistingArrayError as e:
+            if skip_existing:
+                print(' - Skipping already present timestamps array.')
+                return
+            else:
+                raise e
+        self._tstates_d = self.get_timestamp_states(name_d)
+        self._tstates_a = self.get_timestamp_states(name_a)
+
+        self.ts_group._v_attrs['init_random_state'] = rs.get_state()
+        for ts_array in (self._timestamps_d, self._timestamps_a):
+            ts_array.attrs['init_random_state'] = rs.get_state()
+            ts_array.attrs['PyBroMo'] = __version__
+            ts_array.attrs['kinetic_rates'] = scheme.rates
+            ts_array.attrs['E_values'] = scheme.E_values
+            ts_array.attrs['em_rates'] = scheme.em_rates
+            if photophysics is not None:
+                ts_array.attrs['photophysics'] = repr(photophysics)
+
+        states = scheme.init_states(self.num_particles, rs)
+        if photophysics is not None:
+            pp_states = photophysics.init_states(self.num_particles, rs)
+        if tcspc is not None:
+            self._tnanotimes_d = self.get_timestamp_nanotimes(name_d)
+            self._tnanotimes_a = self.get_timestamp_nanotimes(name_a)
+            self._tnanotimes_d.attrs['model'] = repr(tcspc)
+            self._tnanotimes_a.attrs['model'] = repr(tcspc)
+            # FRET efficiency for each state, NaN for background (state 255)
+            E_states = np.full(256, np.nan)
+            E_states[:scheme.num_states] = scheme.E_values
+            rs_nanotimes = derived_randomstate(rs)
+        # Load emission in chunks, and save only the final timestamps
+        prev_time = 0
+        for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
+
+            curr_time = np.around(i_start * self.t_step, decimals=1)
+            if curr_time > prev_time:
+                print(' %.1fs' % curr_time, end='', flush=True)
+                prev_time = curr_time
+
+            em_chunk = self.emission[:, i_start:i_end]
+            states_chunk, states = scheme.sim_states(
+                states, em_chunk.shape[1], self.t_step, rs)
+            em_factor = None
+            if photophysics is not None:
+                em_factor, pp_states = photophysics.sim_brightness(
+                    pp_states, em_chunk.shape[1], self.t_step, rs)
+
+            times_chunk_d, par_chunk_d, _, states_chunk_d = \
+                self._sim_timestamps_states(
+                    em_chunk, states_chunk, scheme.em_rates_d, populations,
+                    bg_rate_d, i_start, rs=rs, scale=scale,
+                    em_factor=em_factor)
+
+            times_chunk_a, par_chunk_a, _, states_chunk_a = \
+                self._sim_timestamps_states(
+                    em_chunk, states_chunk, scheme.em_rates_a, populations,
+                    bg_rate_a, i_start, rs=rs, scale=scale,
+                    em_factor=em_factor)
+
+            self._timestamps_d.append(times_chunk_d)
+            self._tparticles_d.append(par_chunk_d)
+            self._tstates_d.append(states_chunk_d)
+            self._timestamps_a.append(times_chunk_a)
+            self._tparticles_a.append(par_chunk_a)
+            self._tstates_a.append(states_chunk_a)
+            if tcspc is not None:
+                self._tnanotimes_d.append(tcspc.sim_nanotimes(
+                    E_states[states_chunk_d], 'D', rs_nanotimes))
+                self._tnanotimes_a.append(tcspc.sim_nanotimes(
+                    E_states[states_chunk_a], 'A', rs_nanotimes))
+            self.ts_store.update_time_index(name_d)
+            self.ts_store.update_time_index(name_a)
 
         # Save current random state so it can be resumed in the next session
         self.ts_group._v_attrs['last_random_state'] = rs.get_state()
         self._timestamps_d._v_attrs['last_random_state'] = rs.get_state()
-        self.ts_store.h5file.flush()
+        self.ts_store.update_timestamps_info(name_d)
+        self.ts_store.update_timestamps_info(name_a)
+        self.ts_store.flush()
 
     def simulate_timestamps_mix_da_online(self, max_rates_d, max_rates_a,
                                  populations, bg_rate_d, bg_rate_a,
@@ -1207,15 +2595,17 @@ class ParticlesSimulation(object):
         name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs)
         name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a, rs)
 
-        kw = dict(clk_p=self.t_step / scale,
+        kw = dict(clk_p=self.t_step / scale, rs_hash=hashfunc(rs.get_state()),
                   populations=populations,
                   num_particles=self.num_particles,
                   bg_particle=self.num_particles,
-                  overwrite=overwrite, chunksize=chunksize)
+                  overwrite=overwrite, chunksize=chunksize,
+                  delta_unit=scale)
         if comp_filter is not None:
             kw.update(comp_filter=comp_filter)
 
-        kw.update(name=name_d, max_rates=max_rates_d, bg_rate=bg_rate_d)
+        kw.update(name=name_d, index_key=self._ts_index_key(name_d))
+        kw.update(max_rates=max_rates_d, bg_rate=bg_rate_d)
         try:
             self._timestamps_d, self._tparticles_d, _ = (
                 self.ts_store.add_timestamps(**kw))
@@ -1226,7 +2616,8 @@ class ParticlesSimulation(object):
             else:
                 raise e
 
-        kw.update(name=name_a, max_rates=max_rates_a, bg_rate=bg_rate_a)
+        kw.update(name=name_a, index_key=self._ts_index_key(name_a))
+        kw.update(max_rates=max_rates_a, bg_rate=bg_rate_a)
         try:
             self._timestamps_a, self._tparticles_a, _ = (
                 self.ts_store.add_timestamps(**kw))
@@ -1276,11 +2667,15 @@ class ParticlesSimulation(object):
             self._tparticles_d.append(par_index_chunk_s_d)
             self._timestamps_a.append(times_chunk_s_a)
             self._tparticles_a.append(par_index_chunk_s_a)
+            self.ts_store.update_time_index(name_d)
+            self.ts_store.update_time_index(name_a)
 
         # Save current random state so it can be resumed in the next session
         self.ts_group._v_attrs['last_random_state'] = rs.get_state()
         self._timestamps_d._v_attrs['last_random_state'] = rs.get_state()
-        self.ts_store.h5file.flush()
+        self.ts_store.update_timestamps_info(name_d)
+        self.ts_store.update_timestamps_info(name_a)
+        self.ts_store.flush()
         print('\n- End trajectories simulation - %s' % ctime(), flush=True)
 
 
@@ -0,0 +1,573 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module implements a directory-based storage backend, alternative to
+the single HDF5 file used by `storage.TrajectoryStore` and
+`storage.TimestampStore`.
+
+A store is a directory with one sub-directory per group ('parameters',
+'trajectories', 'timestamps', ...). Each array is a directory of chunks
+saved as `.npy` files (one file per chunk along the extendable axis)
+plus a pickled metadata file with dtype, shape and attributes.
+
+Chunks are independent files, therefore:
+
+- different processes can write different chunks of the same array
+  (see :meth:`DirectoryArray.write_chunk`), for example one process per
+  time window;
+- readers can memory-map a chunk without copies
+  (see :meth:`DirectoryArray.memmap`);
+- trajectories can be read while they are simulated by another process
+  (see :meth:`ParticlesSimulation.from_datafile` with `follow=True`).
+
+Compression filters are ignored (chunks are stored uncompressed).
+Tables (e.g. the transits and checkpoints of the trajectories) are
+arrays of records, queried in memory (see
+:meth:`DirectoryArray.read_where`).
+
+The backend is registered in `storage.store_backends` with the name
+'directory'.
+"""
+
+import os
+import pickle
+import shutil
+import time
+from pathlib import Path
+
+import numexpr
+import numpy as np
+import tables
+
+from .storage import (TrajectoryStore, TimestampStore, store_backends,
+                      current_time)
+
+
+def _atomic_save(path, array):
+    """Save `array` in the .npy file `path` (via a temporary file)."""
+    tmp_path = path.with_name('%s.%d.tmp' % (path.name, os.getpid()))
+    with open(str(tmp_path), 'wb') as f:
+        np.save(f, array)
+    os.replace(str(tmp_path), str(path))
+
+
+def _atomic_pickle(path, obj):
+    tmp_path = path.with_name('%s.%d.tmp' % (path.name, os.getpid()))
+    with open(str(tmp_path), 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(str(tmp_path), str(path))
+
+
+class DirectoryAttrs:
+    """Dict-like attributes of a group or array, persisted in a file."""
+    def __init__(self, path, readonly=False):
+        self._path = Path(path)
+        self._readonly = readonly
+        self._attrs = {}
+        self.reload()
+
+    def reload(self):
+        """Read the attributes saved (possibly by another process)."""
+        if self._path.exists():
+            with open(str(self._path), 'rb') as f:
+                self._attrs = pickle.load(f)
+
+    def __contains__(self, name):
+        return name in self._attrs
+
+    def __getitem__(self, name):
+        return self._attrs[name]
+
+    def __setitem__(self, name, value):
+        if self._readonly:
+            raise IOError('Store opened in read-only mode.')
+        self._attrs[name] = value
+        _atomic_pickle(self._path, self._attrs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._attrs[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def keys(self):
+        return self._attrs.keys()
+
+    def items(self):
+        return self._attrs.items()
+
+
+class DirectoryArray:
+    """An array stored as a directory of `.npy` chunks.
+
+    The array is extendable along one axis (`extdim`). Chunk `i` contains
+    the elements `[i * chunklen:(i + 1) * chunklen]` along `extdim` and
+    is saved in the file `<i>.npy`. Only the last chunk can be shorter.
+
+    Chunks can be written in any order (see :meth:`write_chunk`): the
+    array size is given by the last chunk written. Reading elements of
+    chunks not written yet (holes) raises `IOError`.
+
+    This class mimics the pytables EArray interface used in PyBroMo
+    (`append`, slicing, `read`, `shape`, `attrs`, `set_attr`).
+    """
+    def __init__(self, path, readonly=False):
+        self.path = Path(path)
+        self.readonly = readonly
+        meta = DirectoryAttrs(self.path / 'meta.pickle')
+        self.dtype = np.dtype(meta['dtype'])
+        self.extdim = meta['extdim']
+        self._shape = tuple(meta['shape'])
+        self.chunklen = meta['chunklen']
+        self.title = meta['title']
+        self.attrs = DirectoryAttrs(self.path / 'attrs.pickle',
+                                    readonly=readonly)
+        self._nrows = self._scan_nrows()
+
+    @classmethod
+    def create(cls, path, dtype, shape, chunklen, title=''):
+        """Create a new empty array in the directory `path`."""
+        path = Path(path)
+        path.mkdir(parents=True)
+        shape = tuple(shape)
+        assert shape.count(0) == 1, 'Exactly one dimension must be 0.'
+        meta = DirectoryAttrs(path / 'meta.pickle')
+        dtype = np.dtype(dtype)
+        # Record arrays (tables) need the description of the fields
+        meta['dtype'] = dtype.descr if dtype.names is not None else dtype.str
+        meta['extdim'] = shape.index(0)
+        meta['shape'] = shape
+        meta['chunklen'] = int(chunklen)
+        meta['title'] = title
+        return cls(path)
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @property
+    def _v_attrs(self):
+        return self.attrs
+
+    @property
+    def atom(self):
+        return tables.Atom.from_dtype(self.dtype)
+
+    @property
+    def nrows(self):
+        return self._nrows
+
+    @property
+    def shape(self):
+        shape = list(self._shape)
+        shape[self.extdim] = self._nrows
+        return tuple(shape)
+
+    @property
+    def chunkshape(self):
+        shape = list(self._shape)
+        shape[self.extdim] = self.chunklen
+        return tuple(shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def set_attr(self, name, value):
+        self.attrs[name] = value
+
+    def get_attr(self, name):
+        return self.attrs[name]
+
+    def _chunk_path(self, i_chunk):
+        return self.path / ('%d.npy' % i_chunk)
+
+    def _chunk_indexes(self):
+        return sorted(int(p.stem) for p in self.path.glob('*.npy'))
+
+    def _scan_nrows(self):
+        indexes = self._chunk_indexes()
+        if len(indexes) == 0:
+            return 0
+        last = np.load(str(self._chunk_path(indexes[-1])), mmap_mode='r')
+        return indexes[-1] * self.chunklen + last.shape[self.extdim]
+
+    def refresh(self):
+        """Update the array size with chunks written by other processes."""
+        self._nrows = self._scan_nrows()
+
+    def memmap(self, i_chunk):
+        """Return the chunk `i_chunk` memory-mapped (read-only, no copy)."""
+        return np.load(str(self._chunk_path(i_chunk)), mmap_mode='r')
+
+    def write_chunk(self, i_chunk, data):
+        """Write the chunk `i_chunk` (independently from other chunks).
+
+        `data` must have `chunklen` elements along the extendable axis,
+        or less when it is the last chunk of the array. Writing a chunk
+        past the end of the array leaves a hole until the previous chunks
+        are written.
+        """
+        if self.readonly:
+            raise IOError('Store opened in read-only mode.')
+        data = np.asarray(data, dtype=self.dtype)
+        assert data.shape[self.extdim] <= self.chunklen
+        _atomic_save(self._chunk_path(i_chunk), data)
+        self._nrows = max(self._nrows,
+                          i_chunk * self.chunklen + data.shape[self.extdim])
+
+    def append(self, data):
+        """Append `data` along the extendable axis."""
+        data = np.asarray(data, dtype=self.dtype)
+        i_chunk, partial = divmod(self._nrows, self.chunklen)
+        if partial > 0:
+            last = np.load(str(self._chunk_path(i_chunk)))
+            data = np.concatenate((last, data), axis=self.extdim)
+        size = data.shape[self.extdim]
+        for start in range(0, size, self.chunklen):
+            index = [slice(None)] * data.ndim
+            index[self.extdim] = slice(start, start + self.chunklen)
+            self.write_chunk(i_chunk, data[tuple(index)])
+            i_chunk += 1
+
+    def read(self, start=None, stop=None):
+        """Read the elements [start:stop] along the extendable axis."""
+        index = [slice(None)] * len(self._shape)
+        index[self.extdim] = slice(start, stop)
+        return self[tuple(index)]
+
+    def __array__(self, dtype=None):
+        return self.read().astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ndim = len(self._shape)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = (key[:i] + (slice(None),) * (ndim + 1 - len(key)) +
+                   key[i + 1:])
+        key = key + (slice(None),) * (ndim - len(key))
+        ext_key = key[self.extdim]
+        if isinstance(ext_key, slice):
+            start, stop, step = ext_key.indices(self._nrows)
+        else:
+            start = range(self._nrows)[ext_key]
+            stop, step = start + 1, 1
+        c_start = start // self.chunklen
+        c_stop = max(-(-stop // self.chunklen), c_start + 1)
+        # Copy each chunk at its offset in the data read
+        offset = c_start * self.chunklen
+        shape = list(self._shape)
+        shape[self.extdim] = max(min(c_stop * self.chunklen, self._nrows) -
+                                 offset, 0)
+        data = np.zeros(shape, dtype=self.dtype)
+        index = [slice(None)] * ndim
+        for i_chunk in range(c_start, c_stop):
+            chunk_start = i_chunk * self.chunklen - offset
+            if chunk_start >= shape[self.extdim]:
+                break
+            size = min(self.chunklen, shape[self.extdim] - chunk_start)
+            path = self._chunk_path(i_chunk)
+            chunk = None
+            if path.exists():
+                chunk = np.load(str(path), mmap_mode='r')
+            if chunk is None or chunk.shape[self.extdim] < size:
+                raise IOError('Chunk %d of "%s" has not been written.' %
+                              (i_chunk, self.path))
+            index[self.extdim] = slice(chunk_start, chunk_start + size)
+            data[tuple(index)] = chunk[tuple(
+                slice(0, size) if i == self.extdim else slice(None)
+                for i in range(ndim))]
+        key = list(key)
+        key[self.extdim] = slice(start - offset, max(stop - offset, 0), step)
+        data = np.array(data[tuple(key)])
+        if not isinstance(ext_key, slice):
+            data = np.take(data, 0, axis=self.extdim - sum(
+                not isinstance(k, slice) for k in key[:self.extdim]))
+        return data
+
+
+    def read_where(self, condition, condvars=None):
+        """Return the records matching `condition` (like a pytables table).
+
+        `condition` is a numexpr expression on the fields of the records
+        and on the variables in `condvars`. The records are read and
+        filtered in memory.
+        """
+        data = self.read()
+        names = dict(condvars or {})
+        names.update((field, data[field]) for field in data.dtype.names)
+        return data[numexpr.evaluate(condition, local_dict=names)]
+
+
+class DirectoryGroup:
+    """A group of arrays stored as a sub-directory of the store."""
+    def __init__(self, path, readonly=False):
+        self.path = Path(path)
+        self.readonly = readonly
+        self._v_attrs = DirectoryAttrs(self.path / '_attrs.pickle',
+                                       readonly=readonly)
+        self._arrays = {}
+
+    @property
+    def _v_name(self):
+        return self.path.name
+
+    @property
+    def attrs(self):
+        return self._v_attrs
+
+    def __contains__(self, name):
+        return (self.path / name / 'meta.pickle').exists()
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise tables.NoSuchNodeError('No array "%s" in "%s".' %
+                                         (name, self.path))
+        if name not in self._arrays:
+            self._arrays[name] = DirectoryArray(self.path / name,
+                                                readonly=self.readonly)
+        return self._arrays[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except tables.NoSuchNodeError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        return iter(self._f_list_nodes())
+
+    def _f_list_nodes(self):
+        return [self[p.parent.name]
+                for p in sorted(self.path.glob('*/meta.pickle'))]
+
+    def create_array(self, name, dtype, shape, chunklen, title=''):
+        if self.readonly:
+            raise IOError('Store opened in read-only mode.')
+        self._arrays[name] = DirectoryArray.create(
+            self.path / name, dtype, shape, chunklen, title=title)
+        return self._arrays[name]
+
+    def remove_array(self, name):
+        if name not in self:
+            raise tables.NoSuchNodeError('No array "%s" in "%s".' %
+                                         (name, self.path))
+        self._arrays.pop(name, None)
+        shutil.rmtree(str(self.path / name))
+
+
+class DirectoryStoreMixin:
+    """Backend primitives for stores saved in a directory.
+
+    Used as first base class together with a `storage` store class
+    (e.g. `TrajectoryStore`), whose methods are implemented on top of
+    these primitives.
+    """
+    backend = 'directory'
+    file_extension = '.d'
+
+    # Default chunk length for arrays created with automatic chunkshape
+    default_chunklen = 2**16
+    # Size of the chunks of the tables (e.g. transits and checkpoints)
+    table_chunk_bytes = 2**20
+
+    def _open(self, mode):
+        self.readonly = mode == 'r'
+        self._groups = {}
+        if mode == 'w':
+            if self.filepath.exists():
+                shutil.rmtree(str(self.filepath))
+            self.filepath.mkdir()
+            self._root_attrs()['title'] = 'PyBroMo simulation directory'
+        elif not self.filepath.is_dir():
+            raise IOError('Store directory "%s" not found.' % self.filepath)
+
+    def _root_attrs(self):
+        return DirectoryAttrs(self.filepath / '_attrs.pickle',
+                              readonly=self.readonly)
+
+    def close(self):
+        self._groups = {}
+        self._close_catalog()
+
+    def flush(self):
+        pass
+
+    def _tune_chunk_cache(self):
+        pass
+
+    def create_group(self, name, title=''):
+        path = self.filepath / name
+        if not path.exists():
+            path.mkdir()
+            group = self.get_group(name)
+            group._v_attrs['TITLE'] = title
+        return self.get_group(name)
+
+    def get_group(self, name):
+        if name not in self._groups:
+            path = self.filepath / name
+            if not path.is_dir():
+                raise tables.NoSuchNodeError('No group "%s".' % name)
+            self._groups[name] = DirectoryGroup(path, readonly=self.readonly)
+        return self._groups[name]
+
+    def _create_array(self, group, name, atom, shape, chunkshape=None,
+                      filters=None, title='', expectedrows=None):
+        shape = tuple(shape)
+        if chunkshape is None:
+            chunklen = self.default_chunklen
+        else:
+            chunklen = chunkshape[shape.index(0)]
+        return self.get_group(group).create_array(
+            name, atom.dtype, shape, chunklen, title=title)
+
+    def _create_table(self, group, name, dtype, title='',
+                      index_columns=()):
+        # Tables are arrays of records (without indexes) with chunks of
+        # about `table_chunk_bytes`, since appending rewrites the last chunk
+        dtype = np.dtype(dtype)
+        chunklen = max(self.table_chunk_bytes // dtype.itemsize, 1)
+        return self.get_group(group).create_array(name, dtype, (0,),
+                                                  chunklen, title=title)
+
+    def _get_array(self, group, name):
+        return self.get_group(group)[name]
+
+    def _has_array(self, group, name):
+        return name in self.get_group(group)
+
+    def _remove_array(self, group, name):
+        self.get_group(group).remove_array(name)
+
+    def get_param_attr(self, name):
+        return self.get_group('parameters')._v_attrs[name]
+
+    def set_sim_params(self, nparams, attr_params):
+        """Store parameters in the 'parameters' group.
+
+        See :meth:`storage.BaseStore.set_sim_params`.
+        """
+        attrs = self.get_group('parameters')._v_attrs
+        params = dict(attrs['nparams']) if 'nparams' in attrs else {}
+        for name, value in nparams.items():
+            val = value[0] if value[0] is not None else 'none'
+            params[name] = (val, value[1])
+        attrs['nparams'] = params
+        for name, value in attr_params.items():
+            attrs[name] = value
+
+    @property
+    def numeric_params(self):
+        attrs = self.get_group('parameters')._v_attrs
+        return {name: value[0] for name, value in attrs['nparams'].items()}
+
+    @property
+    def numeric_params_meta(self):
+        return dict(self.get_group('parameters')._v_attrs['nparams'])
+
+    def save_psf(self, psf):
+        return psf.to_hdf5(_PSFWriter(self), 'psf')
+
+
+class _PSFWriter:
+    """Adapter with the pytables methods used by `psf.to_hdf5()`."""
+    def __init__(self, store):
+        self.store = store
+
+    def create_array(self, group, name, obj, title=''):
+        obj = np.asarray(obj)
+        array = self.store.get_group(group).create_array(
+            name, obj.dtype, (0,) + obj.shape[1:], max(len(obj), 1),
+            title=title)
+        array.append(obj)
+        return array
+
+    def set_node_attr(self, node, name, value):
+        node.set_attr(name, value)
+
+
+class DirectoryTrajectoryStore(DirectoryStoreMixin, TrajectoryStore):
+    """A directory store for trajectories (see `storage.TrajectoryStore`).
+
+    Chunks and attributes are replaced atomically and committed time steps
+    are not modified, therefore the store can be read while another
+    process writes it (see :meth:`wait_committed`).
+    """
+    # Number of committed time steps visible in the cached arrays
+    _visible_steps = 0
+
+    def committed(self):
+        if self.readonly:
+            # The committed steps are updated by the writer process
+            self.get_group('trajectories')._v_attrs.reload()
+        return super().committed()
+
+    def refresh(self):
+        """Update the arrays with the time steps committed meanwhile."""
+        for array in self.get_group('trajectories')._arrays.values():
+            array.refresh()
+
+    def wait_committed(self, num_steps, poll_interval=1., timeout=None):
+        """Wait until the first `num_steps` time steps are committed.
+
+        Used to read a store while another process is still writing it.
+        When new steps are committed, the store is refreshed to see them
+        (see :meth:`refresh`).
+
+        Arguments:
+            num_steps (int): number of time steps needed.
+            poll_interval (float): seconds between checks of the committed
+                time steps.
+            timeout (float or None): if not None, max seconds to wait
+                before raising `TimeoutError`.
+
+        Returns:
+            The number of committed time steps (None for files written
+            without commits).
+        """
+        t_start = time.time()
+        while True:
+            committed, complete = self.committed()
+            if committed is None or committed >= num_steps:
+                break
+            if complete:
+                raise ValueError('Requested %d time steps but the complete '
+                                 'file has only %d.' % (num_steps, committed))
+            if timeout is not None and time.time() - t_start > timeout:
+                raise TimeoutError('Timeout waiting for %d committed time '
+                                   'steps (%d committed).' %
+                                   (num_steps, committed))
+            time.sleep(poll_interval)
+        if committed is not None and committed > self._visible_steps:
+            self.refresh()
+            self._visible_steps = committed
+        return committed
+
+    def get_psf_array(self):
+        return self.get_group('psf')._f_list_nodes()[0]
+
+
+
+class DirectoryTimestampStore(DirectoryStoreMixin, TimestampStore):
+    """A directory store for timestamps (see `storage.TimestampStore`).
+    """
+    def _create_timestamps_index(self):
+        # No index of the timestamps arrays: they are matched by name
+        return None
+
+    def _timestamps_index(self):
+        return None
+
+
+store_backends['directory'] = (DirectoryTrajectoryStore,
+                               DirectoryTimestampStore)
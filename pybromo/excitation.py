@@ -0,0 +1,133 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module defines the alternated excitation schedules used to simulate
+μs-ALEX and ns-ALEX (PIE) smFRET measurements.
+
+In μs-ALEX each laser is on only during a window of the alternation
+period, which is much longer than the diffusion time step. Photons are
+generated only in the time bins where a laser is on.
+
+In ns-ALEX (or PIE) the alternation period is the laser repetition period
+(tens of ns) and the windows are delays in the TCSPC range. All the
+lasers are active in every diffusion time step and the excitation source
+only shifts the photon nanotimes.
+"""
+
+import numpy as np
+
+from .diffusion import hashfunc
+
+
+class ExcitationSchedule:
+    """Alternated excitation schedule for a set of lasers.
+
+    Lasers are numbered in the same order of `windows` (for smFRET the
+    convention is 0 for the donor and 1 for the acceptor laser).
+    """
+
+    def __init__(self, period, windows, offset=0, pulsed=False):
+        """
+        Arguments:
+            period (float): alternation period (seconds). For `pulsed`
+                schedules, this is the laser repetition period.
+            windows (list of 2-tuples): (start, stop) of the on-window
+                (seconds) for each laser. Windows are defined in
+                `[0, period]` relative to the beginning of each period.
+            offset (float): time (seconds) when the first period starts.
+            pulsed (bool): if True, the schedule is a ns-ALEX (PIE) one
+                and `windows` are the delays in the TCSPC range.
+        """
+        windows = [tuple(float(t) for t in w) for w in windows]
+        for start, stop in windows:
+            if not 0 <= start < stop <= period:
+                msg = ('Excitation windows must be (start, stop) with '
+                       '0 <= start < stop <= period (%r)' % (windows,))
+                raise ValueError(msg)
+        self.period = float(period)
+        self.windows = windows
+        self.offset = float(offset)
+        self.pulsed = pulsed
+
+    @property
+    def num_lasers(self):
+        return len(self.windows)
+
+    @property
+    def duty_cycles(self):
+        """Fraction of the period each laser is on."""
+        return np.array([(stop - start) / self.period
+                         for start, stop in self.windows])
+
+    def __repr__(self):
+        return ('ExcitationSchedule(period=%r, windows=%r, offset=%r, '
+                'pulsed=%r)' % (self.period, self.windows, self.offset,
+                                self.pulsed))
+
+    def hash(self):
+        """Return an hash string computed on the schedule definition."""
+        return hashfunc(repr(self))
+
+    def _to_units(self, value, unit):
+        """Convert `value` (seconds) in integer multiples of `unit`."""
+        n = int(np.round(value / unit))
+        if not np.isclose(n * unit, value, rtol=1e-6, atol=0):
+            msg = ('Excitation schedule times must be multiples of %g s '
+                   '(got %g s).' % (unit, value))
+            raise ValueError(msg)
+        return n
+
+    def window_bins(self, t_step):
+        """Return period, windows and offset in units of diffusion steps."""
+        assert not self.pulsed
+        period = self._to_units(self.period, t_step)
+        windows = [(self._to_units(start, t_step), self._to_units(stop, t_step))
+                   for start, stop in self.windows]
+        offset = self._to_units(self.offset, t_step) % period
+        return period, windows, offset
+
+    def active_bins(self, laser, i_start, size, t_step):
+        """Return a bool mask of the time bins where `laser` is on.
+
+        Arguments:
+            laser (int): index of the laser.
+            i_start (int): index of the first time bin.
+            size (int): number of time bins.
+            t_step (float): duration of a time bin (seconds).
+
+        Returns:
+            Bool array of length `size` or None when the laser is always
+            active (pulsed schedules).
+        """
+        if self.pulsed:
+            return None
+        period, windows, offset = self.window_bins(t_step)
+        start, stop = windows[laser]
+        phase = (np.arange(i_start, i_start + size, dtype='int64') -
+                 offset) % period
+        return (phase >= start) * (phase < stop)
+
+    def measurement_specs(self, clk_p, tcspc_unit=None):
+        """Dict of ALEX fields for the Photon-HDF5 `measurement_specs` group.
+
+        Arguments:
+            clk_p (float): timestamps unit (seconds).
+            tcspc_unit (float or None): nanotimes unit (seconds), needed
+                only for pulsed schedules.
+        """
+        if self.pulsed:
+            assert tcspc_unit is not None, 'ns-ALEX requires nanotimes.'
+            unit = tcspc_unit
+            specs = dict(laser_repetition_rate=1 / self.period)
+        else:
+            unit = clk_p
+            specs = dict(alex_period=self._to_units(self.period, unit),
+                         alex_offset=self._to_units(self.offset, unit))
+        for i, (start, stop) in enumerate(self.windows):
+            specs['alex_excitation_period%d' % (i + 1)] = np.array(
+                (self._to_units(start, unit), self._to_units(stop, unit)))
+        return specs
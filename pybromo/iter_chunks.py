@@ -12,9 +12,18 @@ Copyright (C) 2013-2014 Antonino Ingargiola tritemio@gmail.com
 This module implements iterator functions to loop over arrays in chunks.
 """
 
+import queue
+import threading
+
 import numpy as np
 
 
+# The HDF5 library (as built for PyTables) is not thread-safe: all the
+# PyTables calls made while a background thread reads chunks (see
+# `iter_chunks_prefetch`) must hold this lock.
+hdf5_lock = threading.RLock()
+
+
 def iter_chunksize(num_samples, chunksize):
     """Iterator used to iterate in chunks over an array of size `num_samples`.
     At each iteration returns `chunksize` except for the last iteration.
@@ -51,19 +60,117 @@ def iter_chunk_index(num_samples, chunksize):
         i += c_size
 
 
-def reduce_chunk(func, array):
+def read_rows(array, rows, i_start, i_end):
+    """Read the time slice [i_start:i_end] of the `rows` (first axis) of
+    `array`.
+
+    Consecutive rows are read with a single slice.
+    """
+    rows = np.asarray(rows, dtype='int64')
+    if rows.size == 0:
+        return array[0:0, ..., i_start:i_end]
+    runs = np.split(rows, np.nonzero(np.diff(rows) != 1)[0] + 1)
+    return np.concatenate([array[run[0]:run[-1] + 1, ..., i_start:i_end]
+                           for run in runs])
+
+
+def iter_chunks_prefetch(arrays, num_samples, chunksize, depth=2, rows=None):
+    """Iterate in chunks along the last axis of one or more (pytables) arrays.
+
+    The chunks are read (and decompressed) in a background thread up to
+    `depth` chunks ahead of the one returned, so that reading the next
+    chunks overlaps with processing the current one. The chunks are read
+    holding `hdf5_lock`, which the caller must also hold for any other
+    PyTables call (e.g. writing the results) made during the iteration.
+
+    Arguments:
+        arrays (list): arrays sliced with `array[..., i_start:i_end]`.
+        num_samples (int): the number of samples along the last axis.
+        chunksize (int): the number of samples in each chunk.
+        depth (int): the number of chunks read in advance. If 0, read
+            each chunk when requested (no background thread).
+        rows (function or None): if not None, a function of `(i_start,
+            i_end)` returning the sorted indexes of the rows (first axis)
+            to read in each chunk. If None, read all the rows.
+
+    Returns:
+        An iterator yielding `(i_start, i_end, chunks)`, where `chunks`
+        is a list with the chunk of each array in `arrays`.
+    """
+    def read(i_start, i_end):
+        index = None if rows is None else rows(i_start, i_end)
+        with hdf5_lock:
+            if index is not None:
+                return [read_rows(array, index, i_start, i_end)
+                        for array in arrays]
+            return [array[..., i_start:i_end] for array in arrays]
+
+    if depth < 1:
+        for i_start, i_end in iter_chunk_index(num_samples, chunksize):
+            yield i_start, i_end, read(i_start, i_end)
+        return
+
+    chunk_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for i_start, i_end in iter_chunk_index(num_samples, chunksize):
+                if not put((i_start, i_end, read(i_start, i_end))):
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(None)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop the reader also when the loop is interrupted
+        stop.set()
+        thread.join()
+
+
+def reduce_chunk(func, array, depth=2):
     """Reduce with `func`, chunk by chunk, the passed pytable `array`.
+
+    The chunks are read in advance in a background thread, see
+    :func:`iter_chunks_prefetch`.
     """
     res = []
-    for slice in iter_chunk_slice(array.shape[-1], array.chunkshape[-1]):
-        res.append(func(array[..., slice]))
+    for _, _, (chunk,) in iter_chunks_prefetch(
+            [array], array.shape[-1], array.chunkshape[-1], depth=depth):
+        res.append(func(chunk))
     return func(res)
 
 
-def map_chunk(func, array, out_array):
+def map_chunk(func, array, out_array, depth=2):
     """Map with `func`, chunk by chunk, the input pytable `array`.
     The result is stored in the output pytable array `out_array`.
+
+    The chunks are read in advance in a background thread, see
+    :func:`iter_chunks_prefetch`.
     """
-    for slice in iter_chunk_slice(array.shape[-1], array.chunkshape[-1]):
-        out_array.append(func(array[..., slice]))
+    for _, _, (chunk,) in iter_chunks_prefetch(
+            [array], array.shape[-1], array.chunkshape[-1], depth=depth):
+        result = func(chunk)
+        with hdf5_lock:
+            out_array.append(result)
     return out_array
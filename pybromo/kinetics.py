@@ -0,0 +1,345 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module implements kinetic schemes used to simulate state dynamics
+(e.g. conformational changes) of the diffusing particles.
+
+A kinetic scheme is a continuous-time Markov chain with `S` states. The
+state trajectory of each particle is simulated in chunks of time bins
+aligned with the emission chunks used in the timestamp generation.
+"""
+
+import itertools
+
+import numpy as np
+
+from .diffusion import hashfunc
+
+
+def _compose_prefix(maps):
+    """Compute the prefix composition of the random maps in `maps`.
+
+    `maps` has shape (num_particles, num_jumps, num_states) and
+    `maps[n, m, s]` is the state reached by particle `n` at the jump `m`
+    when starting from state `s`. The returned array has the same shape and
+    contains the composition of all the maps up to jump `m` (inclusive).
+    The composition is computed with a parallel prefix scan, requiring
+    only log2(num_jumps) vectorized steps.
+    """
+    maps = maps.copy()
+    offset = 1
+    while offset < maps.shape[1]:
+        # Apply the maps until `m - offset` first, then the maps in `m`
+        maps[:, offset:] = np.take_along_axis(maps[:, offset:],
+                                              maps[:, :-offset], axis=-1)
+        offset *= 2
+    return maps
+
+
+def _compose_prefix_codes(codes, comp_table):
+    """Same as :func:`_compose_prefix` for maps encoded as integer codes.
+
+    `comp_table[a, b]` is the code of the map `b` followed by map `a`.
+    """
+    num_codes = comp_table.shape[0]
+    comp_table = comp_table.ravel()
+    codes = codes.astype('int32')
+    offset = 1
+    while offset < codes.shape[1]:
+        index = codes[:, offset:] * num_codes
+        index += codes[:, :-offset]
+        codes[:, offset:] = comp_table.take(index)
+        offset *= 2
+    return codes
+
+
+class KineticScheme:
+    """A kinetic scheme with `S` states and first-order transition rates.
+
+    Each state has (optionally) a FRET efficiency and a peak emission rate.
+    States are labeled with integers from 0 to `S - 1`.
+    """
+
+    # Max number of jumps per particle simulated in a vectorized block
+    max_block_jumps = 2**14
+    # Max number of states for which jump maps are encoded as integers
+    max_coded_states = 4
+
+    def __init__(self, rates, E_values=None, em_rates=None, p0=None):
+        """
+        Arguments:
+            rates (2D array): square matrix of transition rates (1/s).
+                The element `rates[i, j]` is the rate from state `i` to
+                state `j`. The diagonal is ignored.
+            E_values (sequence or None): FRET efficiency of each state.
+            em_rates (sequence or None): peak emission rate (cps) of each
+                state. Note this includes the detection losses.
+            p0 (sequence or None): probability of each state at the start of
+                the simulation. If None, use the stationary distribution.
+        """
+        rates = np.array(rates, dtype='float64', ndmin=2)
+        if rates.shape[0] != rates.shape[1]:
+            raise ValueError('`rates` must be a square matrix.')
+        if (rates < 0).any():
+            raise ValueError('`rates` must contain only non-negative values.')
+        if rates.shape[0] > 255:
+            raise ValueError('Kinetic schemes support up to 255 states.')
+        np.fill_diagonal(rates, 0)
+        self.rates = rates
+        self.exit_rates = rates.sum(axis=1)
+        for name, value in (('E_values', E_values), ('em_rates', em_rates)):
+            if value is not None:
+                value = np.asarray(value, dtype='float64')
+                if value.shape != (self.num_states,):
+                    raise ValueError('`%s` must have one element per state.'
+                                     % name)
+            setattr(self, name, value)
+        if p0 is None:
+            p0 = self.stationary_distribution
+        self.p0 = np.asarray(p0, dtype='float64')
+        if self.p0.shape != (self.num_states,):
+            raise ValueError('`p0` must have one element per state.')
+
+    @property
+    def num_states(self):
+        return self.rates.shape[0]
+
+    @property
+    def generator_matrix(self):
+        """Infinitesimal generator matrix `Q` of the Markov chain."""
+        return self.rates - np.diag(self.exit_rates)
+
+    @property
+    def stationary_distribution(self):
+        """Stationary probability of each state (solves `p Q = 0`)."""
+        A = np.vstack([self.generator_matrix.T, np.ones(self.num_states)])
+        b = np.zeros(self.num_states + 1)
+        b[-1] = 1
+        p, *_ = np.linalg.lstsq(A, b, rcond=None)
+        p = np.clip(p, 0, None)
+        return p / p.sum()
+
+    @property
+    def jump_probabilities(self):
+        """Transition matrix of the jump chain (absorbing states map to self).
+        """
+        P = np.eye(self.num_states)
+        leaving = self.exit_rates > 0
+        P[leaving] = self.rates[leaving] / self.exit_rates[leaving, None]
+        return P
+
+    @property
+    def em_rates_d(self):
+        """Peak emission rate in the donor channel for each state."""
+        return self.em_rates * (1 - self.E_values)
+
+    @property
+    def em_rates_a(self):
+        """Peak emission rate in the acceptor channel for each state."""
+        return self.em_rates * self.E_values
+
+    def __repr__(self):
+        return ('KineticScheme(rates=%r, E_values=%r, em_rates=%r, p0=%r)' %
+                (self.rates.tolist(),
+                 None if self.E_values is None else self.E_values.tolist(),
+                 None if self.em_rates is None else self.em_rates.tolist(),
+                 self.p0.tolist()))
+
+    def hash(self):
+        """Return an hash string computed on the kinetic scheme parameters."""
+        return hashfunc(repr(self))
+
+    def init_states(self, num_particles, rs):
+        """Draw the initial state of `num_particles` particles from `p0`."""
+        return rs.choice(self.num_states, size=num_particles,
+                         p=self.p0).astype('uint8')
+
+    def _jump_codes(self):
+        """Return lookup tables to simulate the jump chain with coded maps.
+
+        Each random jump is a map from the current to the next state.
+        With few states, all the possible maps are enumerated and a map
+        is encoded as `sum(map[s] * S**s)`.
+
+        Returns:
+            A tuple of 3 arrays:
+            - the sorted probability break points of the jump maps.
+            - the map code for each interval between break points.
+            - the composition table of the map codes.
+        """
+        if hasattr(self, '_jump_codes_cache'):
+            return self._jump_codes_cache
+        S = self.num_states
+        cum_prob = np.cumsum(self.jump_probabilities, axis=1)
+        breaks = np.unique(cum_prob[:, :-1])
+        u_intervals = np.hstack([[0], breaks])
+        powers = S ** np.arange(S)
+        interval_maps = (u_intervals[:, None, None] >=
+                         cum_prob[None, :, :-1]).sum(-1)
+        interval_codes = (interval_maps * powers).sum(-1)
+        maps = np.array(list(itertools.product(range(S), repeat=S)))[:, ::-1]
+        assert ((maps * powers).sum(-1) == np.arange(S**S)).all()
+        composed = np.take_along_axis(maps[:, None, :],
+                                      maps[None, :, :], axis=-1)
+        comp_table = (composed * powers).sum(-1).astype('int16')
+        self._jump_codes_cache = (breaks, interval_codes.astype('int16'),
+                                  comp_table)
+        return self._jump_codes_cache
+
+    def _sim_jumps(self, states, num_jumps, rs):
+        """Simulate `num_jumps` jumps of the jump chain for each particle.
+
+        Returns:
+            2D array with the state after each jump, one row per particle.
+        """
+        u = rs.rand(states.size, num_jumps)
+        if self.num_states <= self.max_coded_states:
+            breaks, interval_codes, comp_table = self._jump_codes()
+            codes = interval_codes[np.searchsorted(breaks, u, side='right')]
+            codes = _compose_prefix_codes(codes, comp_table)
+            powers = self.num_states ** states.astype('int16')
+            return (codes // powers[:, None] % self.num_states).astype('uint8')
+
+        cum_prob = np.cumsum(self.jump_probabilities, axis=1)
+        cum_prob[:, -1] = 1
+        maps = np.empty((states.size, num_jumps, self.num_states),
+                        dtype='uint8')
+        for s in range(self.num_states):
+            maps[..., s] = (u[..., np.newaxis] >= cum_prob[s]).sum(-1)
+        maps = _compose_prefix(maps)
+        return np.take_along_axis(maps, states[:, None, None].astype('intp'),
+                                  axis=-1)[..., 0]
+
+    def sim_states(self, states, num_bins, t_step, rs):
+        """Simulate the state trajectory of each particle in a time chunk.
+
+        The dwell times are exponentially distributed and the jumps are
+        simulated in vectorized blocks for all the particles. Since dwell
+        times are memoryless, only the current state needs to be carried
+        between consecutive chunks.
+
+        Arguments:
+            states (1D array): state of each particle at the chunk start.
+            num_bins (int): number of time bins in the chunk.
+            t_step (float): duration of a time bin in seconds.
+            rs (RandomState): random state used to draw the random numbers.
+
+        Returns:
+            A tuple of 2 arrays:
+            - the state in each time bin, shape (num_particles, num_bins).
+              When multiple transitions happen in a bin, the bin is assigned
+              the last state.
+            - the state of each particle at the end of the chunk.
+        """
+        states = np.asarray(states, dtype='uint8')
+        num_bins = int(num_bins)
+        duration = num_bins * t_step
+        num_particles = states.size
+        if num_bins == 0:
+            return (np.empty((num_particles, 0), dtype='uint8'),
+                    states.copy())
+        # Time of the last simulated jump and current state for each particle
+        t_curr = np.zeros(num_particles)
+        s_curr = states.copy()
+        # Jumps inside the chunk of each block: index of the flattened
+        # (particle, bin) array and state after the jump
+        jump_keys, jump_states = [], []
+        num_jumps = int(np.ceil(self.exit_rates.max() * duration * 1.2)) + 16
+        num_jumps = min(num_jumps, self.max_block_jumps)
+        exit_rates = np.where(self.exit_rates > 0, self.exit_rates, np.nan)
+        while True:
+            active = np.nonzero((t_curr < duration) &
+                                (self.exit_rates[s_curr] > 0))[0]
+            if active.size == 0:
+                break
+            s_start = s_curr[active]
+            s_jumps = self._sim_jumps(s_start, num_jumps, rs)
+            s_before = np.hstack([s_start[:, None], s_jumps[:, :-1]])
+            dwell = rs.standard_exponential(s_jumps.shape)
+            dwell /= exit_rates[s_before]
+            dwell[np.isnan(dwell)] = np.inf   # absorbing states
+            t_jumps = np.cumsum(dwell, axis=1)
+            t_jumps += t_curr[active, None]
+            rows, cols = np.nonzero(t_jumps < duration)
+            bins = np.minimum(t_jumps[rows, cols] / t_step, num_bins - 1)
+            jump_keys.append(active[rows] * num_bins + bins.astype('int64'))
+            jump_states.append(s_jumps[rows, cols])
+            t_curr[active] = t_jumps[:, -1]
+            s_curr[active] = s_jumps[:, -1]
+
+        # The flattened trajectories are piecewise constant: one segment
+        # starting at the first bin of each particle and one for each jump.
+        # A stable sort keeps the time order of the jumps in the same bin.
+        keys = np.concatenate([np.arange(num_particles) * num_bins] +
+                              jump_keys)
+        seg_states = np.concatenate([states] + jump_states)
+        order = np.argsort(keys, kind='stable')
+        keys, seg_states = keys[order], seg_states[order]
+        # With multiple transitions in a bin keep only the last state
+        last = np.append(keys[1:] != keys[:-1], True)
+        keys, seg_states = keys[last], seg_states[last]
+        lengths = np.diff(np.append(keys, num_particles * num_bins))
+        states_chunk = np.repeat(seg_states, lengths).reshape(num_particles,
+                                                              num_bins)
+        states_end = states_chunk[:, -1].copy()
+        return states_chunk, states_end
+
+
+class Photophysics(KineticScheme):
+    """Blinking and bleaching model of the emitting dye.
+
+    The dye has 3 states: on (0), off (1, e.g. triplet or dark state) and
+    bleached (2, absorbing). The emission of each particle is multiplied
+    by the brightness of the current state before the Poisson sampling
+    of the photons.
+    """
+    state_names = ('on', 'off', 'bleached')
+
+    def __init__(self, k_off, k_on, k_bleach=0, k_bleach_off=0,
+                 off_brightness=0):
+        """
+        Arguments:
+            k_off (float): rate (1/s) of the on -> off transition.
+            k_on (float): rate (1/s) of the off -> on transition.
+            k_bleach (float): rate (1/s) of bleaching from the on state.
+            k_bleach_off (float): rate (1/s) of bleaching from the off state.
+            off_brightness (float): brightness of the off state relative
+                to the on state. Use 0 (default) for a dark state.
+        """
+        rates = [[0, k_off, k_bleach],
+                 [k_on, 0, k_bleach_off],
+                 [0, 0, 0]]
+        # Start in the stationary distribution of the on-off blinking
+        p0 = [1, 0, 0]
+        if k_on + k_off > 0:
+            p0 = [k_on / (k_on + k_off), k_off / (k_on + k_off), 0]
+        super().__init__(rates, p0=p0)
+        self.k_off, self.k_on = k_off, k_on
+        self.k_bleach, self.k_bleach_off = k_bleach, k_bleach_off
+        self.off_brightness = off_brightness
+        self.brightness = np.array([1, off_brightness, 0], dtype='float32')
+
+    def __repr__(self):
+        return ('Photophysics(k_off=%r, k_on=%r, k_bleach=%r, '
+                'k_bleach_off=%r, off_brightness=%r)' %
+                (self.k_off, self.k_on, self.k_bleach, self.k_bleach_off,
+                 self.off_brightness))
+
+    def sim_brightness(self, states, num_bins, t_step, rs):
+        """Simulate the relative brightness of each particle in a time chunk.
+
+        Arguments are the same as in :meth:`KineticScheme.sim_states`.
+
+        Returns:
+            A tuple of 2 arrays:
+            - float32 array of brightness (between 0 and 1) with shape
+              (num_particles, num_bins). Multiply it by the emission.
+            - the state of each particle at the end of the chunk.
+        """
+        states_chunk, states_end = self.sim_states(states, num_bins, t_step,
+                                                   rs)
+        return self.brightness[states_chunk], states_end
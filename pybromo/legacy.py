@@ -39,6 +39,7 @@ def parallel_gen_timestamps(dview, max_em_rate, bg_rate):
 def merge_ph_times(times_list, times_par_list, time_block):
     """Build an array of timestamps joining the arrays in `ph_times_list`.
     `time_block` is the duration of each array of timestamps.
+    For timestamps saved on disk, use :func:`timestamps.merge_ensemble`.
     """
     offsets = np.arange(len(times_list)) * time_block
     cum_sizes = np.cumsum([ts.size for ts in times_list])
@@ -0,0 +1,116 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module implements the simulation of TCSPC nanotimes (photon arrival
+times relative to the excitation pulse) for lifetime-resolved smFRET.
+
+The nanotime of each photon is the sum of the fluorescence decay, a
+random delay drawn from the instrument response function (IRF), and
+is finally quantized in TCSPC bins.
+"""
+
+import numpy as np
+
+from .diffusion import hashfunc
+
+
+class TCSPCModel:
+    """Model of fluorescence decays and TCSPC acquisition.
+
+    The donor lifetime in presence of FRET is `tau_d * (1 - E)`. Acceptor
+    photons are emitted after the donor de-excitation by FRET, therefore
+    their nanotime is the sum of the donor (FRET-shortened) and of the
+    acceptor decays. Background photons have uniformly distributed
+    nanotimes.
+    """
+
+    def __init__(self, tau_d, tau_a, tcspc_unit, tcspc_num_bins=4096,
+                 irf=None, irf_unit=None, offset=0):
+        """
+        Arguments:
+            tau_d (float): donor lifetime without FRET (seconds).
+            tau_a (float): acceptor lifetime (seconds).
+            tcspc_unit (float): duration of a TCSPC bin (seconds).
+            tcspc_num_bins (int): number of TCSPC bins (max 2**16). The TCSPC
+                range (`tcspc_unit * tcspc_num_bins`) is also the laser
+                repetition period: decays longer than the range wrap around.
+            irf (array or None): histogram of the IRF. If None, the IRF is
+                a delta function.
+            irf_unit (float or None): bin width of `irf` (seconds). If None
+                use `tcspc_unit`.
+            offset (float): delay (seconds) of the excitation pulse in the
+                TCSPC range.
+        """
+        if tcspc_num_bins > 2**16:
+            raise ValueError('`tcspc_num_bins` must be <= 2**16.')
+        self.tau_d = tau_d
+        self.tau_a = tau_a
+        self.tcspc_unit = tcspc_unit
+        self.tcspc_num_bins = int(tcspc_num_bins)
+        self.offset = offset
+        self.irf_unit = tcspc_unit if irf_unit is None else irf_unit
+        self.irf = None
+        self._irf_cdf = None
+        if irf is not None:
+            self.irf = np.asarray(irf, dtype='float64')
+            self._irf_cdf = np.cumsum(self.irf) / self.irf.sum()
+
+    @property
+    def tcspc_range(self):
+        return self.tcspc_unit * self.tcspc_num_bins
+
+    @property
+    def nanotimes_specs(self):
+        """Dict of nanotimes specs in the Photon-HDF5 format."""
+        return dict(tcspc_unit=self.tcspc_unit,
+                    tcspc_num_bins=self.tcspc_num_bins,
+                    tcspc_range=self.tcspc_range)
+
+    def __repr__(self):
+        irf_hash = None if self.irf is None else hashfunc(self.irf.tolist())
+        return ('TCSPCModel(tau_d=%r, tau_a=%r, tcspc_unit=%r, '
+                'tcspc_num_bins=%r, irf=%s, irf_unit=%r, offset=%r)' %
+                (self.tau_d, self.tau_a, self.tcspc_unit, self.tcspc_num_bins,
+                 irf_hash, self.irf_unit, self.offset))
+
+    def sim_irf_delay(self, size, rs):
+        """Draw `size` random delays (seconds) from the IRF table."""
+        if self._irf_cdf is None:
+            return np.zeros(size)
+        index = np.searchsorted(self._irf_cdf, rs.rand(size), side='right')
+        return (index + rs.rand(size)) * self.irf_unit
+
+    def sim_nanotimes(self, E_photons, channel, rs, delay=None):
+        """Simulate the nanotimes of a set of photons.
+
+        Arguments:
+            E_photons (array): FRET efficiency of the emitter of each photon.
+                Background photons are marked with NaN.
+            channel (string): 'D' for donor or 'A' for acceptor photons.
+            rs (RandomState): random state used to draw the random numbers.
+            delay (array or None): additional delay (seconds) of each photon,
+                for example the delay of the exciting laser pulse in PIE.
+
+        Returns:
+            uint16 array of nanotimes in TCSPC bins.
+        """
+        assert channel in ('D', 'A')
+        E_photons = np.asarray(E_photons, dtype='float64')
+        size = E_photons.size
+        is_bg = np.isnan(E_photons)
+        tau_da = self.tau_d * (1 - np.where(is_bg, 0, E_photons))
+        decay = rs.standard_exponential(size) * tau_da
+        if channel == 'A':
+            decay += rs.standard_exponential(size) * self.tau_a
+        decay += self.sim_irf_delay(size, rs)
+        decay += self.offset
+        if delay is not None:
+            decay += delay
+        nanotimes = np.floor_divide(decay, self.tcspc_unit).astype('int64')
+        nanotimes[is_bg] = rs.randint(self.tcspc_num_bins, size=is_bg.sum())
+        nanotimes %= self.tcspc_num_bins
+        return nanotimes.astype('uint16')
@@ -12,10 +12,14 @@ File part of PyBroMo: a single molecule diffusion simulator.
 Copyright (C) 2013-2014 Antonino Ingargiola tritemio@gmail.com
 """
 
+import json
 from pathlib import Path
+from collections import OrderedDict
 import time
+import numpy as np
 import tables
 
+from .transits import transit_dtype
 from ._version import get_versions
 __version__ = get_versions()['version']
 
@@ -23,6 +27,157 @@ __version__ = get_versions()['version']
 # Compression filter used by default for arrays
 default_compression = tables.Filters(complevel=5, complib='blosc')
 
+# Default compression profile for each kind of array. A profile is a dict
+# of `tables.Filters` arguments (complib, complevel, shuffle, bitshuffle)
+# plus an optional `nthreads` (number of blosc threads, None: don't change).
+# Profiles can be overridden per store (see `BaseStore.set_compression`).
+compression_profiles = {
+    'emission': dict(complib='blosc', complevel=5, shuffle=True),
+    'emission_tot': dict(complib='blosc', complevel=5, shuffle=True),
+    'position': dict(complib='blosc', complevel=5, shuffle=True),
+    'timestamps': dict(complib='blosc', complevel=5, shuffle=True),
+    'timestamps_delta': dict(complib='blosc:lz4', complevel=5,
+                             shuffle=False, bitshuffle=True),
+    'particles': dict(complib='blosc', complevel=5, shuffle=True),
+    'photon_data': dict(complib='blosc', complevel=5, shuffle=True),
+}
+
+
+# Chunk layouts of the trajectory arrays (see `particles_per_chunk`)
+chunk_layouts = ('time-major', 'particle-major', 'balanced')
+
+
+def particles_per_chunk(layout, num_particles):
+    """Number of particles in a chunk of the trajectory arrays.
+
+    A 'time-major' chunk contains all the particles (fast reading of time
+    windows), a 'particle-major' chunk a single particle (fast reading of
+    single particles) and a 'balanced' one about sqrt(`num_particles`).
+    """
+    if layout == 'time-major':
+        return max(num_particles, 1)
+    elif layout == 'particle-major':
+        return 1
+    elif layout == 'balanced':
+        return max(int(np.ceil(np.sqrt(num_particles))), 1)
+    raise ValueError('Unknown chunk layout "%s", valid layouts are: %s.' %
+                     (layout, ', '.join(chunk_layouts)))
+
+
+def _next_prime(n):
+    """Return the smallest prime number >= `n`."""
+    n = max(int(n), 2)
+    while any(n % d == 0 for d in range(2, int(n**0.5) + 1)):
+        n += 1
+    return n
+
+
+def chunk_cache_params(layout, num_particles, chunk_nbytes):
+    """Return the PyTables chunk-cache parameters for a chunk `layout`.
+
+    The cache holds, for each array, two rows of chunks spanning all the
+    particles (i.e. a time window of all the particles and the following
+    one). The number of hash slots is a prime number about 100 times the
+    number of chunks in the cache, as recommended by HDF5. The PyTables
+    defaults are used as lower bounds.
+
+    Arguments:
+        layout (string): one of `chunk_layouts`.
+        num_particles (int): number of particles in the arrays.
+        chunk_nbytes (int): size in bytes of the largest chunk.
+
+    Returns:
+        Dict of parameters for `tables.open_file`.
+    """
+    num_chunks = 2 * int(np.ceil(num_particles /
+                                 particles_per_chunk(layout, num_particles)))
+    cache_size = max(num_chunks * int(chunk_nbytes),
+                     tables.parameters.CHUNK_CACHE_SIZE)
+    nslots = max(_next_prime(100 * num_chunks),
+                 tables.parameters.CHUNK_CACHE_NELMTS)
+    return dict(CHUNK_CACHE_SIZE=cache_size, CHUNK_CACHE_NELMTS=nslots)
+
+
+def make_filters(profile):
+    """Return a `tables.Filters` object for a compression `profile` (dict).
+
+    If the profile defines `nthreads`, set the max number of blosc threads
+    (in pytables this setting is global for the process).
+    """
+    profile = dict(profile)
+    nthreads = profile.pop('nthreads', None)
+    if nthreads is not None:
+        tables.set_blosc_max_threads(nthreads)
+    return tables.Filters(**profile)
+
+
+def benchmark_codecs(sample, profiles=None, repeat=3, disk_speed=200e6,
+                     verbose=False):
+    """Measure compression ratio and throughput of filters on `sample`.
+
+    Each candidate profile is used to write and read `sample` (e.g. a real
+    chunk of emission, positions or timestamps) in an in-memory HDF5 file.
+    The recommended profile is the one minimizing the estimated time to
+    write and read the sample back, i.e. compression + decompression time
+    plus the time to transfer the compressed data at `disk_speed`.
+
+    Arguments:
+        sample (array): the data to compress (array of any shape).
+        profiles (list of dict or None): the candidate compression profiles
+            (see `compression_profiles`). If None, use a set of blosc
+            codecs and levels with byte-shuffle and bit-shuffle.
+        repeat (int): number of repetitions of each measurement. The best
+            time is used.
+        disk_speed (float): disk throughput (bytes/s) used to estimate the
+            I/O time of the compressed data.
+        verbose (bool): if True, also print a table with the results.
+
+    Returns:
+        A 2-tuple with the list of results (one dict per profile with
+        keys 'profile', 'ratio', 'write_speed', 'read_speed' and
+        'io_time') and the recommended profile.
+    """
+    sample = np.ascontiguousarray(sample)
+    if profiles is None:
+        profiles = [dict(complib='blosc:%s' % codec, complevel=level,
+                         shuffle=not bitshuffle, bitshuffle=bitshuffle)
+                    for codec in ('blosclz', 'lz4', 'zstd')
+                    for level in (1, 5, 9)
+                    for bitshuffle in (False, True)]
+    results = []
+    for profile in profiles:
+        filters = make_filters(profile)
+        t_write, t_read = np.inf, np.inf
+        for _ in range(repeat):
+            h5file = tables.open_file('benchmark_codecs.h5', mode='w',
+                                      driver='H5FD_CORE',
+                                      driver_core_backing_store=0)
+            try:
+                t0 = time.perf_counter()
+                array = h5file.create_carray('/', 'sample', obj=sample,
+                                             filters=filters)
+                h5file.flush()
+                t_write = min(t_write, time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                array.read()
+                t_read = min(t_read, time.perf_counter() - t0)
+                size_on_disk = array.size_on_disk
+            finally:
+                h5file.close()
+        io_time = t_write + t_read + 2 * size_on_disk / disk_speed
+        results.append(dict(profile=profile,
+                            ratio=sample.nbytes / size_on_disk,
+                            write_speed=sample.nbytes / t_write,
+                            read_speed=sample.nbytes / t_read,
+                            io_time=io_time))
+    best = min(results, key=lambda r: r['io_time'])
+    if verbose:
+        for res in results:
+            print('%-50s ratio %6.2f  write %8.1f MB/s  read %8.1f MB/s %s' %
+                  (res['profile'], res['ratio'], res['write_speed'] / 1e6,
+                   res['read_speed'] / 1e6, '*' if res is best else ''))
+    return results, best['profile']
+
 
 def current_time():
     return time.strftime("%Y-%m-%d %H:%M:%S")
@@ -32,29 +187,625 @@ class ExistingArrayError(Exception):
     pass
 
 
+def _to_json(value, **kwargs):
+    """Serialize parameters (possibly containing slices or arrays) to JSON.
+
+    `kwargs` are passed to `json.dumps` (e.g. `sort_keys`).
+    """
+    def default(obj):
+        if isinstance(obj, slice):
+            return [obj.start, obj.stop]
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError('Cannot serialize %r' % obj)
+    return json.dumps(value, default=default, **kwargs)
+
+
+class TimestampsIndexRow(tables.IsDescription):
+    """Row of the table indexing the timestamps arrays of a file."""
+    name = tables.StringCol(1024, pos=0)
+    # Simulation parameters without random state (e.g. the name "core")
+    index_key = tables.StringCol(1024, pos=1)
+    # Hash of the random state at the beginning of the simulation
+    rs_hash = tables.StringCol(32, pos=2)
+    clk_p = tables.Float64Col(pos=3)
+    max_rates = tables.StringCol(1024, pos=4)
+    populations = tables.StringCol(1024, pos=5)
+    bg_rate = tables.StringCol(256, pos=6)
+    num_photons = tables.Int64Col(pos=7)
+    t_start = tables.Int64Col(pos=8)
+    t_stop = tables.Int64Col(pos=9)
+
+
+def checkpoint_dtype(num_particles):
+    """Return the dtype of the rows of the checkpoints table.
+
+    See :meth:`TrajectoryStore.add_checkpoints`.
+    """
+    return np.dtype([('i_start', 'i8'), ('size', 'i8'),
+                     ('position', 'f8', (num_particles, 3)),
+                     ('rs_key', 'u4', (624,)), ('rs_pos', 'i8'),
+                     ('rs_has_gauss', 'i1'), ('rs_cached_gaussian', 'f8')])
+
+
+class DeltaTimestamps:
+    """Delta-encoded on-disk timestamps array.
+
+    Timestamps are stored as differences between consecutive timestamps,
+    in units of `delta_unit`, in a narrow unsigned dtype (array `name`).
+    Differences that do not fit (or negative ones or not multiple of
+    `delta_unit`) are marked with the max value of the dtype and stored
+    in the int64 array `name + '_esc'`. Every `anchor_period`
+    timestamps the absolute timestamp and the number of previous escapes
+    are stored in `name + '_anchors'`, allowing to decode any slice
+    reading at most `anchor_period` extra elements.
+
+    This class mimics the pytables array interface used for timestamps
+    (`append`, slicing, `read`, `shape`, `attrs`) and always returns
+    int64 timestamps.
+    """
+    def __init__(self, node, esc, anchors):
+        """
+        Arguments:
+            node: the array of the deltas (`name`).
+            esc, anchors: the arrays `name + '_esc'` and
+                `name + '_anchors'`.
+        """
+        self._deltas = node
+        self._esc = esc
+        self._anchors = anchors
+        self.delta_dtype = node.dtype
+        self.anchor_period = int(node.attrs['anchor_period'])
+        self.delta_unit = int(node.attrs['delta_unit'])
+        self._esc_value = np.iinfo(self.delta_dtype).max
+        self._num_esc = self._esc.nrows
+        self._last = self[-1] if self.nrows > 0 else 0
+
+    @property
+    def name(self):
+        return self._deltas.name
+
+    @property
+    def attrs(self):
+        return self._deltas.attrs
+
+    @property
+    def _v_attrs(self):
+        return self._deltas._v_attrs
+
+    @property
+    def nrows(self):
+        return self._deltas.nrows
+
+    @property
+    def shape(self):
+        return (self.nrows,)
+
+    @property
+    def dtype(self):
+        return np.dtype('int64')
+
+    @property
+    def chunkshape(self):
+        return self._deltas.chunkshape
+
+    def __len__(self):
+        return self.nrows
+
+    def set_attr(self, name, value):
+        self._deltas.set_attr(name, value)
+
+    def __array__(self, dtype=None):
+        return self.read().astype(dtype, copy=False)
+
+    def append(self, timestamps):
+        """Append a sorted int64 array of timestamps."""
+        timestamps = np.asarray(timestamps, dtype='int64')
+        if timestamps.size == 0:
+            return
+        n0 = self.nrows
+        diff = np.diff(timestamps, prepend=self._last)
+        deltas, remainder = np.divmod(diff, self.delta_unit)
+        is_esc = (deltas < 0) | (deltas >= self._esc_value) | (remainder != 0)
+        deltas = deltas.astype(self.delta_dtype)
+        deltas[is_esc] = self._esc_value
+        # Anchors at global indexes multiple of `anchor_period`
+        index = np.arange(-n0 % self.anchor_period, timestamps.size,
+                          self.anchor_period)
+        num_esc_before = self._num_esc + np.cumsum(is_esc) - is_esc
+        if index.size > 0:
+            self._anchors.append(np.column_stack(
+                (timestamps[index], num_esc_before[index])))
+        self._deltas.append(deltas)
+        self._esc.append(diff[is_esc])
+        self._num_esc += int(is_esc.sum())
+        self._last = timestamps[-1]
+
+    def read(self, start=None, stop=None):
+        """Read and decode the timestamps in the slice [start:stop]."""
+        start, stop, _ = slice(start, stop).indices(self.nrows)
+        if stop <= start:
+            return np.zeros(0, dtype='int64')
+        block = start // self.anchor_period
+        base = block * self.anchor_period
+        t_anchor, esc_start = self._anchors[block]
+        deltas = self._deltas[base:stop]
+        is_esc = deltas == self._esc_value
+        diff = deltas.astype('int64')
+        diff *= self.delta_unit
+        diff[is_esc] = self._esc[esc_start:esc_start + is_esc.sum()]
+        timestamps = np.cumsum(diff)
+        timestamps += t_anchor - diff[0]
+        return timestamps[start - base:]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                return self.read(key.start, key.stop)[::key.step]
+            return self.read(key.start, key.stop)
+        index = range(self.nrows)[key]
+        return self.read(index, index + 1)[0]
+
+
+# Emission quantizations: atom, number of levels and default min. value
+emission_quantizations = {
+    'uint16': (tables.UInt16Atom(), 2**16 - 1, None),
+    'uint8log': (tables.UInt8Atom(), 2**8 - 1, 1e-6),
+}
+
+
+class QuantizedEmission:
+    """Fixed-point on-disk emission array.
+
+    The emission (normalized in [0, 1]) is stored as unsigned integers `q`.
+    With the 'uint16' quantization the emission is `offset + q * scale`
+    (maximum absolute error `scale / 2`, i.e. ~7.6e-6). With 'uint8log'
+    the emission is `exp(offset + (q - 1) * scale)` for `q > 0` and 0 for
+    `q = 0` (maximum relative error `scale / 2`, ~2.7% for the default
+    `min_value` of 1e-6), and emission values below `min_value` (minus
+    half a quantization step) are stored as 0.
+
+    Both errors are well below the Poisson noise of the photon counts in
+    a time bin, `sqrt(emission * max_rate * t_step)`, for
+    `max_rate * t_step` up to ~1.
+
+    This class mimics the pytables array interface used for the emission
+    (`append`, slicing, `read`, `shape`, `attrs`) and returns float32
+    arrays, dequantizing each slice as it is read.
+    """
+    def __init__(self, node):
+        self._node = node
+        self.quantization = node.attrs['quantization']
+        self.scale = float(node.attrs['scale'])
+        self.offset = float(node.attrs['offset'])
+        self._max_q = emission_quantizations[self.quantization][1]
+
+    @staticmethod
+    def quantization_params(quantization, min_value=None):
+        """Return the (scale, offset) of a `quantization`."""
+        _, levels, default_min_value = emission_quantizations[quantization]
+        if quantization == 'uint16':
+            return 1 / levels, 0.
+        if min_value is None:
+            min_value = default_min_value
+        offset = np.log(min_value)
+        return -offset / (levels - 1), offset
+
+    @property
+    def name(self):
+        return self._node.name
+
+    @property
+    def attrs(self):
+        return self._node.attrs
+
+    @property
+    def _v_attrs(self):
+        return self._node._v_attrs
+
+    @property
+    def nrows(self):
+        return self._node.nrows
+
+    @property
+    def shape(self):
+        return self._node.shape
+
+    @property
+    def dtype(self):
+        return np.dtype('float32')
+
+    @property
+    def chunkshape(self):
+        return self._node.chunkshape
+
+    def __len__(self):
+        return len(self._node)
+
+    def set_attr(self, name, value):
+        self._node.set_attr(name, value)
+
+    def __array__(self, dtype=None):
+        return self.read().astype(dtype, copy=False)
+
+    def quantize(self, emission):
+        """Return the quantized (integer) version of `emission`."""
+        emission = np.asarray(emission, dtype='float64')
+        if self.quantization == 'uint16':
+            q = np.rint((emission - self.offset) / self.scale)
+        else:
+            with np.errstate(divide='ignore'):
+                q = np.rint((np.log(emission) - self.offset) / self.scale) + 1
+            q[~(q > 0)] = 0
+        return np.clip(q, 0, self._max_q).astype(self._node.atom.dtype)
+
+    def dequantize(self, q):
+        """Return the float32 emission from the quantized values `q`."""
+        if self.quantization == 'uint16':
+            emission = np.multiply(q, self.scale, dtype='float32')
+            if self.offset != 0:
+                emission += self.offset
+            return emission
+        is_zero = q == 0
+        emission = np.multiply(q, self.scale, dtype='float32')
+        emission += self.offset - self.scale
+        np.exp(emission, out=emission)
+        emission[is_zero] = 0
+        return emission
+
+    def append(self, emission):
+        """Append a block of emission (float array)."""
+        self._node.append(self.quantize(emission))
+
+    def read(self, start=None, stop=None):
+        """Read and dequantize the rows in the slice [start:stop]."""
+        return self.dequantize(self._node.read(start, stop))
+
+    def __getitem__(self, key):
+        return self.dequantize(self._node[key])
+
+
+# Integer dtypes of quantized positions
+position_quantizations = ('int16', 'int32')
+
+
+class CompactPositions:
+    """On-disk position array with quantized values and/or time stride.
+
+    Positions are stored every `stride` time steps. When `quantization` is
+    'int16' or 'int32' the coordinates are stored as integer multiples of
+    `quantum` (meters) relative to `origin` (one value per coordinate),
+    otherwise as float32.
+
+    When reading, the positions between two stored steps are reconstructed
+    according to `reconstruction`:
+
+    - 'linear': linear interpolation;
+    - 'bridge': a Brownian bridge with the step standard deviation of each
+      particle (`step_sigma`). The random numbers are drawn from a random
+      state seeded by `bridge_seed` and the stored chunk index, so reading
+      the same step twice returns the same position.
+
+    Steps after the last stored one are held constant ('linear') or
+    continued as a free Brownian motion ('bridge'). With 'periodic'
+    `boundary`, displacements between stored steps use the minimum image
+    convention and results are folded in the box (`origin`, `origin +
+    period`). Reconstructed radial coordinates (when `period` is 0 for the
+    R coordinate) are approximate.
+
+    This class mimics the pytables array interface used for positions
+    (`append`, slicing, `shape`, `attrs`) and returns float32 arrays.
+    """
+    def __init__(self, node):
+        self._node = node
+        attrs = node.attrs
+        self.stride = int(attrs['stride'])
+        self.quantization = attrs['quantization']
+        self.quantum = float(attrs['quantum'])
+        self.origin = np.asarray(attrs['origin'], dtype='float64')
+        self.period = np.asarray(attrs['period'], dtype='float64')
+        self.boundary = attrs['boundary']
+        self.step_sigma = np.asarray(attrs['step_sigma'], dtype='float64')
+        self.bridge_seed = int(attrs['bridge_seed'])
+        self.reconstruction = attrs['reconstruction']
+        self._num_steps = int(attrs['num_steps'])
+
+    @property
+    def name(self):
+        return self._node.name
+
+    @property
+    def attrs(self):
+        return self._node.attrs
+
+    @property
+    def _v_attrs(self):
+        return self._node._v_attrs
+
+    @property
+    def shape(self):
+        return self._node.shape[:-1] + (self._num_steps,)
+
+    @property
+    def dtype(self):
+        return np.dtype('float32')
+
+    @property
+    def chunkshape(self):
+        chunkshape = self._node.chunkshape
+        return chunkshape[:-1] + (chunkshape[-1] * self.stride,)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def set_attr(self, name, value):
+        self._node.set_attr(name, value)
+
+    def __array__(self, dtype=None):
+        return self[:].astype(dtype, copy=False)
+
+    def append(self, position):
+        """Append a block of positions with shape (particles, coords, steps).
+        """
+        position = np.asarray(position)
+        num_steps = position.shape[-1]
+        first = -self._num_steps % self.stride
+        position = position[..., first::self.stride]
+        if self.quantization is not None:
+            origin = self.origin[:, np.newaxis]
+            position = np.rint((position - origin) / self.quantum)
+            info = np.iinfo(self.quantization)
+            if position.size > 0 and (position.min() < info.min or
+                                      position.max() > info.max):
+                raise ValueError('Positions out of the %s range (quantum %g m)'
+                                 % (self.quantization, self.quantum))
+        self._node.append(position.astype(self._node.atom.dtype))
+        self._num_steps += num_steps
+        self._node.attrs['num_steps'] = self._num_steps
+
+    def _read_stored(self, key0, key1, start, stop):
+        """Read and dequantize the stored steps [start:stop]."""
+        stored = self._node[key0, key1, start:stop]
+        if self.quantization is None:
+            return stored.astype('float64')
+        origin = self.origin[key1]
+        if np.ndim(origin) > 0:
+            origin = origin[:, np.newaxis]
+        return stored * self.quantum + origin
+
+    def _bridge_increments(self, key0, key1, j0, j1):
+        """Brownian motion increments for the stored intervals [j0:j1].
+
+        Returns an array with shape (..., j1 - j0, stride).
+        """
+        chunk = self._node.chunkshape[-1]
+        num_particles, num_coords = self._node.shape[:2]
+        block_start, block_stop = j0 // chunk, (j1 - 1) // chunk + 1
+        increments = []
+        for block in range(block_start, block_stop):
+            rs = np.random.RandomState((self.bridge_seed, block))
+            increments.append(rs.standard_normal(
+                (num_particles, num_coords, chunk, self.stride)))
+        offset = block_start * chunk
+        increments = np.concatenate(increments, axis=2)[
+            :, :, j0 - offset:j1 - offset][key0, key1]
+        sigma = np.asarray(self.step_sigma[key0])
+        sigma = sigma.reshape(sigma.shape + (1,) * (increments.ndim -
+                                                    sigma.ndim))
+        return increments * sigma
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (4 - len(key)) + key[i + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+        key0, key1, tkey = key
+        if isinstance(tkey, slice):
+            start, stop, step = tkey.indices(self._num_steps)
+        else:
+            start = range(self._num_steps)[tkey]
+            stop, step = start + 1, 1
+        if stop <= start:
+            return self._node[key0, key1, 0:0].astype('float32')
+        k = self.stride
+        nstored = self._node.shape[-1]
+        j0 = start // k
+        j1 = min((stop - 1) // k + 2, nstored)
+        pos = self._read_stored(key0, key1, j0, j1)
+        if k > 1:
+            pos = self._reconstruct(pos, key0, key1, j0, j1)
+        pos = pos[..., start - j0 * k:stop - j0 * k:step]
+        if not isinstance(tkey, slice):
+            pos = pos[..., 0]
+        return pos.astype('float32')
+
+    def _reconstruct(self, stored, key0, key1, j0, j1):
+        """Return the positions of all the steps from step `j0 * stride`
+        to the end of the stored interval `j1 - 1`."""
+        k = self.stride
+        period = self.period[key1]
+        origin = self.origin[key1]
+        if np.ndim(period) > 0:
+            period = period[:, np.newaxis]
+            origin = origin[:, np.newaxis]
+        # Coordinates with period 0 (e.g. radial) are not periodic
+        is_periodic = (period > 0) & (self.boundary == 'periodic')
+        period_safe = np.where(period > 0, period, 1)
+        delta = np.diff(stored, axis=-1)
+        # Minimum image convention for periodic boundaries
+        delta -= np.rint(delta / period_safe) * period * is_periodic
+
+        # Interpolation between the stored steps. The last stored step is
+        # followed by the steps beyond it (up to a full stride).
+        frac = np.arange(k) / k
+        pos = stored[..., :, np.newaxis] + np.zeros(k)
+        pos[..., :-1, :] += delta[..., :, np.newaxis] * frac
+        if self.reconstruction == 'bridge':
+            increments = self._bridge_increments(key0, key1, j0, j1)
+            cumulated = np.cumsum(increments, axis=-1)
+            walk = cumulated - increments    # starts from 0 at stored steps
+            # Pin the walk to 0 at the end of each interval
+            walk[..., :-1, :] -= cumulated[..., :-1, -1:] * frac
+            pos += walk
+        pos = pos.reshape(pos.shape[:-2] + (-1,))
+        pos = pos[..., :min(pos.shape[-1], self._num_steps - j0 * k)]
+
+        if self.boundary == 'periodic':
+            folded = np.mod(pos - origin, period_safe) + origin
+            pos = np.where(is_periodic, folded, pos)
+        elif self.boundary == 'mirror':
+            upper = origin + period
+            pos = np.where((period > 0) & (pos > upper), 2 * upper - pos, pos)
+            pos = np.where(pos < origin, 2 * origin - pos, pos)
+        return pos
+
+
+class LRUCache:
+    """A dict-like cache keeping the `maxsize` most recently used items."""
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def clear(self):
+        self._data.clear()
+
+    def get_or_compute(self, key, func):
+        """Return the item `key`, computing it with `func()` if missing."""
+        if key in self._data:
+            self._data.move_to_end(key)
+            return self._data[key]
+        value = func()
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return value
+
+
+class VirtualArray:
+    """Read-only array computed on demand, chunk by chunk, along time.
+
+    The last axis of the array is time, divided in chunks of `chunksize`
+    elements (the last chunk may be shorter). Reading a slice calls
+    `get_chunk(i_chunk)` for each chunk overlapping the slice, which
+    returns the full chunk (shape `shape[:-1] + (chunk_length,)`). Caching
+    of the computed chunks is delegated to `get_chunk`.
+
+    This class mimics the pytables array interface used for emission and
+    positions (slicing, `shape`, `chunkshape`, `attrs`).
+    """
+    def __init__(self, name, shape, chunksize, get_chunk, dtype='float32',
+                 attrs=None):
+        self.name = name
+        self.shape = tuple(shape)
+        self.chunksize = int(chunksize)
+        self.get_chunk = get_chunk
+        self.dtype = np.dtype(dtype)
+        self.attrs = {} if attrs is None else attrs
+
+    @property
+    def chunkshape(self):
+        return self.shape[:-1] + (self.chunksize,)
+
+    @property
+    def nrows(self):
+        return self.shape[-1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return self[...].astype(dtype, copy=False)
+
+    def read(self, start=None, stop=None):
+        return self[..., start:stop]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ndim = len(self.shape)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = (key[:i] + (slice(None),) * (ndim + 1 - len(key)) +
+                   key[i + 1:])
+        key = key + (slice(None),) * (ndim - len(key))
+        lead_key, tkey = key[:-1], key[-1]
+        if isinstance(tkey, slice):
+            start, stop, step = tkey.indices(self.shape[-1])
+        else:
+            start = range(self.shape[-1])[tkey]
+            stop, step = start + 1, 1
+        c_start = start // self.chunksize
+        c_stop = max((stop - 1) // self.chunksize + 1, c_start + 1)
+        chunks = [self.get_chunk(i)[lead_key + (Ellipsis,)]
+                  for i in range(c_start, min(c_stop,
+                                              self._num_chunks()))]
+        if len(chunks) == 0:
+            data = np.zeros(self.shape[:-1] + (0,),
+                            dtype=self.dtype)[lead_key + (Ellipsis,)]
+        else:
+            data = np.concatenate(chunks, axis=-1)
+        offset = c_start * self.chunksize
+        data = data[..., start - offset:max(stop - offset, 0):step]
+        if not isinstance(tkey, slice):
+            data = data[..., 0]
+        return data.astype(self.dtype, copy=False)
+
+    def _num_chunks(self):
+        return -(-self.shape[-1] // self.chunksize)
+
+
 class BaseStore(object):
 
     @staticmethod
-    def calc_chunkshape(chunksize, shape, kind='bytes'):
+    def calc_chunkshape(chunksize, shape, kind='bytes', layout='time-major'):
+        """Return the (integer) chunk shape of an array of shape `shape`.
+
+        The last dimension of `shape` is the time axis and, for 2-D and
+        3-D arrays, the first dimension is the particles axis.
+
+        Arguments:
+            chunksize (int or None): if `kind` is 'times', the chunk size
+                along the time axis. If 'bytes', the number of elements in
+                a chunk. If None, return None (automatic chunk shape).
+            shape (tuple): shape of the array.
+            kind (string): 'times' or 'bytes', see `chunksize`.
+            layout (string): one of `chunk_layouts`, the number of
+                particles in a chunk (see :func:`particles_per_chunk`).
+        """
         assert kind in ['times', 'bytes']
         if chunksize is None:
             return None
+        if layout not in chunk_layouts:
+            raise ValueError('Unknown chunk layout "%s", valid layouts are: '
+                             '%s.' % (layout, ', '.join(chunk_layouts)))
 
+        leading = tuple(int(dimsize) for dimsize in shape[:-1])
+        if len(leading) > 0:
+            leading = ((particles_per_chunk(layout, leading[0]),) +
+                       leading[1:])
         divisor = 1
         if kind == 'bytes':
-            for dimsize in shape[:-1]:
+            for dimsize in leading:
                 divisor *= dimsize
-
-        if len(shape) == 1:
-            chunkshape = (chunksize / divisor,)
-        elif len(shape) == 2:
-            chunkshape = (shape[0], chunksize / divisor)
-        elif len(shape) == 3:
-            chunkshape = (shape[0], shape[1], chunksize / divisor)
-        return chunkshape
+        time_size = int(chunksize) // divisor
+        if time_size < 1 or (kind == 'times' and time_size != chunksize):
+            msg = ('Invalid chunksize %r for shape %r (chunk length along '
+                   'time must be a positive integer).' % (chunksize, shape))
+            raise ValueError(msg)
+        return leading + (time_size,)
 
     def __init__(self, datafile, path='./', nparams=None, attr_params=None,
-                 mode='r'):
+                 mode='r', compression=None, chunk_cache=None):
         """Return a new HDF5 file to store simulation results.
 
         The HDF5 file has two groups:
@@ -62,7 +813,16 @@ class BaseStore(object):
             containing all the simulation numeric-parameters
 
         If `mode='w'`, `datafile` will be overwritten (if exists).
+        `compression` is a dict of compression profiles (see
+        `compression_profiles`) overriding the default ones, per array kind.
+        `chunk_cache` is a dict of PyTables chunk-cache parameters
+        (e.g. `CHUNK_CACHE_SIZE`, `CHUNK_CACHE_NELMTS`) used to open the file.
         """
+        self.compression = {kind: dict(profile) for kind, profile
+                            in compression_profiles.items()}
+        if compression is not None:
+            for kind, profile in compression.items():
+                self.set_compression(kind, **profile)
         if nparams is None: nparams = {}
         if attr_params is None: attr_params = {}
         if isinstance(datafile, Path):
@@ -71,22 +831,118 @@ class BaseStore(object):
             if not Path(path).exists():
                 raise ValueError('Path "%s" does not exists.' % path)
             self.filepath = Path(path, datafile)
-        self.h5file = tables.open_file(str(self.filepath), mode=mode)
+        if chunk_cache is None: chunk_cache = {}
+        self.chunk_cache = chunk_cache
         self.filename = str(self.filepath)
+        self._open(mode)
         if mode == 'w':
-            self.h5file.title = "PyBroMo simulation file"
-
             # Create the groups
-            self.h5file.create_group('/', 'parameters', 'Simulation parameters')
+            self.create_group('parameters', 'Simulation parameters')
             # Set the simulation parameters
             self.set_sim_params(nparams, attr_params)
 
+    # Backend primitives: all the access to the underlying storage goes
+    # through the following methods. Other backends (see `dirstore`)
+    # override them.
+    backend = 'hdf5'
+    file_extension = '.hdf5'
+
+    # Catalog of the data folder updated when adding arrays (see `catalog`),
+    # set by the object creating the store
+    catalog = None
+
+    def _open(self, mode):
+        """Open the underlying storage (`self.filepath`)."""
+        self.h5file = tables.open_file(self.filename, mode=mode,
+                                       **self.chunk_cache)
+        if mode == 'w':
+            self.h5file.title = "PyBroMo simulation file"
+
     def close(self):
         self.h5file.close()
+        self._close_catalog()
+
+    def _close_catalog(self):
+        """Close the connection to the catalog of the data folder."""
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
+
+    def flush(self):
+        self.h5file.flush()
+
+    def create_group(self, name, title=''):
+        """Create the group `name` (in the root), if not existing."""
+        if name not in self.h5file.root:
+            self.h5file.create_group('/', name, title)
+        return self.get_group(name)
+
+    def get_group(self, name):
+        """Return the group `name` (in the root)."""
+        return self.h5file.get_node('/', name)
+
+    def _create_array(self, group, name, atom, shape, chunkshape=None,
+                      filters=None, title='', expectedrows=None):
+        """Create an extendable array `name` in `group`."""
+        kwargs = {} if expectedrows is None else dict(
+            expectedrows=expectedrows)
+        return self.h5file.create_earray('/' + group, name, atom=atom,
+                                         shape=shape, chunkshape=chunkshape,
+                                         filters=filters, title=title,
+                                         **kwargs)
+
+    def _create_table(self, group, name, dtype, title='',
+                      index_columns=()):
+        """Create an (empty) table `name` in `group` with rows of `dtype`.
+
+        The columns in `index_columns` are indexed to speed up queries.
+        """
+        table = self.h5file.create_table('/' + group, name, np.dtype(dtype),
+                                         title=title,
+                                         filters=default_compression)
+        for column in index_columns:
+            table.colinstances[column].create_index()
+        return table
+
+    def _get_array(self, group, name):
+        """Return the array `name` in `group` (raise NoSuchNodeError)."""
+        return self.h5file.get_node('/' + group, name)
+
+    def _has_array(self, group, name):
+        return name in self.get_group(group)
+
+    def _remove_array(self, group, name):
+        self.h5file.remove_node('/' + group, name)
+
+    def get_param_attr(self, name):
+        """Return the attribute `name` of the '/parameters' group."""
+        return self.h5file.get_node_attr('/parameters', name)
+
+    def set_compression(self, kind, **profile):
+        """Set the compression profile for arrays of type `kind`.
+
+        Arguments:
+            kind (string): the kind of array, a key in `compression_profiles`.
+            profile: keyword arguments of `tables.Filters` (complib,
+                complevel, shuffle, bitshuffle) and `nthreads`.
+
+        The profile is used for the arrays created afterwards.
+        """
+        if kind not in compression_profiles:
+            raise ValueError('Unknown array kind "%s", valid kinds are: %s.' %
+                             (kind, ', '.join(compression_profiles)))
+        make_filters(dict(profile, nthreads=None))  # validate the arguments
+        self.compression[kind] = dict(profile)
+
+    def filters(self, kind):
+        """Return the `tables.Filters` for arrays of type `kind`."""
+        return make_filters(self.compression[kind])
 
     def open(self):
         """Reopen a file after has been closed (uses the store filename)."""
-        self.__init__(self.h5file.filename, mode='r')
+        self.__init__(self.filepath, mode='r',
+                      compression=self.compression,
+                      chunk_cache=self.chunk_cache)
 
     def set_sim_params(self, nparams, attr_params):
         """Store parameters in `params` in `h5file.root.parameters`.
@@ -106,6 +962,9 @@ class BaseStore(object):
         """
         for name, value in nparams.items():
             val = value[0] if value[0] is not None else 'none'
+            if name in self.h5file.root.parameters:
+                # Update a parameter (e.g. `t_max` of an extended file)
+                self.h5file.remove_node('/parameters', name)
             self.h5file.create_array('/parameters', name, obj=val,
                                      title=value[1])
         for name, value in attr_params.items():
@@ -136,7 +995,8 @@ class TrajectoryStore(BaseStore):
     """An on-disk HDF5 store for trajectories.
     """
     def __init__(self, datafile, path='./', nparams=None, attr_params=None,
-                 mode='r'):
+                 mode='r', compression=None, layout='time-major',
+                 chunk_cache=None):
         """Return a new HDF5 file to store simulation results.
 
         The HDF5 file has two groups:
@@ -147,38 +1007,72 @@ class TrajectoryStore(BaseStore):
             containing simulation trajectories (positions, emission traces)
 
         If `mode='w'`, `datafile` will be overwritten (if exists).
+        `layout` (one of `chunk_layouts`) is the chunk layout of the new
+        trajectory arrays. When reading, if `chunk_cache` is None, the chunk
+        cache is tuned for the layout of the `emission` array in the file.
         """
         super().__init__(datafile, path=path, nparams=nparams,
-                         attr_params=attr_params, mode=mode)
+                         attr_params=attr_params, mode=mode,
+                         compression=compression, chunk_cache=chunk_cache)
+        self.layout = layout
         if mode != 'r':
             # Create the groups
-            self.h5file.create_group('/', 'trajectories',
-                                     'Simulated trajectories')
-            self.h5file.create_group('/', 'psf', 'PSFs used in the simulation')
+            self.create_group('trajectories', 'Simulated trajectories')
+            self.create_group('psf', 'PSFs used in the simulation')
+        elif chunk_cache is None:
+            self._tune_chunk_cache()
+
+    def _tune_chunk_cache(self):
+        """Reopen the file with a chunk cache tuned for the stored layout."""
+        traj_group = self.h5file.root.trajectories
+        if 'emission' not in traj_group:
+            return
+        emission = traj_group.emission
+        self.layout = getattr(emission.attrs, 'layout', 'time-major')
+        chunk_nbytes = max(np.prod(array.chunkshape) * array.atom.itemsize
+                           for array in traj_group
+                           if isinstance(array, tables.EArray))
+        chunk_cache = chunk_cache_params(self.layout, emission.shape[0],
+                                         chunk_nbytes)
+        if any(self.h5file.params[key] != value
+               for key, value in chunk_cache.items()):
+            self.h5file.close()
+            self.chunk_cache = chunk_cache
+            self.h5file = tables.open_file(self.filename, mode='r',
+                                           **chunk_cache)
 
     def add_trajectory(self, name, overwrite=False, shape=(0,), title='',
                        chunksize=2**19, chunkslice='bytes',
-                       comp_filter=default_compression,
-                       atom=tables.Float64Atom(), params=None):
+                       comp_filter=None,
+                       atom=tables.Float64Atom(), params=None, layout=None):
         """Add an trajectory array in '/trajectories'.
+
+        If `comp_filter` is None, use the store compression profile for
+        `name` (or `default_compression` when there is none).
+        If `layout` is None, use the store chunk layout (`self.layout`).
         """
+        if layout is None:
+            layout = self.layout
         if params is None: params = {}
-        group = self.h5file.root.trajectories
-        if name in group:
+        if comp_filter is None:
+            comp_filter = (self.filters(name) if name in self.compression
+                           else default_compression)
+        if self._has_array('trajectories', name):
             print("%s already exists ..." % name, end='')
             if overwrite:
-                self.h5file.remove_node(group, name)
+                self._remove_array('trajectories', name)
                 print(" deleted.")
             else:
                 print(" old returned.")
-                return group.get_node(name)
+                return self._get_array('trajectories', name)
 
         nparams = self.numeric_params
         num_t_steps = nparams['t_max'] / nparams['t_step']
 
-        chunkshape = self.calc_chunkshape(chunksize, shape, kind=chunkslice)
-        store_array = self.h5file.create_earray(
-            group, name, atom=atom,
+        chunkshape = self.calc_chunkshape(chunksize, shape, kind=chunkslice,
+                                          layout=layout)
+        store_array = self._create_array(
+            'trajectories', name, atom=atom,
             shape = shape,
             chunkshape = chunkshape,
             expectedrows = num_t_steps,
@@ -188,12 +1082,14 @@ class TrajectoryStore(BaseStore):
         # Set the array parameters/attributes
         for key, value in params.items():
             store_array.set_attr(key, value)
+        if len(shape) > 1:
+            store_array.set_attr('layout', layout)
         store_array.set_attr('PyBroMo', __version__)
         store_array.set_attr('creation_time', current_time())
         return store_array
 
     def add_emission_tot(self, chunksize=2**19, chunkslice='bytes',
-                         comp_filter=default_compression,
+                         comp_filter=None,
                          overwrite=False, params=None):
         """Add the `emission_tot` array in '/trajectories'.
         """
@@ -204,43 +1100,446 @@ class TrajectoryStore(BaseStore):
         return self.add_trajectory('emission_tot', **kwargs)
 
     def add_emission(self, chunksize=2**19, chunkslice='bytes',
-                     comp_filter=default_compression,
-                     overwrite=False, params=None):
+                     comp_filter=None,
+                     overwrite=False, params=None, layout=None,
+                     name='emission', quantization=None, min_value=None):
         """Add the `emission` array in '/trajectories'.
+
+        A copy of the emission with a different chunk `layout` can be
+        added with a different `name` (e.g. 'emission_pm').
+
+        If `quantization` is 'uint16' or 'uint8log' the emission is stored
+        as fixed-point integers and a :class:`QuantizedEmission` is
+        returned. `min_value` is the smallest non-zero emission stored
+        with 'uint8log' (default 1e-6).
         """
         num_particles = self.numeric_params['np']
-        return self.add_trajectory('emission', shape=(num_particles, 0),
-                                   overwrite=overwrite, chunksize=chunksize,
-                                   chunkslice=chunkslice,
-                                   comp_filter=comp_filter,
-                                   atom=tables.Float32Atom(),
-                                   title='Emission trace of each particle',
-                                   params=params)
+        if comp_filter is None:
+            comp_filter = self.filters('emission')
+        atom = tables.Float32Atom()
+        if quantization is not None:
+            if quantization not in emission_quantizations:
+                msg = ('Unknown quantization "%s", valid values are: %s.' %
+                       (quantization, ', '.join(emission_quantizations)))
+                raise ValueError(msg)
+            atom = emission_quantizations[quantization][0]
+            scale, offset = QuantizedEmission.quantization_params(
+                quantization, min_value)
+            params = dict(params or {}, quantization=quantization,
+                          scale=scale, offset=offset)
+        emission = self.add_trajectory(name, shape=(num_particles, 0),
+                                       overwrite=overwrite,
+                                       chunksize=chunksize,
+                                       chunkslice=chunkslice,
+                                       comp_filter=comp_filter,
+                                       atom=atom,
+                                       title='Emission trace of each particle',
+                                       params=params, layout=layout)
+        return self.get_emission(emission.name)
+
+    def add_emission_pop(self, populations, chunksize=2**19,
+                         chunkslice='bytes', comp_filter=None,
+                         overwrite=False, layout=None):
+        """Add the `emission_pop` array in '/trajectories'.
+
+        The array contains one row for each population with the emission
+        summed over the particles of the population. `populations` is a
+        list of slices of the particles, saved in the 'populations'
+        attribute as an array of (start, stop) rows.
+        """
+        if comp_filter is None:
+            comp_filter = self.filters('emission')
+        pop_bounds = np.array([(pop.start, pop.stop) for pop in populations],
+                              dtype='int64')
+        return self.add_trajectory(
+            'emission_pop', shape=(len(populations), 0), overwrite=overwrite,
+            chunksize=chunksize, chunkslice=chunkslice,
+            comp_filter=comp_filter, atom=tables.Float32Atom(),
+            title='Emission trace summed over each population',
+            params=dict(populations=pop_bounds), layout=layout)
+
+    def get_populations(self):
+        """Return the populations of the `emission_pop` array (slices)."""
+        node = self._get_array('trajectories', 'emission_pop')
+        return [slice(int(start), int(stop))
+                for start, stop in node.attrs['populations']]
+
+    # Zone map: for each simulated time chunk, the index of the first time
+    # step and the maximum and integral of the emission of each row of the
+    # emission array (particles or populations). Used to skip the rows
+    # with negligible emission when simulating timestamps.
+
+    def add_zone_map(self, num_rows):
+        """Add the zone map arrays in the '/zone_map' group.
+
+        Arguments:
+            num_rows (int): number of rows of the emission array.
+        """
+        self.create_group('zone_map', 'Emission summary of each time chunk')
+        for name in ('start', 'max', 'integral'):
+            if self._has_array('zone_map', name):
+                self._remove_array('zone_map', name)
+        self._create_array('zone_map', 'start', atom=tables.Int64Atom(),
+                           shape=(0,), title='First time step of each chunk')
+        self._create_array('zone_map', 'max', atom=tables.Float32Atom(),
+                           shape=(0, num_rows),
+                           title='Maximum emission of each row in each chunk')
+        self._create_array('zone_map', 'integral', atom=tables.Float32Atom(),
+                           shape=(0, num_rows),
+                           title='Summed emission of each row in each chunk')
+
+    def append_zone_map(self, i_start, emission):
+        """Append the zone map of the chunk `emission` starting at `i_start`.
+        """
+        self._get_array('zone_map', 'start').append(
+            np.array([i_start], dtype='int64'))
+        self._get_array('zone_map', 'max').append(
+            emission.max(axis=1)[np.newaxis].astype('float32'))
+        self._get_array('zone_map', 'integral').append(
+            emission.sum(axis=1, dtype='float64')[np.newaxis]
+            .astype('float32'))
+
+    def get_zone_map(self):
+        """Return the zone map or None if the file has none.
+
+        Returns:
+            A tuple (start, max, integral) where `start` is the first time
+            step of each chunk and `max` and `integral` are 2D arrays
+            (num_chunks x num_rows) with the maximum and the sum (over the
+            time steps of the chunk) of the normalized emission of each row.
+            The expected number of photons of a row in a chunk is
+            `integral * max_rate * t_step`.
+        """
+        try:
+            start = self._get_array('zone_map', 'start')
+        except tables.NoSuchNodeError:
+            return None
+        return (start.read(), self._get_array('zone_map', 'max').read(),
+                self._get_array('zone_map', 'integral').read())
+
+    def add_transits(self, threshold):
+        """Add the (empty) `transits` table in '/trajectories'.
+
+        Each row is a transit of a particle through the observation volume,
+        i.e. an interval of time steps where its emission is >= `threshold`
+        (see :class:`transits.TransitTracker`).
+        """
+        if self._has_array('trajectories', 'transits'):
+            self._remove_array('trajectories', 'transits')
+        table = self._create_table(
+            'trajectories', 'transits', transit_dtype,
+            title='Transits of the particles through the observation volume',
+            index_columns=('particle', 'start'))
+        table.set_attr('threshold', threshold)
+        table.set_attr('PyBroMo', __version__)
+        table.set_attr('creation_time', current_time())
+        return table
+
+    def _transits_table(self):
+        """Return the `transits` table (None if missing)."""
+        if not self._has_array('trajectories', 'transits'):
+            return None
+        return self._get_array('trajectories', 'transits')
+
+    def append_transits(self, transits):
+        """Append the `transits` (`transits.transit_dtype` array)."""
+        self._transits_table().append(transits)
+
+    def get_transits(self, condition=None, condvars=None):
+        """Return the stored transits matching `condition` (all if None).
+
+        `condition` is a PyTables condition on the columns of the
+        `transits` table (e.g. 'start < 1000') and `condvars` the dict of
+        the variables used in the condition. Returns None if the file has
+        no transits table.
+        """
+        table = self._transits_table()
+        if table is None:
+            return None
+        if condition is None:
+            return table.read()
+        return table.read_where(condition, condvars)
+
+    def add_checkpoints(self, overwrite=False):
+        """Add the `checkpoints` table in '/trajectories'.
+
+        Each row contains the state of the simulation at the beginning of
+        a time chunk: index of the first time step (`i_start`), number of
+        time steps (`size`), particles positions (`position`) and random
+        state (`rs_key`, `rs_pos`, `rs_has_gauss`, `rs_cached_gaussian`).
+        These are enough to regenerate the trajectories of the chunk.
+        """
+        if self._has_array('trajectories', 'checkpoints'):
+            if not overwrite:
+                return self._get_array('trajectories', 'checkpoints')
+            self._remove_array('trajectories', 'checkpoints')
+        table = self._create_table(
+            'trajectories', 'checkpoints',
+            checkpoint_dtype(self.numeric_params['np']),
+            title='Positions and random state at the start of each chunk')
+        table.set_attr('PyBroMo', __version__)
+        table.set_attr('creation_time', current_time())
+        return table
+
+    def append_checkpoint(self, i_start, size, position, rs):
+        """Append a checkpoint row (see :meth:`add_checkpoints`)."""
+        table = self._get_array('trajectories', 'checkpoints')
+        _, key, pos, has_gauss, cached_gaussian = rs.get_state()
+        table.append([(i_start, size, position, key, pos, has_gauss,
+                       cached_gaussian)])
+
+    def get_checkpoint(self, i_chunk):
+        """Return (i_start, size, position, rs) for the chunk `i_chunk`."""
+        row = self._get_array('trajectories', 'checkpoints')[i_chunk]
+        rs = np.random.RandomState()
+        rs.set_state(('MT19937', row['rs_key'], int(row['rs_pos']),
+                      int(row['rs_has_gauss']),
+                      float(row['rs_cached_gaussian'])))
+        return (int(row['i_start']), int(row['size']),
+                row['position'].copy(), rs)
+
+    def save_psf(self, psf):
+        """Save `psf` in the '/psf' group and link it as 'default_psf'.
+
+        Returns the stored PSF array.
+        """
+        psf_array = psf.to_hdf5(self.h5file, '/psf')
+        self.h5file.create_hard_link('/psf', 'default_psf', target=psf_array)
+        return psf_array
+
+    def get_psf_array(self):
+        """Return the array of the PSF used in the simulation."""
+        return self.h5file.get_node('/psf/default_psf')
+
+    def get_emission(self, name='emission'):
+        """Return the emission array `name` (dequantized if quantized)."""
+        node = self._get_array('trajectories', name)
+        if 'quantization' in node.attrs:
+            return QuantizedEmission(node)
+        return node
 
     def add_position(self, radial=False, chunksize=2**19, chunkslice='bytes',
-                     comp_filter=default_compression, overwrite=False,
-                     params=None):
+                     comp_filter=None, overwrite=False,
+                     params=None, layout=None, quantization=None,
+                     quantum=1e-9, stride=1, boundary='periodic',
+                     step_sigma=None, reconstruction='linear', bridge_seed=0):
         """Add the `position` array in '/trajectories'.
+
+        If `quantization` is 'int16' or 'int32', or `stride` > 1, the
+        positions are stored in compact form and a :class:`CompactPositions`
+        is returned.
+
+        Arguments:
+            quantization (string or None): store coordinates as integer
+                multiples of `quantum` (meters) relative to the box origin
+                (for radial positions R is relative to 0).
+            stride (int): store only one every `stride` time steps.
+            boundary (string): boundary conditions of the simulation
+                ('periodic' or 'mirror'), used to reconstruct the positions
+                between stored steps.
+            step_sigma (array or None): standard deviation (meters) of the
+                1D displacement in a time step, for each particle. Needed
+                by the 'bridge' reconstruction.
+            reconstruction (string): default reconstruction of the steps
+                between stored steps, 'linear' or 'bridge'.
+            bridge_seed (int): seed of the Brownian bridge random numbers.
         """
         num_particles = self.numeric_params['np']
         name, ncoords, prefix = 'position', 3, 'X-Y-Z'
         if radial:
             name, ncoords, prefix = 'position_rz', 2, 'R-Z'
         title = '%s position trace of each particle' % prefix
-        return self.add_trajectory(name, shape=(num_particles, ncoords, 0),
-                                   overwrite=overwrite, chunksize=chunksize,
-                                   chunkslice=chunkslice,
-                                   comp_filter=comp_filter,
-                                   atom=tables.Float32Atom(),
-                                   title=title,
-                                   params=params)
+        if comp_filter is None:
+            comp_filter = self.filters('position')
+        compact = quantization is not None or stride > 1
+        atom = tables.Float32Atom()
+        if compact:
+            params = dict(params or {}, **self._compact_position_params(
+                radial, quantization, quantum, stride, boundary, step_sigma,
+                reconstruction, bridge_seed))
+            if quantization is not None:
+                atom = tables.Atom.from_dtype(np.dtype(quantization))
+        position = self.add_trajectory(name,
+                                       shape=(num_particles, ncoords, 0),
+                                       overwrite=overwrite,
+                                       chunksize=chunksize,
+                                       chunkslice=chunkslice,
+                                       comp_filter=comp_filter,
+                                       atom=atom,
+                                       title=title,
+                                       params=params, layout=layout)
+        return self.get_position(position.name)
+
+    def _compact_position_params(self, radial, quantization, quantum, stride,
+                                 boundary, step_sigma, reconstruction,
+                                 bridge_seed):
+        """Return the attributes of a compact position array."""
+        if quantization not in (None,) + position_quantizations:
+            raise ValueError('Unknown quantization "%s", valid values are: '
+                             '%s.' % (quantization,
+                                      ', '.join(position_quantizations)))
+        assert boundary in ('periodic', 'mirror')
+        assert reconstruction in ('linear', 'bridge')
+        box = self.get_param_attr('box')
+        if radial:
+            origin = np.array([0, box.z1])
+            period = np.array([0, box.z2 - box.z1])
+            extent = np.array([np.hypot(np.abs(box.b[0]).max(),
+                                        np.abs(box.b[1]).max()), period[1]])
+        else:
+            origin = box.b[:, 0].copy()
+            period = box.b[:, 1] - box.b[:, 0]
+            extent = period
+        if quantization is not None:
+            if (extent / quantum).max() > np.iinfo(quantization).max:
+                msg = ('A quantum of %g m is too small for storing the box '
+                       'positions as %s.' % (quantum, quantization))
+                raise ValueError(msg)
+        num_particles = self.numeric_params['np']
+        if step_sigma is None:
+            step_sigma = np.zeros(num_particles)
+        return dict(stride=int(stride), quantization=quantization,
+                    quantum=quantum, origin=origin, period=period,
+                    boundary=boundary, step_sigma=np.asarray(step_sigma),
+                    reconstruction=reconstruction, bridge_seed=bridge_seed,
+                    num_steps=0)
+
+    def get_position(self, name='position'):
+        """Return the position array `name` (as :class:`CompactPositions`
+        if stored in compact form)."""
+        node = self._get_array('trajectories', name)
+        if 'stride' in node.attrs:
+            return CompactPositions(node)
+        return node
+
+
+    # Committed-length protocol. The writer appends a time chunk to all the
+    # trajectory arrays, flushes the file and then commits the new length
+    # in the '/trajectories' attributes. A HDF5 file cannot be read safely
+    # while it is written (PyTables has no SWMR support), therefore only
+    # the directory backend supports reading committed steps while the
+    # simulation runs (see `dirstore.DirectoryTrajectoryStore`).
+
+    def commit(self, num_steps, complete=False):
+        """Mark the first `num_steps` time steps as safe to read.
+
+        Arguments:
+            num_steps (int): number of time steps written in all the
+                trajectory arrays.
+            complete (bool): if True, the simulation is finished and no
+                more time steps will be written.
+        """
+        self.flush()
+        attrs = self.get_group('trajectories')._v_attrs
+        attrs['committed_steps'] = int(num_steps)
+        attrs['complete'] = complete
+        self.flush()
+
+    def committed(self):
+        """Return the number of committed time steps and the `complete` flag.
+
+        For files written without commits, the number of committed steps
+        is None (i.e. the whole arrays) and `complete` is True.
+        """
+        attrs = self.get_group('trajectories')._v_attrs
+        if 'committed_steps' in attrs:
+            return attrs['committed_steps'], attrs['complete']
+        return None, True
+
+
+class CommittedArray:
+    """A trajectory array read while another process is writing it.
+
+    Slicing an array blocks until the requested time steps (last axis) are
+    committed by the writer (see :meth:`TrajectoryStore.commit`). The
+    shape is the final shape of the array, i.e. with `num_steps` time steps.
+
+    This class mimics the pytables array interface used for trajectories
+    (slicing, `read`, `shape`, `chunkshape`, `attrs`).
+    """
+    def __init__(self, store, name, num_steps, poll_interval=1.,
+                 timeout=None):
+        """
+        Arguments:
+            store (DirectoryTrajectoryStore): the store opened in read
+                mode.
+            name (string): name of the array in '/trajectories'.
+            num_steps (int): the final number of time steps of the array.
+            poll_interval, timeout (float): see
+                :meth:`dirstore.DirectoryTrajectoryStore.wait_committed`.
+        """
+        self.store = store
+        self.name = name
+        self.num_steps = int(num_steps)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def _array(self):
+        if self.name.startswith('position'):
+            return self.store.get_position(self.name)
+        return self.store.get_emission(self.name)
+
+    @property
+    def attrs(self):
+        return self._array().attrs
+
+    @property
+    def _v_attrs(self):
+        return self.attrs
+
+    @property
+    def shape(self):
+        return self._array().shape[:-1] + (self.num_steps,)
+
+    @property
+    def dtype(self):
+        return self._array().dtype
+
+    @property
+    def chunkshape(self):
+        return self._array().chunkshape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[...], dtype=dtype)
+
+    def read(self, start=None, stop=None):
+        return self[..., start:stop]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ndim = len(self.shape)
+        if Ellipsis in key:
+            time_key = key[-1] if key[-1] is not Ellipsis else slice(None)
+        elif len(key) == ndim:
+            time_key = key[-1]
+        else:
+            time_key = slice(None)
+        if isinstance(time_key, slice):
+            start, stop, step = time_key.indices(self.num_steps)
+            stop = max(start, stop) if step > 0 else start + 1
+        else:
+            stop = range(self.num_steps)[time_key] + 1
+        self.store.wait_committed(stop, poll_interval=self.poll_interval,
+                                  timeout=self.timeout)
+        return self._array()[key]
 
 
 class TimestampStore(BaseStore):
     """An on-disk HDF5 store for timestamps.
     """
+    # Suffixes of the per-photon arrays stored along each timestamps array
+    photon_array_suffixes = ('_par', '_pos', '_state', '_nanotimes', '_exc')
+    # Suffixes of the auxiliary arrays of delta-encoded timestamps
+    encoding_suffixes = ('_esc', '_anchors')
+    # Encoding of new timestamps arrays: 'int64' or 'delta'
+    timestamps_encoding = 'int64'
+
     def __init__(self, datafile, path='./', nparams=None, attr_params=None,
-                 mode='r'):
+                 mode='r', compression=None):
         """Return a new HDF5 file to store simulation results.
 
         The HDF5 file has two groups:
@@ -253,64 +1552,457 @@ class TimestampStore(BaseStore):
         If `overwrite=True` (default) `datafile` is overwritten (if exists).
         """
         super().__init__(datafile, path=path, nparams=nparams,
-                         attr_params=attr_params, mode=mode)
+                         attr_params=attr_params, mode=mode,
+                         compression=compression)
         if mode != 'r':
-            if 'timestamps' not in self.h5file.root:
-                self.h5file.create_group('/', 'timestamps',
-                                         'Simulated timestamps')
+            group = self.create_group('timestamps', 'Simulated timestamps')
+            # Files with arrays saved without index are not indexed
+            if (self._timestamps_index() is None and
+                    len(group._f_list_nodes()) == 0):
+                self._create_timestamps_index()
+
+    def _create_timestamps_index(self):
+        """Create the table indexing the timestamps arrays."""
+        table = self.h5file.create_table(
+            '/', 'timestamps_index', TimestampsIndexRow,
+            title='Parameters of the timestamps arrays')
+        for column in ('name', 'index_key', 'rs_hash'):
+            table.colinstances[column].create_index()
+        return table
+
+    def _timestamps_index(self):
+        """Return the table indexing the timestamps arrays (None if missing).
+        """
+        if 'timestamps_index' not in self.h5file.root:
+            return None
+        return self.h5file.root.timestamps_index
+
+    @property
+    def has_timestamps_index(self):
+        return self._timestamps_index() is not None
+
+    def _index_remove(self, name):
+        table = self._timestamps_index()
+        coords = table.get_where_list('name == value',
+                                      dict(value=name.encode()))
+        for coord in sorted(coords, reverse=True):
+            table.remove_row(coord)
+
+    def find_timestamps(self, index_key=None, rs_hash=None, condition=None,
+                        condvars=None):
+        """Return the names of the timestamps arrays matching the query.
+
+        The query uses the table indexing the timestamps arrays (see
+        :meth:`timestamps_info`).
+
+        Arguments:
+            index_key (string or None): if not None, the simulation
+                parameters (without random state) of the arrays.
+            rs_hash (string or None): if not None, the hash of the initial
+                random state, or its beginning.
+            condition (string or None): an additional PyTables condition
+                on the columns of the index, e.g. 'num_photons > 1000'.
+            condvars (dict or None): variables used in `condition`.
+
+        Returns:
+            List of names, in order of creation.
+        """
+        table = self._timestamps_index()
+        if table is None:
+            raise ValueError('The file has no timestamps index.')
+        conditions, condvars = [], dict(condvars or {})
+        if index_key is not None:
+            conditions.append('(index_key == _key)')
+            condvars['_key'] = index_key.encode()
+        if rs_hash is not None:
+            # Hashes are hex strings: the ones starting with `rs_hash` are
+            # between `rs_hash` and `rs_hash + 'g'` (index range scan)
+            conditions.append('(rs_hash >= _rs_lo) & (rs_hash < _rs_hi)')
+            condvars.update(_rs_lo=rs_hash.encode(),
+                            _rs_hi=(rs_hash + 'g').encode())
+        if condition is not None:
+            conditions.append('(%s)' % condition)
+        if len(conditions) == 0:
+            rows = table.read()
+        else:
+            rows = table.read_where(' & '.join(conditions), condvars)
+        return [name.decode() for name in rows['name']]
+
+    def timestamps_info(self, name):
+        """Return a dict with the parameters of the timestamps array `name`.
+
+        The keys are the columns of :class:`TimestampsIndexRow`.
+        """
+        table = self._timestamps_index()
+        rows = table.read_where('name == value', dict(value=name.encode()))
+        if len(rows) == 0:
+            raise ValueError('Timestamps "%s" not in the index.' % name)
+        info = {column: rows[column][0] for column in table.colnames}
+        for column in ('name', 'index_key', 'rs_hash'):
+            info[column] = info[column].decode()
+        for column in ('max_rates', 'populations', 'bg_rate'):
+            info[column] = json.loads(info[column].decode())
+        return info
+
+    def timestamps_complete(self, name):
+        """Return True if the simulation of the timestamps `name` completed.
+
+        Arrays saved without the `complete` attribute are complete.
+        """
+        attrs = self.get_timestamps(name).attrs
+        return bool(attrs['complete']) if 'complete' in attrs else True
+
+    def update_timestamps_info(self, name):
+        """Update the number of photons and time range of `name` in the index.
+
+        Called when the simulation of the timestamps array is completed:
+        marks the array as complete (see :meth:`timestamps_complete`).
+        Updates also the time index of the array (see
+        :meth:`update_time_index`).
+        """
+        self.update_time_index(name)
+        self.get_timestamps(name).set_attr('complete', True)
+        table = self._timestamps_index()
+        if table is None:
+            return
+        timestamps = self.get_timestamps(name)
+        num_photons = timestamps.shape[0]
+        t_start, t_stop = 0, 0
+        if num_photons > 0:
+            t_start = int(timestamps[0])
+            t_stop = int(timestamps[num_photons - 1])
+        coords = table.get_where_list('name == value',
+                                      dict(value=name.encode()))
+        for coord in coords:
+            row = table[coord]
+            row['num_photons'] = num_photons
+            row['t_start'], row['t_stop'] = t_start, t_stop
+            table[coord] = [row]
+        table.flush()
+
+    # Time index: for each chunk of `chunk_photons` photons of a timestamps
+    # array, the first timestamp and the number of photons of each particle.
+    # Only complete chunks are stored, the last partial chunk is computed
+    # when reading the index.
+
+    def update_time_index(self, name):
+        """Add to the time index of `name` the chunks appended since the
+        last update.
+
+        Only new complete chunks are read, therefore this method can be
+        called repeatedly while photons are appended.
+        For timestamps without particles array ('_par') only the first
+        timestamp of each chunk is stored.
+        """
+        timestamps = self.get_timestamps(name)
+        particles = self.get_photon_array(name, '_par')
+        self.create_group('time_index', 'Time index of the timestamps arrays')
+        counts = None
+        if self._has_array('time_index', name + '_first'):
+            first = self._get_array('time_index', name + '_first')
+            if particles is not None:
+                counts = self._get_array('time_index', name + '_counts')
+        else:
+            first = self._create_array(
+                'time_index', name + '_first', atom=tables.Int64Atom(),
+                shape=(0,), filters=self.filters('timestamps'),
+                title='First timestamp of each chunk')
+            first.set_attr('chunk_photons', timestamps.chunkshape[0])
+            if particles is not None:
+                num_counts = max(particles.attrs['num_particles'],
+                                 particles.attrs['bg_particle'] + 1)
+                counts = self._create_array(
+                    'time_index', name + '_counts', atom=tables.UInt32Atom(),
+                    shape=(0, num_counts), filters=self.filters('particles'),
+                    title='Number of photons of each particle in each chunk')
+        chunk_photons = first.attrs['chunk_photons']
+        num_chunks = timestamps.shape[0] // chunk_photons
+        first_new, counts_new = [], []
+        for i_chunk in range(first.shape[0], num_chunks):
+            i_start = i_chunk * chunk_photons
+            first_new.append(timestamps[i_start])
+            if counts is not None:
+                par_chunk = particles[i_start:i_start + chunk_photons]
+                counts_new.append(np.bincount(par_chunk,
+                                              minlength=counts.shape[1]))
+        if len(first_new) > 0:
+            first.append(np.array(first_new, dtype='int64'))
+            if counts is not None:
+                counts.append(np.array(counts_new, dtype='uint32'))
+
+    def get_time_index(self, name):
+        """Return the time index of the timestamps array `name`.
+
+        Returns:
+            A tuple (first, counts, chunk_photons) where `first` is
+            the array of the first timestamp of each chunk of
+            `chunk_photons` photons and `counts` is a 2D array
+            (num_chunks x num_particles + 1) with the number of photons
+            of each particle (last column is the background) per chunk.
+            The last chunk may be partial. `counts` is None for timestamps
+            without particles array.
+        """
+        first, chunk_photons = self._time_index_first(name)
+        particles = self.get_photon_array(name, '_par')
+        if particles is None:
+            return first, None, chunk_photons
+        counts = self._get_array('time_index', name + '_counts').read()
+        i_start = counts.shape[0] * chunk_photons
+        num_photons = self.get_timestamps(name).shape[0]
+        if num_photons > i_start:
+            tail = np.bincount(particles[i_start:num_photons],
+                               minlength=counts.shape[1])
+            counts = np.vstack([counts, tail.astype('uint32')])
+        return first, counts, chunk_photons
+
+    def _time_index_first(self, name):
+        """Return first timestamp of each chunk (including the partial one).
+        """
+        first_array = self._get_array('time_index', name + '_first')
+        chunk_photons = first_array.attrs['chunk_photons']
+        first = first_array.read()
+        i_start = first.shape[0] * chunk_photons
+        timestamps = self.get_timestamps(name)
+        if timestamps.shape[0] > i_start:
+            first = np.append(first, timestamps[i_start])
+        return first, chunk_photons
+
+    def get_timestamp_window(self, name, t_start, t_stop, suffixes=('_par',)):
+        """Return the photons with `t_start <= timestamp < t_stop`.
+
+        Only the chunks overlapping the time window are read, using the
+        time index of `name` (see :meth:`update_time_index`).
+
+        Arguments:
+            name (string): name of the timestamps array.
+            t_start, t_stop (int): the time window in timestamps units
+                (i.e. `clk_p`).
+            suffixes (tuple): suffixes of the per-photon arrays to return
+                (e.g. '_par', '_pos', '_nanotimes').
+
+        Returns:
+            A tuple with the timestamps in the window and then, for each
+            suffix, the per-photon array (None if missing).
+        """
+        first, chunk_photons = self._time_index_first(name)
+        timestamps = self.get_timestamps(name)
+        # The chunk before the first one starting at `t_start` can contain
+        # photons at `t_start` (e.g. duplicates across the boundary)
+        i_chunk_start = max(np.searchsorted(first, t_start, side='left') - 1,
+                            0)
+        i_chunk_stop = np.searchsorted(first, t_stop, side='left')
+        i_start = i_chunk_start * chunk_photons
+        i_stop = min(i_chunk_stop * chunk_photons, timestamps.shape[0])
+        ts = timestamps[i_start:i_stop]
+        # Select the window inside the chunks read
+        i_stop = i_start + np.searchsorted(ts, t_stop, side='left')
+        i_start += np.searchsorted(ts, t_start, side='left')
+        ts = ts[i_start - i_chunk_start * chunk_photons:
+                i_stop - i_chunk_start * chunk_photons]
+        photon_arrays = [self.get_photon_array(name, suffix)
+                         for suffix in suffixes]
+        return (ts,) + tuple(None if array is None else array[i_start:i_stop]
+                             for array in photon_arrays)
 
     def add_timestamps(self, name, clk_p, max_rates, bg_rate,
                        num_particles, bg_particle, populations=None,
                        overwrite=False, chunksize=2**16,
-                       comp_filter=default_compression, save_pos=False,
-                       spatial_dims=None):
-        if name in self.h5file.root.timestamps:
-            if overwrite:
-                self.h5file.remove_node('/timestamps', name=name)
-                self.h5file.remove_node('/timestamps', name=name + '_par')
-                try:
-                    self.h5file.remove_node('/timestamps', name=name + '_pos')
-                except tables.NoSuchNodeError:
-                    pass
+                       comp_filter=None, save_pos=False,
+                       spatial_dims=None, save_states=False,
+                       nanotimes_specs=None, save_excitation=False,
+                       encoding=None, delta_dtype='uint16', delta_unit=1,
+                       index_key=None, rs_hash=None, save_particles=True):
+        """Create a timestamps array and the associated per-photon arrays.
+
+        When `encoding` is 'delta' timestamps are stored delta-encoded in
+        the `delta_dtype` type (see :class:`DeltaTimestamps`), when 'int64'
+        as absolute values. If None, use `self.timestamps_encoding`.
+        `delta_unit` is the expected common divisor of the timestamps
+        differences (e.g. the `scale` of the simulation).
+        If `comp_filter` is None, each array is compressed according to
+        the store compression profile of its kind, otherwise `comp_filter`
+        is used for all the arrays.
+        The array is added to the index of the timestamps arrays (when
+        present) with key `index_key` (default `name`) and random state
+        hash `rs_hash`, see :meth:`find_timestamps`.
+        If `save_particles` is False, the particles array ('_par') is not
+        created (e.g. for timestamps simulated from the emission summed
+        per population).
+        The array is marked as incomplete until the simulation calls
+        :meth:`update_timestamps_info`. An existing incomplete array is
+        replaced even when `overwrite` is False.
+
+        Returns:
+            The timestamps, particles (or None) and positions (or None)
+            arrays.
+        """
+        if encoding is None:
+            encoding = self.timestamps_encoding
+        assert encoding in ('int64', 'delta')
+        replace = False
+        if self._has_array('timestamps', name):
+            # Incomplete arrays (e.g. of a failed simulation) are replaced
+            replace = overwrite or not self.timestamps_complete(name)
+            if replace:
+                self._remove_array('timestamps', name)
+                for suffix in (self.photon_array_suffixes +
+                               self.encoding_suffixes):
+                    try:
+                        self._remove_array('timestamps', name + suffix)
+                    except tables.NoSuchNodeError:
+                        pass
+                for suffix in ('_first', '_counts'):
+                    try:
+                        self._remove_array('time_index', name + suffix)
+                    except tables.NoSuchNodeError:
+                        pass
             else:
                 msg = 'Timestamp array already exist (%s)' % name
                 raise ExistingArrayError(msg)
 
-        times_array = self.h5file.create_earray(
-            '/timestamps', name, atom=tables.Int64Atom(),
-            shape = (0,),
-            chunkshape = (chunksize,),
-            filters = comp_filter,
-            title = 'Simulated photon timestamps')
+        def filters(kind):
+            return self.filters(kind) if comp_filter is None else comp_filter
+
+        if encoding == 'int64':
+            times_array = self._create_array(
+                'timestamps', name, atom=tables.Int64Atom(),
+                shape = (0,),
+                chunkshape = (chunksize,),
+                filters = filters('timestamps'),
+                title = 'Simulated photon timestamps')
+        else:
+            times_array = self._create_delta_timestamps(
+                name, delta_dtype, delta_unit, chunksize,
+                comp_filter=filters('timestamps_delta'))
         times_array.set_attr('clk_p', clk_p)
         times_array.set_attr('max_rates', max_rates)
         times_array.set_attr('bg_rate', bg_rate)
         times_array.set_attr('populations', populations)
         times_array.set_attr('PyBroMo', __version__)
         times_array.set_attr('creation_time', current_time())
-        particles_array = self.h5file.create_earray(
-            '/timestamps', name + '_par', atom=tables.UInt8Atom(),
-            shape = (0,),
-            chunkshape = (chunksize,),
-            filters = comp_filter,
-            title = 'Particle number for each timestamp')
-        particles_array.set_attr('num_particles', num_particles)
-        particles_array.set_attr('bg_particle', bg_particle)
-        particles_array.set_attr('PyBroMo', __version__)
-        particles_array.set_attr('creation_time', current_time())
+        times_array.set_attr('complete', False)
+        particles_array = None
+        if save_particles:
+            particles_array = self._create_array(
+                'timestamps', name + '_par', atom=tables.UInt8Atom(),
+                shape = (0,),
+                chunkshape = (chunksize,),
+                filters = filters('particles'),
+                title = 'Particle number for each timestamp')
+            particles_array.set_attr('num_particles', num_particles)
+            particles_array.set_attr('bg_particle', bg_particle)
+            particles_array.set_attr('PyBroMo', __version__)
+            particles_array.set_attr('creation_time', current_time())
         positions_array = None
         if save_pos:
             assert spatial_dims is not None, 'You need to pass `spatial_dims`.'
-            positions_array = self.h5file.create_earray(
-                '/timestamps', name + '_pos', atom=tables.Float32Atom(),
+            positions_array = self._create_array(
+                'timestamps', name + '_pos', atom=tables.Float32Atom(),
                 shape=(0, spatial_dims),
                 chunkshape=(chunksize, spatial_dims),
-                filters=comp_filter,
+                filters=filters('position'),
                 title='Particle position for each timestamp')
             positions_array.set_attr('PyBroMo', __version__)
             positions_array.set_attr('creation_time', current_time())
+        if save_states:
+            self.add_photon_array(name, '_state', atom=tables.UInt8Atom(),
+                                  title='Particle state for each timestamp',
+                                  chunksize=chunksize, comp_filter=comp_filter)
+        if nanotimes_specs is not None:
+            nanotimes_array = self.add_photon_array(
+                name, '_nanotimes', atom=tables.UInt16Atom(),
+                title='TCSPC nanotime for each timestamp',
+                chunksize=chunksize, comp_filter=comp_filter)
+            for key, value in nanotimes_specs.items():
+                nanotimes_array.set_attr(key, value)
+        if save_excitation:
+            self.add_photon_array(
+                name, '_exc', atom=tables.UInt8Atom(),
+                title='Excitation source (laser) for each timestamp',
+                chunksize=chunksize, comp_filter=comp_filter)
+        table = self._timestamps_index()
+        if table is not None:
+            if replace:
+                self._index_remove(name)
+            row = table.row
+            row['name'] = name
+            row['index_key'] = name if index_key is None else index_key
+            row['rs_hash'] = '' if rs_hash is None else rs_hash
+            row['clk_p'] = clk_p
+            row['max_rates'] = _to_json(max_rates)
+            row['populations'] = _to_json(populations)
+            row['bg_rate'] = _to_json(bg_rate)
+            row.append()
+            table.flush()
+        if self.catalog is not None:
+            self.catalog.add_timestamps(self.filepath.name, name, clk_p,
+                                        max_rates, bg_rate, populations)
         return times_array, particles_array, positions_array
 
+    def _create_delta_timestamps(self, name, delta_dtype, delta_unit,
+                                 chunksize, comp_filter=None):
+        """Create the arrays for delta-encoded timestamps `name`."""
+        if comp_filter is None:
+            comp_filter = self.filters('timestamps_delta')
+        deltas = self._create_array(
+            'timestamps', name, atom=tables.Atom.from_dtype(
+                np.dtype(delta_dtype)),
+            shape=(0,), chunkshape=(chunksize,), filters=comp_filter,
+            title='Simulated photon timestamps (delta-encoded)')
+        deltas.set_attr('encoding', 'delta')
+        deltas.set_attr('anchor_period', chunksize)
+        deltas.set_attr('delta_unit', delta_unit)
+        esc = self._create_array(
+            'timestamps', name + '_esc', atom=tables.Int64Atom(),
+            shape=(0,), filters=default_compression,
+            title='Timestamps delta escapes')
+        anchors = self._create_array(
+            'timestamps', name + '_anchors', atom=tables.Int64Atom(),
+            shape=(0, 2), filters=default_compression,
+            title='Timestamps anchors (timestamp, num. of previous escapes)')
+        return DeltaTimestamps(deltas, esc, anchors)
+
+    def get_timestamps(self, name):
+        """Return the timestamps array `name` (decoded if delta-encoded)."""
+        node = self._get_array('timestamps', name)
+        if 'encoding' in node.attrs and node.attrs['encoding'] == 'delta':
+            return DeltaTimestamps(
+                node, self._get_array('timestamps', name + '_esc'),
+                self._get_array('timestamps', name + '_anchors'))
+        return node
+
+    def add_photon_array(self, name, suffix, atom, title, chunksize=2**16,
+                         comp_filter=None):
+        """Add a per-photon array aligned with the timestamps array `name`.
+
+        The array is stored in '/timestamps' with name `name + suffix`.
+        If `comp_filter` is None, use the 'photon_data' compression profile.
+        """
+        assert suffix in self.photon_array_suffixes
+        if comp_filter is None:
+            comp_filter = self.filters('photon_data')
+        photon_array = self._create_array(
+            'timestamps', name + suffix, atom=atom,
+            shape = (0,),
+            chunkshape = (chunksize,),
+            filters = comp_filter,
+            title = title)
+        photon_array.set_attr('PyBroMo', __version__)
+        photon_array.set_attr('creation_time', current_time())
+        return photon_array
+
+    def get_photon_array(self, name, suffix):
+        """Return the per-photon array `name + suffix` or None if missing."""
+        try:
+            return self._get_array('timestamps', name + suffix)
+        except tables.NoSuchNodeError:
+            return None
+
+
+# Store classes (trajectories, timestamps) for each storage backend.
+# Other backends are registered by their module (see `dirstore`).
+store_backends = {'hdf5': (TrajectoryStore, TimestampStore)}
+
 
 if __name__ == '__main__':
     d = {'D': (1.2e-11, 'Diffusion coefficient (m^2/s)'),
@@ -0,0 +1,170 @@
+"""
+Unit tests for the batch runner in `pybromo.batch`.
+
+Running the tests requires `py.test`.
+"""
+
+import json
+import os
+from pathlib import Path
+
+import pytest
+import tables
+
+from pybromo import batch
+from pybromo.batch import (expand_jobs, run_batch, run_job, load_manifest,
+                           main)
+from pybromo.diffusion import ParticlesSimulation
+from pybromo.storage import TimestampStore
+
+
+def make_config(path):
+    return dict(
+        path=str(path), seed=3, replicates=2, processes=2, retries=1,
+        merge=True,
+        diffusion=dict(
+            t_step=0.5e-6, t_max=0.005, num_particles=[2, 3],
+            D=['12e-12', 6e-12], psf='gaussian',
+            box=dict(x1=-4e-6, x2=4e-6, y1=-4e-6, y2=4e-6, z1=-6e-6,
+                     z2=6e-6),
+            options=dict(total_emission=False, chunksize=2**12)),
+        timestamps=dict(em_rates=[2e5, 3e5], E_values=[0.75, 0.25],
+                        num_particles=[2, 3], bg_rate_d=1e3, bg_rate_a=800),
+        grid={'timestamps.E_values': [[0.75, 0.25], [0.5, 0.5]]})
+
+
+def test_expand_jobs(tmp_path):
+    config = make_config(tmp_path)
+    config['grid']['diffusion.t_max'] = [0.005, 0.01]
+    jobs = expand_jobs(config)
+    assert [job['key'] for job in jobs] == ['ID0-0', 'ID0-1', 'ID1-0',
+                                            'ID1-1']
+    assert [job['diffusion']['t_max'] for job in jobs] == [0.005, 0.005,
+                                                           0.01, 0.01]
+    assert all(len(job['timestamps']) == 2 for job in jobs)
+    # Seeds are reproducible and different for each simulation
+    assert expand_jobs(config) == jobs
+    seeds = [ts['seed'] for job in jobs for ts in job['timestamps']]
+    assert len(set(seeds)) == len(seeds)
+    assert len(set(job['seed'] for job in jobs)) == len(jobs)
+    with pytest.raises(ValueError):
+        expand_jobs(dict(config, grid={'t_max': [1, 2]}))
+
+
+def test_run_batch(tmp_path):
+    config = make_config(tmp_path)
+    manifest = run_batch(config)
+    assert set(manifest['jobs']) == {'ID0-0', 'ID0-1'}
+    for entry in manifest['jobs'].values():
+        assert entry['status'] == 'done' and entry['attempts'] == 1
+        assert (tmp_path / entry['trajectory_file']).exists()
+        assert len(entry['timestamps']) == 2
+    assert len(manifest['merged']) == 2
+    for merged in manifest['merged'].values():
+        with tables.open_file(str(tmp_path / merged['photon_hdf5'])) as h5:
+            assert h5.root.photon_data.timestamps.shape[0] > 0
+    assert load_manifest(tmp_path) == manifest
+
+    # Completed jobs are skipped
+    mtimes = {f: (tmp_path / f).stat().st_mtime
+              for f in [e['trajectory_file'] for e in
+                        manifest['jobs'].values()]}
+    assert run_batch(config) == manifest
+    assert mtimes == {f: (tmp_path / f).stat().st_mtime for f in mtimes}
+
+    # Failed jobs are retried and reported
+    config_path = tmp_path / 'config.json'
+    config = make_config(tmp_path / 'failing')
+    config['diffusion']['psf'] = dict(kind='gaussian', wrong_arg=1)
+    config['replicates'] = 1
+    with open(str(config_path), 'w') as f:
+        json.dump(config, f)
+    assert main([str(config_path), '-p', '1']) == 1
+    entry = load_manifest(tmp_path / 'failing')['jobs']['ID0-0']
+    assert entry['status'] == 'failed' and entry['attempts'] == 2
+    assert 'wrong_arg' in entry['error']
+
+
+def test_run_job_incomplete_timestamps(tmp_path, monkeypatch):
+    # Timestamps arrays of a failed attempt are simulated again on retry
+    config = make_config(tmp_path)
+    config.update(replicates=1, grid={})
+    job = expand_jobs(config)[0]
+
+    def failing_update(self, name):
+        raise RuntimeError('Simulated failure')
+
+    # Fail after writing the first chunk of photons
+    monkeypatch.setattr(TimestampStore, 'update_time_index', failing_update)
+    with pytest.raises(RuntimeError):
+        run_job(job)
+    monkeypatch.undo()
+    result = run_job(job)
+    (tmp_path / 'ref').mkdir()
+    reference = run_job(dict(job, path=str(tmp_path / 'ref')))
+    names = result['timestamps']['ts0']['names']
+    assert names == reference['timestamps']['ts0']['names']
+    ts_file = tmp_path / result['timestamps_file']
+    ref_file = tmp_path / 'ref' / reference['timestamps_file']
+    with tables.open_file(str(ts_file)) as h5, \
+            tables.open_file(str(ref_file)) as h5_ref:
+        for name in names:
+            timestamps = h5.get_node('/timestamps', name)
+            assert timestamps.attrs['complete']
+            assert timestamps.shape[0] > 0
+            assert (timestamps.read() ==
+                    h5_ref.get_node('/timestamps', name).read()).all()
+
+
+def test_run_job_directory_backend(tmp_path, monkeypatch):
+    config = make_config(tmp_path)
+    config.update(replicates=1, grid={})
+    config['diffusion']['options']['backend'] = 'directory'
+    job = expand_jobs(config)[0]
+    result = run_job(job)
+    assert result['trajectory_file'].endswith('.d')
+    assert (tmp_path / result['trajectory_file']).is_dir()
+
+    # The complete trajectories are found and not simulated again
+    def failing_simulation(*args, **kwargs):
+        raise AssertionError('Trajectories simulated again.')
+
+    monkeypatch.setattr(ParticlesSimulation, 'simulate_diffusion',
+                        failing_simulation)
+    assert run_job(job)['trajectory_file'] == result['trajectory_file']
+
+
+def _crash_job(job):
+    """Fake `run_job` killing the worker process."""
+    os._exit(1)
+
+
+def _crash_once_job(job):
+    """Fake `run_job` killing the worker process only on the first call."""
+    marker = Path(job['path']) / 'crashed'
+    if not marker.exists():
+        marker.touch()
+        os._exit(1)
+    return dict(status='done', hash=job['hash'])
+
+
+def test_run_batch_broken_pool(tmp_path, monkeypatch):
+    # Jobs running in a pool whose worker died are retried in a new pool
+    config = make_config(tmp_path / 'once')
+    config['merge'] = False
+    monkeypatch.setattr(batch, 'run_job', _crash_once_job)
+    manifest = run_batch(config)
+    assert set(manifest['jobs']) == {'ID0-0', 'ID0-1'}
+    for entry in manifest['jobs'].values():
+        assert entry['status'] == 'done' and entry['attempts'] <= 2
+
+    # When the retries are exhausted the jobs are reported as failed
+    config = make_config(tmp_path / 'always')
+    config['merge'] = False
+    monkeypatch.setattr(batch, 'run_job', _crash_job)
+    manifest = run_batch(config, processes=1)
+    assert set(manifest['jobs']) == {'ID0-0', 'ID0-1'}
+    for entry in manifest['jobs'].values():
+        assert entry['status'] == 'failed' and entry['attempts'] == 2
+        assert 'BrokenProcessPool' in entry['error']
+    assert load_manifest(tmp_path / 'always') == manifest
@@ -0,0 +1,116 @@
+"""
+Unit tests for the artifact cache in `pybromo.cache`.
+
+Running the tests requires `py.test`.
+"""
+
+import numpy as np
+
+import pybromo as pbm
+from pybromo.cache import (ArtifactCache, cached_diffusion,
+                           cached_timestamps, cached_photon_hdf5)
+
+
+box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+D1, D2 = 12e-12, 6e-12
+
+
+def test_ArtifactCache(tmp_path):
+    calls = []
+
+    def make_compute(size):
+        def compute(path):
+            calls.append(size)
+            filepath = path / 'data.bin'
+            filepath.write_bytes(b'x' * size)
+            return filepath
+        return compute
+
+    with ArtifactCache(tmp_path / 'cache', max_size=2500) as cache:
+        f1 = cache.get_or_compute('a', dict(x=1, s=slice(0, 2)),
+                                  make_compute(1000))
+        assert f1.read_bytes() == b'x' * 1000
+        # Same inputs (in any order): no computation
+        assert cache.get_or_compute('a', dict(s=slice(0, 2), x=1),
+                                    make_compute(1000)) == f1
+        assert calls == [1000]
+        assert cache.key_of(f1) == cache.key('a', dict(x=1, s=slice(0, 2)))
+        f2 = cache.get_or_compute('a', dict(x=2), make_compute(1000))
+        assert cache.get(cache.key_of(f1)) == f1  # f1 more recently used
+        f3 = cache.get_or_compute('b', dict(x=2), make_compute(1000))
+        # f2 is the least recently used and is evicted
+        assert not f2.exists() and f1.exists() and f3.exists()
+        assert cache.size == 2000
+        assert [e['stage'] for e in cache.entries()] == ['a', 'b']
+        assert cache.evict(max_size=0, keep=cache.key_of(f3)) == \
+            [cache.key('a', dict(x=1, s=slice(0, 2)))]
+        assert cache.size == 1000
+
+
+def _simulation(seed):
+    rs = np.random.RandomState(seed)
+    P = pbm.Particles.from_specs(num_particles=(2, 3), D=(D1, D2), box=box,
+                                 rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.005, particles=P,
+                                box=box, psf=pbm.GaussianPSF())
+    return S, rs
+
+
+def test_cached_pipeline(tmp_path):
+    cache = ArtifactCache(tmp_path / 'cache')
+    results = []
+    for session in range(2):
+        S, rs = _simulation(1)
+        S = cached_diffusion(cache, S, rs, total_emission=False,
+                             chunksize=2**12, verbose=False)
+        mix_sim = pbm.TimestampSimulation(
+            S, em_rates=(2e5, 3e5), E_values=(0.7, 0.2), num_particles=(2, 3),
+            bg_rate_d=1e3, bg_rate_a=800)
+        ts_file = cached_timestamps(cache, mix_sim, rs)
+        ph_file = cached_photon_hdf5(cache, mix_sim)
+        mix_sim.merge_da()
+        results.append((S.store.filepath, ts_file, ph_file, rs.get_state()[1],
+                        mix_sim.ts[:], mix_sim.name_timestamps_a))
+        S.store.close()
+        S.ts_store.close()
+    (traj_1, ts_1, ph_1, state_1, ts_data_1, name_a_1), \
+        (traj_2, ts_2, ph_2, state_2, ts_data_2, name_a_2) = results
+    assert (traj_1, ts_1, ph_1, name_a_1) == (traj_2, ts_2, ph_2, name_a_2)
+    assert (state_1 == state_2).all()
+    assert (ts_data_1 == ts_data_2).all()
+    assert len(cache.entries()) == 3
+    assert ph_1.exists()
+
+    # A different seed is a different artifact
+    S, rs = _simulation(2)
+    S = cached_diffusion(cache, S, rs, total_emission=False, chunksize=2**12,
+                         verbose=False)
+    assert S.store.filepath != traj_1
+    assert len(cache.entries('trajectories')) == 2
+    S.store.close()
+    cache.close()
+
+
+def test_cached_timestamps_scale(tmp_path):
+    cache = ArtifactCache(tmp_path / 'cache')
+    S, rs = _simulation(1)
+    S = cached_diffusion(cache, S, rs, total_emission=False, chunksize=2**12,
+                         verbose=False)
+    mix_sim = pbm.TimestampSimulation(
+        S, em_rates=(2e5, 3e5), E_values=(0.7, 0.2), num_particles=(2, 3),
+        bg_rate_d=1e3, bg_rate_a=800)
+    state = rs.get_state()
+    ts_files, clk_p = [], []
+    for scale in (10, 10, 20):
+        rs.set_state(state)
+        ts_files.append(cached_timestamps(cache, mix_sim, rs, scale=scale))
+        mix_sim.merge_da()
+        clk_p.append(mix_sim.clk_p)
+        S.ts_store.close()
+        del S.ts_store, S.ts_group
+    # Same scale is a hit, a different scale is a miss
+    assert ts_files[0] == ts_files[1] != ts_files[2]
+    assert len(cache.entries('timestamps')) == 2
+    assert clk_p[0] == 2 * clk_p[2]
+    S.store.close()
+    cache.close()
@@ -0,0 +1,101 @@
+"""
+Unit tests for the catalog of simulation files in `pybromo.catalog`.
+
+Running the tests requires `py.test`.
+"""
+
+import pytest
+import numpy as np
+
+import pybromo as pbm
+from pybromo.catalog import Catalog, catalog_filename
+
+
+box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+D1, D2 = 12e-12, 6e-12
+
+
+def _simulate(path, num_particles, D, ID=0):
+    rs = np.random.RandomState(1)
+    P = pbm.Particles.from_specs(num_particles=num_particles, D=D, box=box,
+                                 rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.005, particles=P,
+                                box=box, psf=pbm.GaussianPSF(), ID=ID)
+    S.simulate_diffusion(total_emission=False, rs=rs, path=path,
+                         chunksize=2**12, verbose=False)
+    populations = [slice(0, num_particles[0])]
+    if len(num_particles) > 1:
+        populations.append(slice(num_particles[0], sum(num_particles)))
+    rates = [1e5] * len(populations)
+    S.simulate_timestamps_mix_da(
+        max_rates_d=rates, max_rates_a=[3e5] * len(populations),
+        populations=populations, bg_rate_d=1e3, bg_rate_a=1e3, rs=rs)
+    S.names = S.timestamp_names
+    S.store.close()
+    S.ts_store.close()
+    return S
+
+
+def test_catalog(tmp_path):
+    S1 = _simulate(tmp_path, (2, 3), (D1, D2))
+    S2 = _simulate(tmp_path, (4,), (D2,))
+    assert (tmp_path / catalog_filename).exists()
+    # The catalog connection is closed with the store
+    assert S1.store.catalog is None and S1.ts_store.catalog is None
+    with Catalog(tmp_path) as catalog:
+        # Lookup by hash
+        datafiles = catalog.lookup(S1.hash()[:6], 'trajectories')
+        assert datafiles == [S1.store.filepath]
+        assert catalog.lookup(S2.hash(), 'timestamps') == [S2.ts_store.filepath]
+        # Queries by parameters
+        assert len(catalog.find()) == 2
+        assert len(catalog.find(kind=None)) == 4
+        found = catalog.find(D=D1)
+        assert [f['path'] for f in found] == [S1.store.filepath]
+        assert found[0]['populations'] == [(D1, 2), (D2, 3)]
+        assert found[0]['psf_hash'] == S1.psf.hash()
+        assert len(catalog.find(D=D2)) == 2
+        assert len(catalog.find(np=(4, 5))) == 2
+        found = catalog.find(pico_mol=S2.concentration(pM=True))
+        assert [f['path'] for f in found] == [S2.store.filepath]
+        assert len(catalog.find(t_step=0.5e-6, ID=0)) == 2
+        with pytest.raises(ValueError):
+            catalog.find(foo=1)
+        # Timestamps queries
+        timestamps = catalog.find_timestamps(E=0.75)
+        assert len(timestamps) == 4
+        assert {ts['name'] for ts in timestamps} == set(S1.names + S2.names)
+        assert all(np.allclose(ts['E_values'], 0.75) for ts in timestamps)
+        assert catalog.find_timestamps(E=(0.1, 0.5)) == []
+        assert len(catalog.find_timestamps(D=D1)) == 2
+
+    # Lookup from `from_datafile` uses the catalog
+    S = pbm.ParticlesSimulation.from_datafile(S1.hash()[:6], path=tmp_path)
+    assert S.store.filepath == S1.store.filepath
+    assert len(S.timestamp_names) == 2
+    S.store.close()
+    S.ts_store.close()
+
+    # Rebuild the catalog from the files
+    (tmp_path / catalog_filename).unlink()
+    with Catalog(tmp_path) as catalog:
+        assert catalog.scan() == 4
+        assert len(catalog.find(D=D1, kind=None)) == 2
+        assert len(catalog.find_timestamps()) == 4
+        assert catalog.lookup(S2.hash()[:6], 'trajectories') == [
+            S2.store.filepath]
+
+    # Timestamps added to a file opened for appending are cataloged
+    S = pbm.ParticlesSimulation.from_datafile(S1.hash()[:6], path=tmp_path,
+                                              mode='a')
+    mix_sim = pbm.TimestampSimulation(
+        S, em_rates=(2e5, 3e5), E_values=(0.25, 0.25), num_particles=(2, 3),
+        bg_rate_d=1e3, bg_rate_a=1e3)
+    mix_sim.run_da(rs=np.random.RandomState(2))
+    names = {mix_sim.name_timestamps_d, mix_sim.name_timestamps_a}
+    S.store.close()
+    S.ts_store.close()
+    with Catalog(tmp_path) as catalog:
+        timestamps = catalog.find_timestamps(E=0.25)
+        assert {ts['name'] for ts in timestamps} == names
+        assert len(catalog.find_timestamps()) == 6
@@ -0,0 +1,80 @@
+"""
+Unit tests for the detector artifacts stage in `pybromo.detectors`.
+
+Running the tests requires `py.test`.
+"""
+
+import pytest
+import numpy as np
+
+from pybromo.detectors import DetectorModel, dead_time_filter
+
+
+def dead_time_filter_loop(times, dead_time, t_last=-np.inf):
+    mask = np.zeros(times.size, dtype=bool)
+    for i, t in enumerate(times):
+        if t - t_last >= dead_time:
+            mask[i] = True
+            t_last = t
+    return mask
+
+
+def random_timestamps(rs, size=20000):
+    return np.cumsum(rs.geometric(0.3, size=size) - 1).astype('int64')
+
+
+def test_dead_time_filter():
+    rs = np.random.RandomState(1)
+    times = random_timestamps(rs).astype(float)
+    for dead_time in (0.5, 1, 2.5, 7):
+        mask = dead_time_filter(times, dead_time, t_last=1)
+        assert (mask == dead_time_filter_loop(times, dead_time, 1)).all()
+        assert (np.diff(times[mask]) >= dead_time).all()
+
+
+def test_DetectorStream_chunks():
+    rs = np.random.RandomState(2)
+    ts = random_timestamps(rs)
+    par = rs.randint(4, size=ts.size).astype('uint8')
+    model = DetectorModel(dead_time=100e-9, clk_p=25e-9)
+    stream = model.stream(50e-9, rs)
+    ts_full, photons_full = stream.process(ts, {'_par': par}, flush=True)
+    assert (np.diff(ts_full) >= 4).all()
+    assert (ts_full % 2 == 0).all()
+
+    stream = model.stream(50e-9, rs)
+    ts_list, par_list = [], []
+    for i in range(0, ts.size, 3000):
+        ts_c, photons = stream.process(ts[i:i + 3000],
+                                       {'_par': par[i:i + 3000]})
+        ts_list.append(ts_c)
+        par_list.append(photons['_par'])
+    ts_c, photons = stream.flush({'_par': par[:0]})
+    ts_list.append(ts_c)
+    par_list.append(photons['_par'])
+    assert (np.hstack(ts_list) == ts_full).all()
+    assert (np.hstack(par_list) == photons_full['_par']).all()
+
+
+def test_DetectorStream_jitter_afterpulses():
+    rs = np.random.RandomState(3)
+    ts = random_timestamps(rs) * 100
+    model = DetectorModel(dead_time=40e-9, afterpulse_prob=0.05,
+                          afterpulse_delay=1e-6, jitter=20e-9)
+    stream = model.stream(1e-9, rs, bg_particle=9)
+    out_ts, out_par = [], []
+    for i in range(0, ts.size, 1000):
+        ts_c, photons = stream.process(
+            ts[i:i + 1000], {'_par': np.zeros(ts[i:i + 1000].size, 'uint8')})
+        out_ts.append(ts_c)
+        out_par.append(photons['_par'])
+    ts_c, photons = stream.flush({'_par': np.zeros(0, 'uint8')})
+    out_ts = np.hstack(out_ts + [ts_c])
+    out_par = np.hstack(out_par + [photons['_par']])
+    assert (np.diff(out_ts) >= 39).all()
+    num_ap = (out_par == 9).sum()
+    assert out_ts.size - num_ap <= ts.size
+    assert abs(num_ap / (out_ts.size - num_ap) - 0.05) < 0.01
+
+    with pytest.raises(ValueError):
+        DetectorModel(afterpulse_prob=1)
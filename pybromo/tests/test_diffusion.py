@@ -7,6 +7,7 @@ Running the tests requires `py.test`.
 import pytest
 import numpy as np
 import json
+import tables
 
 import pybromo as pbm
 
@@ -62,7 +63,7 @@ def randomstate_equal(rs1, rs2):
     return equal
 
 
-def create_diffusion_sim(psf=pbm.NumericPSF()):
+def create_diffusion_sim(psf=pbm.NumericPSF(), path='./'):
     rs = np.random.RandomState(_SEED)
     specs = {k: v for k, v in particles_specs.items()
              if k in ['num_particles', 'D', 'box']}
@@ -71,7 +72,7 @@ def create_diffusion_sim(psf=pbm.NumericPSF()):
     S = pbm.ParticlesSimulation(t_step=t_step, t_max=t_max,
                                 particles=P, box=box, psf=psf)
     S.simulate_diffusion(save_pos=True, total_emission=False, radial=False,
-                         rs=rs)
+                         rs=rs, path=path)
     S.store.close()
     return S.hash()[:6]
 
@@ -238,6 +239,7 @@ def test_simulate_timestamps():
     kw.pop('rs')
     S.simulate_timestamps_mix(**kw)
     S.store.close()
+    S.ts_store.close()
 
 
 def test_TimestampSimulation():
@@ -259,3 +261,839 @@ def test_TimestampSimulation():
         rs = np.random.RandomState(_SEED)
         mix_sim.run(rs=rs, overwrite=True)
         mix_sim.save_photon_hdf5()
+        S.store.close()
+        S.ts_store.close()
+
+
+def test_KineticTimestampSimulation(tmp_path):
+    hash_ = create_diffusion_sim(path=tmp_path)
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path, mode='a')
+    scheme = pbm.KineticScheme([[0, 200], [300, 0]], E_values=(0.2, 0.8),
+                               em_rates=(300e3, 200e3))
+    kin_sim = pbm.KineticTimestampSimulation(
+        S, scheme, num_particles=(1, 3), bg_rate_d=1400, bg_rate_a=800)
+    kin_sim.summarize()
+
+    rs = np.random.RandomState(_SEED)
+    kin_sim.run_da(rs=rs, overwrite=True)
+    kin_sim.merge_da()
+    assert kin_sim.ts.size == kin_sim.states.size == kin_sim.part.size
+    assert (np.diff(kin_sim.ts) >= 0).all()
+    is_bg = kin_sim.part == S.num_particles
+    assert (kin_sim.states[is_bg] == 255).all()
+    assert set(kin_sim.states[~is_bg]) <= {0, 1}
+    # Acceptor photons are enriched in the high-FRET state
+    frac_a = [kin_sim.a_ch[~is_bg & (kin_sim.states == s)].mean()
+              for s in (0, 1)]
+    assert frac_a[0] < frac_a[1]
+    kin_sim.save_photon_hdf5()
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_TimestampSimulation_photophysics(tmp_path):
+    hash_ = create_diffusion_sim(path=tmp_path)
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path, mode='a')
+    params = dict(em_rates=(400e3, 400e3), E_values=(0.75, 0.25),
+                  num_particles=(1, 3), bg_rate_d=1400, bg_rate_a=800)
+
+    # Particles bleach in a few microseconds: only background is left
+    pp = pbm.Photophysics(k_off=1e4, k_on=1e5, k_bleach=1e6)
+    mix_sim = pbm.TimestampSimulation(S, photophysics=pp, **params)
+    mix_sim.summarize()
+    mix_sim.run_da(rs=np.random.RandomState(_SEED), overwrite=True)
+    mix_sim.merge_da()
+    num_bg = (mix_sim.part == S.num_particles).sum()
+    assert num_bg > 0
+    assert (mix_sim.part == S.num_particles).mean() > 0.99
+
+    # Fast blinking without bleaching reduces the emission
+    pp = pbm.Photophysics(k_off=1e5, k_on=1e5)
+    mix_sim_pp = pbm.TimestampSimulation(S, photophysics=pp, **params)
+    mix_sim_pp.run_da(rs=np.random.RandomState(_SEED), overwrite=True)
+    mix_sim_pp.merge_da()
+    mix_sim = pbm.TimestampSimulation(S, **params)
+    mix_sim.run_da(rs=np.random.RandomState(_SEED), overwrite=True)
+    mix_sim.merge_da()
+    num_ph = (mix_sim.part < S.num_particles).sum()
+    num_ph_pp = (mix_sim_pp.part < S.num_particles).sum()
+    assert abs(num_ph_pp / num_ph - 0.5) < 0.1
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_TimestampSimulation_nanotimes(tmp_path):
+    hash_ = create_diffusion_sim(path=tmp_path)
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path, mode='a')
+    tcspc = pbm.TCSPCModel(tau_d=4e-9, tau_a=3e-9, tcspc_unit=16e-12,
+                           tcspc_num_bins=4096)
+    params = dict(em_rates=(400e3, 400e3), E_values=(0.75, 0.25),
+                  num_particles=(1, 3), bg_rate_d=1400, bg_rate_a=800)
+    for run in ('run', 'run_da'):
+        mix_sim = pbm.TimestampSimulation(S, tcspc=tcspc, **params)
+        getattr(mix_sim, run)(rs=np.random.RandomState(_SEED),
+                              overwrite=True)
+        mix_sim.merge_da()
+        assert mix_sim.nanotimes.dtype == np.uint16
+        assert mix_sim.nanotimes.size == mix_sim.ts.size
+        # Donor decay is shortened by FRET, acceptor decay is delayed
+        is_sig = mix_sim.part < S.num_particles
+        nt_d = mix_sim.nanotimes[is_sig & ~mix_sim.a_ch].mean()
+        nt_a = mix_sim.nanotimes[is_sig & mix_sim.a_ch].mean()
+        assert nt_d < tcspc.tau_d / tcspc.tcspc_unit
+        assert nt_d < nt_a
+        mix_sim.save_photon_hdf5()
+
+    # Nanotimes do not change the timestamps
+    mix_sim_nt = mix_sim
+    mix_sim = pbm.TimestampSimulation(S, **params)
+    mix_sim.run_da(rs=np.random.RandomState(_SEED), overwrite=True)
+    mix_sim.merge_da()
+    assert mix_sim.nanotimes is None
+    assert (mix_sim.ts == mix_sim_nt.ts).all()
+
+    # Nanotimes require the FRET efficiency of each population
+    with pytest.raises(ValueError):
+        S.simulate_timestamps_mix(
+            populations=mix_sim.populations, max_rates=mix_sim.em_rates_d,
+            bg_rate=1400, rs=np.random.RandomState(_SEED), tcspc=tcspc)
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_TimestampSimulation_alex(tmp_path):
+    hash_ = create_diffusion_sim(path=tmp_path)
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path, mode='a')
+    excitation = pbm.ExcitationSchedule(period=50e-6,
+                                        windows=[(0, 20e-6), (25e-6, 45e-6)])
+    params = dict(em_rates=(400e3, 400e3), E_values=(0.75, 0.25),
+                  num_particles=(1, 3), bg_rate_d=1400, bg_rate_a=800)
+    for run in ('run', 'run_da'):
+        mix_sim = pbm.TimestampSimulation(S, excitation=excitation, **params)
+        getattr(mix_sim, run)(rs=np.random.RandomState(_SEED),
+                              overwrite=True)
+        mix_sim.merge_da()
+        assert mix_sim.laser.size == mix_sim.ts.size
+        # Photons are emitted only inside the window of their laser
+        specs = excitation.measurement_specs(mix_sim.clk_p)
+        phase = mix_sim.ts % specs['alex_period']
+        for laser in range(excitation.num_lasers):
+            start, stop = specs['alex_excitation_period%d' % (laser + 1)]
+            mask = mix_sim.laser == laser
+            assert ((phase[mask] >= start) & (phase[mask] < stop)).all()
+        # During acceptor excitation the donor channel has only background
+        is_sig = mix_sim.part < S.num_particles
+        assert not (is_sig & ~mix_sim.a_ch & (mix_sim.laser == 1)).any()
+        assert (is_sig & mix_sim.a_ch & (mix_sim.laser == 1)).any()
+        mix_sim.save_photon_hdf5()
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_TimestampSimulation_pie(tmp_path):
+    hash_ = create_diffusion_sim(path=tmp_path)
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path, mode='a')
+    tcspc = pbm.TCSPCModel(tau_d=4e-9, tau_a=3e-9, tcspc_unit=50e-12,
+                           tcspc_num_bins=1000)
+    excitation = pbm.ExcitationSchedule(
+        period=50e-9, windows=[(0, 25e-9), (25e-9, 50e-9)], pulsed=True)
+    params = dict(em_rates=(400e3, 400e3), E_values=(0.75, 0.25),
+                  num_particles=(1, 3), bg_rate_d=1400, bg_rate_a=800)
+    with pytest.raises(ValueError):
+        pbm.TimestampSimulation(S, excitation=excitation, **params)
+    mix_sim = pbm.TimestampSimulation(S, excitation=excitation, tcspc=tcspc,
+                                      **params)
+    mix_sim.run_da(rs=np.random.RandomState(_SEED), overwrite=True)
+    mix_sim.merge_da()
+    is_sig = mix_sim.part < S.num_particles
+    nt_aex = mix_sim.nanotimes[is_sig & (mix_sim.laser == 1)]
+    nt_dex = mix_sim.nanotimes[is_sig & (mix_sim.laser == 0)]
+    # Photons excited by the second laser are delayed by its window
+    assert np.median(nt_aex) > 500
+    assert np.median(nt_dex) < 500
+    mix_sim.save_photon_hdf5()
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_TimestampSimulation_detector(tmp_path):
+    hash_ = create_diffusion_sim(path=tmp_path)
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path, mode='a')
+    detector = pbm.DetectorModel(dead_time=60e-9, afterpulse_prob=0.01,
+                                 jitter=1e-9, clk_p=12.5e-9)
+    params = dict(em_rates=(400e3, 400e3), E_values=(0.75, 0.25),
+                  num_particles=(1, 3), bg_rate_d=1400, bg_rate_a=800)
+    mix_sim = pbm.TimestampSimulation(S, **params)
+    mix_sim.run_da(rs=np.random.RandomState(_SEED), overwrite=True)
+    mix_sim.merge_da()
+    ts_ideal = mix_sim.ts
+    for run in ('run', 'run_da'):
+        mix_sim = pbm.TimestampSimulation(S, detector=detector, **params)
+        getattr(mix_sim, run)(rs=np.random.RandomState(_SEED),
+                              overwrite=True)
+        mix_sim.merge_da()
+        assert mix_sim.clk_p == 12.5e-9
+        for a_ch in (False, True):
+            ts_ch = mix_sim.ts[mix_sim.a_ch == a_ch]
+            assert (np.diff(ts_ch) * mix_sim.clk_p >= 60e-9).all()
+        mix_sim.save_photon_hdf5()
+    # The detector stage does not change the photon generation
+    ts_ideal_clk = ts_ideal * 4
+    assert abs(mix_sim.ts.size / ts_ideal.size - 1) < 0.05
+    assert np.isin(mix_sim.ts[mix_sim.part < S.num_particles],
+                   ts_ideal_clk + np.arange(-1, 2)[:, None]).mean() > 0.99
+
+    # Standalone pass over an existing timestamps array
+    mix_sim = pbm.TimestampSimulation(S, **params)
+    mix_sim.run_da(rs=np.random.RandomState(_SEED), overwrite=True)
+    name_det = pbm.detectors.apply_detector(
+        S.ts_store, mix_sim.name_timestamps_d, detector, overwrite=True)
+    ts_det = S.ts_store.h5file.get_node('/timestamps', name_det)
+    par_det = S.ts_store.h5file.get_node('/timestamps', name_det + '_par')
+    assert ts_det.attrs['clk_p'] == 12.5e-9
+    assert ts_det.shape == par_det.shape
+    assert (np.diff(ts_det[:]) >= 5).all()
+    assert name_det in S.timestamp_names
+
+    # Time slice without simulated chunks (only the detector flush)
+    for method in ('simulate_timestamps_mix', 'simulate_timestamps_mix_da'):
+        kw = dict(max_rates=(1e5, 3e5), bg_rate=1e3)
+        if method.endswith('_da'):
+            kw = dict(max_rates_d=(1e5, 3e5), max_rates_a=(3e5, 1e5),
+                      bg_rate_d=1e3, bg_rate_a=1e3)
+        getattr(S, method)(populations=mix_sim.populations,
+                           rs=np.random.RandomState(_SEED), overwrite=True,
+                           timeslice=S.t_step / 2, detector=detector, **kw)
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_TimestampSimulation_delta_encoding(tmp_path):
+    hash_ = create_diffusion_sim(path=tmp_path)
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path, mode='a')
+    params = dict(em_rates=(400e3, 400e3), E_values=(0.75, 0.25),
+                  num_particles=(1, 3), bg_rate_d=1400, bg_rate_a=800)
+    mix_sim = pbm.TimestampSimulation(S, **params)
+    mix_sim.run_da(rs=np.random.RandomState(_SEED), overwrite=True)
+    mix_sim.merge_da()
+    ts_int64 = mix_sim.ts
+    S.open_store_timestamp(encoding='delta')
+    for run in ('run', 'run_da'):
+        mix_sim = pbm.TimestampSimulation(S, **params)
+        getattr(mix_sim, run)(rs=np.random.RandomState(_SEED),
+                              overwrite=True)
+        mix_sim.merge_da()
+        ts_d, _, _ = S.get_timestamp_data(mix_sim.name_timestamps_d)
+        assert isinstance(ts_d, pbm.storage.DeltaTimestamps)
+    assert mix_sim.ts.dtype == np.int64
+    assert (mix_sim.ts == ts_int64).all()
+    assert mix_sim.name_timestamps_d + '_esc' not in S.timestamp_names
+    S.ts_store.timestamps_encoding = 'int64'
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_diffusion_sim_layout(tmp_path):
+    rs = np.random.RandomState(_SEED)
+    P = pbm.Particles.from_specs(num_particles=(5, 7), D=(D1, D2), box=box,
+                                 rs=rs)
+    S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.01, particles=P,
+                                box=box, psf=pbm.GaussianPSF())
+    S.simulate_diffusion(total_emission=False, rs=rs, chunksize=2**12,
+                         path=tmp_path, layout='balanced',
+                         particle_major_copy=True)
+    assert S.emission.chunkshape == (4, 2**12)
+    assert S.emission_pm.chunkshape == (1, 2**12)
+    assert (S.emission_pm[:] == S.emission[:]).all()
+    assert (S.particle_emission(3, 10, 5000) == S.emission[3, 10:5000]).all()
+    hash_ = S.hash()[:6]
+    S.store.close()
+    S2 = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path)
+    assert S2.store.layout == 'balanced'
+    assert S2.store.h5file.params['CHUNK_CACHE_NELMTS'] >= 100 * 2 * 3
+    assert S2.emission_pm.shape == S2.emission.shape
+    S2.store.close()
+
+
+def test_diffusion_sim_quantization(tmp_path):
+    emission = {}
+    for quantization in (None, 'uint16', 'uint8log'):
+        rs = np.random.RandomState(_SEED)
+        P = pbm.Particles.from_specs(num_particles=(2, 3), D=(D1, D2),
+                                     box=box, rs=rs)
+        S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.01, particles=P,
+                                    box=box, psf=pbm.NumericPSF())
+        path = tmp_path / str(quantization)
+        path.mkdir()
+        S.simulate_diffusion(total_emission=False, rs=rs, chunksize=2**12,
+                             path=path,
+                             quantization=quantization)
+        emission[quantization] = S.emission[:]
+        S.simulate_timestamps_mix(max_rates=(2e5, 3e5),
+                                  populations=(slice(0, 2), slice(2, 5)),
+                                  bg_rate=1e3, rs=rs)
+        S.store.close()
+        S.ts_store.close()
+    em = emission[None]
+    assert np.abs(emission['uint16'] - em).max() < 1e-5
+    large = em > 2e-6
+    assert large.sum() > 0
+    rel_error = np.abs(emission['uint8log'] - em)[large] / em[large]
+    assert rel_error.max() < 0.03
+
+
+def test_diffusion_sim_compact_positions(tmp_path):
+    position = {}
+    storages = {'float': None,
+                'compact': dict(quantization='int16', stride=4,
+                                reconstruction='bridge')}
+    for label, position_storage in storages.items():
+        rs = np.random.RandomState(_SEED)
+        P = pbm.Particles.from_specs(num_particles=(2, 3), D=(D1, D2),
+                                     box=box, rs=rs)
+        S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.01, particles=P,
+                                    box=box, psf=pbm.NumericPSF())
+        path = tmp_path / label
+        path.mkdir()
+        S.simulate_diffusion(total_emission=False, save_pos=True, rs=rs,
+                             chunksize=2**12, path=path,
+                             position_storage=position_storage)
+        position[label] = S.position[:]
+        S.simulate_timestamps_mix(max_rates=(2e5, 3e5),
+                                  populations=(slice(0, 2), slice(2, 5)),
+                                  bg_rate=1e3, rs=rs, save_pos=True)
+        S.store.close()
+        S.ts_store.close()
+    assert position['compact'].shape == position['float'].shape
+    # Positions on opposite box boundaries are the same position
+    period = np.diff(box.b, axis=1)
+    error = position['compact'] - position['float']
+    error = np.abs(error - np.rint(error / period) * period)
+    assert error[..., ::4].max() < 1e-9
+    assert np.median(error) < 10 * max(S.sigma_1d)
+
+
+@pytest.mark.parametrize('backend', ['hdf5', 'directory'])
+def test_diffusion_sim_virtual(tmp_path, backend):
+    sims = {}
+    for virtual in (False, True):
+        rs = np.random.RandomState(_SEED)
+        P = pbm.Particles.from_specs(num_particles=(2, 3), D=(D1, D2),
+                                     box=box, rs=rs)
+        S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.01, particles=P,
+                                    box=box, psf=pbm.NumericPSF())
+        path = tmp_path / str(virtual)
+        path.mkdir()
+        S.simulate_diffusion(total_emission=False, save_pos=True, rs=rs,
+                             chunksize=2**12, path=path, virtual=virtual,
+                             cache_chunks=2, backend=backend)
+        S.simulate_timestamps_mix(max_rates=(2e5, 3e5),
+                                  populations=(slice(0, 2), slice(2, 5)),
+                                  bg_rate=1e3, rs=rs, save_pos=True)
+        sims[virtual] = S
+    S, Sv = sims[False], sims[True]
+    assert 'emission' not in Sv.traj_group
+    assert Sv.emission.shape == S.emission.shape
+    assert Sv.emission.chunkshape == S.emission.chunkshape
+    assert (Sv.emission[:, 5000:13000] == S.emission[:, 5000:13000]).all()
+    assert (Sv.position[2, :, 100:9000:7] == S.position[2, :, 100:9000:7]).all()
+    assert np.allclose(Sv.emission_tot[:], S.emission[:].sum(axis=0))
+    assert len(Sv._trajectories_cache) == 2
+    name = S.timestamp_names[0]
+    assert (Sv.ts_store.get_timestamps(name)[:] ==
+            S.ts_store.get_timestamps(name)[:]).all()
+    positions = Sv.get_photon_positions(name)
+    saved = S.ts_store.get_photon_array(name, '_pos')[:]
+    assert np.allclose(positions, saved, equal_nan=True)
+    hash_ = Sv.hash()[:6]
+    emission = Sv.emission[1, :100]
+    for S in sims.values():
+        S.store.close()
+        S.ts_store.close()
+    S2 = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path / 'True')
+    assert (S2.emission[1, :100] == emission).all()
+    S2.store.close()
+    S2.ts_store.close()
+
+
+def test_diffusion_sim_directory_backend(tmp_path):
+    sims = {}
+    for backend in ('hdf5', 'directory'):
+        rs = np.random.RandomState(_SEED)
+        P = pbm.Particles.from_specs(num_particles=(2, 3), D=(D1, D2),
+                                     box=box, rs=rs)
+        S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.01, particles=P,
+                                    box=box, psf=pbm.NumericPSF())
+        path = tmp_path / backend
+        path.mkdir()
+        S.simulate_diffusion(total_emission=False, save_pos=True, rs=rs,
+                             chunksize=2**12, path=path, backend=backend)
+        S.simulate_timestamps_mix(max_rates=(2e5, 3e5),
+                                  populations=(slice(0, 2), slice(2, 5)),
+                                  bg_rate=1e3, rs=rs)
+        sims[backend] = S
+    S, Sd = sims['hdf5'], sims['directory']
+    assert Sd.store.filepath.is_dir()
+    assert Sd.store.filepath.suffix == '.d'
+    assert Sd.store.numeric_params == S.store.numeric_params
+    assert Sd.emission.shape == S.emission.shape
+    assert (Sd.emission[:, 3000:9000] == S.emission[:, 3000:9000]).all()
+    assert (Sd.position[:] == S.position[:]).all()
+    name = S.timestamp_names[0]
+    for ts, ts_d in zip(S.get_timestamp_data(name)[:2],
+                        Sd.get_timestamp_data(name)[:2]):
+        assert (ts_d[:] == ts[:]).all()
+    for S in sims.values():
+        S.store.close()
+        S.ts_store.close()
+
+
+_FOLLOW_WRITER = """
+import numpy as np
+import pybromo as pbm
+box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+rs = np.random.RandomState(%d)
+P = pbm.Particles.from_specs(num_particles=(2, 3), D=(%r, %r), box=box, rs=rs)
+S = pbm.ParticlesSimulation(t_step=%r, t_max=0.05, particles=P, box=box,
+                            psf=pbm.NumericPSF())
+S.simulate_diffusion(total_emission=False, rs=rs, chunksize=2**12,
+                     path=%r, backend=%r, verbose=False)
+S.store.close()
+"""
+
+
+def _committed_dirs(path):
+    """Return the directory stores in `path` with committed time steps."""
+    attrs_files = path.glob('*.d/trajectories/_attrs.pickle')
+    return [p.parent.parent for p in attrs_files
+            if 'committed_steps' in pbm.dirstore.DirectoryAttrs(p)]
+
+
+def test_diffusion_sim_follow(tmp_path):
+    import sys
+    import subprocess
+    import time
+
+    path = tmp_path / 'traj'
+    path.mkdir()
+    code = _FOLLOW_WRITER % (_SEED, D1, D2, t_step, str(path), 'directory')
+    writer = subprocess.Popen([sys.executable, '-c', code])
+    try:
+        t_start = time.time()
+        while len(_committed_dirs(path)) == 0:
+            assert time.time() - t_start < 60 and writer.poll() is None
+            time.sleep(0.01)
+        hash_ = path.glob('*.d').__next__().name.split('_')[1][:6]
+        S = pbm.ParticlesSimulation.from_datafile(
+            hash_, path=path, follow=True, poll_interval=0.01, timeout=60)
+        assert S.emission.shape == (5, S.n_samples)
+        kw = dict(max_rates=(2e5, 3e5), populations=(slice(0, 2), slice(2, 5)),
+                  bg_rate=1e3)
+        S.simulate_timestamps_mix(seed=1, path=tmp_path, **kw)
+        ts_follow = S.ts_store.get_timestamps(S.timestamp_names[0])[:]
+        assert S.store.committed() == (S.n_samples, True)
+        S.store.close()
+        S.ts_store.close()
+    finally:
+        assert writer.wait(timeout=60) == 0
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=path,
+                                              ignore_timestamps=True)
+    S.simulate_timestamps_mix(seed=1, path=path, **kw)
+    assert (S.ts_store.get_timestamps(S.timestamp_names[0])[:] ==
+            ts_follow).all()
+    S.store.close()
+    S.ts_store.close()
+
+    # HDF5 files cannot be followed
+    path = tmp_path / 'traj_hdf5'
+    path.mkdir()
+    code = _FOLLOW_WRITER % (_SEED, D1, D2, t_step, str(path), 'hdf5')
+    subprocess.check_call([sys.executable, '-c', code])
+    assert len(list(path.glob('*.committed'))) == 0
+    with pytest.raises(ValueError):
+        pbm.ParticlesSimulation.from_datafile(hash_, path=path, follow=True)
+
+
+def test_timestamps_index(tmp_path):
+    S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.01,
+                                particles=pbm.Particles.from_specs(
+                                    num_particles=(2, 3), D=(D1, D2), box=box,
+                                    rs=np.random.RandomState(_SEED)),
+                                box=box, psf=pbm.NumericPSF())
+    S.simulate_diffusion(total_emission=False, chunksize=2**12, path=tmp_path,
+                         rs=np.random.RandomState(_SEED), verbose=False)
+    detector = pbm.DetectorModel(dead_time=60e-9, clk_p=12.5e-9)
+    kw = dict(max_rates=(2e5, 3e5), populations=(slice(0, 2), slice(2, 5)),
+              bg_rate=1e3)
+    S.simulate_timestamps_mix(rs=np.random.RandomState(1), **kw)
+    S.simulate_timestamps_mix(rs=np.random.RandomState(2), **kw)
+    S.simulate_timestamps_mix(rs=np.random.RandomState(1), detector=detector,
+                              **kw)
+    assert S.ts_store.has_timestamps_index
+    assert len(S.timestamp_names) == 3
+    # The name "pattern" without detector is part of the name with detector
+    # but the index lookup is exact
+    hash_1 = pbm.hashfunc(np.random.RandomState(1).get_state())[:6]
+    names = S.timestamps_match_mix(hash_=hash_1, **kw)
+    assert len(names) == 1 and 'DET' not in names[0]
+    assert len(S.timestamps_match_mix(**kw)) == 2
+    names_det = S.timestamps_match_mix(hash_=hash_1, detector=detector, **kw)
+    assert len(names_det) == 1 and 'DET' in names_det[0]
+
+    info = S.ts_store.timestamps_info(names[0])
+    timestamps = S.ts_store.get_timestamps(names[0])[:]
+    assert info['num_photons'] == timestamps.size > 0
+    assert info['t_start'] == timestamps[0]
+    assert info['t_stop'] == timestamps[-1]
+    assert info['max_rates'] == [2e5, 3e5]
+    assert info['populations'] == [[0, 2], [2, 5]]
+    assert info['rs_hash'].startswith(hash_1)
+    found = S.ts_store.find_timestamps(condition='num_photons >= n',
+                                       condvars=dict(n=timestamps.size))
+    assert set(found) == {
+        name for name in S.timestamp_names if
+        S.ts_store.timestamps_info(name)['num_photons'] >= timestamps.size}
+
+    # The detector pass on existing timestamps is indexed too
+    name_det = pbm.detectors.apply_detector(S.ts_store, names[0], detector,
+                                            overwrite=True)
+    assert name_det == names_det[0]
+    assert S.timestamps_match_mix(hash_=hash_1, detector=detector,
+                                  **kw) == [name_det]
+    S.store.close()
+    S.ts_store.close()
+
+
+@pytest.mark.parametrize('emission', ['particles', 'populations'])
+def test_merge_ensemble(tmp_path, emission):
+    populations = (slice(0, 2), slice(2, 5))
+    kw = dict(max_rates_d=(1e5, 2e5), max_rates_a=(3e5, 1e5),
+              populations=populations, bg_rate_d=1e3, bg_rate_a=2e3)
+    sim_populations = None
+    if emission == 'populations':
+        # Timestamps simulated from the population emission (no particles)
+        sim_populations, kw['populations'] = populations, None
+    filepaths, names, data = [], [], []
+    for EID in range(3):
+        rs = np.random.RandomState(pbm.diffusion.get_seed(_SEED, EID=EID))
+        S = pbm.ParticlesSimulation(
+            t_step=t_step, t_max=0.01, box=box, psf=pbm.GaussianPSF(),
+            EID=EID, particles=pbm.Particles.from_specs(
+                num_particles=(2, 3), D=(D1, D2), box=box, rs=rs))
+        S.simulate_diffusion(total_emission=False, chunksize=2**12,
+                             path=tmp_path, rs=rs, populations=sim_populations,
+                             verbose=False)
+        S.simulate_timestamps_mix_da(rs=rs, **kw)
+        name_d, name_a = S.timestamp_names
+        filepaths.append(S.ts_store.filepath)
+        names.append((name_d, name_a))
+        ts_data = [S.get_timestamp_data(name) for name in names[-1]]
+        data.append([ts[:] for ts, _, _ in ts_data] +
+                    [None if par is None else par[:] for _, par, _ in ts_data])
+        S.store.close()
+        S.ts_store.close()
+
+    h5_fname = tmp_path / 'merged.hdf5'
+    info = pbm.timestamps.merge_ensemble(filepaths, names, h5_fname,
+                                         chunksize=7)
+    clk_p = 50e-9
+    assert list(info['offsets']) == [0, 200000, 400000]
+    if emission == 'populations':
+        assert info['particle_offsets'] is None
+        ts = np.hstack([np.hstack(d[:2]) + offset
+                        for d, offset in zip(data, info['offsets'])])
+        with tables.open_file(str(h5_fname)) as h5file:
+            photon_data = h5file.root.photon_data
+            assert 'particles' not in photon_data
+            assert (photon_data.timestamps[:] == np.sort(ts)).all()
+            num_a = sum(d[1].size for d in data)
+            assert photon_data.detectors[:].sum() == num_a
+        return
+    assert info['particle_offsets'] == [0, 5, 10]
+    # Expected result: merge in memory
+    ts, det, par = [], [], []
+    for (ts_d, ts_a, par_d, par_a), offset, par_offset in zip(
+            data, info['offsets'], info['particle_offsets']):
+        ts_i, a_ch, par_i = pbm.timestamps.merge_da(ts_d, par_d, ts_a, par_a)
+        ts.append(ts_i + offset)
+        det.append(a_ch)
+        par.append(np.where(par_i == 5, 15, par_i.astype(int) + par_offset))
+    ts, det, par = np.hstack(ts), np.hstack(det), np.hstack(par)
+    with tables.open_file(str(h5_fname)) as h5file:
+        photon_data = h5file.root.photon_data
+        assert photon_data.timestamps_specs.timestamps_unit.read() == clk_p
+        assert (photon_data.timestamps[:] == ts).all()
+        assert (np.diff(photon_data.timestamps[:]) >= 0).all()
+        # Photons with the same timestamp may be sorted differently
+        order = np.lexsort((photon_data.particles[:],
+                            photon_data.detectors[:], ts))
+        order_expected = np.lexsort((par, det, ts))
+        assert (photon_data.detectors[:][order] == det[order_expected]).all()
+        assert (photon_data.particles[:][order] == par[order_expected]).all()
+
+
+def test_diffusion_sim_extend(tmp_path):
+    # Durations multiple of the chunk size (4096 steps), long enough to
+    # change the hash when doubled
+    t_max1 = 5 * 4096 * t_step
+    sims = {}
+    for name, t_max_sim in (('single', 2 * t_max1), ('extended', t_max1)):
+        rs = np.random.RandomState(_SEED)
+        P = pbm.Particles.from_specs(num_particles=(2, 3), D=(D1, D2),
+                                     box=box, rs=rs)
+        S = pbm.ParticlesSimulation(t_step=t_step, t_max=t_max_sim,
+                                    particles=P, box=box,
+                                    psf=pbm.NumericPSF())
+        path = tmp_path / name
+        path.mkdir()
+        S.simulate_diffusion(total_emission=False, save_pos=True, rs=rs,
+                             chunksize=2**12, chunkslice='times', path=path,
+                             verbose=False)
+        sims[name] = S
+    S = sims['extended']
+    assert S.emission.shape == (5, 5 * 4096)
+    path = tmp_path / 'extended'
+    hash_ = S.hash()[:6]
+    S.store.close()
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=path)
+    S.extend(t_max1, verbose=False)
+    S1 = sims['single']
+    assert S.n_samples == S1.n_samples
+    assert S.emission.shape == S1.emission.shape
+    assert (S.emission[:] == S1.emission[:]).all()
+    assert (S.position[:] == S1.position[:]).all()
+    assert S.store.numeric_params['t_max'] == pytest.approx(2 * t_max1)
+    assert S.store.committed() == (S.n_samples, True)
+    # The file is renamed after the new t_max (and hash)
+    assert S.hash() == S1.hash() and not S1.hash().startswith(hash_)
+    assert S.store.filepath.name == S1.store.filepath.name
+    assert not (path / sims['extended'].store.filepath.name).exists()
+    with pbm.catalog.Catalog(path) as catalog:
+        files = catalog.find(t_max=2 * t_max1)
+        assert len(catalog.lookup(hash_, 'trajectories')) == 0
+    assert len(files) == 1
+    assert files[0]['hash'] == S.hash()
+
+    # Timestamps simulated after the extension are found from the new hash
+    hash_ = S.hash()[:6]
+    S.simulate_timestamps_mix(max_rates=(2e5,), populations=(slice(0, 5),),
+                              bg_rate=1e3, rs=np.random.RandomState(1),
+                              chunksize=2**13)
+    assert hash_ in S.ts_store.filepath.name
+    S.ts_store.close()
+    S.store.close()
+    S1.store.close()
+
+    # Reload the extended file and extend it again
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=path)
+    assert hasattr(S, 'ts_store')
+    assert S.n_samples == S1.n_samples
+    S.ts_store.close()
+    # Duration for which `int(t_max / t_step)` rounds down the steps
+    S.extend(2003 * t_step, verbose=False)
+    num_steps = S1.n_samples + 2003
+    assert S.emission.shape == (5, num_steps)
+    assert S.position.shape == (5, 3, num_steps)
+    assert S.t_max == num_steps * t_step
+    S.store.close()
+    S = pbm.ParticlesSimulation.from_datafile(S.hash()[:6], path=path)
+    assert S.n_samples == num_steps
+    S.extend(1000 * t_step, verbose=False)
+    assert S.emission.shape == (5, num_steps + 1000)
+    assert S.store.committed() == (num_steps + 1000, True)
+    S.store.close()
+
+
+def test_diffusion_sim_population_emission(tmp_path):
+    populations = (slice(0, 2), slice(2, 5))
+    sims = {}
+    for name, pops in (('particles', None), ('populations', populations)):
+        rs = np.random.RandomState(_SEED)
+        P = pbm.Particles.from_specs(num_particles=(2, 3), D=(D1, D2),
+                                     box=box, rs=rs)
+        S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.05, particles=P,
+                                    box=box, psf=pbm.NumericPSF())
+        path = tmp_path / name
+        path.mkdir()
+        S.simulate_diffusion(total_emission=False, rs=rs, chunksize=2**13,
+                             path=path, populations=pops, verbose=False)
+        sims[name] = S
+    S, Sp = sims['particles'], sims['populations']
+    assert Sp.emission.shape == (5, 0)
+    assert Sp.emission_pop.shape == (2, S.n_samples)
+    emission = S.emission[:]
+    for row, pop in zip(Sp.emission_pop[:], populations):
+        assert np.allclose(row, emission[pop].sum(axis=0))
+
+    kw = dict(max_rates=(2e5, 3e5), bg_rate=1e3)
+    S.simulate_timestamps_mix(populations=populations, seed=1, **kw)
+    Sp.simulate_timestamps_mix(populations=None, seed=1, **kw)
+    name = Sp.timestamp_names[0]
+    assert name == S.timestamp_names[0]
+    ts, particles, _ = Sp.get_timestamp_data(name)
+    assert particles is None
+    assert (np.diff(ts[:]) >= 0).all()
+    num_photons = S.get_timestamp_data(name)[0].shape[0]
+    assert abs(ts.shape[0] - num_photons) < 5 * np.sqrt(num_photons)
+    first, counts, _ = Sp.ts_store.get_time_index(name)
+    assert counts is None and first[0] == ts[0]
+
+    Sp.simulate_timestamps_mix_da(max_rates_d=(1e5, 2e5),
+                                  max_rates_a=(1e5, 1e5),
+                                  populations=populations, bg_rate_d=1e3,
+                                  bg_rate_a=1e3, seed=2)
+    assert all(Sp.ts_store.get_photon_array(name, '_par') is None
+               for name in Sp.timestamp_names)
+    with pytest.raises(ValueError):
+        Sp.simulate_timestamps_mix(populations=(slice(0, 5),), seed=3, **kw)
+    with pytest.raises(ValueError):
+        Sp.simulate_timestamps_mix(populations=None, seed=3, save_pos=True,
+                                   **kw)
+
+    # Detector pass on timestamps without particles
+    detector = pbm.DetectorModel(dead_time=60e-9, clk_p=12.5e-9)
+    name_det = pbm.detectors.apply_detector(Sp.ts_store, name, detector)
+    ts_det, par_det, _ = Sp.get_timestamp_data(name_det)
+    assert par_det is None
+    assert 0 < ts_det.shape[0] <= ts.shape[0]
+    assert (np.diff(ts_det[:]) >= 5).all()
+
+    S.ts_store.close()
+    Sp.extend(0.01, verbose=False)
+    assert Sp.emission_pop.shape == (2, S.n_samples + 20000)
+    assert not hasattr(Sp, 'ts_store')
+    for S in sims.values():
+        S.store.close()
+
+
+def test_zone_map(tmp_path):
+    rs = np.random.RandomState(_SEED)
+    P = pbm.Particles.from_specs(num_particles=(4, 6), D=(D1, D2), box=box,
+                                 rs=rs)
+    S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.05, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    S.simulate_diffusion(total_emission=False, save_pos=True, rs=rs,
+                         chunksize=2**12, chunkslice='times', path=tmp_path,
+                         verbose=False)
+    start, em_max, integral = S.store.get_zone_map()
+    assert (start == np.arange(0, S.n_samples, 2**12)).all()
+    emission = S.emission[:]
+    for i, i_start in enumerate(start):
+        em_chunk = emission[:, i_start:i_start + 2**12]
+        assert (em_max[i] == em_chunk.max(axis=1)).all()
+        assert np.allclose(integral[i], em_chunk.sum(axis=1), rtol=1e-5)
+
+    populations = (slice(0, 4), slice(4, 10))
+    kw = dict(max_rates=(2e5, 3e5), populations=populations, bg_rate=1e3,
+              t_chunksize=3000, save_pos=True)
+    ref = []
+    for min_counts in (None, 0, 0.1):
+        S.simulate_timestamps_mix(rs=np.random.RandomState(1),
+                                  min_counts=min_counts, overwrite=True, **kw)
+        name = S.timestamp_names[0]
+        ref.append([array[:] for array in S.get_timestamp_data(name)])
+    # With min_counts=0 all the particles are used
+    for array, array0 in zip(ref[0], ref[1]):
+        assert np.array_equal(array, array0, equal_nan=True)
+    ts, par, pos = ref[2]
+    num_photons = ref[0][0].size
+    assert abs(ts.size - num_photons) < 5 * np.sqrt(num_photons)
+    assert (np.diff(ts) >= 0).all()
+    # Particles IDs and positions are consistent with the trajectories
+    positions = S.get_photon_positions(name)
+    assert np.allclose(pos, positions, equal_nan=True)
+    rows = S._zone_map_rows(populations, (2e5, 3e5), 0.1)
+    assert min(rows(i, i + 3000).size for i in range(0, S.n_samples, 3000)) \
+        < S.num_particles
+
+    S.simulate_timestamps_mix_da(max_rates_d=(1e5, 2e5),
+                                 max_rates_a=(1e5, 1e5),
+                                 populations=populations, bg_rate_d=1e3,
+                                 bg_rate_a=1e3, seed=4, min_counts=0.1)
+    S.extend(0.01, verbose=False)
+    assert S.store.get_zone_map()[1].shape == (len(start) + 5, 10)
+    S.store.close()
+
+
+def _find_transits(emission, threshold):
+    """Return the transits (particle, start, stop) scanning `emission`."""
+    transits = []
+    for ip, em in enumerate(emission):
+        above = np.concatenate(([False], em >= threshold, [False]))
+        edges = np.diff(above.astype('int8'))
+        for start, stop in zip(np.nonzero(edges == 1)[0],
+                               np.nonzero(edges == -1)[0]):
+            transits.append((ip, start, stop, em[start:stop].max()))
+    return sorted(transits, key=lambda t: (t[1], t[0]))
+
+
+@pytest.mark.parametrize('backend', ['hdf5', 'directory'])
+def test_transits(tmp_path, backend):
+    # Small box to have many transits
+    box_s = pbm.Box(x1=-1e-6, x2=1e-6, y1=-1e-6, y2=1e-6, z1=-2e-6, z2=2e-6)
+    t_max1 = 4096 * t_step * 4
+    sims = {}
+    for name, t_max_sim in (('single', 2 * t_max1), ('extended', t_max1)):
+        rs = np.random.RandomState(_SEED)
+        P = pbm.Particles.from_specs(num_particles=(4, 6), D=(D1, D2),
+                                     box=box_s, rs=rs)
+        S = pbm.ParticlesSimulation(t_step=t_step, t_max=t_max_sim,
+                                    particles=P, box=box_s,
+                                    psf=pbm.NumericPSF())
+        path = tmp_path / name
+        path.mkdir()
+        S.simulate_diffusion(total_emission=False, rs=rs, chunksize=2**12,
+                             chunkslice='times', path=path, verbose=False,
+                             transit_threshold=0.05, backend=backend)
+        sims[name] = S
+    S = sims['single']
+    emission = S.emission[:]
+    expected = _find_transits(emission, 0.05)
+    transits = S.get_transits()
+    assert len(transits) == len(expected) > 0
+    for transit, (ip, start, stop, peak) in zip(transits, expected):
+        assert (transit['particle'], transit['start'],
+                transit['stop']) == (ip, start, stop)
+        assert transit['peak'] == peak
+        assert transit['integral'] == pytest.approx(
+            emission[ip, start:stop].sum(dtype='float64'))
+    assert (S.get_transits(include_open=False)['stop'] < S.n_samples).all()
+
+    # Queries
+    i_start, i_stop = 4000, 12000
+    selected = S.get_transits(particles=[1, 2, 7], i_start=i_start,
+                              i_stop=i_stop, min_peak=0.2)
+    assert len(selected) == sum(
+        1 for ip, start, stop, peak in expected
+        if ip in (1, 2, 7) and stop > i_start and start < i_stop and
+        peak >= 0.2)
+
+    # Transits continue across the extension of a simulation
+    Se = sims['extended']
+    Se.extend(t_max1, verbose=False)
+    assert np.array_equal(Se.get_transits(), transits)
+    S2 = pbm.ParticlesSimulation(t_step=t_step, t_max=0.001,
+                                 particles=Se.particles, box=box_s,
+                                 psf=pbm.NumericPSF())
+    with pytest.raises(ValueError):
+        S2.simulate_diffusion(total_emission=True, path=tmp_path,
+                              transit_threshold=0.05)
+    for S in sims.values():
+        S.store.close()
+
+
+def test_transit_tracker():
+    rs = np.random.RandomState(_SEED)
+    emission = np.repeat(rs.rand(5, 200), 7, axis=1).astype('float32')
+    emission[0] = 0
+    emission[1, :50] = 1
+    tracker = pbm.transits.TransitTracker(5, 0.8)
+    transits = []
+    bounds = np.concatenate(([0], np.sort(rs.choice(1400, 30, replace=False)),
+                             [1400]))
+    for i_start, i_end in zip(bounds[:-1], bounds[1:]):
+        transits.append(tracker.process(emission[:, i_start:i_end], i_start))
+    transits.append(tracker.open_transits(1400))
+    transits = np.sort(np.concatenate(transits), order=('start', 'particle'))
+    expected = _find_transits(emission, 0.8)
+    assert [tuple(t)[:4] for t in transits] == expected
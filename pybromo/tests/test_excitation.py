@@ -0,0 +1,49 @@
+"""
+Unit tests for the alternated excitation schedules in `pybromo.excitation`.
+
+Running the tests requires `py.test`.
+"""
+
+import pytest
+import numpy as np
+
+from pybromo.excitation import ExcitationSchedule
+
+
+def test_ExcitationSchedule_active_bins():
+    t_step = 0.5e-6
+    ex = ExcitationSchedule(period=10e-6, windows=[(0, 4e-6), (5e-6, 9e-6)],
+                            offset=1e-6)
+    assert ex.num_lasers == 2
+    assert np.allclose(ex.duty_cycles, [0.4, 0.4])
+    period, windows, offset = ex.window_bins(t_step)
+    assert (period, windows, offset) == (20, [(0, 8), (10, 18)], 2)
+    # Masks are consistent across chunk boundaries
+    full = ex.active_bins(0, 0, 100, t_step)
+    parts = [ex.active_bins(0, i, 25, t_step) for i in range(0, 100, 25)]
+    assert (np.hstack(parts) == full).all()
+    assert full.sum() == 5 * 8
+    assert not (full & ex.active_bins(1, 0, 100, t_step)).any()
+    assert full[2:10].all() and not full[10:22].any()
+
+    specs = ex.measurement_specs(clk_p=t_step / 10)
+    assert specs['alex_period'] == 200
+    assert specs['alex_offset'] == 20
+    assert tuple(specs['alex_excitation_period2']) == (100, 180)
+
+
+def test_ExcitationSchedule_errors():
+    with pytest.raises(ValueError):
+        ExcitationSchedule(period=10e-6, windows=[(0, 11e-6)])
+    ex = ExcitationSchedule(period=10.2e-6, windows=[(0, 4e-6)])
+    with pytest.raises(ValueError):
+        ex.window_bins(0.5e-6)
+
+
+def test_ExcitationSchedule_pulsed():
+    ex = ExcitationSchedule(period=50e-9, windows=[(0, 25e-9), (25e-9, 50e-9)],
+                            pulsed=True)
+    assert ex.active_bins(1, 0, 100, 0.5e-6) is None
+    specs = ex.measurement_specs(clk_p=50e-9, tcspc_unit=50e-12)
+    assert tuple(specs['alex_excitation_period2']) == (500, 1000)
+    assert np.isclose(specs['laser_repetition_rate'], 20e6)
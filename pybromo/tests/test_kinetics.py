@@ -0,0 +1,98 @@
+"""
+Unit tests for the kinetic schemes in `pybromo.kinetics`.
+
+Running the tests requires `py.test`.
+"""
+
+import time
+
+import pytest
+import numpy as np
+
+from pybromo.kinetics import KineticScheme, Photophysics
+
+
+def test_KineticScheme_stationary():
+    scheme = KineticScheme([[0, 2e3], [1e3, 0]])
+    assert np.allclose(scheme.stationary_distribution, [1 / 3, 2 / 3])
+    assert np.allclose(scheme.p0, [1 / 3, 2 / 3])
+    with pytest.raises(ValueError):
+        KineticScheme([[0, 1, 2], [1, 0, 1]])
+    with pytest.raises(ValueError):
+        KineticScheme([[0, 1], [1, 0]], E_values=[0.1, 0.2, 0.3])
+
+
+def test_KineticScheme_sim_states():
+    rs = np.random.RandomState(1)
+    t_step, num_bins, num_particles = 0.5e-6, 2**17, 50
+    scheme = KineticScheme([[0, 2e3], [1e3, 0]])
+    states = scheme.init_states(num_particles, rs)
+    states_chunk, states_end = scheme.sim_states(states, num_bins, t_step, rs)
+    assert states_chunk.shape == (num_particles, num_bins)
+    assert (states_chunk[:, 0] == states).all()
+    assert (states_chunk[:, -1] == states_end).all()
+
+    # Fraction of time in state 1 and number of transitions
+    states_list = [states_chunk]
+    for _ in range(5):
+        states_chunk, states_end = scheme.sim_states(states_end, num_bins,
+                                                     t_step, rs)
+        states_list.append(states_chunk)
+    states_all = np.hstack(states_list)
+    duration = states_all.shape[1] * t_step
+    num_jumps = (np.diff(states_all.astype(int), axis=1) != 0).sum()
+    expected_jumps = 2 * 2e3 / 3 * duration * num_particles
+    assert abs(states_all.mean() - 2 / 3) < 0.02
+    assert abs(num_jumps / expected_jumps - 1) < 0.05
+
+
+def test_KineticScheme_absorbing():
+    rs = np.random.RandomState(2)
+    scheme = KineticScheme([[0, 1e5], [0, 0]], p0=[1, 0])
+    states = scheme.init_states(10, rs)
+    states_chunk, states_end = scheme.sim_states(states, 2**14, 0.5e-6, rs)
+    assert (states_end == 1).all()
+    assert (np.diff(states_chunk.astype(int), axis=1) >= 0).all()
+
+
+def test_Photophysics_brightness():
+    rs = np.random.RandomState(3)
+    pp = Photophysics(k_off=3e4, k_on=1e5, off_brightness=0.1)
+    assert np.allclose(pp.p0, [1e5 / 1.3e5, 3e4 / 1.3e5, 0])
+    states = pp.init_states(20, rs)
+    brightness, states_end = pp.sim_brightness(states, 2**16, 0.5e-6, rs)
+    assert brightness.dtype == np.float32
+    assert set(np.unique(brightness)) <= {np.float32(1), np.float32(0.1)}
+    expected = (1e5 + 0.1 * 3e4) / 1.3e5
+    assert abs(brightness.mean() - expected) < 0.01
+
+    pp = Photophysics(k_off=3e4, k_on=1e5, k_bleach=1e6)
+    brightness, states_end = pp.sim_brightness(pp.init_states(20, rs),
+                                               2**14, 0.5e-6, rs)
+    assert (states_end == 2).all()
+    assert (brightness[:, -1] == 0).all()
+
+
+def test_Photophysics_many_particles():
+    rs = np.random.RandomState(4)
+    t_step, num_bins, num_particles = 0.5e-6, 2**12, 4000
+    pp = Photophysics(k_off=1e4, k_on=3e4, k_bleach=10)
+    states = pp.init_states(num_particles, rs)
+    t_start = time.perf_counter()
+    brightness, states_end = pp.sim_brightness(states, num_bins, t_step, rs)
+    elapsed = time.perf_counter() - t_start
+    assert brightness.shape == (num_particles, num_bins)
+    assert elapsed < 5
+
+    # Particles blink independently: no correlation between neighbours
+    on = brightness.mean(axis=1)
+    assert abs(np.corrcoef(on[:-1], on[1:])[0, 1]) < 0.1
+    # Number of off -> on transitions per particle
+    num_on = (np.diff(brightness, axis=1) > 0).sum(axis=1)
+    expected = 3e4 * 1e4 / 4e4 * num_bins * t_step
+    assert abs(num_on.mean() / expected - 1) < 0.05
+    assert num_on.std() > 1
+    # Each particle bleaches independently with rate k_bleach * p_on
+    bleached = (states_end == 2).mean()
+    p_bleach = 1 - np.exp(-10 * 0.75 * num_bins * t_step)
+    assert abs(bleached - p_bleach) < 4 * np.sqrt(p_bleach / num_particles)
@@ -0,0 +1,42 @@
+"""
+Unit tests for the nanotimes simulation in `pybromo.nanotimes`.
+
+Running the tests requires `py.test`.
+"""
+
+import pytest
+import numpy as np
+
+from pybromo.nanotimes import TCSPCModel
+
+
+def test_TCSPCModel_decays():
+    rs = np.random.RandomState(1)
+    tcspc_unit = 10e-12
+    model = TCSPCModel(tau_d=4e-9, tau_a=3e-9, tcspc_unit=tcspc_unit,
+                       tcspc_num_bins=2**14)
+    E = np.full(200000, 0.5)
+    nt_d = model.sim_nanotimes(E, 'D', rs)
+    nt_a = model.sim_nanotimes(E, 'A', rs)
+    assert nt_d.dtype == np.uint16
+    assert abs(nt_d.mean() * tcspc_unit / 2e-9 - 1) < 0.02
+    assert abs(nt_a.mean() * tcspc_unit / 5e-9 - 1) < 0.02
+
+    # Background is uniform
+    nt_bg = model.sim_nanotimes(np.full(100000, np.nan), 'D', rs)
+    assert abs(nt_bg.mean() / (model.tcspc_num_bins / 2) - 1) < 0.02
+
+    with pytest.raises(ValueError):
+        TCSPCModel(tau_d=4e-9, tau_a=3e-9, tcspc_unit=tcspc_unit,
+                   tcspc_num_bins=2**17)
+
+
+def test_TCSPCModel_irf():
+    rs = np.random.RandomState(2)
+    irf = np.zeros(100)
+    irf[50] = 1
+    model = TCSPCModel(tau_d=1e-12, tau_a=1e-12, tcspc_unit=20e-12,
+                       tcspc_num_bins=1000, irf=irf, irf_unit=10e-12)
+    nt = model.sim_nanotimes(np.zeros(1000), 'D', rs)
+    # IRF peak at 500-510 ps, i.e. bin 25 with 20 ps bins
+    assert (nt == 25).mean() > 0.9
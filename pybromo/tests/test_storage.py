@@ -0,0 +1,404 @@
+"""
+Unit tests for the on-disk storage in `pybromo.storage`.
+
+Running the tests requires `py.test`.
+"""
+
+import time
+
+import pytest
+import numpy as np
+import tables
+
+import pybromo as pbm
+from pybromo.iter_chunks import (iter_chunks_prefetch, reduce_chunk,
+                                 map_chunk, hdf5_lock)
+from pybromo.dirstore import (DirectoryArray, DirectoryTrajectoryStore,
+                              DirectoryTimestampStore)
+
+from pybromo.storage import (TimestampStore, TrajectoryStore, DeltaTimestamps,
+                             QuantizedEmission, CompactPositions,
+                             VirtualArray, LRUCache, benchmark_codecs,
+                             chunk_cache_params)
+
+
+def make_timestamps(rs, size):
+    delays = rs.geometric(2e-3, size=size) * 10
+    # Add some delays overflowing uint16
+    delays[rs.randint(size, size=20)] = 2**17
+    return np.cumsum(delays).astype('int64') + 2**40
+
+
+@pytest.mark.parametrize('store_class', [TimestampStore,
+                                         DirectoryTimestampStore])
+def test_DeltaTimestamps(tmp_path, store_class):
+    rs = np.random.RandomState(1)
+    ts = make_timestamps(rs, 100000)
+    filename = 'ts_delta' + store_class.file_extension
+    store = store_class(filename, path=tmp_path, mode='w')
+    kw = dict(clk_p=50e-9, max_rates=(1,), bg_rate=1, num_particles=1,
+              bg_particle=1, chunksize=2**12)
+    times, _, _ = store.add_timestamps('ts', encoding='delta', delta_unit=10,
+                                       **kw)
+    assert isinstance(times, DeltaTimestamps)
+    for i in range(0, ts.size, 7000):
+        times.append(ts[i:i + 7000])
+    assert times.shape == ts.shape
+    assert (times[:] == ts).all()
+    assert times[:].dtype == np.int64
+    for start, stop in ((0, 1), (5000, 5001), (4095, 4097), (9999, 70000),
+                        (-10, None), (ts.size - 1, ts.size + 10)):
+        assert (times[start:stop] == ts[start:stop]).all()
+    assert times[-1] == ts[-1]
+    assert times[12345] == ts[12345]
+    assert times.attrs['clk_p'] == 50e-9
+    store.close()
+
+    # Reopen, decode and append
+    store = store_class(filename, path=tmp_path, mode='a')
+    times = store.get_timestamps('ts')
+    assert isinstance(times, DeltaTimestamps)
+    # Differences not multiple of `delta_unit` are escaped
+    times.append(ts[-1] + np.arange(10))
+    assert (times[:ts.size] == ts).all()
+    assert (times[ts.size:] == ts[-1] + np.arange(10)).all()
+
+    if store_class is DirectoryTimestampStore:
+        store.close()
+        return
+    # Delta-encoded arrays are smaller than int64 arrays
+    times_int64, _, _ = store.add_timestamps('ts64', **kw)
+    times_int64.append(ts)
+    size_delta = sum(store.h5file.get_node('/timestamps', 'ts' + s).size_on_disk
+                     for s in ('', '_esc', '_anchors'))
+    assert size_delta < times_int64.size_on_disk / 1.4
+    store.close()
+
+
+@pytest.mark.parametrize('encoding', ['int64', 'delta', 'directory'])
+def test_timestamp_window(tmp_path, encoding):
+    rs = np.random.RandomState(2)
+    ts = make_timestamps(rs, 30000)
+    par = rs.randint(4, size=ts.size).astype('uint8')
+    if encoding == 'directory':
+        store = DirectoryTimestampStore('ts_win.d', path=tmp_path, mode='w')
+        encoding = 'int64'
+    else:
+        store = TimestampStore('ts_win.hdf5', path=tmp_path, mode='w')
+    times, particles, _ = store.add_timestamps(
+        'ts', clk_p=50e-9, max_rates=(1,), bg_rate=1, num_particles=3,
+        bg_particle=3, chunksize=2**10, encoding=encoding, delta_unit=10)
+    # The index is updated incrementally while photons are appended
+    for i in range(0, ts.size, 7000):
+        times.append(ts[i:i + 7000])
+        particles.append(par[i:i + 7000])
+        store.update_time_index('ts')
+    first, counts, chunk_photons = store.get_time_index('ts')
+    assert chunk_photons == 2**10
+    assert (first == ts[::chunk_photons]).all()
+    assert counts.shape == (first.size, 4)
+    assert counts.sum() == ts.size
+    assert (counts[1] == np.bincount(par[1024:2048], minlength=4)).all()
+    for t_start, t_stop in ((0, ts[0]), (ts[0], ts[1]), (ts[0], ts[-1] + 1),
+                            (ts[5000], ts[5000] + 1), (ts[1023], ts[1025]),
+                            (ts[1024] + 1, ts[20000] - 1),
+                            (ts[-1] - 10**6, 2**62)):
+        mask = (ts >= t_start) & (ts < t_stop)
+        ts_w, par_w = store.get_timestamp_window('ts', t_start, t_stop)
+        assert (ts_w == ts[mask]).all()
+        assert (par_w == par[mask]).all()
+    store.close()
+
+
+@pytest.mark.parametrize('encoding', ['int64', 'delta', 'directory'])
+def test_timestamp_window_duplicates(tmp_path, encoding):
+    # Photons with the same timestamp split across a chunk boundary
+    ts = np.array([98, 99, 100, 100, 100, 100, 101, 102, 103, 104])
+    par = np.arange(ts.size, dtype='uint8') % 3
+    if encoding == 'directory':
+        store = DirectoryTimestampStore('ts_dup.d', path=tmp_path, mode='w')
+        encoding = 'int64'
+    else:
+        store = TimestampStore('ts_dup.hdf5', path=tmp_path, mode='w')
+    times, particles, _ = store.add_timestamps(
+        'ts', clk_p=50e-9, max_rates=(1,), bg_rate=1, num_particles=2,
+        bg_particle=2, chunksize=4, encoding=encoding)
+    times.append(ts)
+    particles.append(par)
+    store.update_time_index('ts')
+    for t_start, t_stop in ((100, 101), (99, 100), (100, 105), (101, 102)):
+        mask = (ts >= t_start) & (ts < t_stop)
+        ts_w, par_w = store.get_timestamp_window('ts', t_start, t_stop)
+        assert (ts_w == ts[mask]).all()
+        assert (par_w == par[mask]).all()
+    store.close()
+
+
+def test_compression_profiles(tmp_path):
+    store = TimestampStore('ts_comp.hdf5', path=tmp_path, mode='w',
+                           compression={'particles': dict(complib='blosc:lz4',
+                                                          complevel=1)})
+    store.set_compression('timestamps', complib='blosc:zstd', complevel=3,
+                          shuffle=False, bitshuffle=True)
+    with pytest.raises(ValueError):
+        store.set_compression('not_a_kind', complevel=1)
+    kw = dict(clk_p=50e-9, max_rates=(1,), bg_rate=1, num_particles=1,
+              bg_particle=1, chunksize=2**12)
+    times, particles, _ = store.add_timestamps('ts', **kw)
+    assert times.filters.complib == 'blosc:zstd'
+    assert times.filters.bitshuffle and not times.filters.shuffle
+    assert particles.filters.complib == 'blosc:lz4'
+    assert particles.filters.complevel == 1
+    # An explicit filter is used for all the arrays
+    times, particles, _ = store.add_timestamps(
+        'ts2', comp_filter=tables.Filters(complevel=2, complib='zlib'), **kw)
+    assert times.filters.complib == particles.filters.complib == 'zlib'
+    store.close()
+
+
+def test_benchmark_codecs():
+    rs = np.random.RandomState(1)
+    sample = make_timestamps(rs, 2**14)
+    profiles = [dict(complib='blosc:lz4', complevel=5, bitshuffle=True),
+                dict(complib='zlib', complevel=1)]
+    results, best = benchmark_codecs(sample, profiles, repeat=1)
+    assert len(results) == 2
+    assert best in profiles
+    for res in results:
+        assert res['ratio'] > 1
+        assert res['read_speed'] > 0 and res['write_speed'] > 0
+
+
+def test_calc_chunkshape():
+    calc_chunkshape = TrajectoryStore.calc_chunkshape
+    assert calc_chunkshape(2**10, (0,)) == (2**10,)
+    assert calc_chunkshape(2**10, (8, 0), kind='times') == (8, 2**10)
+    assert calc_chunkshape(2**10, (8, 0)) == (8, 2**7)
+    assert calc_chunkshape(2**10, (8, 0), layout='particle-major') == \
+        (1, 2**10)
+    assert calc_chunkshape(2**10, (8, 3, 0), layout='balanced') == \
+        (3, 3, 2**10 // 9)
+    for chunkshape in (calc_chunkshape(1000, (7, 3, 0)),
+                       calc_chunkshape(1000, (7, 0), layout='balanced')):
+        assert all(isinstance(size, int) for size in chunkshape)
+    with pytest.raises(ValueError):
+        calc_chunkshape(2**3, (100, 0))
+    with pytest.raises(ValueError):
+        calc_chunkshape(2**10, (8, 0), layout='row-major')
+    params = chunk_cache_params('particle-major', 100, 2**20)
+    assert params['CHUNK_CACHE_SIZE'] >= 200 * 2**20
+    assert params['CHUNK_CACHE_NELMTS'] >= 100 * 200
+
+
+def test_QuantizedEmission(tmp_path):
+    d = {'np': (3, 'Number of simulated particles'),
+         't_max': (0.1, 'Simulation total time (s)'),
+         't_step': (5e-07, 'Simulation time-step (s)')}
+    store = TrajectoryStore('traj_quant.hdf5', path=tmp_path, mode='w',
+                            nparams=d)
+    rs = np.random.RandomState(1)
+    em = (np.exp(-rs.rand(3, 5000) * 20) * (rs.rand(3, 5000) > 0.1))
+    em = em.astype('float32')
+    em[0, :10] = 0
+    # Photons per time bin at peak emission: max_rate * t_step
+    counts_peak = 1e6 * 5e-7
+    poisson_noise = np.sqrt(em * counts_peak) / counts_peak
+    for quantization in ('uint16', 'uint8log'):
+        emission = store.add_emission(chunksize=1000, chunkslice='times',
+                                      quantization=quantization,
+                                      name='em_' + quantization)
+        assert isinstance(emission, QuantizedEmission)
+        emission.append(em[:, :3000])
+        emission.append(em[:, 3000:])
+        assert emission.shape == em.shape
+        assert emission[:].dtype == np.float32
+        assert (emission[:, :10][0] == 0).all()
+        error = np.abs(emission[:] - em)
+        large = em > 1e-6
+        assert (error[large] < poisson_noise[large]).all()
+        assert error.max() < (1e-5 if quantization == 'uint16' else 0.03)
+        assert (emission[1, 100:200] == emission[:][1, 100:200]).all()
+    store.close()
+
+
+def test_CompactPositions(tmp_path):
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    d = {'np': (2, 'Number of simulated particles'),
+         't_max': (0.1, 'Simulation total time (s)'),
+         't_step': (5e-07, 'Simulation time-step (s)')}
+    store = TrajectoryStore('traj_pos.hdf5', path=tmp_path, mode='w',
+                            nparams=d, attr_params=dict(box=box))
+    rs = np.random.RandomState(1)
+    sigma = np.array([2e-9, 5e-9])
+    pos = np.cumsum(rs.normal(size=(2, 3, 10000)), axis=-1)
+    pos *= sigma[:, None, None]
+    # Particles crossing the X and Y boundaries
+    pos[:, :2] = pbm.diffusion.wrap_periodic(pos[:, :2] + 3.99e-6, -4e-6, 4e-6)
+
+    position = store.add_position(quantization='int16', chunksize=1000,
+                                  chunkslice='times')
+    assert isinstance(position, CompactPositions)
+    position.append(pos[..., :2500])
+    position.append(pos[..., 2500:])
+    assert position.shape == pos.shape
+    assert np.abs(position[:] - pos).max() <= 0.5e-9 + 1e-12
+    assert (position[1, 2, 50:80:3] == position[:][1, 2, 50:80:3]).all()
+    with pytest.raises(ValueError):
+        store.add_position(quantization='int16', quantum=1e-10,
+                           overwrite=True)
+
+    stride = 10
+    position = store.add_position(stride=stride, chunksize=100,
+                                  chunkslice='times', overwrite=True,
+                                  step_sigma=sigma)
+    position.append(pos[..., :2505])
+    position.append(pos[..., 2505:9995])
+    assert position.shape == (2, 3, 9995)
+    assert position._node.shape == (2, 3, 1000)
+    linear = position[:]
+    assert np.allclose(linear[..., ::stride], pos[..., :9995:stride])
+    # Linear interpolation, folded in the box with the minimum image
+    period = np.array([8e-6, 8e-6, 12e-6])[:, None]
+    error = linear - pos[..., :9995]
+    error -= np.rint(error / period) * period
+    assert np.abs(error).max() < 100e-9
+    position.reconstruction = 'bridge'
+    bridge = position[:]
+    assert np.allclose(bridge[..., ::stride], pos[..., :9995:stride])
+    assert (position[:, :, 1234:5678] == bridge[..., 1234:5678]).all()
+    assert (position[0, 1, 5678] == bridge[0, 1, 5678])
+    steps = np.diff(bridge[..., :9990], axis=-1)
+    steps -= np.rint(steps / 8e-6) * 8e-6
+    assert np.allclose(steps[:, :2].std(axis=(1, 2)), sigma, rtol=0.1)
+    assert ((bridge[:, :2] >= -4e-6) & (bridge[:, :2] <= 4e-6)).all()
+    store.close()
+    store = TrajectoryStore('traj_pos.hdf5', path=tmp_path, mode='r')
+    position = store.get_position()
+    assert position.shape == (2, 3, 9995)
+    assert (position[:] == linear).all()
+    store.close()
+
+
+def test_VirtualArray():
+    data = np.arange(2 * 3 * 1000, dtype='float32').reshape(2, 3, 1000)
+    calls = []
+
+    def compute_chunk(i):
+        calls.append(i)
+        return data[..., i * 64:(i + 1) * 64]
+
+    cache = LRUCache(maxsize=2)
+    array = VirtualArray('test', data.shape, 64, lambda i: cache.get_or_compute(
+        i, lambda: compute_chunk(i)))
+    assert array.chunkshape == (2, 3, 64)
+    for key in ((slice(None),), (Ellipsis, slice(10, 700, 3)),
+                (1, slice(None), slice(63, 65)), (0, 2, 999), (1, 0),
+                (slice(None), 1, slice(990, 2000)), (Ellipsis, slice(5, 5))):
+        assert (array[key] == data[key]).all()
+        assert array[key].shape == data[key].shape
+    num_calls = len(calls)
+    array[0, 0, 990:995]
+    assert len(calls) == num_calls
+    assert len(cache) == 2
+
+
+def test_DirectoryArray(tmp_path):
+    rs = np.random.RandomState(3)
+    data = rs.rand(4, 3, 1000).astype('float32')
+    array = DirectoryArray.create(tmp_path / 'position', 'float32',
+                                  (4, 3, 0), chunklen=128)
+    for start in range(0, 1000, 300):
+        array.append(data[..., start:start + 300])
+    assert array.shape == data.shape
+    assert array.chunkshape == (4, 3, 128)
+    assert (array[:] == data).all()
+    assert (array[1, :, 100:700:3] == data[1, :, 100:700:3]).all()
+    assert (array[..., 999] == data[..., 999]).all()
+    # Chunks are independent files that can be written in any order
+    array2 = DirectoryArray.create(tmp_path / 'emission', 'float32',
+                                   (4, 0), chunklen=256)
+    for i_chunk in (3, 1, 0, 2):
+        array2.write_chunk(i_chunk, data[:, 0, i_chunk * 256:][:, :256])
+    reopened = DirectoryArray(tmp_path / 'emission', readonly=True)
+    assert reopened.shape == (4, 1000)
+    assert (reopened[:] == data[:, 0]).all()
+    assert (np.asarray(reopened.memmap(1)) == data[:, 0, 256:512]).all()
+    # Reading a chunk not written yet (hole) raises an error
+    values = np.arange(24).reshape(2, 12)
+    array3 = DirectoryArray.create(tmp_path / 'holes', 'int64', (2, 0),
+                                   chunklen=4)
+    array3.write_chunk(2, values[:, 8:])
+    array3.write_chunk(0, values[:, :4])
+    assert array3.shape == (2, 12)
+    assert (array3[:, :4] == values[:, :4]).all()
+    assert (array3[1, 9:] == values[1, 9:]).all()
+    with pytest.raises(IOError):
+        array3[:]
+    with pytest.raises(IOError):
+        array3[0, 3:5]
+    array3.write_chunk(1, values[:, 4:8])
+    assert (array3[:] == values).all()
+    assert (array3[:, 2:11:3] == values[:, 2:11:3]).all()
+
+
+def test_DirectoryTrajectoryStore(tmp_path):
+    nparams = {'t_step': (5e-7, 'Time step'), 't_max': (1., 'Duration'),
+               'ID': (0, 'Sim ID'),
+               'EID': (None, 'Engine ID')}
+    store = DirectoryTrajectoryStore('traj.d', path=tmp_path, mode='w',
+                                     nparams=nparams,
+                                     attr_params=dict(box=[1, 2, 3]))
+    store.add_trajectory('emission', shape=(5, 0), chunksize=2**12)
+    emission = store.get_emission()
+    emission.append(np.ones((5, 100), dtype='float32'))
+    store.close()
+    store = DirectoryTrajectoryStore('traj.d', path=tmp_path, mode='r')
+    assert store.numeric_params == {'t_step': 5e-7, 't_max': 1., 'ID': 0,
+                                    'EID': 'none'}
+    assert store.get_param_attr('box') == [1, 2, 3]
+    assert store.get_emission().shape == (5, 100)
+    with pytest.raises(tables.NoSuchNodeError):
+        store.get_position()
+
+
+def test_iter_chunks_prefetch(tmp_path):
+    rs = np.random.RandomState(4)
+    data = rs.rand(3, 10000).astype('float32')
+    with tables.open_file(str(tmp_path / 'prefetch.hdf5'), mode='w') as h5:
+        array = h5.create_earray('/', 'emission', obj=data,
+                                 chunkshape=(3, 1024))
+        out = h5.create_earray('/', 'out', atom=tables.Float32Atom(),
+                               shape=(3, 0))
+        for depth in (0, 1, 3):
+            chunks = list(iter_chunks_prefetch([array, array], 10000, 3000,
+                                               depth=depth))
+            assert [c[:2] for c in chunks] == [(0, 3000), (3000, 6000),
+                                              (6000, 9000), (9000, 10000)]
+            assert (np.hstack([c[2][1] for c in chunks]) == data).all()
+        # The reader thread stops when the loop is interrupted
+        for i_start, i_end, chunks in iter_chunks_prefetch([array], 10000,
+                                                           100, depth=2):
+            break
+        assert reduce_chunk(np.max, array) == data.max()
+        map_chunk(lambda x: 2 * x, array, out)
+        assert (out[:] == 2 * data).all()
+        # Errors in the reader thread are raised in the caller
+        with pytest.raises(TypeError):
+            list(iter_chunks_prefetch([[]], 10, 5, depth=2))
+
+        # The reader thread does not read while the caller holds the lock
+        reads = []
+
+        class Recorder:
+            def __getitem__(self, key):
+                reads.append(key)
+                return array[key]
+
+        for i_start, i_end, chunks in iter_chunks_prefetch(
+                [Recorder()], 10000, 1000, depth=2):
+            with hdf5_lock:
+                num_reads = len(reads)
+                time.sleep(0.02)
+                assert len(reads) == num_reads
+                out.append(chunks[0])
+        assert (out[:, -10000:] == data).all()
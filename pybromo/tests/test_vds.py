@@ -0,0 +1,75 @@
+"""
+Unit tests for the joining of simulation files in `pybromo.vds`.
+
+Running the tests requires `py.test` and h5py.
+"""
+
+import pytest
+import numpy as np
+
+import pybromo as pbm
+from pybromo.vds import (join_trajectories, join_timestamps,
+                         JoinedTrajectoryStore, JoinedTimestampStore)
+
+
+h5py = pytest.importorskip('h5py')
+
+box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+D1, D2 = 12e-12, 6e-12
+
+
+def _simulate(path, EID, t_step=0.5e-6):
+    rs = np.random.RandomState(pbm.diffusion.get_seed(1, EID=EID))
+    P = pbm.Particles.from_specs(num_particles=(2, 3), D=(D1, D2), box=box,
+                                 rs=rs)
+    S = pbm.ParticlesSimulation(t_step=t_step, t_max=0.005, particles=P,
+                                box=box, psf=pbm.GaussianPSF(), EID=EID)
+    S.simulate_diffusion(total_emission=False, rs=rs, path=path,
+                         chunksize=2**12, verbose=False)
+    S.simulate_timestamps_mix(max_rates=(2e5, 3e5), bg_rate=1e3,
+                              populations=(slice(0, 2), slice(2, 5)), rs=rs)
+    S.name = S.timestamp_names[0]
+    S.emission_data = S.emission[:]
+    S.timestamps_data = [array[:] for array in
+                         S.get_timestamp_data(S.name)[:2]]
+    S.store.close()
+    S.ts_store.close()
+    return S
+
+
+def test_join(tmp_path):
+    sims = [_simulate(tmp_path, EID) for EID in range(3)]
+    join_trajectories([S.store.filepath for S in sims], 'joined.hdf5',
+                      path=tmp_path)
+    store = JoinedTrajectoryStore('joined.hdf5', path=tmp_path)
+    emission = store.get_emission()
+    assert emission.chunkshape == sims[0].emission_data.shape[:1] + (2**12,)
+    assert (emission[:] ==
+            np.hstack([S.emission_data for S in sims])).all()
+    assert store.numeric_params['t_max'] == pytest.approx(0.015)
+    store.close()
+
+    key = pbm.ParticlesSimulation._ts_index_key(sims[0].name)
+    join_timestamps([S.ts_store.filepath for S in sims], 'joined_ts.hdf5',
+                    path=tmp_path)
+    ts_store = JoinedTimestampStore('joined_ts.hdf5', path=tmp_path)
+    timestamps = ts_store.get_timestamps(key)
+    num_steps = int(0.005 / 0.5e-6)
+    scale = int(0.5e-6 / timestamps.attrs['clk_p'])
+    expected = np.hstack([S.timestamps_data[0] + i * num_steps * scale
+                          for i, S in enumerate(sims)])
+    assert (timestamps[:] == expected).all()
+    assert (np.diff(timestamps[:]) >= 0).all()
+    n0 = sims[0].timestamps_data[0].size
+    assert (timestamps[n0 - 5:n0 + 5] == expected[n0 - 5:n0 + 5]).all()
+    assert timestamps[n0] == expected[n0]
+    particles = ts_store.get_photon_array(key, '_par')
+    assert (particles[:] ==
+            np.hstack([S.timestamps_data[1] for S in sims])).all()
+    ts_store.close()
+
+    # Files with different parameters cannot be joined
+    S_diff = _simulate(tmp_path, 0, t_step=1e-6)
+    with pytest.raises(ValueError):
+        join_trajectories([sims[0].store.filepath, S_diff.store.filepath],
+                          'joined2.hdf5', path=tmp_path)
@@ -147,13 +147,16 @@ class TimestampSimulation:
 
     - `bg_rate_d`, `bg_rate_a`
 
-    3. Scalars (optional):
+    3. Optional:
 
-    - `timeslice`
+    - `timeslice`, `photophysics`, `tcspc`, `excitation`, `brightness`,
+      `detector`
 
     Attributes created by __init__():
 
     - `em_rates_d`, `em_rates_a`, `D_values`, `populations`, `traj_filename`.
+      With alternated excitation, `em_rates_d` and `em_rates_a` are 2D
+      arrays with one row per laser.
 
     Attributes created by .run():
 
@@ -161,11 +164,15 @@ class TimestampSimulation:
 
     Attributes created by .merge_da():
 
-    - `ts`, `a_ch`, `part`, `clk_p`
+    - `ts`, `a_ch`, `part`, `clk_p`, `pos`, `nanotimes`, `states`, `laser`
+      (`pos`, `nanotimes`, `states` and `laser` are None when not
+      simulated).
     """
 
     def __init__(self, S, em_rates, E_values, num_particles,
-                 bg_rate_d, bg_rate_a, timeslice=None):
+                 bg_rate_d, bg_rate_a, timeslice=None, photophysics=None,
+                 tcspc=None, excitation=None, brightness=None,
+                 detector=None):
         """
         Arguments:
             S (pybromo.ParticlesSimulation): the diffusion simulation object.
@@ -179,12 +186,35 @@ class TimestampSimulation:
             bg_rate_a (float): Poisson background rate in the Acceptor channel
             timeslice (float): optional max time, used to truncate the
                 diffusion simulation and use a smaller duration.
+            photophysics (pybromo.kinetics.Photophysics): optional model
+                of blinking and bleaching applied to all the particles.
+            tcspc (pybromo.nanotimes.TCSPCModel): optional model of
+                fluorescence lifetimes and TCSPC used to simulate nanotimes.
+            excitation (pybromo.excitation.ExcitationSchedule): optional
+                alternated excitation schedule (μs-ALEX or ns-ALEX/PIE).
+                Laser 0 excites the donor and laser 1 the acceptor.
+            brightness (array or None): peak emission rates (cps) with
+                shape (num_lasers, 2, num_populations), the second axis
+                being the donor and acceptor channel. Used only with
+                `excitation`. If None, during donor excitation the rates
+                are computed from `em_rates` and `E_values`, while during
+                acceptor excitation the acceptor channel has rate `em_rates`
+                and the donor channel is dark.
+            detector (pybromo.detectors.DetectorModel): optional model of
+                the detector artifacts (dead time, afterpulsing, jitter and
+                clock quantization), applied to both channels.
         """
         if np.sum(num_particles) > S.num_particles:
             msg = (f'Wrong number of particles. \n\nWith this trajectory '
                    f'file you can specify up to {S.num_particles} particles, '
                    f'but you requested {np.sum(num_particles)}.')
             raise ValueError(msg)
+        if excitation is not None and excitation.pulsed:
+            if tcspc is None:
+                raise ValueError('ns-ALEX excitation requires a TCSPC model.')
+            if not np.isclose(excitation.period, tcspc.tcspc_range):
+                raise ValueError('The ns-ALEX period must be equal to the '
+                                 'TCSPC range.')
         if np.sum(num_particles) < S.num_particles:
             msg = (f'NOTE: You requested a timestamp simulation for only '
                    f'{np.sum(num_particles)} out of the {S.num_particles} '
@@ -195,6 +225,18 @@ class TimestampSimulation:
         assert timeslice <= S.t_max
 
         em_rates_d, em_rates_a = em_rates_from_E_DA_mix(em_rates, E_values)
+        if excitation is not None:
+            if brightness is None:
+                if excitation.num_lasers != 2:
+                    raise ValueError('`brightness` is required for schedules '
+                                     'with more than 2 lasers.')
+                brightness = [[em_rates_d, em_rates_a],
+                              [np.zeros(len(em_rates)), em_rates]]
+            brightness = np.asarray(brightness, dtype='float64')
+            if brightness.shape != (excitation.num_lasers, 2, len(em_rates)):
+                raise ValueError('`brightness` must have shape '
+                                 '(num_lasers, 2, num_populations).')
+            em_rates_d, em_rates_a = brightness[:, 0], brightness[:, 1]
         populations = S.particles.num_particles_to_slices(num_particles)
         D_values = populations_diff_coeff(S.particles, num_particles)
         assert (len(em_rates) == len(E_values) == len(num_particles) ==
@@ -205,7 +247,10 @@ class TimestampSimulation:
                       bg_rate_a=bg_rate_a, timeslice=timeslice,
                       em_rates_d=em_rates_d, em_rates_a=em_rates_a,
                       D_values=D_values, populations=populations,
-                      traj_filename=S.store.filepath.name, save_pos=False)
+                      traj_filename=S.store.filepath.name, save_pos=False,
+                      photophysics=photophysics, tcspc=tcspc,
+                      excitation=excitation, brightness=brightness,
+                      detector=detector)
 
         for k, v in params.items():
             setattr(self, k, v)
@@ -230,6 +275,35 @@ class TimestampSimulation:
             Donor:              {self.bg_rate_d:7,} cps
             Acceptor:           {self.bg_rate_a:7,} cps
         """
+    txt_nanotimes = """
+        Nanotimes:
+            Donor lifetime:     {nt.tau_d:.3g} s
+            Acceptor lifetime:  {nt.tau_a:.3g} s
+            TCSPC unit:         {nt.tcspc_unit:.3g} s ({nt.tcspc_num_bins} bins)
+        """
+    txt_excitation = """
+        Alternated excitation ({kind}):
+            Period:             {ex.period:.3g} s
+        """
+    txt_laser = """
+        Laser{l_i}:
+            On window:          {start:.3g} - {stop:.3g} s
+            Peak rates D:       {rates_d} cps
+            Peak rates A:       {rates_a} cps
+        """
+    txt_detector = """
+        Detectors:
+            Dead time:          {det.dead_time:.3g} s
+            Afterpulsing:       {det.afterpulse_prob:7.2%}
+            Timing jitter:      {det.jitter:.3g} s
+        """
+    txt_photophysics = """
+        Photophysics:
+            On -> Off:          {pp.k_off:.3g} 1/s
+            Off -> On:          {pp.k_on:.3g} 1/s
+            Bleaching (On/Off): {pp.k_bleach:.3g} / {pp.k_bleach_off:.3g} 1/s
+            Off brightness:     {pp.off_brightness:7.1%}
+        """
 
     def __str__(self):
         txt = [self.txt_header.format(self=self)]
@@ -240,6 +314,22 @@ class TimestampSimulation:
                        num_pop=num_pop, D=D, em_rate=em_rate, E=E, pop=pop))
 
         txt.append(self.txt_background.format(self=self))
+        if self.photophysics is not None:
+            txt.append(self.txt_photophysics.format(pp=self.photophysics))
+        if self.tcspc is not None:
+            txt.append(self.txt_nanotimes.format(nt=self.tcspc))
+        if self.detector is not None:
+            txt.append(self.txt_detector.format(det=self.detector))
+        if self.excitation is not None:
+            kind = 'ns-ALEX' if self.excitation.pulsed else 'μs-ALEX'
+            txt.append(self.txt_excitation.format(kind=kind,
+                                                  ex=self.excitation))
+            for l_i, (start, stop) in enumerate(self.excitation.windows):
+                rates_d, rates_a = (
+                    ', '.join('{:,.0f}'.format(r) for r in rates)
+                    for rates in self.brightness[l_i])
+                txt.append(self.txt_laser.format(l_i=l_i, start=start,
+                           stop=stop, rates_d=rates_d, rates_a=rates_a))
         return ''.join(txt)
 
     def summarize(self):
@@ -254,7 +344,14 @@ class TimestampSimulation:
         s4 = 'EmTot_' + '_'.join('%dk' % (em * 1e-3) for em in self.em_rates)
         s5 = 'BgD%d_BgA%d' % (self.bg_rate_d, self.bg_rate_a)
         s6 = 't_max_%ds' % self.timeslice
-        return '_'.join((s1, s2, s3, s4, s5, s6))
+        s = [s1, s2, s3, s4, s5, s6]
+        if self.photophysics is not None:
+            s.append('PP_%s' % self.photophysics.hash()[:6])
+        if self.excitation is not None:
+            s.append('EX_%s' % self.excitation.hash()[:6])
+        if self.detector is not None:
+            s.append('DET_%s' % self.detector.hash()[:6])
+        return '_'.join(s)
 
     @property
     def filename(self):
@@ -272,7 +369,7 @@ class TimestampSimulation:
         self.hash_a = self.hash_d
 
     def run(self, rs, overwrite=True, skip_existing=False, path=None,
-            chunksize=None, save_pos=False):
+            chunksize=None, save_pos=False, scale=10, t_chunksize=None):
         """Compute timestamps for current populations.
 
         This method simulates timestamps separately for donor and acceptor,
@@ -280,12 +377,19 @@ class TimestampSimulation:
         through the trajectory file twice which is slower but more flexible
         than a single-pass.
 
+        `scale` and `t_chunksize` are passed to
+        :meth:`pybromo.ParticlesSimulation.simulate_timestamps_mix`.
+
         See also :meth:`run_da`.
         """
         if path is None:
             path = str(self.S.store.filepath.parent)
         kwargs = dict(rs=rs, overwrite=overwrite, path=path, save_pos=save_pos,
-                      timeslice=self.timeslice, skip_existing=skip_existing)
+                      timeslice=self.timeslice, skip_existing=skip_existing,
+                      photophysics=self.photophysics,
+                      tcspc=self.tcspc, excitation=self.excitation,
+                      detector=self.detector, scale=scale,
+                      t_chunksize=t_chunksize)
         if chunksize is not None:
             kwargs['chunksize'] = chunksize
         header = ' - Mixture Simulation:'
@@ -297,6 +401,7 @@ class TimestampSimulation:
             populations=self.populations,
             max_rates=self.em_rates_d,
             bg_rate=self.bg_rate_d,
+            nanotimes_channel='D', E_values=self.E_values,
             **kwargs)
 
         # Acceptor timestamps hash is from 'last_random_state' attribute
@@ -310,12 +415,13 @@ class TimestampSimulation:
             populations=self.populations,
             max_rates=self.em_rates_a,
             bg_rate=self.bg_rate_a,
+            nanotimes_channel='A', E_values=self.E_values,
             **kwargs)
         self.save_pos = save_pos
         print('\n%s Completed. %s' % (header, ctime()), flush=True)
 
     def run_da(self, rs, overwrite=True, skip_existing=False, path=None,
-               chunksize=None):
+               chunksize=None, scale=10, t_chunksize=None):
         """Compute timestamps for current populations.
 
         This method simulates timestamps for donor and acceptor from a single
@@ -324,15 +430,23 @@ class TimestampSimulation:
         file only once but is more limited than independent simulations
         for D and A as done by :meth:`run`.
 
+        `scale` and `t_chunksize` (if not None) are passed to
+        :meth:`pybromo.ParticlesSimulation.simulate_timestamps_mix_da`.
+
         See also :meth:`run`.
         """
         self.save_pos = False
         if path is None:
             path = str(self.S.store.filepath.parent)
         kwargs = dict(rs=rs, overwrite=overwrite, path=path,
-                      timeslice=self.timeslice, skip_existing=skip_existing)
+                      timeslice=self.timeslice, skip_existing=skip_existing,
+                      photophysics=self.photophysics,
+                      tcspc=self.tcspc, excitation=self.excitation,
+                      detector=self.detector, scale=scale)
         if chunksize is not None:
             kwargs['chunksize'] = chunksize
+        if t_chunksize is not None:
+            kwargs['t_chunksize'] = t_chunksize
         header = ' - Mixture Simulation:'
 
         # Donor timestamps hash is from the input RandomState
@@ -351,33 +465,59 @@ class TimestampSimulation:
     @property
     def name_timestamps_d(self):
         names_d = self.S.timestamps_match_mix(
-            self.em_rates_d, self.populations, self.bg_rate_d, self.hash_d)
+            self.em_rates_d, self.populations, self.bg_rate_d, self.hash_d,
+            photophysics=self.photophysics, excitation=self.excitation,
+            detector=self.detector)
         assert len(names_d) == 1
         return names_d[0]
 
     @property
     def name_timestamps_a(self):
         names_a = self.S.timestamps_match_mix(
-            self.em_rates_a, self.populations, self.bg_rate_a, self.hash_a)
+            self.em_rates_a, self.populations, self.bg_rate_a, self.hash_a,
+            photophysics=self.photophysics, excitation=self.excitation,
+            detector=self.detector)
         assert len(names_a) == 1
         return names_a[0]
 
     def merge_da(self):
         """Merge donor and acceptor timestamps, computes `ts`, `a_ch`, `part`.
+
+        When present, also merge positions, nanotimes, states and
+        excitation source of each timestamp and save them in `pos`,
+        `nanotimes`, `states` and `laser`.
         """
         print(' - Merging D and A timestamps', flush=True)
-        ts_d, ts_par_d, ts_pos_d = self.S.get_timestamp_data(
-            self.name_timestamps_d)
-        ts_a, ts_par_a, ts_pos_a = self.S.get_timestamp_data(
-            self.name_timestamps_a)
+        name_d, name_a = self.name_timestamps_d, self.name_timestamps_a
+        ts_d, ts_par_d, ts_pos_d = self.S.get_timestamp_data(name_d)
+        ts_a, ts_par_a, ts_pos_a = self.S.get_timestamp_data(name_a)
         da_pairs = [ts_d, ts_a, ts_par_d, ts_par_a]
-        self.pos = None
+        fields = ['part']
         if ts_pos_d is not None and ts_pos_a is not None:
             da_pairs.extend([ts_pos_d, ts_pos_a])
-            (ts, part, pos), a_ch = merge_da_multi(*da_pairs)
-            self.pos = pos
-        else:
-            (ts, part), a_ch = merge_da_multi(*da_pairs)
+            fields.append('pos')
+        for field, suffix in (('nanotimes', '_nanotimes'),
+                              ('states', '_state'),
+                              ('laser', '_exc')):
+            array_d = self.S.ts_store.get_photon_array(name_d, suffix)
+            array_a = self.S.ts_store.get_photon_array(name_a, suffix)
+            if array_d is not None and array_a is not None:
+                da_pairs.extend([array_d, array_a])
+                fields.append(field)
+        # Read the on-disk arrays in memory in a single call each
+        da_pairs = [array[:] for array in da_pairs]
+        (ts, *merged), a_ch = merge_da_multi(*da_pairs)
+        merged = dict(zip(fields, merged))
+        part = merged['part']
+        self.pos = merged.get('pos')
+        self.nanotimes = merged.get('nanotimes')
+        self.states = merged.get('states')
+        self.laser = merged.get('laser')
+        if self.nanotimes is not None:
+            nt_attrs = self.S.get_timestamp_nanotimes(name_d).attrs
+            self.nanotimes_specs = {k: nt_attrs[k] for k in
+                                    ('tcspc_unit', 'tcspc_num_bins',
+                                     'tcspc_range')}
 
         assert a_ch.sum() == ts_a.shape[0]
         assert (~a_ch).sum() == ts_d.shape[0]
@@ -397,9 +537,33 @@ class TimestampSimulation:
                 measurement_type = 'smFRET',
                 detectors_specs = dict(spectral_ch1 = np.atleast_1d(0),
                                        spectral_ch2 = np.atleast_1d(1))))
+        user = dict()
         if self.pos is not None:
             print('Saving particle positions in /photon_data/user/positions')
-            photon_data['user'] = dict(positions=self.pos)
+            user['positions'] = self.pos
+        if self.states is not None:
+            print('Saving particle states in /photon_data/user/states')
+            user['states'] = self.states
+        if self.laser is not None:
+            print('Saving excitation source in /photon_data/user/laser')
+            user['laser'] = self.laser
+        if len(user) > 0:
+            photon_data['user'] = user
+        if self.nanotimes is not None:
+            photon_data['nanotimes'] = self.nanotimes
+            photon_data['nanotimes_specs'] = self.nanotimes_specs
+
+        num_lasers = 1
+        if self.excitation is not None:
+            num_lasers = self.excitation.num_lasers
+            kind = 'nsALEX' if self.excitation.pulsed else 'usALEX'
+            measurement_specs = photon_data['measurement_specs']
+            measurement_specs['measurement_type'] = 'smFRET-' + kind
+            tcspc_unit = None
+            if self.nanotimes is not None:
+                tcspc_unit = self.nanotimes_specs['tcspc_unit']
+            measurement_specs.update(self.excitation.measurement_specs(
+                self.clk_p, tcspc_unit=tcspc_unit))
 
         setup = dict(
             num_pixels = 2,
@@ -407,10 +571,16 @@ class TimestampSimulation:
             num_spectral_ch = 2,
             num_polarization_ch = 1,
             num_split_ch = 1,
-            modulated_excitation = False,
-            lifetime = False,
-            excitation_alternated=(False,),
-            excitation_cw=(True,))
+            modulated_excitation = self.excitation is not None,
+            lifetime = self.nanotimes is not None,
+            excitation_alternated=(self.excitation is not None,) * num_lasers,
+            excitation_cw=(self.nanotimes is None,) * num_lasers)
+        if self.nanotimes is not None:
+            # The TCSPC range is the laser repetition period
+            tcspc_range = self.nanotimes_specs['tcspc_range']
+            setup['laser_repetition_rates'] = (1 / tcspc_range,) * num_lasers
+            photon_data['measurement_specs']['laser_repetition_rate'] = \
+                1 / tcspc_range
 
         provenance = dict(filename=self.S.ts_store.filename,
                           software='PyBroMo', software_version=__version__)
@@ -438,3 +608,361 @@ class TimestampSimulation:
         data = self._make_photon_hdf5(identity=identity)
         phc.hdf5.save_photon_hdf5(data, h5_fname=str(filepath),
                                   overwrite=overwrite)
+
+
+class KineticTimestampSimulation(TimestampSimulation):
+    """Simulate timestamps for particles with state dynamics.
+
+    All the simulated particles follow the same kinetic scheme. Emission
+    rates and FRET efficiencies are defined for each state in the scheme.
+
+    Attributes set by input arguments:
+
+    - `scheme`, `num_particles`, `bg_rate_d`, `bg_rate_a`, `timeslice`
+
+    Attributes created by __init__():
+
+    - `D_values`, `populations`, `traj_filename`.
+
+    Attributes created by .run_da():
+
+    - `hash_d`, `hash_a`
+
+    Attributes created by .merge_da():
+
+    - `ts`, `a_ch`, `part`, `states`, `clk_p`
+    """
+
+    def __init__(self, S, scheme, num_particles, bg_rate_d, bg_rate_a,
+                 timeslice=None, photophysics=None, tcspc=None):
+        """
+        Arguments:
+            S (pybromo.ParticlesSimulation): the diffusion simulation object.
+            scheme (pybromo.kinetics.KineticScheme): the kinetic scheme
+                with emission rates and FRET efficiencies for each state.
+            num_particles (list of ints): number of particles in each
+                population.
+            bg_rate_d (float): Poisson background rate in the Donor channel
+            bg_rate_a (float): Poisson background rate in the Acceptor channel
+            timeslice (float): optional max time, used to truncate the
+                diffusion simulation and use a smaller duration.
+            photophysics (pybromo.kinetics.Photophysics): optional model
+                of blinking and bleaching applied to all the particles.
+            tcspc (pybromo.nanotimes.TCSPCModel): optional model of
+                fluorescence lifetimes and TCSPC used to simulate nanotimes.
+        """
+        if scheme.em_rates is None or scheme.E_values is None:
+            raise ValueError('The kinetic scheme needs `em_rates` and '
+                             '`E_values` for each state.')
+        if np.sum(num_particles) > S.num_particles:
+            msg = (f'Wrong number of particles. \n\nWith this trajectory '
+                   f'file you can specify up to {S.num_particles} particles, '
+                   f'but you requested {np.sum(num_particles)}.')
+            raise ValueError(msg)
+        if timeslice is None:
+            timeslice = S.t_max
+        assert timeslice <= S.t_max
+
+        populations = S.particles.num_particles_to_slices(num_particles)
+        D_values = populations_diff_coeff(S.particles, num_particles)
+        params = dict(S=S, scheme=scheme, num_particles=num_particles,
+                      bg_rate_d=bg_rate_d, bg_rate_a=bg_rate_a,
+                      timeslice=timeslice, D_values=D_values,
+                      populations=populations,
+                      traj_filename=S.store.filepath.name, save_pos=False,
+                      photophysics=photophysics, tcspc=tcspc,
+                      excitation=None, detector=None)
+        for k, v in params.items():
+            setattr(self, k, v)
+
+    txt_header = """
+        Timestamps simulation: Kinetic scheme
+        -------------------------------------
+
+        Trajectories file:
+            {self.traj_filename}
+            time slice: {self.timeslice} s
+        """
+    txt_population = """
+        Population{p_i}:
+            # particles:        {num_pop} (first particle {pop.start})
+            D                   {D} m^2/s
+        """
+    txt_state = """
+        State{s_i}:
+            Peak emission rate: {em_rate:,.0f} cps
+            FRET efficiency:    {E:7.1%}
+            Exit rates:         {rates} 1/s
+        """
+
+    def __str__(self):
+        txt = [self.txt_header.format(self=self)]
+        pop_params = (self.num_particles, self.D_values, self.populations)
+        for p_i, (num_pop, D, pop) in enumerate(zip(*pop_params)):
+            txt.append(self.txt_population.format(p_i=p_i + 1,
+                       num_pop=num_pop, D=D, pop=pop))
+        scheme = self.scheme
+        for s_i, (em_rate, E) in enumerate(zip(scheme.em_rates,
+                                               scheme.E_values)):
+            rates = ', '.join('%.3g' % r for r in scheme.rates[s_i])
+            txt.append(self.txt_state.format(s_i=s_i, em_rate=em_rate, E=E,
+                                             rates=rates))
+        txt.append(self.txt_background.format(self=self))
+        if self.photophysics is not None:
+            txt.append(self.txt_photophysics.format(pp=self.photophysics))
+        if self.tcspc is not None:
+            txt.append(self.txt_nanotimes.format(nt=self.tcspc))
+        return ''.join(txt)
+
+    def _compact_repr(self):
+        part_seq = ('%d_s%d' % (np, pop.start)
+                    for np, pop in zip(self.num_particles, self.populations))
+        s1 = 'P_' + '_'.join(part_seq)
+        s2 = 'D_' + '_'.join('%.1e' % D for D in self.D_values)
+        s3 = 'Kin_%s' % self.scheme.hash()[:6]
+        s4 = 'BgD%d_BgA%d' % (self.bg_rate_d, self.bg_rate_a)
+        s5 = 't_max_%ds' % self.timeslice
+        s = [s1, s2, s3, s4, s5]
+        if self.photophysics is not None:
+            s.append('PP_%s' % self.photophysics.hash()[:6])
+        return '_'.join(s)
+
+    def run(self, *args, **kwargs):
+        raise NotImplementedError('Use `run_da()` for kinetic simulations.')
+
+    def run_da(self, rs, overwrite=True, skip_existing=False, path=None,
+               chunksize=None, scale=10, t_chunksize=None):
+        """Compute D and A timestamps and states for current populations.
+
+        See :meth:`pybromo.ParticlesSimulation.simulate_timestamps_kinetic_da`.
+        """
+        if path is None:
+            path = str(self.S.store.filepath.parent)
+        kwargs = dict(rs=rs, overwrite=overwrite, path=path,
+                      timeslice=self.timeslice, skip_existing=skip_existing,
+                      photophysics=self.photophysics,
+                      tcspc=self.tcspc, scale=scale)
+        if chunksize is not None:
+            kwargs['chunksize'] = chunksize
+        if t_chunksize is not None:
+            kwargs['t_chunksize'] = t_chunksize
+        header = ' - Kinetic Simulation:'
+
+        self._calc_hash_da(rs)
+        print('%s Donor + Acceptor timestamps - %s' %
+              (header, ctime()), flush=True)
+        self.S.simulate_timestamps_kinetic_da(
+            scheme=self.scheme,
+            populations=self.populations,
+            bg_rate_d=self.bg_rate_d,
+            bg_rate_a=self.bg_rate_a,
+            **kwargs)
+        print('\n%s Completed. %s' % (header, ctime()), flush=True)
+
+    @property
+    def name_timestamps_d(self):
+        names_d = self.S.timestamps_match_kinetic(
+            self.scheme, 'D', self.populations, self.bg_rate_d, self.hash_d,
+            photophysics=self.photophysics)
+        assert len(names_d) == 1
+        return names_d[0]
+
+    @property
+    def name_timestamps_a(self):
+        names_a = self.S.timestamps_match_kinetic(
+            self.scheme, 'A', self.populations, self.bg_rate_a, self.hash_a,
+            photophysics=self.photophysics)
+        assert len(names_a) == 1
+        return names_a[0]
+
+
+##
+#  Merging of independent simulations
+#
+
+def _merge_sorted_channels(channels, chunksize):
+    """Merge the sorted photon streams of `channels` reading in chunks.
+
+    Arguments:
+        channels (list): (timestamps, particles) on-disk arrays for each
+            detector channel. Particles can be None (all the photons are
+            then assigned to particle 0).
+        chunksize (int): number of photons read at once from each channel.
+
+    Yields:
+        (timestamps, detectors, particles) arrays of sorted photons, using
+        at most ~`chunksize` photons per channel in memory.
+    """
+    sizes = [timestamps.shape[0] for timestamps, _ in channels]
+    positions = [0] * len(channels)
+    buffers = [(np.zeros(0, dtype='int64'), np.zeros(0, dtype='uint8'))
+               for _ in channels]
+    while True:
+        for ch, (timestamps, particles) in enumerate(channels):
+            if buffers[ch][0].size == 0 and positions[ch] < sizes[ch]:
+                i1 = positions[ch]
+                i2 = min(i1 + chunksize, sizes[ch])
+                if particles is None:
+                    buffers[ch] = (timestamps[i1:i2],
+                                   np.zeros(i2 - i1, dtype='uint8'))
+                else:
+                    buffers[ch] = (timestamps[i1:i2], particles[i1:i2])
+                positions[ch] = i2
+        if all(ts.size == 0 for ts, _ in buffers):
+            return
+        # Photons after the last buffered timestamp of a channel can be
+        # still on disk: output only photons up to the earliest of them
+        t_cut = min((buffers[ch][0][-1] for ch in range(len(channels))
+                     if positions[ch] < sizes[ch]), default=None)
+        ts_list, det_list, par_list = [], [], []
+        for ch, (ts, par) in enumerate(buffers):
+            i_cut = ts.size if t_cut is None else \
+                np.searchsorted(ts, t_cut, side='right')
+            ts_list.append(ts[:i_cut])
+            par_list.append(par[:i_cut])
+            det_list.append(np.full(i_cut, ch, dtype='uint8'))
+            buffers[ch] = (ts[i_cut:], par[i_cut:])
+        ts = np.hstack(ts_list)
+        index_sort = ts.argsort(kind='mergesort')
+        yield (ts[index_sort], np.hstack(det_list)[index_sort],
+               np.hstack(par_list)[index_sort])
+
+
+def merge_ensemble(filepaths, names, h5_fname, chunksize=2**18,
+                   identity=None, overwrite=True):
+    """Merge donor and acceptor timestamps of independent simulations.
+
+    The timestamps of the simulations (e.g. run with different EID or ID)
+    are concatenated in a single smFRET Photon-HDF5 file. The timestamps of
+    each simulation are offset by the duration of the previous ones (in
+    integer units of `clk_p`) and the particles are renumbered to be
+    unique across simulations (the background is the last particle). If
+    the timestamps of any file have no particles array (e.g. simulated
+    from the population emission) the merged file has no particles. Data
+    is read and written in chunks, so memory usage does not depend on the
+    number of photons.
+
+    Arguments:
+        filepaths (list): timestamps files (`times_*.hdf5`), in the
+            order of concatenation.
+        names (list): one (name_d, name_a) pair of timestamps array names
+            for each file.
+        h5_fname (string or Path): name of the Photon-HDF5 file.
+        chunksize (int): number of photons read at once from each array.
+        identity (dict or None): the Photon-HDF5 `/identity` fields.
+        overwrite (bool): if True, overwrite `h5_fname` if exists.
+
+    Returns:
+        Dict with the timestamps offset (`offsets`), the first particle
+        ID (`particle_offsets`, None without particles) of each file and
+        the total duration (`t_max`, in seconds).
+    """
+    from .storage import TimestampStore
+    assert len(filepaths) == len(names)
+    stores = [TimestampStore(Path(filepath), mode='r')
+              for filepath in filepaths]
+    try:
+        channels, clk_p, t_max = [], None, 0
+        particle_offsets, bg_particles = [], []
+        num_particles_tot = 0
+        for store, file_names in zip(stores, names):
+            assert len(file_names) == 2
+            file_channels = [(store.get_timestamps(name),
+                              store.get_photon_array(name, '_par'))
+                             for name in file_names]
+            for timestamps, particles in file_channels:
+                if clk_p is None:
+                    clk_p = timestamps.attrs['clk_p']
+                if timestamps.attrs['clk_p'] != clk_p:
+                    raise ValueError('Timestamps have different clk_p (%s).'
+                                     % store.filename)
+            channels.append(file_channels)
+            t_max += float(store.numeric_params['t_max'])
+        save_particles = all(particles is not None
+                             for file_channels in channels
+                             for _, particles in file_channels)
+        if save_particles:
+            for file_channels in channels:
+                particles_attrs = file_channels[0][1].attrs
+                particle_offsets.append(num_particles_tot)
+                bg_particles.append(particles_attrs['bg_particle'])
+                num_particles_tot += particles_attrs['num_particles']
+        else:
+            particle_offsets = bg_particles = [None] * len(channels)
+        # Offsets summed in clock units (no loss of int64 precision)
+        durations = [int(round(float(store.numeric_params['t_max']) / clk_p))
+                     for store in stores]
+        offsets = np.cumsum([0] + durations[:-1]).astype('int64')
+        par_dtype = np.min_scalar_type(num_particles_tot)
+
+        # Write the metadata with placeholder photon data, then stream the
+        # photon data into extendable arrays
+        photon_data = dict(
+            timestamps = np.zeros(1, dtype='int64'),
+            timestamps_specs = dict(timestamps_unit=clk_p),
+            detectors = np.zeros(1, dtype='uint8'),
+            measurement_specs = dict(
+                measurement_type = 'smFRET',
+                detectors_specs = dict(spectral_ch1 = np.atleast_1d(0),
+                                       spectral_ch2 = np.atleast_1d(1))))
+        fields = ['timestamps', 'detectors']
+        if save_particles:
+            photon_data['particles'] = np.zeros(1, dtype=par_dtype)
+            fields.append('particles')
+        setup = dict(
+            num_pixels = 2, num_spots = 1, num_spectral_ch = 2,
+            num_polarization_ch = 1, num_split_ch = 1,
+            modulated_excitation = False, lifetime = False,
+            excitation_alternated = (False,), excitation_cw = (True,))
+        provenance = dict(filename=str(stores[0].filename),
+                          software='PyBroMo', software_version=__version__)
+        description = ('Merge of %d simulations:\n%s' %
+                       (len(stores), '\n'.join(str(store.filepath.name)
+                                               for store in stores)))
+        data = dict(
+            acquisition_duration = round(t_max),
+            description = description,
+            photon_data = photon_data,
+            setup = setup,
+            provenance = provenance,
+            identity = dict() if identity is None else identity)
+        phc.hdf5.save_photon_hdf5(data, h5_fname=str(h5_fname),
+                                  overwrite=overwrite, close=False)
+        h5file = data['_data_file']
+        earrays = {}
+        for field in fields:
+            node = h5file.get_node('/photon_data', field)
+            earray = h5file.create_earray(
+                '/photon_data', field + '_merged', atom=node.atom, shape=(0,),
+                filters=node.filters,
+                expectedrows=sum(ts.shape[0] for file_channels in channels
+                                 for ts, _ in file_channels))
+            node.attrs._f_copy(earray)
+            earray.attrs.TITLE = node.attrs.TITLE
+            node.remove()
+            earray.rename(field)
+            earrays[field] = earray
+
+        num_photons = 0
+        for file_channels, offset, par_offset, bg_particle in zip(
+                channels, offsets, particle_offsets, bg_particles):
+            for ts, det, par in _merge_sorted_channels(file_channels,
+                                                       chunksize):
+                earrays['timestamps'].append(ts + offset)
+                earrays['detectors'].append(det)
+                if save_particles:
+                    par_global = par.astype(par_dtype) + par_dtype.type(
+                        par_offset)
+                    par_global[par == bg_particle] = num_particles_tot
+                    earrays['particles'].append(par_global)
+                num_photons += ts.size
+        h5file.close()
+        print(' - Merged %d photons in %s' % (num_photons, h5_fname),
+              flush=True)
+    finally:
+        for store in stores:
+            store.close()
+    if not save_particles:
+        particle_offsets = None
+    return dict(offsets=offsets, particle_offsets=particle_offsets,
+                t_max=t_max)
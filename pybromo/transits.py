@@ -0,0 +1,110 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module implements the detection of the transits of the particles
+through the observation volume.
+
+A transit is an interval of time steps where the emission of a particle
+is above a threshold. Transits are found while the emission is simulated
+(see `ParticlesSimulation.simulate_diffusion`), processing the emission
+one time chunk at a time. Transits crossing the boundary between two
+chunks are carried to the next chunk.
+"""
+
+import numpy as np
+
+
+# Fields of a transit: particle ID, first and last + 1 time step,
+# maximum emission and emission summed over the time steps
+transit_dtype = np.dtype([('particle', 'u4'), ('start', 'i8'),
+                          ('stop', 'i8'), ('peak', 'f4'),
+                          ('integral', 'f8')])
+
+
+class TransitTracker:
+    """Find the transits of the particles in consecutive emission chunks.
+    """
+    def __init__(self, num_particles, threshold, state=None):
+        """
+        Arguments:
+            num_particles (int): number of particles (rows of the emission).
+            threshold (float): a particle is in a transit when its
+                (normalized) emission is >= `threshold`.
+            state (dict or None): the transits in progress, as returned by
+                :meth:`get_state`, to continue a previous tracking.
+        """
+        self.num_particles = num_particles
+        self.threshold = threshold
+        if state is None:
+            state = dict(start=np.full(num_particles, -1, dtype='int64'),
+                         peak=np.zeros(num_particles, dtype='float32'),
+                         integral=np.zeros(num_particles, dtype='float64'))
+        # Start, peak and integral of the transits in progress (start = -1
+        # when the particle is not in a transit)
+        self.start = np.array(state['start'], dtype='int64')
+        self.peak = np.array(state['peak'], dtype='float32')
+        self.integral = np.array(state['integral'], dtype='float64')
+
+    def get_state(self):
+        """Return the transits in progress (dict of arrays)."""
+        return dict(start=self.start.copy(), peak=self.peak.copy(),
+                    integral=self.integral.copy())
+
+    def process(self, emission, i_start):
+        """Process an emission chunk starting at the time step `i_start`.
+
+        Arguments:
+            emission (2D array): emission of each particle (rows) in the
+                time steps of the chunk (columns).
+            i_start (int): index of the first time step of the chunk.
+
+        Returns:
+            Array of the transits ended in the chunk (`transit_dtype`).
+        """
+        size = emission.shape[1]
+        above = emission >= self.threshold
+        in_transit = self.start >= 0
+        transits = []
+        for ip in np.nonzero(above.any(axis=1) | in_transit)[0]:
+            # +1 where a transit starts, -1 where it ends (exclusive)
+            edges = np.diff(np.concatenate(
+                ([in_transit[ip]], above[ip], [False])).astype('int8'))
+            starts = list(np.nonzero(edges == 1)[0])
+            stops = np.nonzero(edges == -1)[0]
+            if in_transit[ip]:
+                starts.insert(0, 0)
+            for begin, end in zip(starts, stops):
+                em = emission[ip, begin:end]
+                peak = em.max() if end > begin else 0
+                integral = em.sum(dtype='float64')
+                start = i_start + begin
+                if begin == 0 and in_transit[ip]:
+                    # Continue the transit from the previous chunk
+                    start = self.start[ip]
+                    peak = max(peak, self.peak[ip])
+                    integral += self.integral[ip]
+                    self.start[ip] = -1
+                if end == size:
+                    # Transit in progress at the end of the chunk
+                    self.start[ip] = start
+                    self.peak[ip] = peak
+                    self.integral[ip] = integral
+                else:
+                    transits.append((ip, start, i_start + end, peak,
+                                     integral))
+        return np.array(transits, dtype=transit_dtype)
+
+    def open_transits(self, i_stop):
+        """Return the transits in progress, ending them at `i_stop`."""
+        index = np.nonzero(self.start >= 0)[0]
+        transits = np.zeros(index.size, dtype=transit_dtype)
+        transits['particle'] = index
+        transits['start'] = self.start[index]
+        transits['stop'] = i_stop
+        transits['peak'] = self.peak[index]
+        transits['integral'] = self.integral[index]
+        return transits
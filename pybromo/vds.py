@@ -0,0 +1,432 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module joins simulation files without copying the data.
+
+Parallel simulations produce one file per engine (EID) or simulation ID,
+each simulating a time segment with the same parameters. The functions
+:func:`join_trajectories` and :func:`join_timestamps` create an HDF5 file
+of virtual datasets (VDS) concatenating along time the arrays of a list
+of compatible files (same numeric parameters, except ID, EID and t_max,
+and same PSF). The data is read from the original files when the
+joined arrays are sliced.
+
+A VDS is a plain concatenation: the timestamps of each segment are
+relative to the segment start. The joined file stores the offset of each
+segment (in '/segments') and :class:`JoinedTimestampStore` returns the
+timestamps with the offsets applied (see :class:`OffsetTimestamps`).
+
+Creating the joined file requires h5py (reading it requires only
+PyTables).
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import tables
+
+from .storage import TrajectoryStore, TimestampStore, DeltaTimestamps
+from .psflib import psf_from_pytables
+from .diffusion import ParticlesSimulation
+
+
+# Numeric parameters that can differ between the joined files
+_segment_params = ('ID', 'EID', 't_max')
+
+
+def _psf_hash(h5file):
+    """Return the hash of the default PSF in `h5file` (None if missing)."""
+    if '/psf/default_psf' not in h5file:
+        return None
+    return psf_from_pytables(h5file.get_node('/psf/default_psf')).hash()
+
+
+def check_compatible(filepaths):
+    """Check that the simulation files in `filepaths` can be joined.
+
+    The files must have the same numeric parameters (except ID, EID and
+    t_max) and the same PSF. Raise ValueError if they don't.
+
+    Returns:
+        List of the t_max of each file.
+    """
+    if len(filepaths) == 0:
+        raise ValueError('No files to join.')
+    t_max_list, reference = [], None
+    for filepath in filepaths:
+        with tables.open_file(str(filepath), mode='r') as h5file:
+            params = {par.name: par.read() for par in h5file.root.parameters}
+            psf_hash = _psf_hash(h5file)
+        t_max_list.append(float(params['t_max']))
+        for name in _segment_params:
+            params.pop(name, None)
+        if reference is None:
+            reference = (filepath, params, psf_hash)
+            continue
+        ref_filepath, ref_params, ref_psf_hash = reference
+        if psf_hash != ref_psf_hash:
+            raise ValueError('Files "%s" and "%s" have different PSF.' %
+                             (ref_filepath, filepath))
+        if set(params) != set(ref_params):
+            raise ValueError('Files "%s" and "%s" have different parameters.'
+                             % (ref_filepath, filepath))
+        for name, value in params.items():
+            if not np.array_equal(value, ref_params[name]):
+                raise ValueError(
+                    'Files "%s" and "%s" have different values of "%s" '
+                    '(%r, %r).' % (ref_filepath, filepath, name,
+                                   ref_params[name], value))
+    return t_max_list
+
+
+def _source_filename(source, vds_path):
+    """Return the path of the file `source` relative to the VDS folder.
+
+    HDF5 looks for relative source files in the folder of the VDS file,
+    so the joined file can be moved together with the source files.
+    """
+    return os.path.relpath(str(Path(source).resolve()),
+                           str(Path(vds_path).resolve()))
+
+
+def _create_vds(filepaths, vds_filepath, arrays):
+    """Create the virtual datasets in `vds_filepath` (needs h5py).
+
+    `arrays` is a list of (vds_name, source_names, shapes, dtype): each VDS
+    concatenates along the last axis the arrays `source_names[i]` (with
+    shape `shapes[i]`) of `filepaths[i]`.
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('Joining files requires h5py (pip install h5py).')
+    vds_dir = Path(vds_filepath).parent
+    sources = [_source_filename(filepath, vds_dir) for filepath in filepaths]
+    with h5py.File(str(vds_filepath), 'w') as h5file:
+        for vds_name, source_names, shapes, dtype in arrays:
+            size = sum(shape[-1] for shape in shapes)
+            layout = h5py.VirtualLayout(shape=shapes[0][:-1] + (size,),
+                                        dtype=dtype)
+            i_start = 0
+            for source, source_name, shape in zip(sources, source_names,
+                                                  shapes):
+                i_stop = i_start + shape[-1]
+                layout[..., i_start:i_stop] = h5py.VirtualSource(
+                    source, source_name, shape=shape, dtype=dtype)
+                i_start = i_stop
+            h5file.create_virtual_dataset(vds_name, layout, fillvalue=0)
+
+
+def _copy_common(source, h5file, t_max_list):
+    """Copy parameters and PSF of `source` and create the '/segments' group.
+    """
+    source.root.parameters._f_copy(h5file.root, recursive=True)
+    if 'psf' in source.root:
+        source.root.psf._f_copy(h5file.root, recursive=True)
+    # The joined file simulates the total duration
+    title = h5file.root.parameters.t_max.title
+    h5file.remove_node('/parameters', 't_max')
+    h5file.create_array('/parameters', 't_max', obj=sum(t_max_list),
+                        title=title)
+    group = h5file.create_group('/', 'segments', 'Joined time segments')
+    h5file.create_array(group, 't_max', obj=np.array(t_max_list),
+                        title='Duration of each segment (s)')
+    return group
+
+
+def _array_shapes(h5files, where, source_names):
+    """Return shapes and dtype of the arrays to join (validating them)."""
+    nodes = [h5file.get_node(where, name)
+             for h5file, name in zip(h5files, source_names)]
+    for node in nodes:
+        if node.shape[:-1] != nodes[0].shape[:-1] or \
+                node.dtype != nodes[0].dtype:
+            raise ValueError('Array "%s" has different shape or type in the '
+                             'joined files.' % node._v_pathname)
+    return [node.shape for node in nodes], nodes[0].dtype, nodes[0]
+
+
+def join_trajectories(filepaths, vds_filename, path='./', names=None):
+    """Join along time the trajectories of compatible simulation files.
+
+    Arguments:
+        filepaths (list): trajectories files (`pybromo_*.hdf5`) in the
+            order of the time segments.
+        vds_filename (string): name of the joined file.
+        path (string or Path): folder of the joined file.
+        names (list or None): names of the arrays in '/trajectories' to
+            join. If None, join 'emission', 'emission_tot' and 'position'
+            when present in all the files.
+
+    Returns:
+        The path of the joined file, to be opened with
+        :class:`JoinedTrajectoryStore`.
+    """
+    t_max_list = check_compatible(filepaths)
+    vds_filepath = Path(path, vds_filename)
+    h5files = [tables.open_file(str(filepath), mode='r')
+               for filepath in filepaths]
+    try:
+        if names is None:
+            names = [name for name in ('emission', 'emission_tot', 'position')
+                     if all(name in h5file.root.trajectories
+                            for h5file in h5files)]
+        arrays, first_nodes = [], []
+        for name in names:
+            shapes, dtype, node = _array_shapes(h5files, '/trajectories',
+                                                [name] * len(h5files))
+            if 'stride' in node.attrs:
+                raise ValueError('Compact positions ("%s") cannot be '
+                                 'joined.' % name)
+            arrays.append(('/trajectories/' + name, [node._v_pathname] *
+                           len(h5files), shapes, dtype))
+            first_nodes.append(node)
+        _create_vds(filepaths, vds_filepath, arrays)
+
+        with tables.open_file(str(vds_filepath), mode='a') as h5file:
+            source = h5files[0]
+            group = _copy_common(source, h5file, t_max_list)
+            if len(arrays) > 0:
+                h5file.create_array(group, 'num_steps',
+                                    obj=np.array([shape[-1] for shape
+                                                  in arrays[0][2]]),
+                                    title='Time steps of each segment')
+            source.root.trajectories._v_attrs._f_copy(
+                h5file.root.trajectories)
+            for node in first_nodes:
+                joined = h5file.get_node('/trajectories', node.name)
+                node.attrs._f_copy(joined)
+                joined.attrs['joined_chunkshape'] = node.chunkshape
+    finally:
+        for h5file in h5files:
+            h5file.close()
+    return vds_filepath
+
+
+def _timestamps_names(h5file):
+    """Return the timestamps arrays of `h5file` grouped by index key."""
+    keys = {}
+    for node in h5file.root.timestamps:
+        if 'clk_p' not in node.attrs:
+            continue
+        key = ParticlesSimulation._ts_index_key(node.name)
+        keys.setdefault(key, []).append(node.name)
+    return keys
+
+
+def join_timestamps(filepaths, vds_filename, path='./', names=None):
+    """Join along time the timestamps of compatible simulation files.
+
+    The timestamps of each segment are shifted by the duration of the
+    previous segments (rounded to the timestamps unit) when read through
+    :class:`JoinedTimestampStore`. Per-photon arrays (e.g. '_par') present
+    in all the files are joined too.
+
+    Arguments:
+        filepaths (list): timestamps files (`times_*.hdf5`) in the
+            order of the time segments.
+        vds_filename (string): name of the joined file.
+        path (string or Path): folder of the joined file.
+        names (dict or None): map of the names of the joined timestamps
+            arrays to the list of the names of the arrays to join, one per
+            file. If None, join the arrays with the same simulation
+            parameters (name without the random state part), when there is
+            one such array in each file.
+
+    Returns:
+        The path of the joined file, to be opened with
+        :class:`JoinedTimestampStore`.
+    """
+    t_max_list = check_compatible(filepaths)
+    vds_filepath = Path(path, vds_filename)
+    h5files = [tables.open_file(str(filepath), mode='r')
+               for filepath in filepaths]
+    try:
+        if names is None:
+            names = {}
+            file_keys = [_timestamps_names(h5file) for h5file in h5files]
+            for key in sorted(file_keys[0]):
+                per_file = [keys.get(key, []) for keys in file_keys]
+                if all(len(file_names) == 1 for file_names in per_file):
+                    names[key] = [file_names[0] for file_names in per_file]
+        if len(names) == 0:
+            raise ValueError('No timestamps arrays to join.')
+
+        arrays, joined_nodes = [], []
+        for name, source_names in names.items():
+            if len(source_names) != len(h5files):
+                raise ValueError('Timestamps "%s": %d arrays for %d files.' %
+                                 (name, len(source_names), len(h5files)))
+            for h5file, source_name in zip(h5files, source_names):
+                node = h5file.get_node('/timestamps', source_name)
+                if node.attrs['clk_p'] != h5files[0].get_node(
+                        '/timestamps', source_names[0]).attrs['clk_p']:
+                    raise ValueError('Timestamps "%s" have different clk_p.'
+                                     % name)
+                if 'encoding' in node.attrs and \
+                        node.attrs['encoding'] == 'delta':
+                    raise ValueError('Delta-encoded timestamps ("%s") '
+                                     'cannot be joined.' % source_name)
+            suffixes = [''] + [
+                suffix for suffix in TimestampStore.photon_array_suffixes
+                if all(source_name + suffix in h5file.root.timestamps
+                       for h5file, source_name in zip(h5files, source_names))]
+            for suffix in suffixes:
+                shapes, dtype, node = _array_shapes(
+                    h5files, '/timestamps',
+                    [source_name + suffix for source_name in source_names])
+                arrays.append(('/timestamps/' + name + suffix,
+                               ['/timestamps/' + source_name + suffix
+                                for source_name in source_names],
+                               shapes, dtype))
+                joined_nodes.append((name + suffix, node, shapes))
+        _create_vds(filepaths, vds_filepath, arrays)
+
+        with tables.open_file(str(vds_filepath), mode='a') as h5file:
+            source = h5files[0]
+            group = _copy_common(source, h5file, t_max_list)
+            source.root.timestamps._v_attrs._f_copy(h5file.root.timestamps)
+            for joined_name, node, shapes in joined_nodes:
+                joined = h5file.get_node('/timestamps', joined_name)
+                node.attrs._f_copy(joined)
+                joined.attrs['joined_chunkshape'] = node.chunkshape
+                if 'clk_p' not in node.attrs:
+                    continue
+                # Offsets in timestamps units of the segments and index of
+                # the first timestamp of each segment
+                clk_p = node.attrs['clk_p']
+                offsets = np.round(np.cumsum([0] + t_max_list[:-1]) /
+                                   clk_p).astype('int64')
+                starts = np.cumsum([0] + [shape[-1] for shape in shapes])
+                h5file.create_array(group, joined_name + '_offsets',
+                                    obj=offsets,
+                                    title='Timestamps offset of each segment')
+                h5file.create_array(group, joined_name + '_starts',
+                                    obj=starts.astype('int64'),
+                                    title='Index of the first timestamp of '
+                                          'each segment')
+    finally:
+        for h5file in h5files:
+            h5file.close()
+    return vds_filepath
+
+
+class JoinedArray:
+    """A joined (virtual) array with the chunk shape of the source arrays.
+
+    Virtual datasets are not chunked: this wrapper exposes the chunk shape
+    of the joined arrays (used to iterate in chunks) and delegates all the
+    other attributes to the pytables node.
+    """
+    def __init__(self, node):
+        self._node = node
+
+    @property
+    def chunkshape(self):
+        return tuple(self._node.attrs['joined_chunkshape'])
+
+    def __getattr__(self, name):
+        return getattr(self._node, name)
+
+    def __getitem__(self, key):
+        return self._node[key]
+
+    def __len__(self):
+        return len(self._node)
+
+    def __array__(self, dtype=None):
+        return self._node.read().astype(dtype, copy=False)
+
+
+class OffsetTimestamps:
+    """Timestamps of joined segments, each shifted by its segment offset.
+
+    This class mimics the pytables array interface used for timestamps
+    (slicing, `read`, `shape`, `attrs`) and returns int64 timestamps.
+    """
+    def __init__(self, node, offsets, starts):
+        self._node = node
+        self.offsets = offsets
+        self.starts = starts
+
+    @property
+    def name(self):
+        return self._node.name
+
+    @property
+    def attrs(self):
+        return self._node.attrs
+
+    @property
+    def nrows(self):
+        return self._node.nrows
+
+    @property
+    def shape(self):
+        return (self.nrows,)
+
+    @property
+    def dtype(self):
+        return np.dtype('int64')
+
+    @property
+    def chunkshape(self):
+        return tuple(self._node.attrs['joined_chunkshape'])
+
+    def __len__(self):
+        return self.nrows
+
+    def __array__(self, dtype=None):
+        return self.read().astype(dtype, copy=False)
+
+    def read(self, start=None, stop=None):
+        """Read the timestamps in the slice [start:stop] adding the offsets.
+        """
+        start, stop, _ = slice(start, stop).indices(self.nrows)
+        if stop <= start:
+            return np.zeros(0, dtype='int64')
+        timestamps = self._node[start:stop].astype('int64')
+        i_seg = np.searchsorted(self.starts, start, side='right') - 1
+        while i_seg < self.offsets.size and self.starts[i_seg] < stop:
+            i1 = max(self.starts[i_seg], start) - start
+            i2 = min(self.starts[i_seg + 1], stop) - start
+            timestamps[i1:i2] += self.offsets[i_seg]
+            i_seg += 1
+        return timestamps
+
+    __getitem__ = DeltaTimestamps.__getitem__
+
+
+class JoinedTrajectoryStore(TrajectoryStore):
+    """Read-only store of trajectories joined by :func:`join_trajectories`.
+    """
+    def __init__(self, datafile, path='./'):
+        super().__init__(datafile, path=path, mode='r')
+
+    def _tune_chunk_cache(self):
+        # Joined arrays are not chunked, the cache of each source file is
+        # handled by the HDF5 library
+        pass
+
+    def _get_array(self, group, name):
+        return JoinedArray(super()._get_array(group, name))
+
+
+class JoinedTimestampStore(TimestampStore):
+    """Read-only store of timestamps joined by :func:`join_timestamps`.
+    """
+    def __init__(self, datafile, path='./'):
+        super().__init__(datafile, path=path, mode='r')
+
+    def get_timestamps(self, name):
+        """Return the timestamps array `name` with the segment offsets."""
+        node = self._get_array('timestamps', name)
+        segments = self.h5file.root.segments
+        return OffsetTimestamps(node,
+                                segments._f_get_child(name + '_offsets')[:],
+                                segments._f_get_child(name + '_starts')[:])
@@ -39,6 +39,7 @@ setup(name = project_name,
                    ],
       packages = ['pybromo', 'pybromo.utils', 'pybromo.tests'],
       package_data = {'pybromo': ['psf_data/*']},
+      entry_points = {'console_scripts': ['pybromo-batch = pybromo.batch:main']},
       keywords = ('single-molecule FRET smFRET biophysics confocal '
                   'freely-diffusing brownian-motion simulator'),
       )